@@ -2,10 +2,12 @@
 Main URL Configuration for Frontend Web Service
 User Management Focus - Full Development
 """
+from boiler_common.metrics import metrics_view
 from django.contrib import admin
 from django.urls import path, include
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('dashboard.urls')),
 ]
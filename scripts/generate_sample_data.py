@@ -8,7 +8,6 @@ import os
 import sys
 import json
 import random
-import requests
 from datetime import datetime, timedelta
 
 # Sample boiler sites data
@@ -71,6 +70,7 @@ def generate_sensor_reading(sensor_config):
 
 def send_sample_data(base_url="http://localhost"):
     """Send sample IoT data to the ingestion service"""
+    import requests
     
     print("🚀 Generating sample IoT data...")
     
@@ -181,6 +181,8 @@ def create_sample_alerts():
 
 def main():
     """Main function to generate all sample data"""
+    import requests
+
     print("🏭 Boiler Monitoring Platform - Sample Data Generator")
     print("=" * 60)
     
@@ -51,6 +51,12 @@ EOF
     fi
 fi
 
+# Seed the ingest site/sensor registry with the demo sites (iot_ingestion)
+if [ "$SEED_REGISTRY" = "true" ] && python manage.py help seed_registry >/dev/null 2>&1; then
+    echo "Seeding site and sensor registry..."
+    python manage.py seed_registry
+fi
+
 # Collect static files (for services that need it)
 if [ -f "manage.py" ] && python manage.py help collectstatic >/dev/null 2>&1; then
     echo "Collecting static files..."
@@ -66,6 +72,19 @@ fi
 echo "Django initialization completed successfully!"
 echo "========================================="
 
+# Serve the ASGI application with uvicorn workers (SERVER_MODE=asgi)
+if [ "$SERVER_MODE" = "asgi" ]; then
+    echo "Starting uvicorn with ${WEB_CONCURRENCY:-2} workers..."
+    # Per-worker metrics files from a previous run would be counted again
+    if [ -n "$METRICS_MULTIPROCESS_DIR" ]; then
+        rm -rf "$METRICS_MULTIPROCESS_DIR" && mkdir -p "$METRICS_MULTIPROCESS_DIR"
+    fi
+    exec uvicorn "${DJANGO_SETTINGS_MODULE%.settings}.asgi:application" \
+        --host 0.0.0.0 --port ${PORT:-8000} \
+        --workers ${WEB_CONCURRENCY:-2} \
+        --lifespan off --no-access-log
+fi
+
 # Start the Django development server
 echo "Starting Django development server..."
 exec python manage.py runserver 0.0.0.0:${PORT:-8000}
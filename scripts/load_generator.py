@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+Ingest load generator and latency benchmark for the IoT ingestion service
+
+Builds on generate_sample_data.py: the sensors and value ranges are the same,
+but any number of sites is simulated and requests are fired concurrently
+from an asyncio event loop with keep-alive connections (standard library
+only, no HTTP client package needed).
+
+Two load models:
+  closed loop (default)  --concurrency workers send back-to-back requests
+  open loop (--rate)     requests start on a fixed schedule regardless of how
+                         fast the server answers; latency is measured from
+                         the scheduled start, so queueing in a saturated
+                         server shows up in the percentiles instead of
+                         silently lowering the offered load
+
+Payload formats (--format):
+  json     one site payload per request to /api/ingest/
+  ndjson   --sites-per-request payloads per request to /api/ingest/bulk/
+  frame    the same as binary frames (see sensor_frame.py)
+
+Site ids are BLR0000, BLR0001, ... ; register them with
+``python manage.py seed_registry --fleet N`` before loading a real service.
+
+Usage:
+    python scripts/load_generator.py --stand-in --duration 5
+    python scripts/load_generator.py --url http://localhost:8002 --sites 1000 \\
+        --format frame --sites-per-request 100 --rate 200 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_sample_data import SENSOR_CONFIGS, generate_sensor_reading  # noqa: E402
+from sensor_frame import CONTENT_TYPE as FRAME_CONTENT_TYPE, encode_frame  # noqa: E402
+
+ENDPOINTS = {"json": "/api/ingest/", "ndjson": "/api/ingest/bulk/", "frame": "/api/ingest/bulk/"}
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+class PayloadFactory:
+    """Builds request bodies for a simulated fleet with strictly increasing per-site timestamps"""
+
+    def __init__(self, sites, sensors, sites_per_request, payload_format, seed=42):
+        self.site_ids = [f"BLR{n:04d}" for n in range(sites)]
+        self.sensors = SENSOR_CONFIGS[:sensors]
+        self.sensor_types = [config["sensor_type"] for config in self.sensors]
+        self.sites_per_request = 1 if payload_format == "json" else sites_per_request
+        self.format = payload_format
+        self.content_type = {
+            "json": "application/json", "ndjson": "application/x-ndjson", "frame": FRAME_CONTENT_TYPE,
+        }[payload_format]
+
+        # Pre-generate realistic values once; picking from a pool keeps the generator cheap
+        random.seed(seed)
+        self._values = [[generate_sensor_reading(config) for config in self.sensors] for _ in range(997)]
+        self._next_site = 0
+        self._last_ms = {}
+        self._tick = 0
+
+    def next_body(self):
+        """Return ``(body, readings)`` for the next request"""
+        now_ms = int(time.time() * 1000)
+        lines = []
+        frames = []
+        for _ in range(self.sites_per_request):
+            site_id = self.site_ids[self._next_site]
+            self._next_site = (self._next_site + 1) % len(self.site_ids)
+            timestamp = max(now_ms, self._last_ms.get(site_id, 0) + 1)
+            self._last_ms[site_id] = timestamp
+            values = self._values[self._tick % len(self._values)]
+            self._tick += 1
+            if self.format == "frame":
+                frames.append(encode_frame(site_id, self.sensor_types, [timestamp], [values]))
+            else:
+                lines.append(json.dumps({
+                    "site_id": site_id,
+                    "timestamp": timestamp,
+                    "readings": [{"sensor_type": name, "value": value}
+                                 for name, value in zip(self.sensor_types, values)],
+                }))
+        body = b"".join(frames) if frames else "\n".join(lines).encode()
+        return body, self.sites_per_request * len(self.sensor_types)
+
+
+class HTTPConnection:
+    """Minimal HTTP/1.1 keep-alive client connection on asyncio streams"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path, body, content_type):
+        """Send one POST and return the status code, reconnecting if the server closed the connection"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        length, chunked, close = 0, False, False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding" and "chunked" in value:
+                chunked = True
+            elif name == "connection" and value == "close":
+                close = True
+        if chunked:
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class LoadRun:
+    """Fires requests and records latency and outcome of each"""
+
+    def __init__(self, url, factory, timeout=10):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip("/") + ENDPOINTS[factory.format]
+        self.factory = factory
+        self.timeout = timeout
+        self.latencies = []
+        self.outcomes = Counter()
+        self.readings = 0
+        self._idle = []
+
+    async def request(self, started):
+        """Send one request; latency counts from ``started`` (the scheduled time in open-loop mode)"""
+        body, readings = self.factory.next_body()
+        connection = self._idle.pop() if self._idle else HTTPConnection(self.host, self.port)
+        try:
+            status = await asyncio.wait_for(
+                connection.post(self.path, body, self.factory.content_type), self.timeout
+            )
+        except asyncio.TimeoutError:
+            connection.close()
+            self.outcomes["timeout"] += 1
+            return
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            connection.close()
+            self.outcomes["connection error"] += 1
+            return
+        self._idle.append(connection)
+        self.latencies.append(time.perf_counter() - started)
+        self.outcomes[status] += 1
+        if status == 200:
+            self.readings += readings
+
+    async def closed_loop(self, concurrency, deadline):
+        async def worker():
+            while time.perf_counter() < deadline:
+                await self.request(time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def open_loop(self, rate, deadline, max_inflight):
+        interval = 1 / rate
+        start = time.perf_counter()
+        inflight = set()
+        sent = 0
+        while True:
+            scheduled = start + sent * interval
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent += 1
+            if len(inflight) >= max_inflight:
+                # The server is too far behind to keep the schedule; record it rather than wait
+                self.outcomes["client overload"] += 1
+                continue
+            task = asyncio.create_task(self.request(scheduled))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+        if inflight:
+            await asyncio.gather(*inflight)
+
+    def close(self):
+        for connection in self._idle:
+            connection.close()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(run, elapsed):
+    latencies = sorted(run.latencies)
+    total = sum(run.outcomes.values())
+    errors = total - run.outcomes[200]
+    return {
+        "requests": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(run.outcomes[200] / elapsed, 1),
+        "readings_per_s": round(run.readings / elapsed, 1),
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "outcomes": {str(key): count for key, count in sorted(run.outcomes.items(), key=str)},
+        "latency_ms": {
+            f"p{pct:g}": round(percentile(latencies, pct) * 1000, 2) if latencies else None for pct in PERCENTILES
+        },
+    }
+
+
+# ============================================================================
+# STAND-IN SERVER (for CI runs without Docker)
+# ============================================================================
+
+class StandInServer:
+    """
+    Local HTTP server that accepts any ingest request
+
+    It reads requests the same way the service would see them on the wire
+    and answers 200 after ``delay`` seconds, so the generator itself can be
+    exercised and benchmarked without the platform running.
+    """
+
+    def __init__(self, delay=0.0, host="127.0.0.1"):
+        self.delay = delay
+        self.host = host
+        self.server = None
+        self.url = None
+        self._handlers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, 0)
+        self.url = f"http://{self.host}:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def stop(self):
+        """Stop accepting and wait for open connections to be closed by the client"""
+        self.server.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=1)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                body = b'{"status": "ok"}'
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(task)
+
+
+async def run(args):
+    stand_in = None
+    url = args.url
+    if args.stand_in:
+        stand_in = await StandInServer(args.stand_in_delay / 1000).start()
+        url = stand_in.url
+
+    factory = PayloadFactory(args.sites, args.sensors, args.sites_per_request, args.format)
+    load = LoadRun(url, factory, timeout=args.timeout)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if args.rate:
+        await load.open_loop(args.rate, deadline, args.max_inflight)
+    else:
+        await load.closed_loop(args.concurrency, deadline)
+    elapsed = time.perf_counter() - start
+    load.close()
+    if stand_in is not None:
+        await stand_in.stop()
+
+    summary = summarize(load, elapsed)
+    summary["target"] = url + ENDPOINTS[args.format]
+    summary["mode"] = f"open loop at {args.rate} req/s" if args.rate else f"closed loop x{args.concurrency}"
+    return summary
+
+
+def print_report(summary):
+    print(f"Target:      {summary['target']} ({summary['mode']})")
+    print(f"Requests:    {summary['requests']} in {summary['elapsed_s']} s")
+    print(f"Throughput:  {summary['throughput_rps']} req/s, {summary['readings_per_s']} readings/s")
+    print(f"Error rate:  {summary['error_rate']:.2%}  {summary['outcomes']}")
+    print("Latency:     " + "  ".join(f"{name} {value} ms" for name, value in summary["latency_ms"].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost/api/iot", help="Base URL of the ingestion service")
+    parser.add_argument("--stand-in", action="store_true", help="Target a local stand-in server instead of --url")
+    parser.add_argument("--stand-in-delay", type=float, default=0, help="Stand-in response delay in ms")
+    parser.add_argument("--sites", type=int, default=100, help="Simulated sites")
+    parser.add_argument("--sensors", type=int, default=len(SENSOR_CONFIGS), choices=range(1, len(SENSOR_CONFIGS) + 1),
+                        help="Sensors per site")
+    parser.add_argument("--format", choices=sorted(ENDPOINTS), default="json", help="Payload format")
+    parser.add_argument("--sites-per-request", type=int, default=50, help="Site payloads per bulk request")
+    parser.add_argument("--concurrency", type=int, default=10, help="Closed-loop workers")
+    parser.add_argument("--rate", type=float, default=0, help="Open-loop request rate per second")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="Open-loop cap on outstanding requests")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+    parser.add_argument("--timeout", type=float, default=10, help="Per-request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Binary sensor frame encoder for gateways
+
+Standalone (standard library only) encoder for the compact frame format
+accepted by the IoT ingestion service with
+``Content-Type: application/vnd.steambytes.frame``. The format is documented
+in services/iot_ingestion/data_receiver/frames.py; keep the two in sync.
+
+Usage:
+    from sensor_frame import CONTENT_TYPE, encode_payloads
+    body = encode_payloads(payloads)   # the JSON site payloads a gateway would send
+    requests.post(url, data=body, headers={"Content-Type": CONTENT_TYPE})
+"""
+
+import math
+import struct
+from datetime import datetime, timezone
+
+CONTENT_TYPE = "application/vnd.steambytes.frame"
+MAGIC = b"SBF1"
+FLAG_FLOAT64 = 0x01
+
+
+def encode_frame(site_id, sensor_types, timestamps, rows, float64=False):
+    """
+    Encode one site's readings as a frame
+
+    timestamps are epoch milliseconds in ascending order; rows holds one
+    sequence of values per timestamp, aligned with sensor_types. Use None for
+    missing values.
+    """
+    site = site_id.encode("utf-8")
+    parts = [struct.pack("<4sBB", MAGIC, FLAG_FLOAT64 if float64 else 0, len(site)), site,
+             struct.pack("<B", len(sensor_types))]
+    for sensor_type in sensor_types:
+        name = sensor_type.encode("utf-8")
+        parts.append(struct.pack("<B", len(name)))
+        parts.append(name)
+
+    base = timestamps[0] if timestamps else 0
+    parts.append(struct.pack("<qI", base, len(timestamps)))
+    previous = base
+    deltas = []
+    for timestamp in timestamps:
+        deltas.append(timestamp - previous)
+        previous = timestamp
+    parts.append(struct.pack(f"<{len(deltas)}I", *deltas))
+
+    values = [math.nan if value is None else value for row in rows for value in row]
+    parts.append(struct.pack(f"<{len(values)}{'d' if float64 else 'f'}", *values))
+    return b"".join(parts)
+
+
+def to_epoch_ms(timestamp):
+    """Convert an ISO 8601 string (naive means UTC) to epoch milliseconds"""
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def encode_payloads(payloads, float64=False):
+    """
+    Encode JSON-style site payloads as back-to-back frames
+
+    Payloads of the same site are merged into one frame, so a gateway can
+    buffer several ticks and send them together.
+    """
+    by_site = {}
+    for payload in payloads:
+        site = by_site.setdefault(payload["site_id"], {})
+        default_ms = to_epoch_ms(payload["timestamp"]) if payload.get("timestamp") else None
+        for reading in payload["readings"]:
+            timestamp = reading.get("timestamp")
+            timestamp_ms = to_epoch_ms(timestamp) if timestamp else default_ms
+            site.setdefault(timestamp_ms, {})[reading["sensor_type"]] = reading["value"]
+
+    frames = []
+    for site_id, instants in by_site.items():
+        sensor_types = sorted({name for values in instants.values() for name in values})
+        timestamps = sorted(instants)
+        rows = [[instants[ts].get(name) for name in sensor_types] for ts in timestamps]
+        frames.append(encode_frame(site_id, sensor_types, timestamps, rows, float64=float64))
+    return b"".join(frames)
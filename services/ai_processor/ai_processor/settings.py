@@ -11,11 +11,17 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Code shared by the services (boiler_common) lives in <repo>/shared; containers mount it into /app
+SHARED_DIR = BASE_DIR.parent.parent / 'shared'
+if SHARED_DIR.is_dir() and str(SHARED_DIR) not in sys.path:
+    sys.path.append(str(SHARED_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -43,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'boiler_common.metrics.metrics_middleware',  # first, so the latency covers every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -160,6 +167,105 @@ CACHES = {
     }
 }
 
+# Readings stream published by iot_ingestion
+READINGS_STREAM_KEY = os.environ.get('READINGS_STREAM_KEY', 'iot_ingestion:readings')
+
+# Streaming anomaly detectors fed by the iot_ingestion readings stream (manage.py run_detectors)
+ANALYTICS_DETECTORS = {
+    'stream_key': READINGS_STREAM_KEY,
+    'events_maxlen': int(os.environ.get('ANOMALY_EVENTS_MAXLEN', 10000)),  # anomaly events kept (approximate)
+    'checkpoint_interval_seconds': int(os.environ.get('DETECTOR_CHECKPOINT_INTERVAL', 30)),
+    'detectors': {
+        'alpha': float(os.environ.get('DETECTOR_EWMA_ALPHA', 0.05)),  # EWMA weight of the newest reading
+        'window': int(os.environ.get('DETECTOR_WINDOW', 60)),  # readings in the rolling z-score window
+        'warmup': 30,  # readings per sensor before it can raise events
+        'z_threshold': float(os.environ.get('DETECTOR_Z_THRESHOLD', 4.0)),
+        'cusum_k': 0.5,  # drift slack, in standard deviations
+        'cusum_h': float(os.environ.get('DETECTOR_CUSUM_H', 8.0)),  # drift alarm level
+        'std_floor': 1e-3,
+    },
+    # Mahalanobis distance of each site's sensor vector; set MULTIVARIATE_ENABLED=0 to disable
+    'multivariate_enabled': os.environ.get('MULTIVARIATE_ENABLED', '1') == '1',
+    'multivariate': {
+        # fuel_level is left out: it falls between refills, so it has no stable mean
+        'sensor_types': ['temperature', 'pressure', 'flow_rate', 'efficiency'],
+        'warmup': 100,  # vectors per site before it can raise events
+        'threshold': float(os.environ.get('MULTIVARIATE_THRESHOLD', 5.0)),  # Mahalanobis distance
+        'ridge': 1e-3,  # added to the diagonal of the co-moment matrix
+        'refresh': 100,  # vectors between exact inversions
+    },
+}
+
+# Analytics responses cached until new data arrives for their sites; set RESULT_CACHE_ENABLED=0 to disable
+ANALYTICS_RESULT_CACHE = {
+    'enabled': os.environ.get('RESULT_CACHE_ENABLED', '1') == '1',
+    'watermarks_key': os.environ.get('DATA_WATERMARKS_KEY', 'iot_ingestion:site_watermarks'),
+    'ttl_seconds': CACHES['default']['TIMEOUT'],  # drops entries nobody asks for any more
+    'local_entries': int(os.environ.get('RESULT_CACHE_LOCAL_ENTRIES', 256)),  # in-process LRU tier
+    'settle_seconds': 2,  # results this close to new data are kept only this long (InfluxDB write lag)
+    'lock_seconds': 30,  # longest wait for another process computing the same result
+}
+
+# In-memory window store of recent readings per site and sensor; set WINDOW_STORE_ENABLED=0 to disable
+ANALYTICS_WINDOWS = {
+    'enabled': os.environ.get('WINDOW_STORE_ENABLED', '1') == '1',
+    'stream_key': READINGS_STREAM_KEY,
+    'points': int(os.environ.get('WINDOW_STORE_POINTS', 3600)),  # newest readings kept per site and sensor
+    'max_mb': int(os.environ.get('WINDOW_STORE_MAX_MB', 256)),  # bounds the number of site and sensor pairs kept
+    'snapshot_path': os.environ.get('WINDOW_STORE_SNAPSHOT', str(BASE_DIR / 'state' / 'window_store.npz')),
+}
+
+# Nightly fleet analytics (manage.py run_fleet_analytics)
+ANALYTICS_FLEET = {
+    'workers': int(os.environ.get('FLEET_ANALYTICS_WORKERS', os.cpu_count() or 1)),  # worker processes
+    'lookback_days': int(os.environ.get('FLEET_ANALYTICS_LOOKBACK_DAYS', 30)),  # history of a site seen for the first time
+    'chunk_days': 7,  # days of one site read from InfluxDB at a time
+}
+
+# Parquet archive of raw readings for offline analytics (manage.py export_history)
+ANALYTICS_ARCHIVE = {
+    'root': os.environ.get('ARCHIVE_ROOT', str(BASE_DIR / 'archive')),
+    'chunk_rows': int(os.environ.get('ARCHIVE_CHUNK_ROWS', 100_000)),  # readings per batch and row group
+}
+
+# Fuel and efficiency forecasts, refitted for the whole fleet on a schedule (manage.py run_forecasts)
+ANALYTICS_FORECASTS = {
+    'interval_seconds': int(os.environ.get('FORECAST_INTERVAL', 900)),  # between refits
+    'lookback_hours': int(os.environ.get('FORECAST_LOOKBACK_HOURS', 48)),  # history each fit sees
+    'every_seconds': 900,  # slot width of the fitted means
+    'alpha': 0.3,  # Holt level smoothing
+    'beta': 0.1,  # Holt trend smoothing
+    'horizon_days': int(os.environ.get('FORECAST_HORIZON_DAYS', 30)),  # later crossings are reported as none
+    'min_points': 6,  # slots with data needed for a forecast
+    'targets': [
+        # A sensor falling towards a threshold; a rise of more than reset_rise (refill, servicing) starts a new cycle
+        {'sensor_type': 'fuel_level', 'threshold': float(os.environ.get('FORECAST_FUEL_EMPTY', 0)), 'reset_rise': 10.0},
+        {'sensor_type': 'efficiency', 'threshold': float(os.environ.get('FORECAST_EFFICIENCY_MIN', 80)),
+         'reset_rise': 3.0},
+    ],
+}
+
+# Fleet KPI tables per organization and period, precomputed into Redis (manage.py run_fleet_kpis)
+ANALYTICS_KPIS = {
+    'interval_seconds': int(os.environ.get('KPI_INTERVAL', 300)),  # between refreshes
+    'ttl_seconds': int(os.environ.get('KPI_TTL', 3600)),  # payloads not refreshed for this long disappear
+    'organizations_key': os.environ.get('SITE_ORGANIZATIONS_KEY', 'iot_ingestion:site_organizations'),
+    'periods': {'24h': 900, '7d': 3600, '30d': 21600},  # lookback -> slot width in seconds
+    # Optimal operating band per sensor type, inclusive
+    'bands': {'efficiency': (85.0, 100.0), 'temperature': (80.0, 95.0), 'pressure': (10.0, 15.0)},
+}
+
+# Nightly data-quality gap reports per site, sensor and day (manage.py run_data_quality)
+ANALYTICS_QUALITY = {
+    'sensor_types': ['temperature', 'pressure', 'flow_rate', 'fuel_level', 'efficiency'],  # expected at every site
+    'cadence_seconds': {},  # sensor type -> expected seconds between readings; others use their median interval
+    'default_cadence_seconds': 60,  # for a sensor with neither, e.g. one without readings
+    'tolerance': float(os.environ.get('QUALITY_GAP_TOLERANCE', 2.0)),  # cadences without a reading that make a gap
+    'max_gaps': 20,  # longest gaps listed per report
+    'chunk_sites': int(os.environ.get('QUALITY_CHUNK_SITES', 50)),  # sites read and checked at a time
+    'lookback_days': 7,  # sites with readings this long before the checked days are expected to report
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,9 +1,21 @@
 from django.urls import path
-from analytic.views import health_check
+from boiler_common.metrics import metrics_view
+from analytic.views import (
+    anomaly_events, data_quality, fleet_kpis, forecasts, health_check, multivariate_scores, rolling_statistics,
+    window_statistics,
+)
 
-# Minimal URL configuration - Health check only
+# Health check, analytics API and Prometheus metrics
 urlpatterns = [
     path('health/', health_check, name='health_check'),
     path('api/health/', health_check, name='api_health_check'),
+    path('api/analytics/rolling/', rolling_statistics, name='rolling_statistics'),
+    path('api/analytics/window/', window_statistics, name='window_statistics'),
+    path('api/analytics/anomalies/', anomaly_events, name='anomaly_events'),
+    path('api/analytics/multivariate/', multivariate_scores, name='multivariate_scores'),
+    path('api/analytics/forecasts/', forecasts, name='forecasts'),
+    path('api/analytics/fleet-kpis/', fleet_kpis, name='fleet_kpis'),
+    path('api/analytics/quality/', data_quality, name='data_quality'),
+    path('metrics', metrics_view, name='metrics'),
     path('', health_check, name='root'),  # Default route
 ]
@@ -1,3 +1,33 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import AnalyticsWatermark, SensorDailyStats, SensorForecast, SensorGapReport
+
+
+@admin.register(SensorDailyStats)
+class SensorDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ['site_id', 'sensor_type', 'day', 'samples', 'mean', 'min_value', 'max_value', 'p95']
+    list_filter = ['sensor_type']
+    search_fields = ['site_id']
+    date_hierarchy = 'day'
+
+
+@admin.register(AnalyticsWatermark)
+class AnalyticsWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['job', 'site_id', 'processed_until', 'updated_at']
+    list_filter = ['job']
+    search_fields = ['site_id']
+
+
+@admin.register(SensorForecast)
+class SensorForecastAdmin(admin.ModelAdmin):
+    list_display = ['site_id', 'sensor_type', 'latest', 'linear_crossing', 'holt_crossing', 'computed_at']
+    list_filter = ['sensor_type']
+    search_fields = ['site_id']
+
+
+@admin.register(SensorGapReport)
+class SensorGapReportAdmin(admin.ModelAdmin):
+    list_display = ['site_id', 'sensor_type', 'day', 'readings', 'completeness', 'gap_count', 'longest_gap_seconds']
+    list_filter = ['sensor_type']
+    search_fields = ['site_id']
+    date_hierarchy = 'day'
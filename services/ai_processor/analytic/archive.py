@@ -0,0 +1,230 @@
+"""
+Parquet archive of raw sensor history for offline analytics
+
+``HistoryExporter`` copies readings out of InfluxDB into one Parquet file
+per site per UTC day::
+
+    <root>/site_id=BLR001/2025-01-01.parquet
+
+A file has three columns: ``time`` (UTC timestamps in ns), ``sensor_type``
+(dictionary-encoded) and ``value`` (float32), grouped by sensor type and in
+time order within each. A day is streamed off the InfluxDB response in
+batches of ``chunk_rows`` readings, and each batch is written as one row
+group, so the exporter's memory depends on the batch size, not on the range.
+
+Readers open the files memory-mapped and go one row group at a time.
+``iter_partitions`` yields numpy columns for batch jobs,
+``load_archive_chunk`` gives the (sensors x slots) means the fleet job
+otherwise reads from InfluxDB, and ``load_archive_readings`` the raw
+readings the data-quality job does.
+"""
+
+import logging
+import os
+import resource
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from boiler_common import flux
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+NS = 1_000_000_000
+
+SCHEMA = pa.schema([
+    ('time', pa.timestamp('ns', tz='UTC')),
+    ('sensor_type', pa.dictionary(pa.int32(), pa.string())),
+    ('value', pa.float32()),
+])
+
+
+class Partition(NamedTuple):
+    site_id: str
+    day: date
+    path: str
+
+
+def partition_path(root, site_id, day):
+    return os.path.join(root, f"site_id={quote(site_id, safe='')}", f"{day.isoformat()}.parquet")
+
+
+def to_day(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).date()
+
+
+def day_seconds(day):
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def to_table(rows):
+    """Arrow table in the archive schema from raw flux Rows"""
+    times = np.fromiter((row.time for row in rows), dtype=np.int64, count=len(rows))
+    values = np.fromiter((row.value for row in rows), dtype=np.float32, count=len(rows))
+    sensors = pa.array([row.group[1] for row in rows], type=pa.string()).dictionary_encode()
+    return pa.Table.from_arrays([pa.array(times, type=SCHEMA.field('time').type), sensors, pa.array(values)],
+                                schema=SCHEMA)
+
+
+class HistoryExporter:
+    """Writes the raw readings of sites over whole UTC days to the Parquet archive"""
+
+    def __init__(self, executor, root, chunk_rows=100_000, overwrite=False, report=None):
+        self.executor = executor
+        self.root = root
+        self.chunk_rows = chunk_rows
+        self.overwrite = overwrite
+        self.report = report or (lambda line: None)
+
+    def export_day(self, site_id, day):
+        """Write one site's day; returns the readings written (no file for a day without readings)"""
+        path = partition_path(self.root, site_id, day)
+        start = day_seconds(day)
+        query = flux.SeriesQuery((), start, start + DAY, sites=(site_id,))
+        temporary = f"{path}.{os.getpid()}.tmp"
+        writer = None
+        written = 0
+        try:
+            for rows in self.executor.stream_raw(query, self.chunk_rows):
+                if writer is None:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writer = pq.ParquetWriter(temporary, SCHEMA, compression='zstd')
+                writer.write_table(to_table(rows), row_group_size=self.chunk_rows)
+                written += len(rows)
+            if writer is not None:
+                writer.close()
+                writer = None
+                os.replace(temporary, path)
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return written
+
+    def run(self, sites, start, stop):
+        """Export every site over the days ``[start, stop)`` (dates); returns a summary dict"""
+        days = [start + timedelta(days=offset) for offset in range((stop - start).days)]
+        summary = {'sites': len(sites), 'days': len(days), 'files': 0, 'skipped': 0, 'failed': 0, 'readings': 0}
+        started = time.monotonic()
+        for index, site_id in enumerate(sites, 1):
+            for day in days:
+                if not self.overwrite and os.path.exists(partition_path(self.root, site_id, day)):
+                    summary['skipped'] += 1
+                    continue
+                try:
+                    written = self.export_day(site_id, day)
+                except Exception:
+                    summary['failed'] += 1
+                    logger.exception("Exporting %s on %s failed", site_id, day)
+                    continue
+                summary['files'] += bool(written)
+                summary['readings'] += written
+            self.report(f"{index}/{len(sites)} sites, {summary['files']} files, {summary['readings']:,} readings, "
+                        f"peak RSS {peak_rss_mb():.0f} MiB")
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        summary['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        return summary
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+def partitions(root, sites=None, start=None, stop=None):
+    """Archived ``Partition`` files of ``sites`` (all when None) for days in ``[start, stop)``, by site and day"""
+    found = []
+    if not os.path.isdir(root):
+        return found
+    wanted = None if sites is None else set(sites)
+    for directory in sorted(os.listdir(root)):
+        if not directory.startswith('site_id='):
+            continue
+        site_id = unquote(directory[len('site_id='):])
+        if wanted is not None and site_id not in wanted:
+            continue
+        for name in sorted(os.listdir(os.path.join(root, directory))):
+            if not name.endswith('.parquet'):
+                continue
+            day = date.fromisoformat(name[:-len('.parquet')])
+            if (start is None or day >= start) and (stop is None or day < stop):
+                found.append(Partition(site_id, day, os.path.join(root, directory, name)))
+    return found
+
+
+def iter_partitions(root, sites=None, start=None, stop=None, sensor_types=None):
+    """
+    ``(partition, sensor_types, times_ns, values)`` per row group of the archived days, from memory-mapped files
+
+    ``sensor_types`` is an object array of labels, ``times_ns`` int64 and
+    ``values`` float32. Only one row group is decoded at a time.
+    """
+    wanted = None if sensor_types is None else set(sensor_types)
+    for partition in partitions(root, sites, start, stop):
+        parquet = pq.ParquetFile(partition.path, memory_map=True, read_dictionary=['sensor_type'])
+        for group in range(parquet.num_row_groups):
+            table = parquet.read_row_group(group)
+            labels = table.column('sensor_type').combine_chunks()
+            codes = labels.indices.to_numpy(zero_copy_only=False)
+            names = np.asarray(labels.dictionary.to_pylist(), dtype=object)
+            times = table.column('time').combine_chunks().cast(pa.int64()).to_numpy()
+            values = table.column('value').combine_chunks().to_numpy()
+            if wanted is not None:
+                keep = np.isin(names, list(wanted))[codes]
+                codes, times, values = codes[keep], times[keep], values[keep]
+            if len(values):
+                yield partition, names[codes], times, values
+
+
+def slot_means(start, stop, every, labels, times, values):
+    """
+    Means per slot of ``every`` seconds over ``[start, stop)`` as ``(sorted labels, labels x slots array)``
+
+    ``times`` are epoch seconds; NaN where a slot has no values.
+    """
+    names, rows = np.unique(np.asarray(labels, dtype=object), return_inverse=True)
+    slots = -(-(stop - start) // every)
+    slot = (np.asarray(times, dtype=np.int64) - start) // every
+    keep = (slot >= 0) & (slot < slots)
+    flat = rows[keep] * slots + slot[keep]
+    size = len(names) * slots
+    sums = np.bincount(flat, weights=np.asarray(values, dtype=np.float64)[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return names.tolist(), means.reshape(len(names), slots)
+
+
+def load_archive_chunk(root, site_id, start, stop, every):
+    """Fleet job loader reading the archive: per-slot means of a site's sensors over ``[start, stop)``"""
+    labels, times, values = [], [], []
+    for _, sensors, times_ns, chunk in iter_partitions(root, [site_id], to_day(start), to_day(stop - 1) + timedelta(1)):
+        labels.append(sensors)
+        times.append(times_ns // NS)
+        values.append(chunk)
+    if not labels:
+        return slot_means(start, stop, every, [], [], [])
+    return slot_means(start, stop, every, np.concatenate(labels), np.concatenate(times), np.concatenate(values))
+
+
+def load_archive_readings(root, sites, start, stop):
+    """Data-quality job loader reading the archive: ``(site_ids, sensor_types, times_ns, values)`` in ``[start, stop)``"""
+    columns = ([], [], [], [])
+    for partition, sensors, times_ns, chunk in iter_partitions(root, sites, to_day(start), to_day(stop - 1) + timedelta(1)):
+        keep = (times_ns >= start * NS) & (times_ns < stop * NS)
+        columns[0].append(np.full(keep.sum(), partition.site_id, dtype=object))
+        columns[1].append(sensors[keep])
+        columns[2].append(times_ns[keep])
+        columns[3].append(chunk[keep].astype(np.float64))
+    dtypes = (object, object, np.int64, np.float64)
+    return tuple(np.concatenate(chunks) if chunks else np.array([], dtype=dtype) for chunks, dtype in zip(columns, dtypes))
+
+
+def archived_sites(root):
+    """Site ids with at least one archived day"""
+    return sorted({partition.site_id for partition in partitions(root)})
@@ -0,0 +1,30 @@
+"""
+Redis access for the analytic app
+
+Keys live under the service key prefix of the Django cache configuration.
+The iot_ingestion readings stream is read under that service's own prefix.
+"""
+
+import threading
+
+from django.conf import settings
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    """Return the process-wide Redis client for REDIS_URL"""
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                import redis
+
+                _redis = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=5, socket_connect_timeout=1)
+    return _redis
+
+
+def key_prefix():
+    """Service key prefix shared with the Django cache configuration"""
+    return settings.CACHES['default'].get('KEY_PREFIX', 'ai_processor')
@@ -0,0 +1,195 @@
+"""
+Live anomaly detection on the iot_ingestion readings stream
+
+``DetectorRunner`` follows the readings stream with blocking XREADs. Each
+entry is a whole ingest batch in columnar form (see
+``boiler_common.readings``), and it goes to ``DetectorTable.update`` in one
+call, and to the per-site ``MultivariateTable`` when multivariate scoring is
+on. Every event raised is appended to the anomaly events stream straight
+away.
+
+Every ``checkpoint_interval`` seconds, and on shutdown, the runner saves the
+detector tables to Redis together with the ID of the last stream entry it
+applied. A restarted runner restores that checkpoint and resumes from that
+entry. Readings published in between are neither lost nor counted twice,
+unless the stream was trimmed past the saved position.
+"""
+
+import logging
+import time
+
+from boiler_common import metrics, readings as stream_format
+
+from .cache import key_prefix
+from .detectors import DetectorTable
+from .multivariate import MultivariateTable
+
+logger = logging.getLogger(__name__)
+
+READINGS = metrics.counter('analytics_stream_readings_total', 'Readings applied to the streaming detectors')
+EVENTS = metrics.counter('analytics_anomaly_events_total', 'Anomaly events raised, by detector', ['detector'])
+TRACKED = metrics.gauge('analytics_detector_keys', 'Site and sensor pairs with detector state')
+TRACKED_SITES = metrics.gauge('analytics_multivariate_sites', 'Sites with multivariate detector state')
+
+
+def anomaly_keys():
+    """Keys of the anomaly events stream and of the detector checkpoint"""
+    return f"{key_prefix()}:anomalies", f"{key_prefix()}:detectors:checkpoint"
+
+
+def multivariate_key(checkpoint_key):
+    """Key of the multivariate table checkpoint saved next to the detector checkpoint"""
+    return f"{checkpoint_key}:multivariate"
+
+
+def event_fields(event):
+    """Stream entry fields of an AnomalyEvent"""
+    return {
+        'site': event.site_id,
+        'sensor': event.sensor_type,
+        'ts': event.timestamp,
+        'value': repr(event.value),
+        'detector': event.detector,
+        'score': f'{event.score:.3f}',
+        'threshold': repr(event.threshold),
+    }
+
+
+def parse_event(entry_id, fields):
+    """An anomaly events stream entry as a JSON-ready dict"""
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return {
+        'id': entry_id.decode() if isinstance(entry_id, bytes) else entry_id,
+        'site_id': fields['site'],
+        'sensor_type': fields['sensor'],
+        'timestamp': int(fields['ts']),
+        'value': float(fields['value']),
+        'detector': fields['detector'],
+        'score': float(fields['score']),
+        'threshold': float(fields['threshold']),
+    }
+
+
+class DetectorRunner:
+    """Applies readings stream entries to a DetectorTable and publishes its events"""
+
+    def __init__(self, client, table, stream_key, events_key, checkpoint_key, last_id='$',
+                 events_maxlen=10_000, checkpoint_interval=30.0, clock=time.monotonic, multivariate=None):
+        self.client = client
+        self.table = table
+        self.multivariate = multivariate
+        self.stream_key = stream_key
+        self.events_key = events_key
+        self.checkpoint_key = checkpoint_key
+        self.last_id = last_id
+        self.events_maxlen = events_maxlen
+        self.checkpoint_interval = checkpoint_interval
+        self._clock = clock
+        self._last_checkpoint = clock()
+        TRACKED.set_function(lambda: len(self.table))
+        if multivariate is not None:
+            TRACKED_SITES.set_function(lambda: len(self.multivariate))
+
+        self.readings = 0
+        self.events = 0
+
+    @classmethod
+    def restore(cls, client, checkpoint_key, detector_config, multivariate_config=None, **kwargs):
+        """
+        Runner resuming from the checkpoint in Redis, or starting at new entries without a usable one
+
+        With ``multivariate_config`` the runner also scores sites with a
+        MultivariateTable, restored when it was saved at the same entry.
+        """
+        data = client.get(checkpoint_key)
+        table, last_id = None, None
+        if data is not None:
+            try:
+                table, extra = DetectorTable.loads(data, **detector_config)
+            except ValueError as e:
+                logger.warning("Ignoring detector checkpoint %s: %s", checkpoint_key, e)
+            else:
+                last_id = extra['last_id']
+                logger.info("Restored %d detector keys at stream entry %s", len(table), last_id)
+        if table is None:
+            table = DetectorTable(**detector_config)
+        if last_id is not None:
+            kwargs['last_id'] = last_id
+        if multivariate_config is not None:
+            kwargs['multivariate'] = cls.restore_multivariate(client, checkpoint_key, multivariate_config, last_id)
+        return cls(client, table, checkpoint_key=checkpoint_key, **kwargs)
+
+    @staticmethod
+    def restore_multivariate(client, checkpoint_key, config, last_id):
+        """The saved MultivariateTable if it was saved at stream entry ``last_id``, otherwise an empty one"""
+        data = client.get(multivariate_key(checkpoint_key)) if last_id is not None else None
+        if data is not None:
+            try:
+                table, extra = MultivariateTable.loads(data, **config)
+            except ValueError as e:
+                logger.warning("Ignoring multivariate checkpoint: %s", e)
+            else:
+                if extra.get('last_id') == last_id:
+                    logger.info("Restored multivariate state of %d sites", len(table))
+                    return table
+                logger.warning("Ignoring multivariate checkpoint saved at entry %s", extra.get('last_id'))
+        return MultivariateTable(**config)
+
+    def apply(self, entries):
+        """Apply ``(entry_id, fields)`` stream entries in order and publish their events"""
+        for entry_id, fields in entries:
+            site_ids, sensor_types, timestamps, values = stream_format.decode(fields)
+            events = self.table.update(site_ids, sensor_types, timestamps, values)
+            if self.multivariate is not None:
+                events += self.multivariate.update(site_ids, sensor_types, timestamps, values)
+            if events:
+                self.publish(events)
+            self.readings += len(values)
+            READINGS.inc(len(values))
+            self.last_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+    def publish(self, events):
+        pipe = self.client.pipeline(transaction=False)
+        for event in events:
+            pipe.xadd(self.events_key, event_fields(event), maxlen=self.events_maxlen, approximate=True)
+            EVENTS.labels(event.detector).inc()
+        pipe.execute()
+        self.events += len(events)
+
+    def poll(self, block_ms=1000, count=100):
+        """Wait up to ``block_ms`` for new entries and apply them; returns the number of entries"""
+        response = self.client.xread({self.stream_key: self.last_id}, count=count, block=block_ms)
+        entries = response[0][1] if response else []
+        self.apply(entries)
+        if self._clock() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+        return len(entries)
+
+    def checkpoint(self):
+        """Save the detector tables and the last applied entry ID"""
+        pipe = self.client.pipeline()
+        pipe.set(self.checkpoint_key, self.table.dumps(last_id=self.last_id))
+        if self.multivariate is not None:
+            pipe.set(multivariate_key(self.checkpoint_key), self.multivariate.dumps(last_id=self.last_id))
+        pipe.execute()
+        self._last_checkpoint = self._clock()
+
+    def run(self, stop, block_ms=1000):
+        """Poll until the ``stop`` event is set, then write a final checkpoint"""
+        while not stop.is_set():
+            try:
+                self.poll(block_ms)
+            except Exception:
+                logger.exception("Reading %s failed, retrying", self.stream_key)
+                stop.wait(1)
+        self.checkpoint()
+
+    def stats(self):
+        return {
+            'keys': len(self.table),
+            'sites': len(self.multivariate) if self.multivariate is not None else 0,
+            'state_bytes': self.table.nbytes + (self.multivariate.nbytes if self.multivariate is not None else 0),
+            'readings': self.readings,
+            'events': self.events,
+            'last_id': self.last_id,
+        }
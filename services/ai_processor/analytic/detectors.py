@@ -0,0 +1,250 @@
+"""
+Streaming anomaly detectors with fixed-size state per (site, sensor)
+
+Each reading is judged against state kept for its ``(site, sensor)`` and
+updated in O(1). There is no re-query of history:
+
+- EWMA: exponentially weighted mean and variance. The score is the
+  reading's deviation from the mean in EWMA standard deviations.
+- rolling z-score: the reading against the mean and std of the previous
+  ``window`` values. These come from running sums over a ring of the last
+  ``window`` values, which are re-summed every ``window`` updates so
+  rounding error cannot build up.
+- CUSUM: two-sided cumulative sums of the EWMA-standardised deviation
+  beyond ``k``. They catch a sustained drift that no single reading makes
+  obvious, and are reset once they pass ``h``.
+
+All state lives in two preallocated numpy arrays: one row of scalars per
+key, plus the ring of recent values. A batch of readings updates every key
+in a few vectorised steps. A key that occurs several times in a batch is
+handled in rounds, one occurrence per round, so its updates stay in order.
+
+An event is emitted when a detector's score crosses its threshold. The
+detector is then latched until a reading scores below the threshold again,
+so an anomaly lasting many readings produces one event.
+"""
+
+import io
+from typing import NamedTuple
+
+import numpy as np
+
+# Columns of the per-key state array
+COUNT, MEAN, VAR, ROLL_SUM, ROLL_SQUARES, CUSUM_UP, CUSUM_DOWN, LATCHED, LAST_TS = range(9)
+COLUMNS = 9
+
+# Latch bits, one per detector direction
+DETECTOR_BITS = {'ewma': 1, 'zscore': 2, 'cusum_up': 4, 'cusum_down': 8}
+
+DEFAULTS = {
+    'alpha': 0.05,  # EWMA weight of the newest reading
+    'window': 60,  # readings in the rolling z-score window
+    'warmup': 30,  # readings of a key before its detectors may fire
+    'z_threshold': 4.0,  # |score| that raises an EWMA or rolling z-score event
+    'cusum_k': 0.5,  # deviation, in EWMA standard deviations, ignored by CUSUM
+    'cusum_h': 8.0,  # CUSUM sum that raises a drift event
+    'std_floor': 1e-3,  # lower bound on a standard deviation, for flat-lining sensors
+}
+
+
+class AnomalyEvent(NamedTuple):
+    site_id: str
+    sensor_type: str
+    timestamp: int  # epoch nanoseconds of the reading
+    value: float
+    detector: str  # ewma, zscore, cusum_up or cusum_down
+    score: float
+    threshold: float
+
+
+def occurrence_rounds(rows):
+    """Split batch positions into rounds in which every row occurs at most once, preserving order"""
+    order = np.argsort(rows, kind='stable')
+    ordered = rows[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    occurrence = np.empty(len(rows), dtype=np.int64)
+    occurrence[order] = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    if not len(rows) or occurrence.max() == 0:
+        return [np.arange(len(rows))]
+    return [np.flatnonzero(occurrence == n) for n in range(occurrence.max() + 1)]
+
+
+class DetectorTable:
+    """Array-backed detector state for every (site, sensor) seen"""
+
+    def __init__(self, capacity=1024, **config):
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown detector settings: {', '.join(sorted(unknown))}")
+        self.config = {**DEFAULTS, **config}
+        self.window = int(self.config['window'])
+        self.keys = []  # (site_id, sensor_type) per row
+        self._rows = {}
+        self.state = np.zeros((capacity, COLUMNS))
+        self.ring = np.zeros((capacity, self.window))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.state.nbytes + self.ring.nbytes
+
+    def rows_for(self, site_ids, sensor_types):
+        """Row of each (site, sensor), adding rows for keys not seen before"""
+        rows = self._rows
+        result = np.empty(len(site_ids), dtype=np.int64)
+        for index, key in enumerate(zip(site_ids, sensor_types)):
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = len(self.keys)
+                self.keys.append(key)
+            result[index] = row
+        if len(self.keys) > len(self.state):
+            self._grow(len(self.keys))
+        return result
+
+    def _grow(self, needed):
+        capacity = max(needed, 2 * len(self.state))
+        state = np.zeros((capacity, COLUMNS))
+        state[:len(self.state)] = self.state
+        ring = np.zeros((capacity, self.window))
+        ring[:len(self.ring)] = self.ring
+        self.state, self.ring = state, ring
+
+    def update(self, site_ids, sensor_types, timestamps, values):
+        """Fold a batch of readings into the state; returns the AnomalyEvents it raised, in batch order"""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        rows = self.rows_for(site_ids, sensor_types)
+        events = []
+        for positions in occurrence_rounds(rows):
+            events.extend(self._update_round(rows[positions], timestamps[positions], values[positions], positions))
+        events.sort(key=lambda event: event[0])
+        return [event for _, event in events]
+
+    def _update_round(self, rows, timestamps, x, positions):
+        """Update rows that are all distinct; returns (batch position, event) pairs"""
+        config, window = self.config, self.window
+        state = self.state[rows]  # copy, written back at the end
+        count = state[:, COUNT]
+        ready = count >= config['warmup']
+
+        # EWMA score against the state before this reading
+        ewma_std = np.maximum(np.sqrt(state[:, VAR]), config['std_floor'])
+        ewma_score = (x - state[:, MEAN]) / ewma_std
+
+        # Rolling z-score against the previous ``window`` values
+        filled = np.minimum(count, window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            roll_mean = state[:, ROLL_SUM] / filled
+            roll_var = (state[:, ROLL_SQUARES] - state[:, ROLL_SUM] * roll_mean) / (filled - 1)
+        roll_std = np.maximum(np.sqrt(np.maximum(roll_var, 0.0)), config['std_floor'])
+        roll_score = np.where(filled >= 2, (x - roll_mean) / roll_std, 0.0)
+
+        # CUSUM of the standardised deviation
+        step = np.where(ready, ewma_score, 0.0)
+        cusum_up = np.maximum(0.0, state[:, CUSUM_UP] + step - config['cusum_k'])
+        cusum_down = np.maximum(0.0, state[:, CUSUM_DOWN] - step - config['cusum_k'])
+
+        # Fold the reading in: EWMA (West's incremental form), then the ring and its sums
+        first = count == 0
+        diff = x - state[:, MEAN]
+        increment = config['alpha'] * diff
+        state[:, MEAN] = np.where(first, x, state[:, MEAN] + increment)
+        state[:, VAR] = np.where(first, 0.0, (1 - config['alpha']) * (state[:, VAR] + diff * increment))
+        slot = (count % window).astype(np.int64)
+        evicted = np.where(count >= window, self.ring[rows, slot], 0.0)
+        self.ring[rows, slot] = x
+        state[:, ROLL_SUM] += x - evicted
+        state[:, ROLL_SQUARES] += x * x - evicted * evicted
+        wrapped = slot == window - 1
+        if wrapped.any():
+            ring = self.ring[rows[wrapped]]
+            state[wrapped, ROLL_SUM] = ring.sum(axis=1)
+            state[wrapped, ROLL_SQUARES] = (ring * ring).sum(axis=1)
+        state[:, COUNT] = count + 1
+        state[:, LAST_TS] = timestamps
+
+        # Threshold crossings, latched per detector until the score drops back
+        latched = state[:, LATCHED].astype(np.int64)
+        threshold = config['z_threshold']
+        checks = (
+            ('ewma', ewma_score, ready & (np.abs(ewma_score) > threshold), threshold),
+            ('zscore', roll_score, ready & (np.abs(roll_score) > threshold), threshold),
+            ('cusum_up', cusum_up, ready & (cusum_up > config['cusum_h']), config['cusum_h']),
+            ('cusum_down', -cusum_down, ready & (cusum_down > config['cusum_h']), config['cusum_h']),
+        )
+        events = []
+        for detector, scores, above, limit in checks:
+            bit = DETECTOR_BITS[detector]
+            fired = above & ((latched & bit) == 0)
+            latched = np.where(above, latched | bit, latched & ~bit)
+            for index in np.flatnonzero(fired):
+                site_id, sensor_type = self.keys[rows[index]]
+                events.append((positions[index], AnomalyEvent(
+                    site_id, sensor_type, int(timestamps[index]), float(x[index]),
+                    detector, float(scores[index]), limit,
+                )))
+        # A CUSUM that fired starts accumulating again from zero
+        state[:, CUSUM_UP] = np.where(cusum_up > config['cusum_h'], 0.0, cusum_up)
+        state[:, CUSUM_DOWN] = np.where(cusum_down > config['cusum_h'], 0.0, cusum_down)
+        state[:, LATCHED] = latched
+        self.state[rows] = state
+        return events
+
+    def snapshot(self, site_id, sensor_type):
+        """Current state of one key as a dict, or None if it has not been seen"""
+        row = self._rows.get((site_id, sensor_type))
+        if row is None:
+            return None
+        state = self.state[row]
+        filled = min(int(state[COUNT]), self.window)
+        ring = self.ring[row, :filled]
+        return {
+            'count': int(state[COUNT]),
+            'ewma_mean': float(state[MEAN]),
+            'ewma_std': float(np.sqrt(state[VAR])),
+            'rolling_mean': float(ring.mean()) if filled else None,
+            'rolling_std': float(ring.std(ddof=1)) if filled > 1 else None,
+            'cusum_up': float(state[CUSUM_UP]),
+            'cusum_down': float(state[CUSUM_DOWN]),
+            'last_timestamp': int(state[LAST_TS]),
+        }
+
+    def dumps(self, **extra):
+        """Serialise the table, plus string ``extra`` values, as an ``.npz`` blob"""
+        size = len(self.keys)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            sites=np.array([key[0] for key in self.keys], dtype=str),
+            sensors=np.array([key[1] for key in self.keys], dtype=str),
+            state=self.state[:size],
+            ring=self.ring[:size],
+            config=np.array(sorted(self.config.items()), dtype=str),
+            **{name: np.array(value, dtype=str) for name, value in extra.items()},
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data, **config):
+        """
+        Rebuild a table from ``dumps`` output; returns ``(table, extra)``
+
+        Raises ValueError when the blob was written with different detector
+        settings, whose state would not mean the same thing.
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as blob:
+            table = cls(capacity=max(1, len(blob['sites'])), **config)
+            saved = dict(blob['config'].tolist())
+            current = {name: str(value) for name, value in table.config.items()}
+            if saved != current:
+                raise ValueError("checkpoint was written with different detector settings")
+            table.keys = list(zip(blob['sites'].tolist(), blob['sensors'].tolist()))
+            table._rows = {key: row for row, key in enumerate(table.keys)}
+            table.state[:len(table.keys)] = blob['state']
+            table.ring[:len(table.keys)] = blob['ring']
+            extra = {name: str(blob[name]) for name in blob.files
+                     if name not in ('sites', 'sensors', 'state', 'ring', 'config')}
+        return table, extra
@@ -0,0 +1,215 @@
+"""
+Fleet-wide batch analytics on a process pool
+
+``FleetJob`` computes daily statistics for every sensor of every site. It
+spreads the sites over a ``ProcessPoolExecutor``, one task per site. A
+worker streams the site's history from InfluxDB a few days at a time. Each
+chunk is the one-minute means of all the site's sensors, laid out as a
+(sensors x minutes) array and reduced with the vectorised kernels, so a
+worker's memory is bounded by the chunk size, not by the history length.
+
+Workers only compute. The parent process collects each site's rows as its
+task finishes and writes them with one bulk upsert. The same transaction
+advances the site's ``AnalyticsWatermark``. A job that crashed or was
+interrupted therefore resumes from each site's watermark, and only the
+sites in flight at the time are recomputed.
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+import numpy as np
+from boiler_common import flux
+from django.db import transaction
+
+from . import history
+from .kernels import block_stats, rolling_stats
+from .models import AnalyticsWatermark, SensorDailyStats
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+JOB = 'daily_stats'
+PERCENTILES = (5, 50, 95)
+STAT_FIELDS = ('samples', 'mean', 'std', 'min_value', 'max_value', 'p05', 'p50', 'p95', 'peak_hour_mean')
+
+
+class SiteResult(NamedTuple):
+    site_id: str
+    rows: list  # (sensor_type, day start epoch seconds, stats in STAT_FIELDS order)
+    points: int  # one-minute means read
+
+
+def site_chunk_query(bucket, site_id, start, stop, every):
+    """Flux query for the per-slot means of every sensor of one site"""
+    query = flux.SeriesQuery((), start, stop, sites=(site_id,), every=every, group_by=('sensor_type',))
+    return query.to_flux(bucket)
+
+
+def load_site_chunk(site_id, start, stop, every):
+    """Per-slot means of a site's sensors over ``[start, stop)`` as ``(sensor_types, values)``"""
+    from django.conf import settings
+
+    frame = history.query_frame(site_chunk_query(settings.INFLUXDB_CONFIG['bucket'], site_id, start, stop, every))
+    if frame.empty:
+        return history.layout([], start, stop, every, [], [], [])
+    return history.layout(None, start, stop, every, frame['sensor_type'].to_numpy(),
+                          history.epoch_seconds(frame), frame['_value'].to_numpy())
+
+
+def list_sites(start, stop):
+    """Site ids with readings in ``[start, stop)``"""
+    from django.conf import settings
+
+    query = (
+        'import "influxdata/influxdb/schema"\n'
+        f'schema.tagValues(bucket: {flux.flux_string(settings.INFLUXDB_CONFIG["bucket"])}, tag: "site_id",'
+        f' predicate: (r) => r._measurement == {flux.flux_string(flux.MEASUREMENT)},'
+        f' start: {flux.flux_time(start)}, stop: {flux.flux_time(stop)})'
+    )
+    frame = history.query_frame(query)
+    return sorted(frame['_value'].tolist()) if not frame.empty else []
+
+
+def daily_rows(sensor_types, values, start, every):
+    """Daily statistics rows of a (sensors x slots) array that starts at midnight and covers whole days"""
+    per_day = DAY // every
+    stats = block_stats(values, per_day, PERCENTILES)
+    hour = max(1, 3600 // every)
+    # Highest one-hour mean of each day, from windows with at least half an hour of data
+    hourly = rolling_stats(values, hour, ('mean',), min_periods=max(1, hour // 2))['mean']
+    hourly = hourly.reshape(len(sensor_types), -1, per_day)
+    has_peak = ~np.isnan(hourly).all(axis=2)
+    peak = np.full(has_peak.shape, np.nan)
+    peak[has_peak] = np.nanmax(hourly[has_peak], axis=1)
+
+    columns = [stats['count'], stats['mean'], stats['std'], stats['min'], stats['max'],
+               stats['p5'], stats['p50'], stats['p95'], peak]
+    rows = []
+    for sensor, day in zip(*np.nonzero(stats['count'])):
+        row = [column[sensor, day] for column in columns]
+        rows.append((sensor_types[sensor], start + int(day) * DAY,
+                     [int(row[0])] + [None if np.isnan(value) else float(value) for value in row[1:]]))
+    return rows
+
+
+def analyze_site(site_id, start, stop, every=60, chunk_days=7, load=load_site_chunk):
+    """Worker task: daily statistics of one site over whole days ``[start, stop)``, read chunk by chunk"""
+    rows = []
+    points = 0
+    for chunk_start in range(start, stop, chunk_days * DAY):
+        chunk_stop = min(stop, chunk_start + chunk_days * DAY)
+        sensor_types, values = load(site_id, chunk_start, chunk_stop, every)
+        if not len(sensor_types):
+            continue
+        points += int(np.count_nonzero(~np.isnan(values)))
+        rows.extend(daily_rows(sensor_types, values, chunk_start, every))
+    return SiteResult(site_id, rows, points)
+
+
+def _reset_worker_clients():
+    """Pool initializer: clients inherited from the parent must not share its sockets"""
+    history._client = None
+
+
+def to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+def day_start(seconds):
+    return seconds - seconds % DAY
+
+
+def save_site(job, result, until):
+    """Upsert a site's rows and advance its watermark to ``until`` in one transaction"""
+    stats = [
+        SensorDailyStats(site_id=result.site_id, sensor_type=sensor_type, day=to_datetime(day).date(),
+                         **dict(zip(STAT_FIELDS, values)))
+        for sensor_type, day, values in result.rows
+    ]
+    with transaction.atomic():
+        SensorDailyStats.objects.bulk_create(
+            stats, batch_size=1000, update_conflicts=True,
+            unique_fields=['site_id', 'sensor_type', 'day'], update_fields=[*STAT_FIELDS, 'computed_at'],
+        )
+        AnalyticsWatermark.objects.update_or_create(
+            job=job, site_id=result.site_id, defaults={'processed_until': to_datetime(until)},
+        )
+
+
+class FleetJob:
+    """Daily statistics for many sites, resumable per site"""
+
+    def __init__(self, workers=4, every=60, chunk_days=7, lookback_days=30, job=JOB,
+                 load=load_site_chunk, report=None, report_interval=5.0):
+        if DAY % every:
+            raise ValueError("every must divide a day")
+        self.workers = workers
+        self.every = every
+        self.chunk_days = chunk_days
+        self.lookback_days = lookback_days
+        self.job = job
+        self.load = load
+        self.report = report or (lambda line: None)
+        self.report_interval = report_interval
+
+    def plan(self, sites, until, full=False):
+        """``[(site_id, start)]`` for the sites with whole days left before ``until``"""
+        until = day_start(until)
+        default_start = until - self.lookback_days * DAY
+        watermarks = {} if full else {
+            site_id: int(processed_until.timestamp())
+            for site_id, processed_until in AnalyticsWatermark.objects.filter(job=self.job)
+            .values_list('site_id', 'processed_until')
+        }
+        tasks = []
+        for site_id in sites:
+            start = day_start(watermarks.get(site_id, default_start))
+            if start < until:
+                tasks.append((site_id, start))
+        return tasks
+
+    def run(self, sites, until, full=False):
+        """Process every site up to the start of ``until``'s day; returns a summary dict"""
+        until = day_start(until)
+        tasks = self.plan(sites, until, full)
+        summary = {'sites': len(sites), 'scheduled': len(tasks), 'done': 0, 'failed': 0, 'rows': 0, 'points': 0}
+        if not tasks:
+            return summary
+
+        started = last_report = time.monotonic()
+        # Workers never use the database connection they inherit; only this process writes results
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_reset_worker_clients) as pool:
+            futures = {
+                pool.submit(analyze_site, site_id, start, until, self.every, self.chunk_days, self.load): site_id
+                for site_id, start in tasks
+            }
+            for future in as_completed(futures):
+                site_id = futures[future]
+                try:
+                    result = future.result()
+                    save_site(self.job, result, until)
+                except Exception:
+                    summary['failed'] += 1
+                    logger.exception("Fleet analytics failed for site %s", site_id)
+                else:
+                    summary['done'] += 1
+                    summary['rows'] += len(result.rows)
+                    summary['points'] += result.points
+                now = time.monotonic()
+                finished = summary['done'] + summary['failed']
+                if now - last_report >= self.report_interval or finished == len(tasks):
+                    last_report = now
+                    rate = finished / (now - started)
+                    self.report(
+                        f"{finished}/{len(tasks)} sites ({summary['failed']} failed), {summary['rows']} rows, "
+                        f"{summary['points']:,} points, {rate:.1f} sites/s, "
+                        f"ETA {(len(tasks) - finished) / rate:.0f}s"
+                    )
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        return summary
@@ -0,0 +1,231 @@
+"""
+Fleet-wide trend forecasts: when fuel runs out and when efficiency needs maintenance
+
+Each forecast target is one sensor type falling towards a threshold, e.g.
+``fuel_level`` towards empty. ``ForecastJob`` loads the recent history of
+every site as one (sites x slots) grid of slot means and fits two trend
+models to all rows at once:
+
+- ``linear``: least-squares line through the row's values, from masked sums
+- ``holt``: Holt's double exponential smoothing (level and trend), one
+  vectorised update per slot across all sites
+
+Both give a level at the newest value and a rate per hour, from which the
+time the threshold is crossed follows. A refill or maintenance shows up as
+a rise larger than the target's ``reset_rise``; values before a row's last
+such rise belong to an earlier cycle and are ignored.
+
+The job runs on a schedule (``manage.py run_forecasts``) and stores one
+``SensorForecast`` row per site and target, so requests only read rows.
+"""
+
+import logging
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from django.db import transaction
+
+from . import history
+from .models import SensorForecast
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+METHODS = ('linear', 'holt')
+
+# Forecast targets: a sensor type falling towards a threshold, and the rise that starts a new cycle
+DEFAULT_TARGETS = (
+    {'sensor_type': 'fuel_level', 'threshold': 0.0, 'reset_rise': 10.0},  # empty; a refill adds at least 10%
+    {'sensor_type': 'efficiency', 'threshold': 80.0, 'reset_rise': 3.0},  # maintenance due; servicing restores it
+)
+
+
+def since_last_rise(values, rise):
+    """
+    Copy of ``values`` with NaN before each row's last rise of more than ``rise``
+
+    A rise is measured between consecutive values of a row, gaps skipped.
+    """
+    values = np.array(values, dtype=np.float64)
+    series, slots = values.shape
+    valid = ~np.isnan(values)
+    # Index of the newest value at or before each slot, -1 before the first one
+    newest = np.maximum.accumulate(np.where(valid, np.arange(slots), -1), axis=1)
+    previous = np.full_like(newest, -1)
+    previous[:, 1:] = newest[:, :-1]
+    previous_value = np.take_along_axis(values, np.maximum(previous, 0), axis=1)
+    rises = valid & (previous >= 0) & (values - previous_value > rise)
+    start = np.where(rises.any(axis=1), slots - 1 - np.argmax(rises[:, ::-1], axis=1), 0)
+    values[np.arange(slots) < start[:, None]] = np.nan
+    return values
+
+
+def linear_trend(values, hours):
+    """
+    Least-squares line of every row of ``values`` against ``hours`` (slot times in hours)
+
+    Returns ``(level, rate)``: the line at each row's newest value and its
+    slope per hour. Rows with fewer than two values are NaN.
+    """
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Centred on each row's mean time, so the sums stay small
+        mean_hour = np.where(valid, hours, 0.0).sum(axis=1) / counts
+        mean_value = np.where(valid, values, 0.0).sum(axis=1) / counts
+        dt = np.where(valid, hours - mean_hour[:, None], 0.0)
+        dv = np.where(valid, values - mean_value[:, None], 0.0)
+        rate = (dt * dv).sum(axis=1) / (dt * dt).sum(axis=1)
+        level = mean_value + rate * (hours[newest_slot(valid)] - mean_hour)
+    rate[counts < 2] = np.nan
+    level[counts < 2] = np.nan
+    return level, rate
+
+
+def newest_slot(valid):
+    """Slot of each row's newest value (the last slot for rows without values)"""
+    return valid.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+
+
+def holt(values, hours, alpha=0.3, beta=0.1):
+    """
+    Holt's linear exponential smoothing of every row, skipping NaN slots
+
+    Returns ``(level, rate)`` after each row's newest value, the rate per
+    hour. A row starts at its first value with no trend; across a gap the
+    trend extrapolates the level and is updated per hour elapsed. Rows with
+    fewer than two values are NaN.
+    """
+    series, slots = values.shape
+    level = np.full(series, np.nan)
+    rate = np.zeros(series)
+    seen = np.full(series, np.nan)  # hour of the newest value so far
+    counts = np.zeros(series, dtype=np.int64)
+    for slot in range(slots):
+        value = values[:, slot]
+        valid = ~np.isnan(value)
+        started = valid & (counts > 0)
+        first = valid & (counts == 0)
+        elapsed = hours[slot] - seen[started]
+        predicted = level[started] + rate[started] * elapsed
+        new_level = alpha * value[started] + (1 - alpha) * predicted
+        rate[started] = beta * (new_level - level[started]) / elapsed + (1 - beta) * rate[started]
+        level[started] = new_level
+        level[first] = value[first]
+        seen[valid] = hours[slot]
+        counts += valid
+    level[counts < 2] = np.nan
+    rate[counts < 2] = np.nan
+    return level, rate
+
+
+def crossing_hours(level, rate, threshold, horizon):
+    """
+    Hours from the newest value until ``level + rate * t`` falls to ``threshold``
+
+    0 when already at or below it; NaN when not falling or not crossing
+    within ``horizon`` hours.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hours = np.where(level <= threshold, 0.0, (level - threshold) / -rate)
+    hours[~(level <= threshold) & ~(rate < 0)] = np.nan
+    hours[hours > horizon] = np.nan
+    return hours
+
+
+def forecast_grid(grid, threshold, reset_rise=None, alpha=0.3, beta=0.1, horizon_days=30, min_points=6):
+    """
+    Forecast rows for every site of a Grid; sites with fewer than ``min_points`` values in the cycle are left out
+
+    Each row is a dict with the ``SensorForecast`` fields except the ids.
+    """
+    values = grid.values if reset_rise is None else since_last_rise(grid.values, reset_rise)
+    hours = (grid.timestamps - grid.start) / HOUR
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    last = newest_slot(valid)
+    observed = grid.timestamps[last]
+    fits = {}
+    for method, (level, rate) in (('linear', linear_trend(values, hours)),
+                                  ('holt', holt(values, hours, alpha, beta))):
+        fits[method] = level, rate, crossing_hours(level, rate, threshold, horizon_days * 24)
+
+    rows = []
+    for row in np.flatnonzero(counts >= min_points):
+        fields = {
+            'threshold': threshold,
+            'samples': int(counts[row]),
+            'latest': float(values[row, last[row]]),
+            'observed_at': to_datetime(observed[row]),
+        }
+        for method, (level, rate, eta) in fits.items():
+            fields[f'{method}_level'] = float(level[row])
+            fields[f'{method}_rate'] = float(rate[row])
+            fields[f'{method}_crossing'] = (
+                None if np.isnan(eta[row]) else to_datetime(observed[row] + eta[row] * HOUR)
+            )
+        rows.append((grid.sites[row], fields))
+    return rows
+
+
+def to_datetime(seconds):
+    return datetime.fromtimestamp(float(seconds), tz=timezone.utc)
+
+
+class ForecastJob:
+    """Fits every configured target for the whole fleet and stores the forecasts"""
+
+    def __init__(self, targets=DEFAULT_TARGETS, lookback=2 * 86400, every=900, alpha=0.3, beta=0.1,
+                 horizon_days=30, min_points=6, load=history.load_grid):
+        self.targets = targets
+        self.lookback = lookback
+        self.every = every
+        self.alpha = alpha
+        self.beta = beta
+        self.horizon_days = horizon_days
+        self.min_points = min_points
+        self.load = load
+
+    def run(self, now=None, sites=None):
+        """Forecast every target from the history up to ``now`` (epoch seconds); returns a summary dict"""
+        started = time.monotonic()
+        now = int(time.time() if now is None else now)
+        stop = now - now % self.every
+        summary = {'targets': 0, 'failed': 0, 'sites': 0, 'forecasts': 0}
+        for target in self.targets:
+            sensor_type = target['sensor_type']
+            try:
+                grid = self.load(sensor_type, sites, stop - self.lookback, stop, self.every)
+                rows = forecast_grid(grid, target['threshold'], target.get('reset_rise'), self.alpha, self.beta,
+                                     self.horizon_days, self.min_points)
+                save_forecasts(sensor_type, rows, sites)
+            except Exception:
+                summary['failed'] += 1
+                logger.exception("Forecasting %s failed", sensor_type)
+                continue
+            summary['targets'] += 1
+            summary['sites'] = max(summary['sites'], len(grid.sites))
+            summary['forecasts'] += len(rows)
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        return summary
+
+
+def save_forecasts(sensor_type, rows, sites=None):
+    """
+    Upsert one target's forecasts and delete the others of ``sites`` (all when None), in one transaction
+
+    A site without a row has no forecast any more, e.g. just after a refill
+    or when it stopped reporting, so its old row must not be served.
+    """
+    forecasts = [SensorForecast(site_id=site_id, sensor_type=sensor_type, **fields) for site_id, fields in rows]
+    stale = SensorForecast.objects.filter(sensor_type=sensor_type).exclude(site_id__in=[site_id for site_id, _ in rows])
+    if sites is not None:
+        stale = stale.filter(site_id__in=sites)
+    with transaction.atomic():
+        stale.delete()
+        if forecasts:
+            SensorForecast.objects.bulk_create(
+                forecasts, batch_size=1000, update_conflicts=True, unique_fields=['site_id', 'sensor_type'],
+                update_fields=[field for field in rows[0][1]] + ['computed_at'],
+            )
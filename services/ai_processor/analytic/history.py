@@ -0,0 +1,202 @@
+"""
+Sensor history from InfluxDB as regular (site x time) grids
+
+The ingestion service writes every reading to the ``sensor_data`` bucket as a
+``sensor_reading`` point tagged with ``site_id`` and ``sensor_type``. For
+analytics, one sensor type of many sites is averaged by InfluxDB into fixed
+slots (``aggregateWindow``) and laid out as a 2-D array with one row per
+site, which is the input of the ``kernels`` module. Several sensor types
+are loaded together as a 3-D (sites x sensors x slots) ``Cube``. Queries are built with
+the shared ``boiler_common.flux`` layer, so the reduction runs in InfluxDB.
+"""
+
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+from boiler_common import metrics
+from boiler_common import flux
+from django.conf import settings
+
+INFLUX_LATENCY = metrics.histogram(
+    'influxdb_request_duration_seconds', 'InfluxDB call latency, failures included', ['operation'],
+)
+QUERY_LATENCY = INFLUX_LATENCY.labels('query')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class HistoryError(ValueError):
+    """A history request that cannot be answered as asked"""
+
+
+@dataclass
+class Grid:
+    """One sensor type of several sites on a regular time grid"""
+    sensor_type: str
+    sites: list  # row labels
+    start: int  # epoch seconds of the first slot
+    every: int  # slot width in seconds
+    values: np.ndarray  # float64 (sites x slots), NaN where a slot has no data
+
+    @property
+    def timestamps(self):
+        """Epoch seconds of each slot start"""
+        return self.start + self.every * np.arange(self.values.shape[1], dtype=np.int64)
+
+
+@dataclass
+class Cube:
+    """Several sensor types of several sites on a regular time grid"""
+    sensor_types: list
+    sites: list
+    start: int
+    every: int
+    values: np.ndarray  # float64 (sites x sensor types x slots), NaN where a slot has no data
+
+    def sensor(self, sensor_type):
+        """The (sites x slots) values of one sensor type"""
+        return self.values[:, self.sensor_types.index(sensor_type)]
+
+
+def parse_duration(text):
+    """Convert a Flux-style duration such as ``90s``, ``15m``, ``1h`` or ``7d`` into seconds"""
+    try:
+        return flux.parse_duration(text)
+    except flux.QueryError as e:
+        raise HistoryError(str(e)) from None
+
+
+def parse_time(value):
+    """Convert an ISO 8601 string (naive means UTC) or a numeric epoch in seconds into epoch seconds"""
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise HistoryError(f"invalid timestamp {value!r}") from None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def grid_query(bucket, sensor_type, sites, start, stop, every):
+    """Flux query for the per-slot means of one sensor type, optionally limited to ``sites``"""
+    query = flux.SeriesQuery((sensor_type,), start, stop, sites=sites or (), every=every, group_by=('site_id',))
+    return query.to_flux(bucket)
+
+
+def layout(labels, start, stop, every, row_labels, times, values):
+    """
+    Place parallel ``row_labels``, ``times`` (epoch seconds) and ``values`` on a (labels x slots) array
+
+    Rows follow ``labels`` when given, otherwise the sorted distinct row
+    labels; points of other rows or outside ``[start, stop)`` are dropped.
+    Returns the labels and the array.
+    """
+    row_labels = np.asarray(row_labels, dtype=object)
+    times = np.asarray(times, dtype=np.int64)
+    if labels is None:
+        labels = sorted(set(row_labels.tolist()))
+    rows = {label: row for row, label in enumerate(labels)}
+    slots = -(-(stop - start) // every)
+    grid = np.full((len(labels), slots), np.nan)
+    row = np.fromiter((rows.get(label, -1) for label in row_labels), dtype=np.int64, count=len(row_labels))
+    slot = (times - start) // every
+    keep = (row >= 0) & (slot >= 0) & (slot < slots)
+    grid[row[keep], slot[keep]] = np.asarray(values, dtype=np.float64)[keep]
+    return list(labels), grid
+
+
+def label_indexes(labels, values):
+    """Position of each of ``values`` in ``labels``, -1 for values not in it"""
+    import pandas as pd
+
+    return pd.Index(list(labels), dtype=object).get_indexer(np.asarray(values, dtype=object)).astype(np.int64)
+
+
+def to_cube(sensor_types, sites, start, stop, every, site_ids, sensors, times, values):
+    """
+    Lay out points of several sensor types as a Cube
+
+    Sites follow ``sites`` when given, otherwise the sorted distinct site ids;
+    points of other sites or sensor types, or outside ``[start, stop)``, are
+    dropped.
+    """
+    if sites is None:
+        import pandas as pd
+
+        sites = sorted(pd.unique(np.asarray(site_ids, dtype=object)))
+    sensor_types, sites = list(sensor_types), list(sites)
+    slots = -(-(stop - start) // every)
+    cube = np.full((len(sites), len(sensor_types), slots), np.nan)
+    site = label_indexes(sites, site_ids)
+    sensor = label_indexes(sensor_types, sensors)
+    slot = (np.asarray(times, dtype=np.int64) - start) // every
+    keep = (site >= 0) & (sensor >= 0) & (slot >= 0) & (slot < slots)
+    cube[site[keep], sensor[keep], slot[keep]] = np.asarray(values, dtype=np.float64)[keep]
+    return Cube(sensor_types, sites, start, every, cube)
+
+
+def to_grid(sensor_type, sites, start, stop, every, site_ids, times, values):
+    """Lay out one sensor type's points as a Grid with a row per site (see ``layout``)"""
+    sites, grid = layout(sites, start, stop, every, site_ids, times, values)
+    return Grid(sensor_type, sites, start, every, grid)
+
+
+def get_query_api():
+    """Return the process-wide InfluxDB query API, creating the client on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from influxdb_client import InfluxDBClient
+
+                config = settings.INFLUXDB_CONFIG
+                _client = InfluxDBClient(url=config['url'], token=config['token'], org=config['org'])
+    return _client.query_api()
+
+
+def get_executor():
+    """Shared-layer executor for typed queries on the configured bucket"""
+    config = settings.INFLUXDB_CONFIG
+    return flux.InfluxExecutor(get_query_api(), config['bucket'], config['org'])
+
+
+def query_frame(query):
+    """Run a Flux query; returns one DataFrame for all its tables"""
+    import pandas as pd
+
+    config = settings.INFLUXDB_CONFIG
+    with QUERY_LATENCY.time():
+        frames = get_query_api().query_data_frame(query, org=config['org'])
+    if isinstance(frames, list):
+        frames = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return frames
+
+
+def epoch_seconds(frame):
+    return frame['_time'].astype('int64').to_numpy() // 1_000_000_000
+
+
+def load_grid(sensor_type, sites, start, stop, every):
+    """Per-slot means of ``sensor_type`` for ``sites`` (all sites with data when None) over ``[start, stop)``"""
+    frame = query_frame(grid_query(settings.INFLUXDB_CONFIG['bucket'], sensor_type, sites, start, stop, every))
+    if frame.empty:
+        return to_grid(sensor_type, sites or [], start, stop, every, [], [], [])
+    return to_grid(sensor_type, sites, start, stop, every,
+                   frame['site_id'].to_numpy(), epoch_seconds(frame), frame['_value'].to_numpy())
+
+
+def load_cube(sensor_types, sites, start, stop, every):
+    """Per-slot means of several sensor types for ``sites`` (all sites with data when None), in one query"""
+    query = flux.SeriesQuery(sensor_types, start, stop, sites=sites or (), every=every)
+    frame = query_frame(query.to_flux(settings.INFLUXDB_CONFIG['bucket']))
+    if frame.empty:
+        return to_cube(sensor_types, sites or [], start, stop, every, [], [], [], [])
+    return to_cube(sensor_types, sites, start, stop, every, frame['site_id'].to_numpy(),
+                   frame['sensor_type'].to_numpy(), epoch_seconds(frame), frame['_value'].to_numpy())
@@ -0,0 +1,205 @@
+"""
+Vectorised rolling statistics over many sensor series at once
+
+Every kernel takes a 2-D float array with one row per series (one site's
+sensor) and one column per slot of a regular time grid, NaN where a slot has
+no data. It returns an array of the same shape whose column ``t`` holds the
+statistic of the trailing window ``t - window + 1 .. t``. Windows at the
+start of the grid are partial, and windows with fewer than ``min_periods``
+values are NaN.
+
+All rows are computed together with whole-array numpy operations:
+
+- count, mean and std come from cumulative sums, O(slots) per row whatever
+  the window
+- min and max use the van Herk/Gil-Werman block scan, also O(slots) per row
+- percentiles sort every window, so they cost O(slots * window * log window)
+  per row and are computed in row chunks to bound the temporary memory
+
+``block_stats`` computes the same statistics over consecutive fixed blocks
+(e.g. days of minutes) instead of trailing windows.
+"""
+
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+STATISTICS = ('count', 'mean', 'std', 'min', 'max')
+
+# Largest sorted-window temporary the percentile kernel allocates per chunk, in elements
+PERCENTILE_CHUNK_ELEMENTS = 1 << 23
+
+
+def _as_grid(values, window, min_periods):
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim != 2:
+        raise ValueError("values must be a 2-D (series x time) array")
+    if window < 1:
+        raise ValueError("window must be at least 1 slot")
+    if not 1 <= min_periods <= window:
+        raise ValueError("min_periods must be between 1 and the window")
+    return values
+
+
+def _window_sums(values, window):
+    """Sum over each trailing window along the time axis, from one cumulative sum"""
+    cumsum = np.cumsum(values, axis=1)
+    sums = cumsum.copy()
+    sums[:, window:] -= cumsum[:, :-window]
+    return sums
+
+
+def rolling_count(values, window):
+    """Number of non-NaN values in each trailing window"""
+    values = _as_grid(values, window, 1)
+    return _window_sums((~np.isnan(values)).astype(np.int64), window)
+
+
+def _moments(values, window, counts):
+    """Per-window mean and sample variance, computed around each row's mean for precision"""
+    valid = ~np.isnan(values)
+    row_counts = valid.sum(axis=1, keepdims=True)
+    center = np.nansum(values, axis=1, keepdims=True) / np.maximum(row_counts, 1)
+    deviations = np.where(valid, values - center, 0.0)
+    sums = _window_sums(deviations, window)
+    squares = _window_sums(deviations * deviations, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+        variance = np.maximum(squares - sums * mean, 0.0) / (counts - 1)
+    variance[counts < 2] = np.nan
+    return mean + center, variance
+
+
+def _rolling_extreme(values, window, extreme, fill):
+    """Trailing-window min or max (``extreme`` is np.minimum or np.maximum) with the van Herk/Gil-Werman scan"""
+    series, slots = values.shape
+    length = window - 1 + slots
+    padded = np.full((series, math.ceil(length / window) * window), fill)
+    padded[:, window - 1:length] = np.where(np.isnan(values), fill, values)
+    blocks = padded.reshape(series, -1, window)
+    # The window starting at padded slot i spans the end of i's block and the start of the next one
+    prefix = extreme.accumulate(blocks, axis=2).reshape(series, -1)
+    suffix = extreme.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(series, -1)
+    return extreme(suffix[:, :slots], prefix[:, window - 1:length])
+
+
+def rolling_percentiles(values, window, percentiles, min_periods=1, counts=None):
+    """
+    Trailing-window percentiles, one array per entry of ``percentiles``
+
+    Interpolates linearly between the closest ranks, as ``numpy.percentile``
+    does by default.
+    """
+    values = _as_grid(values, window, min_periods)
+    if counts is None:
+        counts = rolling_count(values, window)
+    series, slots = values.shape
+    fractions = np.asarray(percentiles, dtype=np.float64) / 100
+    if np.any((fractions < 0) | (fractions > 1)):
+        raise ValueError("percentiles must be between 0 and 100")
+
+    padded = np.full((series, window - 1 + slots), np.nan)
+    padded[:, window - 1:] = values
+    results = np.full((len(fractions), series, slots), np.nan)
+    rows = max(1, PERCENTILE_CHUNK_ELEMENTS // max(1, slots * window))
+    for start in range(0, series, rows):
+        stop = min(series, start + rows)
+        # NaN sorts last, so each window's values are its first ``count`` entries
+        ordered = np.sort(sliding_window_view(padded[start:stop], window, axis=1), axis=2)
+        results[:, start:stop] = _ranked(ordered, counts[start:stop], fractions)
+    results[:, counts < min_periods] = np.nan
+    return list(results)
+
+
+def _ranked(ordered, counts, fractions):
+    """
+    Percentiles of sorted windows along the last axis whose first ``counts`` entries are values
+
+    Interpolates linearly between the closest ranks; one result per fraction.
+    """
+    last = np.maximum(counts - 1, 0)
+    results = np.empty((len(fractions),) + ordered.shape[:-1])
+    for index, fraction in enumerate(fractions):
+        rank = fraction * last
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        low = np.take_along_axis(ordered, lower[..., None], axis=-1)[..., 0]
+        high = np.take_along_axis(ordered, upper[..., None], axis=-1)[..., 0]
+        results[index] = low + (high - low) * (rank - lower)
+    return results
+
+
+def rolling_stats(values, window, statistics=STATISTICS, percentiles=(), min_periods=1):
+    """
+    Rolling statistics of every row of ``values`` over a trailing window of ``window`` slots
+
+    Returns a dict from statistic name (``count``, ``mean``, ``std``,
+    ``min``, ``max``, and ``p<q>`` per percentile) to a float array shaped
+    like ``values``. ``std`` is the sample standard deviation.
+    """
+    values = _as_grid(values, window, min_periods)
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f"unknown statistics: {', '.join(sorted(unknown))}")
+    counts = rolling_count(values, window)
+    empty = counts < min_periods
+    results = {}
+    if 'count' in statistics:
+        results['count'] = counts.astype(np.float64)
+    if 'mean' in statistics or 'std' in statistics:
+        mean, variance = _moments(values, window, counts)
+        if 'mean' in statistics:
+            results['mean'] = mean
+        if 'std' in statistics:
+            results['std'] = np.sqrt(variance)
+    if 'min' in statistics:
+        results['min'] = _rolling_extreme(values, window, np.minimum, np.inf)
+    if 'max' in statistics:
+        results['max'] = _rolling_extreme(values, window, np.maximum, -np.inf)
+    for name, result in results.items():
+        if name != 'count':
+            result[empty] = np.nan
+    if percentiles:
+        for q, result in zip(percentiles, rolling_percentiles(values, window, percentiles, min_periods, counts)):
+            results[f'p{q:g}'] = result
+    return results
+
+
+def block_stats(values, block, percentiles=()):
+    """
+    Statistics of consecutive non-overlapping blocks of ``block`` slots, e.g. days of minutes
+
+    Returns a dict like ``rolling_stats`` with one column per block; the slot
+    count must be a multiple of ``block``. Blocks without values are NaN
+    (``count`` 0).
+    """
+    values = _as_grid(values, block, 1)
+    series, slots = values.shape
+    if slots % block:
+        raise ValueError("the slot count must be a multiple of the block")
+    # NaN sorts last, so each block's values are its first ``count`` entries
+    ordered = np.sort(values.reshape(series, slots // block, block), axis=2)
+    valid = ~np.isnan(ordered)
+    counts = valid.sum(axis=2)
+    filled = np.where(valid, ordered, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=2) / counts
+        deviations = np.where(valid, ordered - mean[..., None], 0.0)
+        std = np.sqrt((deviations * deviations).sum(axis=2) / (counts - 1))
+    std[counts < 2] = np.nan
+    empty = counts == 0
+    last = np.maximum(counts - 1, 0)
+    results = {
+        'count': counts.astype(np.float64),
+        'mean': mean,
+        'std': std,
+        'min': np.where(empty, np.nan, ordered[..., 0]),
+        'max': np.where(empty, np.nan, np.take_along_axis(ordered, last[..., None], axis=2)[..., 0]),
+    }
+    if percentiles:
+        fractions = np.asarray(percentiles, dtype=np.float64) / 100
+        for q, result in zip(percentiles, _ranked(ordered, counts, fractions)):
+            result[empty] = np.nan
+            results[f'p{q:g}'] = result
+    return results
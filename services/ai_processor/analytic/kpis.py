@@ -0,0 +1,211 @@
+"""
+Fleet efficiency KPIs per boiler, precomputed per period
+
+For each configured period (e.g. the last 24 hours, 7 days or 30 days)
+``FleetKpiJob`` loads the slot means of the core sensor types of every site
+in one InfluxDB query, as a (sites x sensors x slots) ``Cube``, and reduces
+it along the time axis in one vectorised pass:
+
+- ``mean_efficiency``: mean of the efficiency slots
+- ``weighted_efficiency``: efficiency weighted by ``flow_rate``, so the
+  hours a boiler raises the most steam count the most
+- ``fuel_burn_rate``: fuel level lost per hour, from the falls between
+  consecutive slots; rises (refills) are left out
+- ``optimal_fraction``: share of the slots with all banded sensors reported
+  in which every one of them is inside its optimal band
+
+The sums behind each ratio are kept per site, so an organization's fleet
+figures are the same ratios of the summed sums. Within an organization each
+boiler gets the percentile rank of its weighted efficiency.
+
+One JSON payload per period and organization (and ``ALL_ORGANIZATIONS`` for
+the whole fleet) is stored in Redis, so the dashboard fleet table is one
+GET. Sites are grouped by the site -> organization hash that iot_ingestion
+publishes from its registry.
+"""
+
+import json
+import logging
+import time
+
+import numpy as np
+
+from . import history
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+ALL_ORGANIZATIONS = '*'
+CORE_SENSORS = ('efficiency', 'fuel_level', 'flow_rate', 'temperature', 'pressure')
+KPIS = ('mean_efficiency', 'weighted_efficiency', 'fuel_burn_rate', 'optimal_fraction')
+
+# Period (lookback) -> slot width in seconds
+DEFAULT_PERIODS = {'24h': 900, '7d': 3600, '30d': 21600}
+
+# Optimal operating band per sensor type, inclusive
+DEFAULT_BANDS = {'efficiency': (85.0, 100.0), 'temperature': (80.0, 95.0), 'pressure': (10.0, 15.0)}
+
+
+def kpis_key(prefix, period, organization):
+    return f"{prefix}:fleet_kpis:{period}:{organization}"
+
+
+def site_totals(cube, bands=DEFAULT_BANDS):
+    """
+    Sums behind the KPIs of every site of a Cube, as a dict of arrays with one value per site
+
+    ``cube`` must hold the ``CORE_SENSORS``; see ``ratios`` for the KPIs.
+    """
+    efficiency, flow, fuel = cube.sensor('efficiency'), cube.sensor('flow_rate'), cube.sensor('fuel_level')
+    observed = ~np.isnan(efficiency)
+    weighted = observed & ~np.isnan(flow)
+    change = np.diff(fuel, axis=1)  # NaN unless both slots have a value
+    paired = ~np.isnan(change)
+    banded = np.stack([cube.sensor(sensor_type) for sensor_type in bands])  # bands x sites x slots
+    lows = np.array([low for low, _ in bands.values()])[:, None, None]
+    highs = np.array([high for _, high in bands.values()])[:, None, None]
+    band_observed = ~np.isnan(banded).any(axis=0)
+    in_band = band_observed & ((banded >= lows) & (banded <= highs)).all(axis=0)
+    return {
+        'efficiency_sum': np.where(observed, efficiency, 0.0).sum(axis=1),
+        'efficiency_slots': observed.sum(axis=1),
+        'weighted_sum': np.where(weighted, efficiency * flow, 0.0).sum(axis=1),
+        'flow_sum': np.where(weighted, flow, 0.0).sum(axis=1),
+        'fuel_burned': -np.where(paired, np.minimum(change, 0.0), 0.0).sum(axis=1),
+        'burn_hours': paired.sum(axis=1) * (cube.every / HOUR),
+        'band_slots': in_band.sum(axis=1),
+        'band_observed': band_observed.sum(axis=1),
+        'data_slots': (~np.isnan(cube.values)).any(axis=1).sum(axis=1),
+    }
+
+
+def ratios(totals):
+    """The ``KPIS`` from ``site_totals`` (per site) or from their sums (a fleet); NaN without data"""
+    pairs = {
+        'mean_efficiency': ('efficiency_sum', 'efficiency_slots'),
+        'weighted_efficiency': ('weighted_sum', 'flow_sum'),
+        'fuel_burn_rate': ('fuel_burned', 'burn_hours'),
+        'optimal_fraction': ('band_slots', 'band_observed'),
+    }
+    kpis = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, (numerator, denominator) in pairs.items():
+            kpis[name] = np.where(totals[denominator] > 0, totals[numerator] / totals[denominator], np.nan)
+    return kpis
+
+
+def percentile_rank(values):
+    """Percentage of the non-NaN values at or below each value (100 for the best); NaN stays NaN"""
+    values = np.asarray(values, dtype=np.float64)
+    known = np.sort(values[~np.isnan(values)])
+    if not len(known):
+        return np.full(values.shape, np.nan)
+    ranks = np.searchsorted(known, values, side='right') * (100.0 / len(known))
+    ranks[np.isnan(values)] = np.nan
+    return ranks
+
+
+def number(value, digits=3):
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+def build_payload(organization, period, cube, sites, totals, computed_at, bands=DEFAULT_BANDS):
+    """JSON payload (bytes) of the fleet table of ``sites``; sites missing from ``cube`` have no data"""
+    index = {site: row for row, site in enumerate(cube.sites)}
+    rows = np.array([index.get(site, -1) for site in sites], dtype=np.int64)
+    picked = {name: np.append(values, 0)[rows] for name, values in totals.items()}  # -1 picks the zero
+    kpis = ratios(picked)
+    fleet = ratios({name: values.sum() for name, values in picked.items()})
+    ranks = percentile_rank(kpis['weighted_efficiency'])
+    hours = cube.every / HOUR
+    boilers = []
+    for row, site_id in enumerate(sites):
+        boiler = {'site_id': site_id}
+        boiler.update((name, number(kpis[name][row])) for name in KPIS)
+        boiler['hours_in_band'] = number(picked['band_slots'][row] * hours)
+        boiler['hours_with_data'] = number(picked['data_slots'][row] * hours)
+        boiler['efficiency_percentile'] = number(ranks[row], 1)
+        boilers.append(boiler)
+    # Best first; boilers without a rank at the end
+    boilers.sort(key=lambda boiler: (boiler['efficiency_percentile'] is None, -(boiler['efficiency_percentile'] or 0),
+                                     boiler['site_id']))
+    slots = cube.values.shape[2]
+    payload = {
+        'organization': organization,
+        'period': period,
+        'start': iso_time(cube.start),
+        'end': iso_time(cube.start + slots * cube.every),
+        'every': cube.every,
+        'computed_at': iso_time(computed_at),
+        'bands': {sensor_type: list(band) for sensor_type, band in bands.items()},
+        'fleet': {
+            'boilers': len(sites),
+            'reporting': int((picked['data_slots'] > 0).sum()),
+            **{name: number(fleet[name]) for name in KPIS},
+        },
+        'boilers': boilers,
+    }
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def iso_time(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def fleet_groups(sites, organizations):
+    """Sorted sites per organization, with every site known (with data or registered) under ``ALL_ORGANIZATIONS``"""
+    groups = {ALL_ORGANIZATIONS: sorted(set(sites) | set(organizations))}
+    for site_id, organization in organizations.items():
+        groups.setdefault(organization, []).append(site_id)
+    return {organization: sorted(members) for organization, members in groups.items()}
+
+
+def read_organizations(client, key):
+    """Site -> organization code hash published by iot_ingestion"""
+    return {site.decode(): organization.decode() for site, organization in client.hgetall(key).items()}
+
+
+class FleetKpiJob:
+    """Computes the KPI payloads of every period and organization and stores them in Redis"""
+
+    def __init__(self, client, prefix, organizations_key, periods=DEFAULT_PERIODS, bands=DEFAULT_BANDS,
+                 ttl=3600, load=history.load_cube):
+        self.client = client
+        self.prefix = prefix
+        self.organizations_key = organizations_key
+        self.periods = periods
+        self.bands = bands
+        self.ttl = ttl
+        self.load = load
+
+    def run(self, now=None):
+        """Refresh every period from the history up to ``now`` (epoch seconds); returns a summary dict"""
+        started = time.monotonic()
+        now = int(time.time() if now is None else now)
+        summary = {'periods': 0, 'failed': 0, 'sites': 0, 'organizations': 0, 'payloads': 0}
+        try:
+            organizations = read_organizations(self.client, self.organizations_key)
+        except Exception:
+            logger.exception("Reading site organizations failed")
+            organizations = {}
+        for period, every in self.periods.items():
+            try:
+                stop = now - now % every
+                cube = self.load(list(CORE_SENSORS), None, stop - history.parse_duration(period), stop, every)
+                totals = site_totals(cube, self.bands)
+                groups = fleet_groups(cube.sites, organizations)
+                pipe = self.client.pipeline(transaction=False)
+                for organization, sites in groups.items():
+                    payload = build_payload(organization, period, cube, sites, totals, now, self.bands)
+                    pipe.set(kpis_key(self.prefix, period, organization), payload, ex=self.ttl)
+                pipe.execute()
+            except Exception:
+                summary['failed'] += 1
+                logger.exception("Computing fleet KPIs over %s failed", period)
+                continue
+            summary['periods'] += 1
+            summary['sites'] = max(summary['sites'], len(groups[ALL_ORGANIZATIONS]))
+            summary['organizations'] = max(summary['organizations'], len(groups) - 1)
+            summary['payloads'] += len(groups)
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        return summary
@@ -0,0 +1,87 @@
+"""
+Benchmark Flux pushdown against pulling every reading and aggregating in pandas
+
+Both approaches answer the same typed query from the configured InfluxDB.
+Pushdown sends it as one Flux query that filters, groups and aggregates in
+InfluxDB. The baseline pulls the raw readings the query selects and reduces
+them with a pandas groupby, as analytics without pushdown would. Bytes are
+the CSV response bodies.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+from boiler_common import flux
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.history import get_executor
+
+
+def aggregate_raw(rows, query):
+    """The query's result computed client-side from raw rows, as a Series indexed by (group..., window)"""
+    frame = pd.DataFrame({
+        'time': [row.time for row in rows],
+        'value': [row.value for row in rows],
+        **{tag: [row.group[flux.TAGS.index(tag)] for row in rows] for tag in query.group_by},
+    })
+    if query.every is None:
+        frame['window'] = query.start * 1_000_000_000
+    else:
+        frame['window'] = frame['time'] - frame['time'] % (query.every * 1_000_000_000)
+    return frame.groupby([*query.group_by, 'window'])['value'].agg(query.aggregate)
+
+
+class Command(BaseCommand):
+    help = 'Time and size a pushed-down Flux aggregate against pulling the raw readings into pandas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensor', nargs='+', default=['temperature'], help='Sensor types')
+        parser.add_argument('--sites', nargs='+', default=(), help='Site ids (default: every site)')
+        parser.add_argument('--range', default='24h', help='Lookback from now')
+        parser.add_argument('--every', default='1h', help="Window width, or 'none' for one value per group")
+        parser.add_argument('--aggregate', default='mean', choices=flux.AGGREGATES)
+        parser.add_argument('--fleet', action='store_true', help='Group by sensor type only (fleet-wide series)')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each approach')
+
+    def handle(self, *args, **options):
+        try:
+            every = None if options['every'] == 'none' else flux.parse_duration(options['every'])
+            stop = int(time.time())
+            query = flux.SeriesQuery(
+                options['sensor'], stop - flux.parse_duration(options['range']), stop, sites=options['sites'],
+                every=every, aggregate=options['aggregate'],
+                group_by=('sensor_type',) if options['fleet'] else flux.TAGS,
+            )
+        except flux.QueryError as e:
+            raise CommandError(str(e))
+        executor = get_executor()
+
+        def pushdown():
+            rows = executor.run(query)
+            return pd.Series([row.value for row in rows],
+                             index=pd.MultiIndex.from_tuples([(*row.group, row.time) for row in rows]))
+
+        def pull_everything():
+            return aggregate_raw(executor.run_raw(query), query)
+
+        results = {}
+        for label, approach in (('pushdown', pushdown), ('pull + pandas', pull_everything)):
+            passes = []
+            for _ in range(options['repeat']):
+                before = executor.bytes_received
+                started = time.perf_counter()
+                result = approach()
+                passes.append((time.perf_counter() - started, executor.bytes_received - before))
+            results[label] = (min(passes)[0], passes[-1][1], result)
+
+        pushed, pulled = results['pushdown'][2], results['pull + pandas'][2]
+        if len(pushed) != len(pulled) or not np.allclose(pushed.sort_index().to_numpy(), pulled.sort_index().to_numpy()):
+            self.stderr.write('pushdown and pull + pandas results differ')
+        self.stdout.write(f"{len(pushed)} result rows")
+        for label, (elapsed, size, _) in results.items():
+            self.stdout.write(f'{label:<16}{elapsed * 1000:>10.1f} ms{size / 1024:>12.1f} KiB')
+        pushdown_time, pushdown_bytes, _ = results['pushdown']
+        pull_time, pull_bytes, _ = results['pull + pandas']
+        self.stdout.write(f'pushdown moves {pull_bytes / max(pushdown_bytes, 1):.0f}x fewer bytes '
+                          f'and is {pull_time / pushdown_time:.1f}x faster')
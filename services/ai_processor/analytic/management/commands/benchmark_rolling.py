@@ -0,0 +1,63 @@
+"""
+Benchmark the vectorised rolling kernels against per-site pandas rolling
+
+Both compute the same statistics over a synthetic (sites x slots) grid with
+10% of the slots missing. The pandas baseline rolls one site's series at a
+time, as a per-site loop over history would.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from analytic.kernels import rolling_stats
+
+STATISTICS = ('mean', 'std', 'min', 'max')
+
+
+class Command(BaseCommand):
+    help = 'Time fleet-wide rolling statistics: numpy kernels versus a per-site pandas loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sites', type=int, default=1000, help='Rows of the grid')
+        parser.add_argument('--slots', type=int, default=1440, help='Time slots per site (1440 = a day of minutes)')
+        parser.add_argument('--window', type=int, default=60, help='Window length in slots')
+        parser.add_argument('--percentiles', type=float, nargs='*', default=[50, 95], help='Percentiles to add')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed kernel passes')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(42)
+        values = rng.normal(80, 5, (options['sites'], options['slots']))
+        values[rng.random(values.shape) < 0.1] = np.nan
+        window, percentiles = options['window'], options['percentiles']
+
+        timings = {}
+        for label, extra in (('mean/std/min/max', ()), ('+ percentiles', percentiles)):
+            passes = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                results = rolling_stats(values, window, STATISTICS, extra)
+                passes.append(time.perf_counter() - started)
+            timings[label] = min(passes)
+
+        started = time.perf_counter()
+        for row in values:
+            rolling = pd.Series(row).rolling(window, min_periods=1)
+            expected = {'mean': rolling.mean(), 'std': rolling.std(), 'min': rolling.min(), 'max': rolling.max()}
+            for q in percentiles:
+                expected[f'p{q:g}'] = rolling.quantile(q / 100)
+        baseline = time.perf_counter() - started
+        for name, series in expected.items():
+            if not np.allclose(results[name][-1], series.to_numpy(), equal_nan=True):
+                self.stderr.write(f'{name} differs from pandas')
+
+        cells = values.size
+        self.stdout.write(f"{options['sites']} sites x {options['slots']} slots, window {window}")
+        for label, elapsed in timings.items():
+            self.stdout.write(f'{label:<20}{elapsed * 1000:>10.1f} ms{cells / elapsed / 1e6:>10.1f} M cells/s')
+        self.stdout.write(
+            f"{'pandas per site':<20}{baseline * 1000:>10.1f} ms{cells / baseline / 1e6:>10.1f} M cells/s"
+            f"  ({baseline / timings['+ percentiles']:.1f}x slower)"
+        )
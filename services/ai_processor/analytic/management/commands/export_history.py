@@ -0,0 +1,47 @@
+"""
+Export raw sensor history from InfluxDB to the Parquet archive, one file per site per day
+"""
+
+import json
+from datetime import date, datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.archive import HistoryExporter, day_seconds
+from analytic.fleet import list_sites
+from analytic.history import get_executor
+
+
+class Command(BaseCommand):
+    help = 'Stream readings by site and UTC day into partitioned Parquet files with bounded memory'
+
+    def add_arguments(self, parser):
+        config = settings.ANALYTICS_ARCHIVE
+        parser.add_argument('--sites', nargs='+', help='Only these sites (default: every site with data)')
+        parser.add_argument('--start', type=date.fromisoformat, help='First UTC day, YYYY-MM-DD (default: --end - 1 day)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Day after the last one exported (default: today)')
+        parser.add_argument('--output', default=config['root'], help='Archive root directory')
+        parser.add_argument('--chunk-rows', type=int, default=config['chunk_rows'],
+                            help='Readings held in memory at a time, and per Parquet row group')
+        parser.add_argument('--overwrite', action='store_true', help='Export days that already have a file again')
+
+    def handle(self, *args, **options):
+        end = options['end'] or datetime.now(timezone.utc).date()
+        start = options['start'] or end - timedelta(days=1)
+        if start >= end:
+            raise CommandError('--start must be before --end')
+        if options['chunk_rows'] < 1:
+            raise CommandError('--chunk-rows must be at least 1')
+        sites = options['sites'] or list_sites(day_seconds(start), day_seconds(end))
+        exporter = HistoryExporter(get_executor(), options['output'], chunk_rows=options['chunk_rows'],
+                                   overwrite=options['overwrite'], report=self.report)
+        self.stdout.write(f"{len(sites)} sites, {(end - start).days} days to {options['output']}")
+        summary = exporter.run(sites, start, end)
+        self.stdout.write(json.dumps(summary))
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} site days failed; rerun to retry them")
+
+    def report(self, line):
+        self.stdout.write(line)
+        self.stdout.flush()
@@ -0,0 +1,68 @@
+"""
+Detect gaps and measure completeness of every sensor's readings over whole UTC days
+"""
+
+import functools
+import json
+from datetime import date, datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.archive import day_seconds
+from analytic.fleet import DAY, list_sites
+from analytic.quality import QualityJob
+
+
+class Command(BaseCommand):
+    help = 'Store a gap and completeness report per site, sensor and UTC day'
+
+    def add_arguments(self, parser):
+        config = settings.ANALYTICS_QUALITY
+        parser.add_argument('--sites', nargs='+', help='Only these sites (default: every site with recent data)')
+        parser.add_argument('--start', type=date.fromisoformat, help='First UTC day, YYYY-MM-DD (default: --end - 1 day)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Day after the last one checked (default: today)')
+        parser.add_argument('--chunk-sites', type=int, default=config['chunk_sites'],
+                            help='Sites read and checked at a time')
+        parser.add_argument('--archive', metavar='DIR',
+                            help='Read readings from this Parquet archive (export_history) instead of InfluxDB')
+
+    def handle(self, *args, **options):
+        config = settings.ANALYTICS_QUALITY
+        end = options['end'] or datetime.now(timezone.utc).date()
+        start = options['start'] or end - timedelta(days=1)
+        if start >= end:
+            raise CommandError('--start must be before --end')
+        if options['chunk_sites'] < 1:
+            raise CommandError('--chunk-sites must be at least 1')
+        job_options = {}
+        if options['archive']:
+            from analytic.archive import archived_sites, load_archive_readings
+
+            job_options['load'] = functools.partial(load_archive_readings, options['archive'])
+        if options['sites']:
+            sites = options['sites']
+        elif options['archive']:
+            sites = archived_sites(options['archive'])
+        else:
+            # Sites that went silent during the checked days still have readings shortly before them
+            sites = list_sites(day_seconds(start) - config['lookback_days'] * DAY, day_seconds(end))
+        job = QualityJob(
+            sensor_types=config['sensor_types'],
+            cadence_seconds=config['cadence_seconds'],
+            default_cadence=config['default_cadence_seconds'],
+            tolerance=config['tolerance'],
+            max_gaps=config['max_gaps'],
+            chunk_sites=options['chunk_sites'],
+            report=self.report,
+            **job_options,
+        )
+        self.stdout.write(f"{len(sites)} sites, {(end - start).days} days")
+        summary = job.run(sites, start, end)
+        self.stdout.write(json.dumps(summary))
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} site days failed; rerun to retry them")
+
+    def report(self, line):
+        self.stdout.write(line)
+        self.stdout.flush()
@@ -0,0 +1,52 @@
+"""
+Run the streaming anomaly detectors on the iot_ingestion readings stream
+"""
+
+import json
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analytic.cache import get_redis
+from analytic.consumer import DetectorRunner, anomaly_keys, multivariate_key
+
+
+class Command(BaseCommand):
+    help = ('Score live readings with the EWMA, rolling z-score, CUSUM and multivariate detectors '
+            'and publish anomaly events')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stats-interval', type=float, default=60, help='Seconds between stats lines (0 disables)')
+        parser.add_argument('--reset', action='store_true', help='Ignore the saved checkpoint and start from new readings')
+
+    def handle(self, *args, **options):
+        config = settings.ANALYTICS_DETECTORS
+        client = get_redis()
+        events_key, checkpoint_key = anomaly_keys()
+        if options['reset']:
+            client.delete(checkpoint_key, multivariate_key(checkpoint_key))
+        runner = DetectorRunner.restore(
+            client, checkpoint_key, config['detectors'],
+            multivariate_config=config['multivariate'] if config['multivariate_enabled'] else None,
+            stream_key=config['stream_key'],
+            events_key=events_key,
+            events_maxlen=config['events_maxlen'],
+            checkpoint_interval=config['checkpoint_interval_seconds'],
+        )
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        if options['stats_interval']:
+            threading.Thread(target=self.report, args=(runner, stop, options['stats_interval']), daemon=True).start()
+
+        self.stdout.write(f"Following {config['stream_key']} from entry {runner.last_id}, events to {events_key}")
+        runner.run(stop)
+        self.stdout.write(json.dumps(runner.stats()))
+
+    def report(self, runner, stop, interval):
+        while not stop.wait(interval):
+            self.stdout.write(json.dumps(runner.stats()))
+            self.stdout.flush()
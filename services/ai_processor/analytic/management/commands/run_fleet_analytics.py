@@ -0,0 +1,66 @@
+"""
+Compute daily sensor statistics for the whole fleet on a process pool
+"""
+
+import functools
+import json
+import time
+from datetime import date, datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.fleet import DAY, FleetJob, list_sites
+
+
+class Command(BaseCommand):
+    help = 'Compute daily statistics of every sensor of every site, resuming from per-site watermarks'
+
+    def add_arguments(self, parser):
+        config = settings.ANALYTICS_FLEET
+        parser.add_argument('--workers', type=int, default=config['workers'], help='Worker processes')
+        parser.add_argument('--sites', nargs='+', help='Only these sites (default: every site with data)')
+        parser.add_argument('--until', type=date.fromisoformat,
+                            help='Process days before this UTC date, YYYY-MM-DD (default: today)')
+        parser.add_argument('--lookback-days', type=int, default=config['lookback_days'],
+                            help='Days processed for a site without a watermark')
+        parser.add_argument('--chunk-days', type=int, default=config['chunk_days'],
+                            help='Days of a site read from InfluxDB per query')
+        parser.add_argument('--full', action='store_true', help='Ignore watermarks and recompute the lookback period')
+        parser.add_argument('--archive', metavar='DIR',
+                            help='Read history from this Parquet archive (export_history) instead of InfluxDB')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_days'] < 1:
+            raise CommandError('--workers and --chunk-days must be at least 1')
+        until = options['until'] or datetime.now(timezone.utc).date()
+        until = int(datetime(until.year, until.month, until.day, tzinfo=timezone.utc).timestamp())
+        job_options = {}
+        if options['archive']:
+            from analytic.archive import archived_sites, load_archive_chunk
+
+            job_options['load'] = functools.partial(load_archive_chunk, options['archive'])
+        job = FleetJob(
+            workers=options['workers'],
+            chunk_days=options['chunk_days'],
+            lookback_days=options['lookback_days'],
+            report=self.report,
+            **job_options,
+        )
+        if options['sites']:
+            sites = options['sites']
+        elif options['archive']:
+            sites = archived_sites(options['archive'])
+        else:
+            sites = list_sites(until - options['lookback_days'] * DAY, until)
+        self.stdout.write(f"{len(sites)} sites, {options['workers']} workers")
+        started = time.monotonic()
+        summary = job.run(sites, until, full=options['full'])
+        summary.setdefault('seconds', round(time.monotonic() - started, 2))
+        self.stdout.write(json.dumps(summary))
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} sites failed; rerun to retry them")
+
+    def report(self, line):
+        self.stdout.write(line)
+        self.stdout.flush()
@@ -0,0 +1,49 @@
+"""
+Refresh the fleet KPI tables of every organization and period, once or on a schedule
+"""
+
+import json
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.cache import get_redis, key_prefix
+from analytic.kpis import FleetKpiJob
+
+
+class Command(BaseCommand):
+    help = 'Compute efficiency, fuel burn and optimal-band KPIs of every boiler and store one table per organization'
+
+    def add_arguments(self, parser):
+        config = settings.ANALYTICS_KPIS
+        parser.add_argument('--once', action='store_true', help='Run one refresh and exit')
+        parser.add_argument('--interval', type=float, default=config['interval_seconds'],
+                            help='Seconds between refreshes')
+
+    def handle(self, *args, **options):
+        config = settings.ANALYTICS_KPIS
+        job = FleetKpiJob(
+            get_redis(),
+            key_prefix(),
+            config['organizations_key'],
+            periods=config['periods'],
+            bands=config['bands'],
+            ttl=config['ttl_seconds'],
+        )
+        if options['once']:
+            summary = job.run()
+            self.stdout.write(json.dumps(summary))
+            if summary['failed']:
+                raise CommandError(f"{summary['failed']} periods failed")
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        self.stdout.write(f"Refreshing {len(config['periods'])} periods every {options['interval']:g}s")
+        while not stop.is_set():
+            self.stdout.write(json.dumps(job.run()))
+            self.stdout.flush()
+            stop.wait(options['interval'])
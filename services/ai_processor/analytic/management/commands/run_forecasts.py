@@ -0,0 +1,50 @@
+"""
+Refit the fuel and efficiency forecasts of the whole fleet, once or on a schedule
+"""
+
+import json
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytic.forecast import ForecastJob
+
+
+class Command(BaseCommand):
+    help = 'Fit linear and Holt trends to every site and store when fuel runs out and efficiency needs maintenance'
+
+    def add_arguments(self, parser):
+        config = settings.ANALYTICS_FORECASTS
+        parser.add_argument('--sites', nargs='+', help='Only these sites (default: every site with data)')
+        parser.add_argument('--once', action='store_true', help='Run one refit and exit')
+        parser.add_argument('--interval', type=float, default=config['interval_seconds'],
+                            help='Seconds between refits')
+
+    def handle(self, *args, **options):
+        config = settings.ANALYTICS_FORECASTS
+        job = ForecastJob(
+            targets=config['targets'],
+            lookback=config['lookback_hours'] * 3600,
+            every=config['every_seconds'],
+            alpha=config['alpha'],
+            beta=config['beta'],
+            horizon_days=config['horizon_days'],
+            min_points=config['min_points'],
+        )
+        if options['once']:
+            summary = job.run(sites=options['sites'])
+            self.stdout.write(json.dumps(summary))
+            if summary['failed']:
+                raise CommandError(f"{summary['failed']} targets failed")
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        self.stdout.write(f"Refitting {len(config['targets'])} targets every {options['interval']:g}s")
+        while not stop.is_set():
+            self.stdout.write(json.dumps(job.run(sites=options['sites'])))
+            self.stdout.flush()
+            stop.wait(options['interval'])
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=50)),
+                ('site_id', models.CharField(max_length=50)),
+                ('processed_until', models.DateTimeField(help_text='History before this instant is done')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['job', 'site_id'],
+                'constraints': [models.UniqueConstraint(fields=('job', 'site_id'), name='unique_job_site_watermark')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SensorDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site_id', models.CharField(max_length=50)),
+                ('sensor_type', models.CharField(max_length=50)),
+                ('day', models.DateField(help_text='UTC day')),
+                ('samples', models.PositiveIntegerField(help_text='Minutes of the day with data')),
+                ('mean', models.FloatField()),
+                ('std', models.FloatField(null=True)),
+                ('min_value', models.FloatField()),
+                ('max_value', models.FloatField()),
+                ('p05', models.FloatField()),
+                ('p50', models.FloatField()),
+                ('p95', models.FloatField()),
+                ('peak_hour_mean', models.FloatField(help_text='Highest rolling one-hour mean of the day', null=True)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['site_id', 'sensor_type', 'day'],
+                'constraints': [models.UniqueConstraint(fields=('site_id', 'sensor_type', 'day'), name='unique_daily_stats')],
+            },
+        ),
+    ]
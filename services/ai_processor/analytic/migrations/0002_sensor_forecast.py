@@ -0,0 +1,36 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytic', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site_id', models.CharField(max_length=50)),
+                ('sensor_type', models.CharField(max_length=50)),
+                ('threshold', models.FloatField()),
+                ('samples', models.PositiveIntegerField(help_text='Slots of the current cycle with data')),
+                ('latest', models.FloatField(help_text='Newest slot mean')),
+                ('observed_at', models.DateTimeField(help_text='Start of the newest slot with data')),
+                ('linear_level', models.FloatField()),
+                ('linear_rate', models.FloatField()),
+                ('linear_crossing', models.DateTimeField(help_text='When the least-squares trend reaches the threshold', null=True)),
+                ('holt_level', models.FloatField()),
+                ('holt_rate', models.FloatField()),
+                ('holt_crossing', models.DateTimeField(help_text="When Holt's smoothed trend reaches the threshold", null=True)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['site_id', 'sensor_type'],
+                'constraints': [models.UniqueConstraint(fields=('site_id', 'sensor_type'), name='unique_sensor_forecast')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytic', '0002_sensor_forecast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorGapReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site_id', models.CharField(max_length=50)),
+                ('sensor_type', models.CharField(max_length=50)),
+                ('day', models.DateField(help_text='UTC day')),
+                ('readings', models.PositiveIntegerField()),
+                ('cadence_seconds', models.FloatField(help_text='Expected interval between readings')),
+                ('cadence_inferred', models.BooleanField(help_text="Median interval of the day's readings, none being configured")),
+                ('expected_slots', models.PositiveIntegerField(help_text='Cadence slots in the day')),
+                ('completeness', models.FloatField(help_text='Share of the cadence slots with a reading')),
+                ('gap_count', models.PositiveIntegerField()),
+                ('gap_seconds', models.FloatField(help_text='Time spent in gaps')),
+                ('longest_gap_seconds', models.FloatField()),
+                ('gaps', models.JSONField(default=list, help_text='Longest gaps as [start, end] UTC times, in time order')),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['site_id', 'sensor_type', 'day'],
+                'constraints': [models.UniqueConstraint(fields=('site_id', 'sensor_type', 'day'), name='unique_gap_report')],
+            },
+        ),
+    ]
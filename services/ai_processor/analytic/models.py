@@ -2,3 +2,110 @@ from django.db import models
 
 # AI Processor Models - Cleaned for Re-implementation  
 # This service will handle analytics and ML processing
+
+
+class SensorDailyStats(models.Model):
+    """
+    Daily statistics of one sensor, computed by the fleet analytics job (run_fleet_analytics)
+    Values are over the day's one-minute means; rows are replaced when a day is recomputed
+    """
+    site_id = models.CharField(max_length=50)
+    sensor_type = models.CharField(max_length=50)
+    day = models.DateField(help_text="UTC day")
+    samples = models.PositiveIntegerField(help_text="Minutes of the day with data")
+    mean = models.FloatField()
+    std = models.FloatField(null=True)
+    min_value = models.FloatField()
+    max_value = models.FloatField()
+    p05 = models.FloatField()
+    p50 = models.FloatField()
+    p95 = models.FloatField()
+    peak_hour_mean = models.FloatField(null=True, help_text="Highest rolling one-hour mean of the day")
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['site_id', 'sensor_type', 'day']
+        constraints = [
+            models.UniqueConstraint(fields=['site_id', 'sensor_type', 'day'], name='unique_daily_stats'),
+        ]
+
+    def __str__(self):
+        return f"{self.site_id} {self.sensor_type} {self.day}"
+
+
+class AnalyticsWatermark(models.Model):
+    """
+    How far a batch analytics job has processed each site's history
+    Written in the same transaction as the site's results, so a restarted job resumes where it stopped
+    """
+    job = models.CharField(max_length=50)
+    site_id = models.CharField(max_length=50)
+    processed_until = models.DateTimeField(help_text="History before this instant is done")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['job', 'site_id']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'site_id'], name='unique_job_site_watermark'),
+        ]
+
+    def __str__(self):
+        return f"{self.job} {self.site_id} {self.processed_until:%Y-%m-%d %H:%M}"
+
+
+class SensorForecast(models.Model):
+    """
+    Latest trend forecast of one site's sensor towards a threshold, written by run_forecasts
+    Rates are per hour; a crossing is null when the sensor is not heading to the threshold within the horizon
+    """
+    site_id = models.CharField(max_length=50)
+    sensor_type = models.CharField(max_length=50)
+    threshold = models.FloatField()
+    samples = models.PositiveIntegerField(help_text="Slots of the current cycle with data")
+    latest = models.FloatField(help_text="Newest slot mean")
+    observed_at = models.DateTimeField(help_text="Start of the newest slot with data")
+    linear_level = models.FloatField()
+    linear_rate = models.FloatField()
+    linear_crossing = models.DateTimeField(null=True, help_text="When the least-squares trend reaches the threshold")
+    holt_level = models.FloatField()
+    holt_rate = models.FloatField()
+    holt_crossing = models.DateTimeField(null=True, help_text="When Holt's smoothed trend reaches the threshold")
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['site_id', 'sensor_type']
+        constraints = [
+            models.UniqueConstraint(fields=['site_id', 'sensor_type'], name='unique_sensor_forecast'),
+        ]
+
+    def __str__(self):
+        return f"{self.site_id} {self.sensor_type} forecast"
+
+
+class SensorGapReport(models.Model):
+    """
+    Data quality of one sensor over a UTC day, computed by the data-quality job (run_data_quality)
+    A gap is a stretch without readings longer than the tolerance times the sensor's cadence
+    """
+    site_id = models.CharField(max_length=50)
+    sensor_type = models.CharField(max_length=50)
+    day = models.DateField(help_text="UTC day")
+    readings = models.PositiveIntegerField()
+    cadence_seconds = models.FloatField(help_text="Expected interval between readings")
+    cadence_inferred = models.BooleanField(help_text="Median interval of the day's readings, none being configured")
+    expected_slots = models.PositiveIntegerField(help_text="Cadence slots in the day")
+    completeness = models.FloatField(help_text="Share of the cadence slots with a reading")
+    gap_count = models.PositiveIntegerField()
+    gap_seconds = models.FloatField(help_text="Time spent in gaps")
+    longest_gap_seconds = models.FloatField()
+    gaps = models.JSONField(default=list, help_text="Longest gaps as [start, end] UTC times, in time order")
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['site_id', 'sensor_type', 'day']
+        constraints = [
+            models.UniqueConstraint(fields=['site_id', 'sensor_type', 'day'], name='unique_gap_report'),
+        ]
+
+    def __str__(self):
+        return f"{self.site_id} {self.sensor_type} {self.day} gaps"
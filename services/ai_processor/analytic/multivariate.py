@@ -0,0 +1,306 @@
+"""
+Multivariate anomaly scoring per site: Mahalanobis distance of the sensor vector
+
+The single-sensor detectors judge each sensor on its own, so a pressure spike
+with a flat temperature scores the same as both rising together. Here a
+site's readings of ``sensor_types`` (k of them) are scored together against
+the site's mean vector and covariance matrix, which capture how its sensors
+move with each other::
+
+    d^2 = (x - mean)^T  cov^-1  (x - mean)
+
+A vector is what a site sends with one timestamp; a sensor missing from it
+keeps its previous value. Each vector is scored against the state before it,
+then folded in, and a site is scored once it has ``warmup`` vectors.
+
+Per site the state is the vector count, the mean vector, the co-moment
+matrix ``M2`` (Welford's running sum of products of deviations, so the
+covariance is ``M2 / (n - 1)``) and the inverse of M2. A vector updates the
+mean and M2 with Welford's rank-one step and the inverse with the
+Sherman-Morrison formula, so scoring and updating cost O(k^2). The inverse
+is recomputed exactly every ``refresh`` vectors and at the end of the
+warmup, so rounding error cannot build up. M2 starts at ``ridge`` times the
+identity, which keeps it invertible from the first vector and bounds the
+distance of a sensor that has been flat so far.
+
+A batch of readings updates the vectors of all its sites with a few
+vectorised steps, in rounds when a site has several timestamps in it. An
+event names the sensor contributing most to the distance.
+
+``window_scores`` is the batch mode: it scores every slot of historical
+(sites x slots x k) windows at once, each slot against the statistics of
+the slots before it, as the streaming table would have.
+"""
+
+import io
+from typing import NamedTuple
+
+import numpy as np
+
+from .detectors import AnomalyEvent, occurrence_rounds
+
+DETECTOR = 'mahalanobis'
+
+DEFAULTS = {
+    'sensor_types': ('temperature', 'pressure', 'flow_rate', 'efficiency'),
+    'warmup': 100,  # vectors of a site before it may raise events
+    'threshold': 5.0,  # Mahalanobis distance that raises an event
+    'ridge': 1e-3,  # added to the diagonal of M2
+    'refresh': 100,  # vectors between exact inversions of M2
+}
+
+
+def rank_one_update(counts, means, m2, precision, vectors):
+    """
+    Score ``vectors`` (n x k) against their rows' state, then fold them in; returns ``(distance, contributions)``
+
+    ``counts``, ``means``, ``m2`` and ``precision`` (the inverse of m2) are
+    the rows' state and are updated in place. ``contributions`` (n x k) add
+    up to the squared distance; the distance is NaN for rows with fewer than
+    two vectors before this one.
+    """
+    delta = vectors - means
+    solved = np.einsum('nij,nj->ni', precision, delta)
+    q = np.einsum('ni,ni->n', delta, solved)
+    scale = (counts - 1)[:, None]
+    contributions = scale * delta * solved
+    with np.errstate(invalid='ignore'):
+        distance = np.where(counts >= 2, np.sqrt(np.maximum(scale[:, 0] * q, 0.0)), np.nan)
+
+    weight = counts / (counts + 1)
+    means += delta / (counts + 1)[:, None]
+    m2 += weight[:, None, None] * delta[:, :, None] * delta[:, None, :]
+    precision -= (weight / (1 + weight * q))[:, None, None] * solved[:, :, None] * solved[:, None, :]
+    counts += 1
+    return distance, contributions
+
+
+class MultivariateTable:
+    """Array-backed Mahalanobis state for every site seen"""
+
+    def __init__(self, capacity=1024, **config):
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown multivariate settings: {', '.join(sorted(unknown))}")
+        self.config = {**DEFAULTS, **config}
+        self.sensor_types = list(self.config['sensor_types'])
+        self._columns = {sensor_type: column for column, sensor_type in enumerate(self.sensor_types)}
+        k = len(self.sensor_types)
+        self.sites = []
+        self._rows = {}
+        self.counts = np.zeros(capacity)
+        self.means = np.zeros((capacity, k))
+        self.m2 = np.zeros((capacity, k, k))
+        self.precision = np.zeros((capacity, k, k))
+        self.current = np.full((capacity, k), np.nan)  # newest value of each sensor
+        self.latched = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self.sites)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.counts, self.means, self.m2, self.precision, self.current,
+                                              self.latched))
+
+    def rows_for(self, site_ids):
+        """Row of each site, adding rows (with an empty state) for sites not seen before"""
+        rows = self._rows
+        result = np.empty(len(site_ids), dtype=np.int64)
+        first_new = len(self.sites)
+        for index, site_id in enumerate(site_ids):
+            row = rows.get(site_id)
+            if row is None:
+                row = rows[site_id] = len(self.sites)
+                self.sites.append(site_id)
+            result[index] = row
+        if len(self.sites) > len(self.counts):
+            self._grow(len(self.sites))
+        if len(self.sites) > first_new:
+            ridge = self.config['ridge']
+            identity = np.eye(len(self.sensor_types))
+            self.m2[first_new:len(self.sites)] = ridge * identity
+            self.precision[first_new:len(self.sites)] = identity / ridge
+        return result
+
+    def _grow(self, needed):
+        capacity = max(needed, 2 * len(self.counts))
+        for name in ('counts', 'means', 'm2', 'precision', 'current', 'latched'):
+            array = getattr(self, name)
+            grown = np.full((capacity, *array.shape[1:]), np.nan if name == 'current' else 0, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def update(self, site_ids, sensor_types, timestamps, values):
+        """Fold a batch of readings into the state; returns the AnomalyEvents it raised, in time order"""
+        columns = np.fromiter((self._columns.get(sensor_type, -1) for sensor_type in sensor_types),
+                              dtype=np.int64, count=len(sensor_types))
+        keep = columns >= 0
+        if not keep.any():
+            return []
+        site_ids = np.asarray(site_ids, dtype=object)[keep]
+        columns = columns[keep]
+        timestamps = np.asarray(timestamps, dtype=np.int64)[keep]
+        values = np.asarray(values, dtype=np.float64)[keep]
+        rows = self.rows_for(site_ids)
+
+        # One vector per site and timestamp, in time order within a site
+        order = np.lexsort((timestamps, rows))
+        rows, columns, timestamps, values = rows[order], columns[order], timestamps[order], values[order]
+        starts = np.r_[True, (rows[1:] != rows[:-1]) | (timestamps[1:] != timestamps[:-1])]
+        group = np.cumsum(starts) - 1
+        vectors = np.full((group[-1] + 1, len(self.sensor_types)), np.nan)
+        vectors[group, columns] = values
+        rows, timestamps = rows[starts], timestamps[starts]
+
+        events = []
+        for positions in occurrence_rounds(rows):
+            events.extend(self._update_round(rows[positions], timestamps[positions], vectors[positions]))
+        events.sort(key=lambda event: event.timestamp)
+        return events
+
+    def _update_round(self, rows, timestamps, vectors):
+        """Update rows that are all distinct"""
+        config = self.config
+        current = np.where(np.isnan(vectors), self.current[rows], vectors)
+        self.current[rows] = current
+        complete = ~np.isnan(current).any(axis=1)
+        rows, timestamps, current = rows[complete], timestamps[complete], current[complete]
+        if not len(rows):
+            return []
+
+        counts, means, m2, precision = self.counts[rows], self.means[rows], self.m2[rows], self.precision[rows]
+        ready = counts >= config['warmup']
+        distance, contributions = rank_one_update(counts, means, m2, precision, current)
+        due = (counts % config['refresh'] == 0) | (counts == config['warmup'])
+        if due.any():
+            precision[due] = np.linalg.inv(m2[due])
+        self.counts[rows], self.means[rows], self.m2[rows], self.precision[rows] = counts, means, m2, precision
+
+        # Threshold crossings, latched per site until the distance drops back
+        above = ready & (distance > config['threshold'])
+        fired = above & ~self.latched[rows]
+        self.latched[rows] = above
+        events = []
+        for index in np.flatnonzero(fired):
+            column = int(np.argmax(contributions[index]))
+            events.append(AnomalyEvent(
+                self.sites[rows[index]], self.sensor_types[column], int(timestamps[index]),
+                float(current[index, column]), DETECTOR, float(distance[index]), config['threshold'],
+            ))
+        return events
+
+    def snapshot(self, site_id):
+        """Current state of one site as a dict (mean, std and correlation per sensor), or None if not seen"""
+        row = self._rows.get(site_id)
+        if row is None:
+            return None
+        count = int(self.counts[row])
+        result = {'count': count, 'sensor_types': self.sensor_types, 'mean': None, 'std': None, 'correlation': None}
+        if count >= 1:
+            result['mean'] = self.means[row].tolist()
+        if count >= 2:
+            covariance = self.m2[row] / (count - 1)
+            std = np.sqrt(np.diag(covariance))
+            result['std'] = std.tolist()
+            result['correlation'] = (covariance / np.outer(std, std)).tolist()
+        return result
+
+    def dumps(self, **extra):
+        """Serialise the table, plus string ``extra`` values, as an ``.npz`` blob"""
+        size = len(self.sites)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            sites=np.array(self.sites, dtype=str),
+            counts=self.counts[:size],
+            means=self.means[:size],
+            m2=self.m2[:size],
+            precision=self.precision[:size],
+            current=self.current[:size],
+            latched=self.latched[:size],
+            config=np.array(sorted((name, str(value)) for name, value in self.config.items()), dtype=str),
+            **{name: np.array(value, dtype=str) for name, value in extra.items()},
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data, **config):
+        """
+        Rebuild a table from ``dumps`` output; returns ``(table, extra)``
+
+        Raises ValueError when the blob was written with different settings.
+        """
+        arrays = ('counts', 'means', 'm2', 'precision', 'current', 'latched')
+        with np.load(io.BytesIO(data), allow_pickle=False) as blob:
+            table = cls(capacity=max(1, len(blob['sites'])), **config)
+            saved = dict(blob['config'].tolist())
+            current = {name: str(value) for name, value in table.config.items()}
+            if saved != current:
+                raise ValueError("checkpoint was written with different multivariate settings")
+            table.sites = blob['sites'].tolist()
+            table._rows = {site_id: row for row, site_id in enumerate(table.sites)}
+            for name in arrays:
+                getattr(table, name)[:len(table.sites)] = blob[name]
+            extra = {name: str(blob[name]) for name in blob.files if name not in ('sites', 'config', *arrays)}
+        return table, extra
+
+
+class WindowScores(NamedTuple):
+    distance: np.ndarray  # (sites x slots), NaN for slots not scored
+    contributions: np.ndarray  # (sites x slots x k), adding up to the squared distance
+    samples: np.ndarray  # vectors per site
+    correlation: np.ndarray  # (sites x k x k) over the whole window, NaN without two vectors
+
+
+def forward_fill(values):
+    """Copy of (sites x slots x k) ``values`` with each NaN replaced by the previous value along the slots"""
+    slots = values.shape[1]
+    newest = np.where(np.isnan(values), -1, np.arange(slots)[None, :, None])
+    newest = np.maximum.accumulate(newest, axis=1)
+    filled = np.take_along_axis(values, np.maximum(newest, 0), axis=1)
+    filled[newest < 0] = np.nan
+    return filled
+
+
+def window_scores(values, warmup=DEFAULTS['warmup'], ridge=DEFAULTS['ridge']):
+    """
+    Mahalanobis distance of every slot of (sites x slots x k) ``values``, each against the slots before it
+
+    Slots where no sensor has a value are skipped, and missing sensors take
+    their previous value, as a streaming ``MultivariateTable`` would see the
+    same vectors. Slots before a site's ``warmup``-th vector are not scored.
+    The running sums are prefix sums over the slot axis and each slot's
+    distance is a batched k x k solve.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sites, slots, k = values.shape
+    filled = forward_fill(values)
+    valid = ~np.isnan(values).all(axis=2) & ~np.isnan(filled).any(axis=2)
+    samples = valid.sum(axis=1)
+    # Centred per site, so the prefix sums of products stay small; distances do not change
+    offset = np.where(valid[..., None], filled, 0.0).sum(axis=1) / np.maximum(samples, 1)[:, None]
+    y = np.where(valid[..., None], filled - offset[:, None, :], 0.0)
+    outer = y[..., :, None] * y[..., None, :]
+
+    counts = np.cumsum(valid, axis=1) - valid  # vectors before each slot
+    sums = np.cumsum(y, axis=1) - y
+    products = np.cumsum(outer, axis=1) - outer
+    means = sums / np.maximum(counts, 1)[..., None]
+    m2 = ridge * np.eye(k) + products - counts[..., None, None] * means[..., :, None] * means[..., None, :]
+    delta = y - means
+    solved = np.linalg.solve(m2, delta[..., None])[..., 0]
+    contributions = (counts - 1)[..., None] * delta * solved
+    scored = valid & (counts >= max(warmup, 2))
+    with np.errstate(invalid='ignore'):
+        distance = np.where(scored, np.sqrt(np.maximum(contributions.sum(axis=2), 0.0)), np.nan)
+    contributions = np.where(scored[..., None], contributions, np.nan)
+
+    total = products[:, -1] + outer[:, -1]
+    mean = (sums[:, -1] + y[:, -1]) / np.maximum(samples, 1)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = (total - samples[:, None, None] * mean[:, :, None] * mean[:, None, :])
+        std = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+        correlation = covariance / (std[:, :, None] * std[:, None, :])
+    correlation[samples < 2] = np.nan
+    return WindowScores(distance, contributions, samples, correlation)
@@ -0,0 +1,316 @@
+"""
+Data quality of raw sensor series: gaps, completeness and regular grids
+
+Gateways drop out and reconnect, so a sensor's readings arrive at an uneven
+pace and with holes. This stage works on the raw readings of many series (one
+per site and sensor type) at once. A ``Readings`` batch holds them in flat
+arrays sorted by series and time, and every step below is a few numpy
+operations over the whole batch, with no loop over the series:
+
+- ``infer_cadence``: median interval between a series' readings, used when
+  no cadence is configured for its sensor type
+- ``find_gaps``: stretches without a reading longer than ``tolerance``
+  cadences, including from the window start to the first reading and from
+  the last one to the window end
+- ``completeness``: share of a series' cadence slots with a reading
+- ``regular_grid``: the readings on a (series x slots) grid, as slot means or
+  as the newest reading, forward-filled up to a number of slots
+
+``QualityJob`` runs the stage for the fleet over whole UTC days, a chunk of
+sites at a time, and stores one ``SensorGapReport`` per site, sensor and day,
+so the dashboard reads data quality without recomputing it.
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from boiler_common import flux
+from django.db import transaction
+
+from . import history
+from .models import SensorGapReport
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+NS = 1_000_000_000
+DEFAULT_SENSOR_TYPES = ('temperature', 'pressure', 'flow_rate', 'fuel_level', 'efficiency')
+REPORT_FIELDS = ('readings', 'cadence_seconds', 'cadence_inferred', 'expected_slots', 'completeness', 'gap_count',
+                 'gap_seconds', 'longest_gap_seconds', 'gaps')
+
+
+class Readings(NamedTuple):
+    keys: list  # (site_id, sensor_type) of each series, sorted
+    series: np.ndarray  # int64 index into keys per reading, ascending
+    times: np.ndarray  # int64 epoch ns, ascending within a series
+    values: np.ndarray  # float64
+
+
+class Gaps(NamedTuple):
+    series: np.ndarray  # int64, ascending
+    starts: np.ndarray  # int64 epoch ns: the reading before the gap, or the window start
+    stops: np.ndarray  # int64 epoch ns: the reading after the gap, or the window end
+
+
+def to_readings(site_ids, sensor_types, times, values, keys=()):
+    """
+    ``Readings`` from parallel arrays in any order
+
+    ``keys`` adds (site_id, sensor_type) series expected in the batch, so
+    a sensor without a single reading still gets a series.
+    """
+    count = len(times)
+    sites = np.concatenate([np.asarray(site_ids, dtype=object), np.array([site for site, _ in keys], dtype=object)])
+    sensors = np.concatenate([np.asarray(sensor_types, dtype=object),
+                              np.array([sensor for _, sensor in keys], dtype=object)])
+    site_codes, site_names = pd.factorize(sites, sort=True)  # hashing, much faster than sorting the strings
+    sensor_codes, sensor_names = pd.factorize(sensors, sort=True)
+    pairs, series = np.unique(site_codes * len(sensor_names) + sensor_codes, return_inverse=True)
+    keys = [(site_names[pair // len(sensor_names)], sensor_names[pair % len(sensor_names)]) for pair in pairs.tolist()]
+    series = series[:count].astype(np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    order = np.lexsort((times, series))
+    return Readings(keys, series[order], times[order], np.asarray(values, dtype=np.float64)[order])
+
+
+def first_of_series(series):
+    """Mask of the first reading of each series in a sorted batch"""
+    first = np.ones(len(series), dtype=bool)
+    first[1:] = series[1:] != series[:-1]
+    return first
+
+
+def infer_cadence(readings):
+    """Median interval in seconds between consecutive readings of each series; NaN with fewer than two"""
+    count = len(readings.keys)
+    same = ~first_of_series(readings.series)[1:]
+    intervals = np.diff(readings.times)[same]
+    owners = readings.series[1:][same]
+    distinct = intervals > 0  # duplicated timestamps say nothing about the cadence
+    intervals, owners = intervals[distinct], owners[distinct]
+    order = np.lexsort((intervals, owners))
+    intervals, owners = intervals[order], owners[order]
+    sizes = np.bincount(owners, minlength=count)
+    starts = np.cumsum(sizes) - sizes
+    cadence = np.full(count, np.nan)
+    known = sizes > 0
+    lower = intervals[(starts + (sizes - 1) // 2)[known]]
+    upper = intervals[(starts + sizes // 2)[known]]
+    cadence[known] = (lower + upper) / 2 / NS
+    return cadence
+
+
+def cadences(readings, configured=None, default=60.0):
+    """
+    Expected cadence in seconds of each series and whether it was inferred
+
+    A series' cadence is the one configured for its sensor type, else the
+    median interval of its readings, else ``default``.
+    """
+    configured = configured or {}
+    fixed = np.array([configured.get(sensor_type, np.nan) for _, sensor_type in readings.keys], dtype=np.float64)
+    inferred = np.isnan(fixed)
+    cadence = np.where(inferred, infer_cadence(readings), fixed)
+    inferred &= ~np.isnan(cadence)
+    return np.where(np.isnan(cadence), float(default), cadence), inferred
+
+
+def find_gaps(readings, cadence, start, stop, tolerance=2.0):
+    """
+    ``Gaps`` longer than ``tolerance`` times each series' ``cadence`` (seconds) over ``[start, stop)``
+
+    The readings must be inside the window; a series without readings is
+    one gap over the whole window.
+    """
+    series, times = readings.series, readings.times
+    first = first_of_series(series)
+    last = np.roll(first, -1)
+    previous = np.roll(times, 1)
+    previous[first] = start * NS
+    empty = np.flatnonzero(np.bincount(series, minlength=len(readings.keys)) == 0)
+    owners = np.concatenate([series, series[last], empty])
+    starts = np.concatenate([previous, times[last], np.full(len(empty), start * NS, dtype=np.int64)])
+    stops = np.concatenate([times, np.full(last.sum() + len(empty), stop * NS, dtype=np.int64)])
+    keep = stops - starts > tolerance * cadence[owners] * NS
+    owners, starts, stops = owners[keep], starts[keep], stops[keep]
+    order = np.lexsort((starts, owners))
+    return Gaps(owners[order], starts[order], stops[order])
+
+
+def completeness(readings, cadence, start, stop):
+    """
+    ``(filled, expected)`` cadence slots of each series over ``[start, stop)``
+
+    Slots of ``cadence`` seconds are counted from ``start``; a slot is
+    filled when it holds at least one reading. ``filled / expected`` is the
+    series' completeness.
+    """
+    count = len(readings.keys)
+    cadence_ns = cadence * NS
+    expected = np.ceil((stop - start) * NS / cadence_ns).astype(np.int64)
+    slot = ((readings.times - start * NS) // cadence_ns[readings.series]).astype(np.int64)
+    new = first_of_series(readings.series)
+    new[1:] |= slot[1:] != slot[:-1]
+    filled = np.bincount(readings.series[new], minlength=count)
+    return np.minimum(filled, expected), expected
+
+
+def fill_forward(values, limit=None):
+    """Copy of a (series x slots) array with each NaN replaced by the value up to ``limit`` slots before it"""
+    slots = values.shape[1]
+    source = np.maximum.accumulate(np.where(np.isnan(values), -1, np.arange(slots)), axis=1)
+    filled = np.take_along_axis(values, np.maximum(source, 0), axis=1)
+    stale = source < 0
+    if limit is not None:
+        stale |= np.arange(slots) - source > limit
+    return np.where(stale, np.nan, filled)
+
+
+def regular_grid(readings, start, stop, every, how='mean', limit=0):
+    """
+    Readings on a (series x slots) grid of ``every`` seconds over ``[start, stop)``
+
+    ``how`` is ``'mean'`` (mean of a slot's readings) or ``'last'`` (the
+    newest one). A slot without readings carries the previous slot's value
+    for up to ``limit`` slots (None: without limit); otherwise it is NaN.
+    """
+    if how not in ('mean', 'last'):
+        raise ValueError("how must be 'mean' or 'last'")
+    count = len(readings.keys)
+    slots = -(-(stop - start) // every)
+    slot = (readings.times - start * NS) // (every * NS)
+    keep = (slot >= 0) & (slot < slots)
+    cells = readings.series[keep] * slots + slot[keep]
+    values = readings.values[keep]
+    if how == 'mean':
+        sums = np.bincount(cells, weights=values, minlength=count * slots)
+        counts = np.bincount(cells, minlength=count * slots)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = np.where(counts > 0, sums / counts, np.nan)
+    else:
+        newest = np.ones(len(cells), dtype=bool)  # cells ascend, and time ascends within a cell
+        newest[:-1] = cells[1:] != cells[:-1]
+        grid = np.full(count * slots, np.nan)
+        grid[cells[newest]] = values[newest]
+    grid = grid.reshape(count, slots)
+    return grid if limit == 0 else fill_forward(grid, limit)
+
+
+def load_readings(sites, start, stop, batch_rows=100_000):
+    """Raw readings of ``sites`` over ``[start, stop)`` from InfluxDB as ``(site_ids, sensor_types, times_ns, values)``"""
+    query = flux.SeriesQuery((), start, stop, sites=tuple(sites))
+    columns = ([], [], [], [])
+    for rows in history.get_executor().stream_raw(query, batch_rows):
+        columns[0].append(np.array([row.group[0] for row in rows], dtype=object))
+        columns[1].append(np.array([row.group[1] for row in rows], dtype=object))
+        columns[2].append(np.fromiter((row.time for row in rows), dtype=np.int64, count=len(rows)))
+        columns[3].append(np.fromiter((row.value for row in rows), dtype=np.float64, count=len(rows)))
+    dtypes = (object, object, np.int64, np.float64)
+    return tuple(np.concatenate(chunks) if chunks else np.array([], dtype=dtype) for chunks, dtype in zip(columns, dtypes))
+
+
+def iso_ns(nanoseconds):
+    return np.datetime_as_string(np.asarray(nanoseconds, dtype='datetime64[ns]').astype('datetime64[s]'),
+                                 unit='s', timezone='UTC').tolist()
+
+
+def gap_lists(gaps, count, max_gaps):
+    """Per series, its ``max_gaps`` longest gaps as ``[start, end]`` ISO times in time order"""
+    order = np.lexsort((gaps.starts, gaps.starts - gaps.stops, gaps.series))  # longest first within a series
+    series = gaps.series[order]
+    rank = np.arange(len(series)) - np.searchsorted(series, series)
+    picked = np.sort(order[rank < max_gaps])  # back in (series, start) order
+    lists = [[] for _ in range(count)]
+    for owner, begin, end in zip(gaps.series[picked].tolist(), iso_ns(gaps.starts[picked]), iso_ns(gaps.stops[picked])):
+        lists[owner].append([begin, end])
+    return lists
+
+
+def report_rows(readings, start, stop, configured=None, default_cadence=60.0, tolerance=2.0, max_gaps=20):
+    """``[(site_id, sensor_type, fields)]`` with the ``REPORT_FIELDS`` of every series over ``[start, stop)``"""
+    count = len(readings.keys)
+    cadence, inferred = cadences(readings, configured, default_cadence)
+    filled, expected = completeness(readings, cadence, start, stop)
+    gaps = find_gaps(readings, cadence, start, stop, tolerance)
+    durations = (gaps.stops - gaps.starts) / NS
+    longest = np.zeros(count)
+    np.maximum.at(longest, gaps.series, durations)
+    columns = {
+        'readings': np.bincount(readings.series, minlength=count).tolist(),
+        'cadence_seconds': np.round(cadence, 3).tolist(),
+        'cadence_inferred': inferred.tolist(),
+        'expected_slots': expected.tolist(),
+        'completeness': np.round(filled / expected, 4).tolist(),
+        'gap_count': np.bincount(gaps.series, minlength=count).tolist(),
+        'gap_seconds': np.round(np.bincount(gaps.series, weights=durations, minlength=count), 3).tolist(),
+        'longest_gap_seconds': np.round(longest, 3).tolist(),
+        'gaps': gap_lists(gaps, count, max_gaps),
+    }
+    return [(site_id, sensor_type, {name: columns[name][row] for name in REPORT_FIELDS})
+            for row, (site_id, sensor_type) in enumerate(readings.keys)]
+
+
+def save_reports(day, rows):
+    """Upsert one day's gap reports in one transaction"""
+    reports = [SensorGapReport(site_id=site_id, sensor_type=sensor_type, day=day, **fields)
+               for site_id, sensor_type, fields in rows]
+    with transaction.atomic():
+        SensorGapReport.objects.bulk_create(
+            reports, batch_size=1000, update_conflicts=True,
+            unique_fields=['site_id', 'sensor_type', 'day'], update_fields=[*REPORT_FIELDS, 'computed_at'],
+        )
+
+
+class QualityJob:
+    """Gap reports of every site's sensors over whole UTC days"""
+
+    def __init__(self, sensor_types=DEFAULT_SENSOR_TYPES, cadence_seconds=None, default_cadence=60.0, tolerance=2.0,
+                 max_gaps=20, chunk_sites=50, load=load_readings, report=None):
+        self.sensor_types = sensor_types
+        self.cadence_seconds = cadence_seconds or {}
+        self.default_cadence = default_cadence
+        self.tolerance = tolerance
+        self.max_gaps = max_gaps
+        self.chunk_sites = chunk_sites
+        self.load = load
+        self.report = report or (lambda line: None)
+
+    def check(self, sites, start, stop):
+        """Report rows of ``sites`` over ``[start, stop)``; every site gets its ``sensor_types`` even without data"""
+        site_ids, sensor_types, times, values = self.load(sites, start, stop)
+        inside = (times >= start * NS) & (times < stop * NS)
+        expected = [(site_id, sensor_type) for site_id in sites for sensor_type in self.sensor_types]
+        readings = to_readings(site_ids[inside], sensor_types[inside], times[inside], values[inside], expected)
+        return report_rows(readings, start, stop, self.cadence_seconds, self.default_cadence, self.tolerance,
+                           self.max_gaps)
+
+    def run(self, sites, start, stop):
+        """Check every site on the days ``[start, stop)`` (dates); returns a summary dict"""
+        days = [start + timedelta(days=offset) for offset in range((stop - start).days)]
+        summary = {'sites': len(sites), 'days': len(days), 'failed': 0, 'reports': 0, 'readings': 0, 'gaps': 0}
+        started = time.monotonic()
+        filled = 0.0
+        for day in days:
+            day_start = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+            for offset in range(0, len(sites), self.chunk_sites):
+                chunk = sites[offset:offset + self.chunk_sites]
+                try:
+                    rows = self.check(chunk, day_start, day_start + DAY)
+                    save_reports(day, rows)
+                except Exception:
+                    summary['failed'] += len(chunk)
+                    logger.exception("Checking data quality of %d sites on %s failed", len(chunk), day)
+                    continue
+                summary['reports'] += len(rows)
+                for _, _, fields in rows:
+                    summary['readings'] += fields['readings']
+                    summary['gaps'] += fields['gap_count']
+                    filled += fields['completeness']
+            self.report(f"{day}: {summary['reports']} reports, {summary['gaps']} gaps")
+        summary['completeness'] = round(filled / summary['reports'], 4) if summary['reports'] else None
+        summary['seconds'] = round(time.monotonic() - started, 2)
+        return summary
@@ -0,0 +1,199 @@
+"""
+Cache of analytics responses, invalidated by new data rather than by a timer
+
+A cached response is keyed on its normalised request parameters and on the
+data watermarks of the sites it covers (see ``boiler_common.readings``).
+iot_ingestion moves a site's watermark forward whenever new readings for it
+are written to InfluxDB, by its write buffer or by its spool replayer. The
+next identical request then maps to a new key and is recomputed, while
+requests for sites without new data keep hitting the cache. The TTL only
+bounds how long an unused entry occupies memory.
+
+Entries live in Redis, shared by every process, with a small in-process
+LRU tier in front that saves the Redis read for hot requests. A miss is
+computed once: concurrent identical requests in a process wait for the
+thread computing it, and other processes wait on a short Redis lock and
+pick the result up from Redis.
+
+A watermark is set just after readings are written, and InfluxDB may take
+a moment to return them from queries. A response computed within
+``settle`` seconds of a watermark may miss those readings, so it is kept
+for only ``settle`` seconds.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from boiler_common import metrics, readings as stream_format
+
+from .cache import get_redis, key_prefix
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.counter('analytics_result_cache_total', 'Analytics result cache lookups, by outcome', ['outcome'])
+LOCAL_HIT, REDIS_HIT, MISS, BYPASS = (LOOKUPS.labels(outcome) for outcome in ('local', 'redis', 'miss', 'bypass'))
+
+
+class ResultCache:
+    """Two-tier cache of serialised results keyed on request parameters and data watermarks"""
+
+    def __init__(self, client, prefix, watermarks_key, ttl=1800, local_entries=256, settle=2.0,
+                 lock_timeout=30.0, poll_interval=0.05):
+        self.client = client
+        self.prefix = prefix
+        self.watermarks_key = watermarks_key
+        self.ttl = ttl
+        self.local_entries = local_entries
+        self.settle = settle
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._local = OrderedDict()  # key -> (content, expires at), least recently used first
+        self._flights = {}  # key -> Event set when the computing thread is done
+        self._lock = threading.Lock()
+
+    def watermark(self, sites):
+        """Newest data watermark (epoch ns) of ``sites``, or of the whole fleet when ``sites`` is None"""
+        fields = [stream_format.ALL_SITES] if sites is None else sorted(set(sites))
+        if not fields:
+            return 0
+        return max((int(value) for value in self.client.hmget(self.watermarks_key, fields) if value is not None),
+                   default=0)
+
+    def key(self, namespace, params, watermark):
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{self.prefix}:results:{namespace}:{digest}:{watermark}"
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return entry[0]
+
+    def _local_put(self, key, content, ttl):
+        with self._lock:
+            self._local[key] = (content, time.monotonic() + ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_entries:
+                self._local.popitem(last=False)
+
+    def fetch(self, namespace, params, sites, compute):
+        """
+        Cached bytes for a request, or those of ``compute()``; returns ``(content, outcome)``
+
+        ``compute`` returns the serialised result, or None for a result that
+        must not be cached (e.g. an error). The outcome is ``local``,
+        ``redis``, ``miss`` or ``bypass`` (Redis unavailable; computed
+        without the cache).
+        """
+        try:
+            watermark = self.watermark(sites)
+        except Exception:
+            logger.warning("Reading data watermarks failed, computing without the cache", exc_info=True)
+            BYPASS.inc()
+            return compute(), 'bypass'
+        key = self.key(namespace, params, watermark)
+        content = self._local_get(key)
+        if content is not None:
+            LOCAL_HIT.inc()
+            return content, 'local'
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+        if not leader:
+            # Another thread of this process is computing the same result
+            flight.wait(self.lock_timeout)
+            content = self._local_get(key)
+            if content is not None:
+                LOCAL_HIT.inc()
+                return content, 'local'
+        try:
+            return self._fetch_shared(key, watermark, compute)
+        finally:
+            if leader:
+                with self._lock:
+                    del self._flights[key]
+                flight.set()
+
+    def _fetch_shared(self, key, watermark, compute):
+        """Read ``key`` from Redis, or compute it under a cross-process lock"""
+        lock_key = f"{key}:lock"
+        deadline = time.monotonic() + self.lock_timeout
+        try:
+            while True:
+                content = self.client.get(key)
+                if content is not None:
+                    self._local_put(key, content, self.ttl)
+                    REDIS_HIT.inc()
+                    return content, 'redis'
+                if self.client.set(lock_key, 1, nx=True, px=int(self.lock_timeout * 1000)):
+                    break
+                if time.monotonic() >= deadline:
+                    break  # the process holding the lock is too slow or gone; compute here too
+                time.sleep(self.poll_interval)
+        except Exception:
+            logger.warning("Result cache unavailable, computing without it", exc_info=True)
+            BYPASS.inc()
+            return compute(), 'bypass'
+
+        MISS.inc()
+        try:
+            content = compute()
+            if content is not None:
+                self._store(key, content, watermark)
+        finally:
+            try:
+                self.client.delete(lock_key)
+            except Exception:
+                logger.warning("Releasing %s failed", lock_key, exc_info=True)
+        return content, 'miss'
+
+    def _store(self, key, content, watermark):
+        # Data written moments ago may not have been visible to the queries behind this result
+        ttl = self.settle if time.time_ns() - watermark < self.settle * 1e9 else self.ttl
+        self._local_put(key, content, ttl)
+        try:
+            self.client.set(key, content, px=int(ttl * 1000))
+        except Exception:
+            logger.warning("Storing %s in the result cache failed", key, exc_info=True)
+
+    def stats(self):
+        return {'local_entries': len(self._local), 'in_flight': len(self._flights)}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the process-wide result cache, or None when it is disabled"""
+    global _result_cache
+    from django.conf import settings
+
+    config = settings.ANALYTICS_RESULT_CACHE
+    if not config['enabled']:
+        return None
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(
+                    get_redis(),
+                    key_prefix(),
+                    config['watermarks_key'],
+                    ttl=config['ttl_seconds'],
+                    local_entries=config['local_entries'],
+                    settle=config['settle_seconds'],
+                    lock_timeout=config['lock_seconds'],
+                )
+    return _result_cache
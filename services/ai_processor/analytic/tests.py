@@ -1,3 +1,1037 @@
-from django.test import TestCase
+"""
+Test cases for the analytic application
+"""
+import io
+import os
+import shutil
+import tempfile
+from datetime import date
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from boiler_common import flux, readings as stream_format
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .archive import HistoryExporter, iter_partitions, load_archive_chunk, load_archive_readings, partitions
+from .consumer import DetectorRunner, multivariate_key
+from .detectors import DetectorTable, occurrence_rounds
+from .fleet import DAY, FleetJob, daily_rows
+from .forecast import ForecastJob, crossing_hours, forecast_grid, holt, linear_trend, since_last_rise
+from .history import Cube, Grid, HistoryError, grid_query, parse_duration, to_cube, to_grid
+from .kpis import FleetKpiJob, kpis_key, percentile_rank, ratios, site_totals
+from .kernels import block_stats, rolling_stats
+from .models import AnalyticsWatermark, SensorDailyStats, SensorForecast, SensorGapReport
+from .multivariate import MultivariateTable, rank_one_update, window_scores
+from .quality import QualityJob, cadences, completeness, find_gaps, regular_grid, to_readings
+from .results import ResultCache
+from .windows import WindowFeeder, WindowStore
+
+T0 = 1_735_725_600  # 2025-01-01T10:00:00Z in seconds
+T0_NS = T0 * 1_000_000_000
+
+
+def redis_client():
+    """Redis client for REDIS_URL, or None when no server is reachable"""
+    import redis
+
+    client = redis.Redis.from_url(settings.REDIS_URL, socket_connect_timeout=0.5, socket_timeout=1)
+    try:
+        client.ping()
+    except redis.RedisError:
+        return None
+    return client
+
+
+REDIS = redis_client()
+
+
+def sample_grid(sites=6, slots=200, missing=0.2, seed=1):
+    """Random (sites x slots) grid with a fraction of the slots missing and one empty row"""
+    rng = np.random.default_rng(seed)
+    values = rng.normal(80, 5, (sites, slots))
+    values[rng.random(values.shape) < missing] = np.nan
+    values[2] = np.nan
+    return values
+
+
+class RollingKernelTest(SimpleTestCase):
+    """Vectorised rolling statistics against pandas, row by row"""
+
+    def assert_matches_pandas(self, values, window, min_periods):
+        results = rolling_stats(values, window, percentiles=(5, 50, 95), min_periods=min_periods)
+        rolling = pd.DataFrame(values.T).rolling(window, min_periods=min_periods)
+        expected = {
+            'mean': rolling.mean(), 'std': rolling.std(), 'min': rolling.min(), 'max': rolling.max(),
+            'p5': rolling.quantile(0.05), 'p50': rolling.quantile(0.5), 'p95': rolling.quantile(0.95),
+        }
+        for name, frame in expected.items():
+            np.testing.assert_allclose(results[name], frame.to_numpy().T, rtol=1e-9, atol=1e-9, err_msg=name)
+        counts = pd.DataFrame(values.T).rolling(window, min_periods=1).count().to_numpy().T
+        np.testing.assert_array_equal(results['count'], counts)
+
+    def test_matches_pandas(self):
+        values = sample_grid()
+        for window, min_periods in ((1, 1), (7, 1), (17, 3), (60, 60), (200, 10)):
+            with self.subTest(window=window, min_periods=min_periods):
+                self.assert_matches_pandas(values, window, min_periods)
+
+    def test_window_longer_than_grid(self):
+        self.assert_matches_pandas(sample_grid(slots=5), 12, 2)
+
+    def test_constant_series_has_zero_std(self):
+        results = rolling_stats(np.full((2, 50), 1e6 + 0.1), 10, ('std',))
+        self.assertTrue(np.isnan(results['std'][:, 0]).all())
+        np.testing.assert_allclose(results['std'][:, 1:], 0.0, atol=1e-6)
+
+    def test_rejects_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            rolling_stats(np.zeros(10), 3)
+        with self.assertRaises(ValueError):
+            rolling_stats(np.zeros((1, 10)), 3, min_periods=4)
+        with self.assertRaises(ValueError):
+            rolling_stats(np.zeros((1, 10)), 3, ('median',))
+        with self.assertRaises(ValueError):
+            rolling_stats(np.zeros((1, 10)), 3, percentiles=(101,))
+
+
+class HistoryTest(SimpleTestCase):
+    """Durations, Flux generation and grid layout"""
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('90s'), 90)
+        self.assertEqual(parse_duration('15m'), 900)
+        self.assertEqual(parse_duration('7d'), 7 * 86400)
+        for text in ('', '0m', '1.5h', '10y', 'h'):
+            with self.assertRaises(HistoryError):
+                parse_duration(text)
+
+    def test_grid_query(self):
+        query = grid_query('sensor_data', 'temperature', ['BLR001', 'B"2'], T0, T0 + 3600, 60)
+        self.assertIn('range(start: 2025-01-01T10:00:00Z, stop: 2025-01-01T11:00:00Z)', query)
+        self.assertIn('r.sensor_type == "temperature"', query)
+        self.assertIn('set: ["BLR001", "B\\"2"]', query)
+        self.assertIn('aggregateWindow(every: 60s, fn: mean', query)
+        self.assertNotIn('contains', grid_query('sensor_data', 'temperature', None, T0, T0 + 60, 60))
+
+    def test_to_grid(self):
+        grid = to_grid(
+            'temperature', None, T0, T0 + 300, 60,
+            ['BLR002', 'BLR001', 'BLR002', 'BLR001'],
+            [T0, T0 + 120, T0 + 240, T0 + 600],  # the last point is past the range
+            [1.0, 2.0, 3.0, 4.0],
+        )
+        self.assertEqual(grid.sites, ['BLR001', 'BLR002'])
+        np.testing.assert_array_equal(grid.values, [
+            [np.nan, np.nan, 2.0, np.nan, np.nan],
+            [1.0, np.nan, np.nan, np.nan, 3.0],
+        ])
+        self.assertEqual(grid.timestamps.tolist(), [T0 + 60 * i for i in range(5)])
+
+        requested = to_grid('temperature', ['BLR003', 'BLR001'], T0, T0 + 60, 60, ['BLR001'], [T0], [5.0])
+        np.testing.assert_array_equal(requested.values, [[np.nan], [5.0]])
+
+
+class RollingViewTest(SimpleTestCase):
+    """GET /api/analytics/rolling/"""
+
+    def setUp(self):
+        values = np.array([[1.0, 2.0, np.nan, 4.0], [10.0, 10.0, 10.0, 10.0]])
+        self.grid = Grid('temperature', ['BLR001', 'BLR002'], T0, 60, values)
+        patcher = mock.patch('analytic.views.load_grid', return_value=self.grid)
+        self.load_grid = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('analytic.views.get_result_cache', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return self.client.get(reverse('rolling_statistics'), params)
+
+    def test_series(self):
+        response = self.get(sensor='temperature', sites='BLR001,BLR002', window='2m', every='1m',
+                            start=str(T0), end=str(T0 + 240), percentiles='50')
+        self.assertEqual(response.status_code, 200)
+        self.load_grid.assert_called_once_with('temperature', ['BLR001', 'BLR002'], T0, T0 + 240, 60)
+        body = response.json()
+        self.assertEqual(body['timestamps'][0], '2025-01-01T10:00:00Z')
+        self.assertEqual(body['sites']['BLR001']['mean'], [1.0, 1.5, 2.0, 4.0])
+        self.assertEqual(body['sites']['BLR001']['std'][:2], [None, 0.5 ** 0.5])
+        self.assertEqual(body['sites']['BLR002']['max'], [10.0] * 4)
+        self.assertEqual(body['sites']['BLR001']['p50'], [1.0, 1.5, 2.0, 4.0])
+
+    def test_latest(self):
+        body = self.get(sensor='temperature', window='3m', stats='min,max', latest='1').json()
+        self.assertEqual(body['sites'], {'BLR001': {'min': 2.0, 'max': 4.0}, 'BLR002': {'min': 10.0, 'max': 10.0}})
+        self.assertEqual(body['time'], '2025-01-01T10:03:00Z')
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get(window='1h').status_code, 400)
+        self.assertEqual(self.get(sensor='temperature', window='90s', every='1m').status_code, 400)
+        self.assertEqual(self.get(sensor='temperature', stats='median').status_code, 400)
+        self.assertEqual(self.get(sensor='temperature', range='1x').status_code, 400)
+        self.load_grid.assert_not_called()
+
+    def test_history_unavailable(self):
+        self.load_grid.side_effect = ConnectionError('influxdb down')
+        with self.assertLogs('analytic.views', 'ERROR'):
+            self.assertEqual(self.get(sensor='temperature').status_code, 503)
+
+
+def steady_readings(count, site_id='BLR001', sensor_type='temperature', seed=2):
+    """``count`` normal readings around 80 as parallel columns"""
+    rng = np.random.default_rng(seed)
+    return ([site_id] * count, [sensor_type] * count,
+            T0_NS + np.arange(count, dtype=np.int64) * 1_000_000_000, rng.normal(80, 1, count))
+
+
+class DetectorTest(SimpleTestCase):
+    """Streaming EWMA, rolling z-score and CUSUM detectors"""
+
+    def test_occurrence_rounds(self):
+        rounds = occurrence_rounds(np.array([3, 1, 3, 3, 1, 2]))
+        self.assertEqual([r.tolist() for r in rounds], [[0, 1, 5], [2, 4], [3]])
+        self.assertEqual([r.tolist() for r in occurrence_rounds(np.array([0, 1]))], [[0, 1]])
+
+    def test_batch_matches_one_at_a_time(self):
+        """A batch with repeated keys leaves the same state as applying its readings one by one"""
+        sites = ['BLR001', 'BLR002'] * 50
+        sensors = ['temperature'] * 100
+        timestamps = np.arange(100)
+        values = np.random.default_rng(3).normal(80, 2, 100)
+        batched, single = DetectorTable(window=7, warmup=5), DetectorTable(window=7, warmup=5)
+        batch_events = batched.update(sites, sensors, timestamps, values)
+        single_events = [event for i in range(100)
+                         for event in single.update(sites[i:i + 1], sensors[i:i + 1], timestamps[i:i + 1], values[i:i + 1])]
+        np.testing.assert_allclose(batched.state[:2], single.state[:2])
+        np.testing.assert_allclose(batched.ring[:2], single.ring[:2])
+        self.assertEqual(batch_events, single_events)
+        snapshot = batched.snapshot('BLR002', 'temperature')
+        self.assertAlmostEqual(snapshot['rolling_mean'], values[1::2][-7:].mean())
+        self.assertAlmostEqual(snapshot['rolling_std'], values[1::2][-7:].std(ddof=1))
+
+    def test_spike_raises_one_event_per_detector(self):
+        table = DetectorTable()
+        self.assertEqual(table.update(*steady_readings(200)), [])
+        events = table.update(['BLR001'] * 2, ['temperature'] * 2, [T0_NS + 1, T0_NS + 2], [95.0, 96.0])
+        self.assertEqual({event.detector for event in events}, {'ewma', 'zscore', 'cusum_up'})
+        self.assertTrue(all(event.timestamp == T0_NS + 1 and event.score > 4 for event in events))
+
+    def test_cusum_catches_slow_drift(self):
+        """A 1.5 sigma shift never crosses the z threshold, but CUSUM raises a downward drift event"""
+        table = DetectorTable(alpha=0.01)
+        table.update(*steady_readings(300))
+        sites, sensors, timestamps, values = steady_readings(40, seed=4)
+        events = table.update(sites, sensors, timestamps, values - 1.5)
+        self.assertIn('cusum_down', {event.detector for event in events})
+        self.assertNotIn('zscore', {event.detector for event in events})
+
+    def test_no_events_during_warmup(self):
+        table = DetectorTable(warmup=30)
+        table.update(*steady_readings(10))
+        self.assertEqual(table.update(['BLR001'], ['temperature'], [T0_NS], [500.0]), [])
+
+    def test_checkpoint_round_trip(self):
+        table = DetectorTable(window=10)
+        table.update(*steady_readings(25))
+        table.update(*steady_readings(5, site_id='BLR002', sensor_type='pressure'))
+        restored, extra = DetectorTable.loads(table.dumps(last_id='1700000000000-3'), window=10)
+        self.assertEqual(extra, {'last_id': '1700000000000-3'})
+        self.assertEqual(restored.keys, table.keys)
+        self.assertEqual(restored.snapshot('BLR002', 'pressure'), table.snapshot('BLR002', 'pressure'))
+        with self.assertRaises(ValueError):
+            DetectorTable.loads(table.dumps(), window=20)
+
+    def test_stream_format_round_trip(self):
+        readings = [('BLR001', 'temperature', T0_NS, 80.5), ('BLR002', 'pressure', T0_NS + 1, 12.25)]
+        fields = {key.encode(): value.encode() if isinstance(value, str) else value
+                  for key, value in stream_format.encode(readings).items()}
+        site_ids, sensor_types, timestamps, values = stream_format.decode(fields)
+        self.assertEqual(site_ids.tolist(), ['BLR001', 'BLR002'])
+        self.assertEqual(sensor_types.tolist(), ['temperature', 'pressure'])
+        self.assertEqual(timestamps.tolist(), [T0_NS, T0_NS + 1])
+        self.assertEqual(values.tolist(), [80.5, 12.25])
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_runner_publishes_events_and_resumes_from_checkpoint(self):
+        prefix = f'test-{os.getpid()}'
+        keys = {'stream_key': f'{prefix}:readings', 'events_key': f'{prefix}:anomalies'}
+        checkpoint_key = f'{prefix}:checkpoint'
+        self.addCleanup(REDIS.delete, checkpoint_key, *keys.values())
+
+        def publish(site_ids, sensor_types, timestamps, values):
+            REDIS.xadd(keys['stream_key'], stream_format.encode(list(zip(site_ids, sensor_types, timestamps, values))))
+
+        publish(*steady_readings(100))
+        runner = DetectorRunner.restore(REDIS, checkpoint_key, {}, last_id='0', **keys)
+        self.assertEqual(runner.poll(block_ms=10), 1)
+        runner.checkpoint()
+
+        publish(['BLR001'], ['temperature'], [T0_NS + 10**12], [120.0])
+        resumed = DetectorRunner.restore(REDIS, checkpoint_key, {}, **keys)
+        self.assertEqual(resumed.last_id, runner.last_id)
+        self.assertEqual(resumed.poll(block_ms=10), 1)
+        self.assertEqual(resumed.table.snapshot('BLR001', 'temperature')['count'], 101)
+
+        with mock.patch('analytic.views.anomaly_keys', return_value=(keys['events_key'], checkpoint_key)):
+            body = self.client.get(reverse('anomaly_events'), {'site': 'BLR001', 'detector': 'zscore'}).json()
+        self.assertEqual(len(body['events']), 1)
+        self.assertEqual(body['events'][0]['value'], 120.0)
+
+
+MULTIVARIATE_SENSORS = ['temperature', 'pressure', 'flow_rate', 'efficiency']
+
+
+def correlated_vectors(sites=2, slots=300, seed=3):
+    """(sites x slots x 4) readings in which temperature and pressure move together"""
+    rng = np.random.default_rng(seed)
+    covariance = np.array([[4, 3, 0, 0], [3, 4, 0, 0], [0, 0, 100, 0], [0, 0, 0, 2]], dtype=np.float64)
+    return rng.multivariate_normal([85, 12, 200, 88], covariance, (sites, slots))
+
+
+def vector_readings(vectors, slots=None):
+    """Stream readings of (sites x slots x k) vectors, slot by slot, skipping NaN"""
+    site_ids, sensor_types, timestamps, values = [], [], [], []
+    for slot in slots if slots is not None else range(vectors.shape[1]):
+        for site in range(vectors.shape[0]):
+            for column, sensor_type in enumerate(MULTIVARIATE_SENSORS):
+                if not np.isnan(vectors[site, slot, column]):
+                    site_ids.append(f'BLR{site + 1:03d}')
+                    sensor_types.append(sensor_type)
+                    timestamps.append(T0_NS + slot * 10**9)
+                    values.append(vectors[site, slot, column])
+    return site_ids, sensor_types, timestamps, values
+
+
+class MultivariateTest(SimpleTestCase):
+    """Mahalanobis scoring of each site's sensor vector, streaming and over historical windows"""
+
+    def test_window_scores_match_the_streaming_updates(self):
+        vectors = correlated_vectors(sites=1, slots=120)
+        vectors[0, 40:45, 2] = np.nan  # flow_rate keeps its previous value
+        vectors[0, 60] = np.nan  # nothing reported
+        scores = window_scores(vectors, warmup=2)
+        counts, means = np.zeros(1), np.zeros((1, 4))
+        m2, precision = np.eye(4)[None] * 1e-3, np.eye(4)[None] * 1e3
+        current = vectors[0, 0]
+        for slot in range(120):
+            if np.isnan(vectors[0, slot]).all():
+                self.assertTrue(np.isnan(scores.distance[0, slot]))
+                continue
+            current = np.where(np.isnan(vectors[0, slot]), current, vectors[0, slot])
+            distance, contributions = rank_one_update(counts, means, m2, precision, current[None])
+            if slot >= 2:
+                self.assertAlmostEqual(scores.distance[0, slot], distance[0], places=6)
+                self.assertAlmostEqual(contributions.sum(), distance[0] ** 2, places=6)
+        np.testing.assert_allclose(precision[0], np.linalg.inv(m2[0]), rtol=1e-6)
+        self.assertEqual(scores.samples[0], 119)
+        self.assertAlmostEqual(scores.correlation[0, 0, 1], 0.75, delta=0.1)
+
+    def test_batch_matches_one_slot_at_a_time(self):
+        """A batch with several timestamps per site leaves the same state as applying them slot by slot"""
+        vectors = correlated_vectors(slots=150)
+        one, batch = MultivariateTable(warmup=20, refresh=30), MultivariateTable(warmup=20, refresh=30)
+        for slot in range(150):
+            one.update(*vector_readings(vectors, [slot]))
+        batch.update(*vector_readings(vectors))
+        self.assertEqual(one.sites, batch.sites)
+        for name in ('counts', 'means', 'm2', 'precision'):
+            np.testing.assert_allclose(getattr(batch, name)[:2], getattr(one, name)[:2], rtol=1e-9)
+
+    def test_decorrelated_spike_raises_an_event_for_the_culprit(self):
+        """A pressure spike with flat temperature is anomalous; both rising together is not"""
+        vectors = correlated_vectors(slots=300)
+        vectors[:, 250] = [85.0, 12.0, 200.0, 88.0]
+        vectors[0, 250, 1] += 8  # pressure alone, 4 std
+        vectors[1, 250, :2] += 8  # temperature and pressure together
+        table = MultivariateTable(warmup=100)
+        events = table.update(*vector_readings(vectors))
+        spikes = [event for event in events if event.timestamp == T0_NS + 250 * 10**9]
+        self.assertEqual([(event.site_id, event.sensor_type, event.detector) for event in spikes],
+                         [('BLR001', 'pressure', 'mahalanobis')])
+        self.assertGreater(spikes[0].score, 5.0)
+        self.assertFalse(any(event.timestamp < T0_NS + 100 * 10**9 for event in events))  # warmup
+        self.assertAlmostEqual(table.snapshot('BLR002')['correlation'][0][1], 0.75, delta=0.1)
+
+    def test_checkpoint_and_restore_with_the_runner(self):
+        stored = {}
+        client = mock.Mock()
+        client.get.side_effect = stored.get
+        client.pipeline.return_value.set.side_effect = stored.__setitem__
+        keys = {'stream_key': 'test:readings', 'events_key': 'test:anomalies'}
+        runner = DetectorRunner.restore(client, 'test:checkpoint', {}, multivariate_config={'warmup': 20}, **keys)
+        fields = stream_format.encode(list(zip(*vector_readings(correlated_vectors(slots=40)))))
+        runner.apply([(b'1-0', fields)])
+        self.assertEqual(runner.stats()['sites'], 2)
+        runner.checkpoint()
+
+        resumed = DetectorRunner.restore(client, 'test:checkpoint', {}, multivariate_config={'warmup': 20}, **keys)
+        self.assertEqual(resumed.last_id, '1-0')
+        self.assertEqual(resumed.multivariate.snapshot('BLR001'), runner.multivariate.snapshot('BLR001'))
+
+        stored[multivariate_key('test:checkpoint')] = MultivariateTable(warmup=20).dumps(last_id='0-1')
+        with self.assertLogs('analytic.consumer', 'WARNING'):
+            stale = DetectorRunner.restore(client, 'test:checkpoint', {}, multivariate_config={'warmup': 20}, **keys)
+        self.assertEqual(len(stale.multivariate), 0)
+        with self.assertRaises(ValueError):
+            MultivariateTable.loads(runner.multivariate.dumps(), warmup=50)
+
+    def test_view(self):
+        vectors = correlated_vectors(slots=48)
+        vectors[0, 40, 1] += 8
+        cube = Cube(MULTIVARIATE_SENSORS, ['BLR001', 'BLR002'], T0, 300, vectors.transpose(0, 2, 1))
+        with mock.patch('analytic.views.load_cube', return_value=cube) as load, \
+                mock.patch('analytic.views.get_result_cache', return_value=None):
+            body = self.client.get(reverse('multivariate_scores'), {
+                'start': T0, 'end': T0 + 48 * 300, 'warmup': 20, 'threshold': 5,
+            }).json()
+            load.assert_called_once_with(MULTIVARIATE_SENSORS, None, T0, T0 + 48 * 300, 300)
+            self.assertEqual(self.client.get(reverse('multivariate_scores'), {'sensors': 'pressure'}).status_code, 400)
+        self.assertEqual(len(body['timestamps']), 48)
+        site = body['sites']['BLR001']
+        self.assertEqual(site['samples'], 48)
+        self.assertIsNone(site['score'][19])
+        self.assertEqual([(a['time'], a['sensor']) for a in site['anomalies']],
+                         [('2025-01-01T13:20:00Z', 'pressure')])
+        self.assertEqual(len(site['correlation']), 4)
+
+
+def synthetic_site_chunk(site_id, start, stop, every):
+    """Fleet job loader: two sensors with a value per slot equal to the slot's day number, BAD fails"""
+    if site_id == 'BAD':
+        raise ConnectionError('influxdb down')
+    slots = (stop - start) // every
+    day = (start + np.arange(slots) * every) // DAY - T0 // DAY
+    return ['pressure', 'temperature'], np.vstack([day + 10.0, day + 80.0])
+
+
+class FleetAnalyticsTest(TestCase):
+    """Daily statistics job on a process pool"""
+
+    def test_block_stats_match_numpy(self):
+        values = sample_grid(slots=240)
+        stats = block_stats(values, 60, (50,))
+        blocks = values.reshape(6, 4, 60)
+        filled = stats['count'] > 0
+        self.assertFalse(filled[2].any())
+        for name, reduce in (('mean', np.nanmean), ('max', np.nanmax), ('p50', np.nanmedian)):
+            np.testing.assert_allclose(stats[name][filled], reduce(blocks[filled], axis=1), err_msg=name)
+        self.assertTrue(np.isnan(stats['mean'][2]).all())
+
+    def test_daily_rows(self):
+        values = np.full((1, 2 * 1440), np.nan)
+        values[0, :120] = np.r_[np.full(60, 1.0), np.full(60, 3.0)]
+        rows = daily_rows(['temperature'], values, T0 - T0 % DAY, 60)
+        self.assertEqual(len(rows), 1)  # the empty second day has no row
+        sensor_type, day, stats = rows[0]
+        self.assertEqual((sensor_type, day), ('temperature', T0 - T0 % DAY))
+        self.assertEqual(dict(zip(('samples', 'mean', 'min', 'max', 'peak_hour_mean'),
+                                  [stats[0], stats[1], stats[3], stats[4], stats[8]])),
+                         {'samples': 120, 'mean': 2.0, 'min': 1.0, 'max': 3.0, 'peak_hour_mean': 3.0})
+
+    def test_run_resumes_from_watermarks(self):
+        until = T0 - T0 % DAY
+        job = FleetJob(workers=2, chunk_days=2, lookback_days=5, load=synthetic_site_chunk)
+        with self.assertLogs('analytic.fleet', 'ERROR'):
+            summary = job.run(['BLR001', 'BLR002', 'BAD'], until)
+        self.assertEqual((summary['done'], summary['failed'], summary['rows']), (2, 1, 2 * 5 * 2))
+        self.assertEqual(SensorDailyStats.objects.filter(site_id='BLR001', sensor_type='temperature').count(), 5)
+        newest = SensorDailyStats.objects.get(site_id='BLR002', sensor_type='temperature', day='2024-12-31')
+        self.assertEqual((newest.samples, newest.mean, newest.p95), (1440, 79.0, 79.0))
+        self.assertFalse(AnalyticsWatermark.objects.filter(site_id='BAD').exists())
+
+        # Sites with a watermark only get the new day; the failed site starts over
+        self.assertEqual(job.plan(['BLR001', 'BAD'], until + DAY),
+                         [('BLR001', until), ('BAD', until + DAY - 5 * DAY)])
+        summary = job.run(['BLR001', 'BLR002'], until + DAY)
+        self.assertEqual((summary['done'], summary['rows']), (2, 4))
+        self.assertEqual(SensorDailyStats.objects.filter(site_id='BLR001').count(), 12)
+        self.assertEqual(job.run(['BLR001'], until + DAY)['scheduled'], 0)
+
+
+class WindowStoreTest(SimpleTestCase):
+    """Mirrored ring buffers of recent readings"""
+
+    def test_window_is_a_copy_of_the_newest_readings(self):
+        store = WindowStore(points=5, max_series=4)
+        sites, sensors, timestamps, values = steady_readings(12)
+        for start in range(0, 12, 4):
+            store.append(sites[start:start + 4], sensors[start:start + 4],
+                         timestamps[start:start + 4], values[start:start + 4])
+        times, window = store.window('BLR001', 'temperature')
+        self.assertEqual(times.tolist(), timestamps[-5:].tolist())
+        self.assertEqual(window.tolist(), values[-5:].tolist())
+        self.assertFalse(np.shares_memory(window, store.values))
+        self.assertEqual(store.window('BLR001', 'temperature', last=2)[1].tolist(), values[-2:].tolist())
+        since = store.window('BLR001', 'temperature', since=int(timestamps[-3]))[0]
+        self.assertEqual(since.tolist(), timestamps[-3:].tolist())
+        self.assertEqual(len(store.window('BLR009', 'temperature')[1]), 0)
+        # Appending to the full ring overwrites the oldest slot of the window, but not the copy
+        store.append(['BLR001'], ['temperature'], [timestamps[-1] + 1], [-1.0])
+        self.assertEqual(window.tolist(), values[-5:].tolist())
+
+    def test_batch_matches_one_at_a_time(self):
+        """A batch with a key repeated more often than the ring holds keeps its newest readings in order"""
+        sites = ['BLR001', 'BLR002', 'BLR001'] * 6
+        sensors = ['temperature'] * 18
+        timestamps = np.arange(18)
+        values = np.arange(18, dtype=np.float64)
+        batched, single = WindowStore(points=4, max_series=2), WindowStore(points=4, max_series=2)
+        batched.append(sites, sensors, timestamps, values)
+        for i in range(18):
+            single.append(sites[i:i + 1], sensors[i:i + 1], timestamps[i:i + 1], values[i:i + 1])
+        for site in ('BLR001', 'BLR002'):
+            self.assertEqual(batched.window(site, 'temperature')[1].tolist(),
+                             single.window(site, 'temperature')[1].tolist())
+        self.assertEqual(batched.window('BLR002', 'temperature')[1].tolist(), [7.0, 10.0, 13.0, 16.0])
+
+    def test_least_recently_used_key_is_evicted(self):
+        store = WindowStore(points=3, max_series=2)
+        store.append(['BLR001', 'BLR002'], ['temperature'] * 2, [1, 1], [1.0, 2.0])
+        store.window('BLR001', 'temperature')
+        store.append(['BLR003'], ['temperature'], [2], [3.0])
+        self.assertEqual(store.keys(), [('BLR001', 'temperature'), ('BLR003', 'temperature')])
+        self.assertEqual(store.evicted, 1)
+        # The reused row starts empty
+        self.assertEqual(store.window('BLR003', 'temperature')[1].tolist(), [3.0])
+
+    def test_snapshot_round_trip(self):
+        store = WindowStore(points=4, max_series=3)
+        store.append(*steady_readings(6))
+        store.append(*steady_readings(2, site_id='BLR002', sensor_type='pressure'))
+        path = os.path.join(tempfile.mkdtemp(), 'state', 'windows.npz')
+        store.save(path, last_id='1700000000000-3')
+
+        restored, extra = WindowStore.load(path, points=4, max_series=3)
+        self.assertEqual(extra, {'last_id': '1700000000000-3'})
+        self.assertEqual(restored.keys(), store.keys())
+        for key in store.keys():
+            np.testing.assert_array_equal(restored.window(*key)[1], store.window(*key)[1])
+        restored.append(['BLR001'], ['temperature'], [T0_NS + 10**12], [90.0])
+        self.assertEqual(restored.window('BLR001', 'temperature')[1][-1], 90.0)
+
+        # A smaller store keeps the most recently used keys
+        smaller, _ = WindowStore.load(path, points=4, max_series=1)
+        self.assertEqual(smaller.keys(), [('BLR002', 'pressure')])
+        with self.assertRaises(ValueError):
+            WindowStore.load(path, points=8)
+
+    def test_view(self):
+        store = WindowStore(points=10, max_series=4)
+        now = T0_NS
+        store.append(['BLR001'] * 3, ['temperature'] * 3, [now, now + 10**9, now + 2 * 10**9], [1.0, 2.0, 6.0])
+        with mock.patch('analytic.views.get_window_store', return_value=store), \
+                mock.patch('analytic.views.time.time_ns', return_value=now + 3 * 10**9):
+            body = self.client.get(reverse('window_statistics'),
+                                   {'sensor': 'temperature', 'range': '1h', 'percentiles': '50'}).json()
+            self.assertEqual(body['sites'], {'BLR001': {
+                'count': 3, 'mean': 3.0, 'std': 7 ** 0.5, 'min': 1.0, 'max': 6.0, 'p50': 2.0,
+                'latest': 6.0, 'latest_time': '2025-01-01T10:00:02Z',
+            }})
+            body = self.client.get(reverse('window_statistics'), {'sensor': 'temperature', 'sites': 'BLR002'}).json()
+            self.assertEqual(body['sites'], {'BLR002': {'count': 0}})
+            self.assertEqual(self.client.get(reverse('window_statistics')).status_code, 400)
+        with mock.patch('analytic.views.get_window_store', return_value=None):
+            self.assertEqual(self.client.get(reverse('window_statistics'), {'sensor': 'temperature'}).status_code, 503)
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_feeder_follows_the_stream(self):
+        key = f'test-{os.getpid()}:window-readings'
+        self.addCleanup(REDIS.delete, key)
+        REDIS.xadd(key, stream_format.encode(list(zip(*steady_readings(20)))))
+        feeder = WindowFeeder(REDIS, WindowStore(points=8, max_series=2), key, last_id='0')
+        self.assertEqual(feeder.poll(block_ms=10), 1)
+        self.assertEqual(len(feeder.store.window('BLR001', 'temperature')[1]), 8)
+        self.assertEqual(feeder.poll(block_ms=10), 0)
+
+
+class ResultCacheTest(SimpleTestCase):
+    """Analytics results cached until new data arrives"""
+
+    def setUp(self):
+        self.prefix = f'test-{os.getpid()}-{self._testMethodName}'
+        self.watermarks_key = f'{self.prefix}:site_watermarks'
+        if REDIS:
+            self.addCleanup(lambda: REDIS.delete(self.watermarks_key, *REDIS.keys(f'{self.prefix}:results:*')))
+        self.computed = []
+
+    def cache(self, **kwargs):
+        return ResultCache(REDIS, self.prefix, self.watermarks_key, **kwargs)
+
+    def compute(self, content=b'{"mean": 1.0}', delay=0):
+        def compute():
+            time.sleep(delay)
+            self.computed.append(content)
+            return content
+        return compute
+
+    def publish(self, site_id, seconds_ago=60):
+        REDIS.hset(self.watermarks_key, mapping={site_id: time.time_ns() - seconds_ago * 10**9, '*': time.time_ns()})
+
+    def test_bypassed_when_redis_is_down(self):
+        import redis
+
+        client = mock.Mock()
+        client.hmget.side_effect = redis.ConnectionError
+        cache = ResultCache(client, 'test', 'test:site_watermarks')
+        with self.assertLogs('analytic.results', 'WARNING'):
+            self.assertEqual(cache.fetch('rolling', {}, ['BLR001'], lambda: b'{}'), (b'{}', 'bypass'))
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_valid_until_new_data_arrives(self):
+        self.publish('BLR001')
+        self.publish('BLR002')
+        cache = self.cache()
+        params = {'sensor': 'temperature', 'sites': ['BLR001']}
+        self.assertEqual(cache.fetch('rolling', params, ['BLR001'], self.compute())[1], 'miss')
+        self.assertEqual(cache.fetch('rolling', params, ['BLR001'], self.compute())[1], 'local')
+        self.assertEqual(self.cache().fetch('rolling', params, ['BLR001'], self.compute())[1], 'redis')
+        # New data for another site leaves the result valid; new data for BLR001 does not
+        self.publish('BLR002', seconds_ago=30)
+        self.assertEqual(cache.fetch('rolling', params, ['BLR001'], self.compute())[1], 'local')
+        self.publish('BLR001', seconds_ago=30)
+        self.assertEqual(cache.fetch('rolling', params, ['BLR001'], self.compute())[1], 'miss')
+        self.assertEqual(len(self.computed), 2)
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_results_next_to_new_data_are_kept_briefly(self):
+        self.publish('BLR001', seconds_ago=0)
+        content, outcome = self.cache(settle=2).fetch('rolling', {}, ['BLR001'], self.compute())
+        self.assertEqual(outcome, 'miss')
+        (key,) = REDIS.keys(f'{self.prefix}:results:*')
+        self.assertLessEqual(REDIS.pttl(key), 2000)
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_errors_are_not_cached(self):
+        cache = self.cache()
+        self.assertEqual(cache.fetch('rolling', {}, None, lambda: None), (None, 'miss'))
+        self.assertEqual(cache.fetch('rolling', {}, None, self.compute())[1], 'miss')
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_concurrent_requests_compute_once(self):
+        self.publish('BLR001')
+        cache = self.cache()
+        outcomes = []
+        threads = [
+            threading.Thread(target=lambda: outcomes.append(
+                cache.fetch('rolling', {}, ['BLR001'], self.compute(delay=0.2))[1]))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.computed), 1)
+        self.assertEqual(sorted(outcomes), ['local', 'local', 'local', 'miss'])
+
+    @skipUnless(REDIS, 'Redis server not available')
+    def test_rolling_view(self):
+        self.publish('BLR001')
+        grid = Grid('temperature', ['BLR001'], T0, 60, np.array([[1.0, 2.0]]))
+        params = {'sensor': 'temperature', 'sites': 'BLR001', 'start': str(T0), 'end': str(T0 + 120)}
+        with mock.patch('analytic.views.load_grid', return_value=grid) as load_grid, \
+                mock.patch('analytic.views.get_result_cache', return_value=self.cache()):
+            first = self.client.get(reverse('rolling_statistics'), params)
+            second = self.client.get(reverse('rolling_statistics'), params)
+        load_grid.assert_called_once()
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('miss', 'local'))
+        self.assertEqual(first.json(), second.json())
+
+
+def falling_grid(sensor_type='fuel_level', slots=96, every=900):
+    """Grid of three sites falling 1, 0 and -0.5 units per hour from 50, with every fourth slot missing"""
+    hours = np.arange(slots) * every / 3600
+    values = np.vstack([50 - hours, np.full(slots, 50.0), 50 + 0.5 * hours])
+    values[:, 3::4] = np.nan
+    return Grid(sensor_type, ['BLR001', 'BLR002', 'BLR003'], T0, every, values)
+
+
+class ForecastTest(TestCase):
+    """Fleet-wide linear and Holt trend forecasts"""
+
+    def test_trends_match_the_slope(self):
+        grid = falling_grid()
+        hours = (grid.timestamps - T0) / 3600
+        for fit in (linear_trend, holt):
+            with self.subTest(fit=fit.__name__):
+                level, rate = fit(grid.values, hours)
+                np.testing.assert_allclose(rate, [-1.0, 0.0, 0.5], atol=1e-3)
+                np.testing.assert_allclose(level, [50 - hours[-2], 50.0, 50 + 0.5 * hours[-2]], atol=1e-2)
+        level, rate = linear_trend(np.array([[np.nan, 1.0, np.nan]]), hours[:3])
+        self.assertTrue(np.isnan(level[0]) and np.isnan(rate[0]))
+
+    def test_refill_starts_a_new_cycle(self):
+        values = np.array([[30.0, 20.0, np.nan, 90.0, 85.0, np.nan], [30.0, 29.0, 31.0, 28.0, np.nan, 27.0]])
+        np.testing.assert_array_equal(since_last_rise(values, 10), [
+            [np.nan, np.nan, np.nan, 90.0, 85.0, np.nan],
+            [30.0, 29.0, 31.0, 28.0, np.nan, 27.0],
+        ])
+
+    def test_crossing_hours(self):
+        hours = crossing_hours(np.array([50.0, 50.0, -1.0, 50.0, 50.0]), np.array([-1.0, 0.5, -1.0, -0.01, np.nan]),
+                               0.0, horizon=1000)
+        np.testing.assert_array_equal(hours, [50.0, np.nan, 0.0, np.nan, np.nan])
+
+    def test_forecast_grid(self):
+        rows = dict(forecast_grid(falling_grid(), threshold=20.0, horizon_days=2))
+        self.assertEqual(sorted(rows), ['BLR001', 'BLR002', 'BLR003'])
+        fuel = rows['BLR001']
+        self.assertEqual((fuel['samples'], fuel['latest']), (72, 50 - 94 / 4))
+        self.assertEqual(fuel['observed_at'].timestamp(), T0 + 94 * 900)
+        self.assertAlmostEqual(fuel['linear_crossing'].timestamp(), T0 + 94 * 900 + 6.5 * 3600, delta=1)
+        self.assertIsNone(rows['BLR002']['holt_crossing'])
+        self.assertEqual(forecast_grid(falling_grid(slots=4), 20.0), [])
+
+    def test_job_stores_forecasts_for_the_view(self):
+        def load(sensor_type, sites, start, stop, every):
+            if sensor_type == 'efficiency':
+                raise ConnectionError('influxdb down')
+            self.assertEqual((stop - start, every), (86400, 900))
+            return falling_grid(sensor_type)
+
+        job = ForecastJob(lookback=86400, load=load)
+        with self.assertLogs('analytic.forecast', 'ERROR'):
+            summary = job.run(now=T0 + 86400)
+        self.assertEqual((summary['targets'], summary['failed'], summary['forecasts']), (1, 1, 3))
+        with self.assertLogs('analytic.forecast', 'ERROR'):
+            job.run(now=T0 + 86400)
+        self.assertEqual(SensorForecast.objects.count(), 3)
+
+        with mock.patch('analytic.views.time.time', return_value=T0 + 94 * 900):
+            body = self.client.get(reverse('forecasts'), {'sites': 'BLR001,BLR002', 'sensor': 'fuel_level'}).json()
+        self.assertEqual(sorted(body['sites']), ['BLR001', 'BLR002'])
+        fuel = body['sites']['BLR001']['fuel_level']
+        self.assertEqual(fuel['observed_at'], '2025-01-02T09:30:00Z')
+        self.assertAlmostEqual(fuel['linear']['rate_per_hour'], -1.0)
+        self.assertAlmostEqual(fuel['linear']['hours_left'], 50 - 94 / 4, delta=0.01)
+        self.assertIsNone(body['sites']['BLR002']['fuel_level']['holt']['crossing_at'])
+
+    def test_refilled_site_loses_its_old_forecast(self):
+        grid = falling_grid()
+        job = ForecastJob(targets=[{'sensor_type': 'fuel_level', 'threshold': 0.0, 'reset_rise': 10.0}],
+                          lookback=86400, load=lambda *args: grid)
+        job.run(now=T0 + 86400)
+        self.assertEqual(SensorForecast.objects.filter(sensor_type='fuel_level').count(), 3)
+
+        # BLR001 refilled two slots ago: too few values in the new cycle for a forecast
+        grid.values[0, -2:] = 95.0
+        summary = job.run(now=T0 + 86400)
+        self.assertEqual(summary['forecasts'], 2)
+        self.assertFalse(SensorForecast.objects.filter(site_id='BLR001').exists())
+        body = self.client.get(reverse('forecasts'), {'sensor': 'fuel_level'}).json()
+        self.assertEqual(sorted(body['sites']), ['BLR002', 'BLR003'])
+
+
+def kpi_cube():
+    """Four hourly slots of the core sensors for BLR001 and BLR002"""
+    nan = np.nan
+    values = np.array([
+        [[90, 90, 80, nan], [50, 48, 90, 88], [100, 100, 200, 100], [85, 85, 85, 85], [12, 12, 12, 20]],
+        [[88, 88, 88, 88], [nan, 60, nan, 58], [50, 50, 50, 50], [100, 100, 100, 100], [12, 12, 12, 12]],
+    ], dtype=np.float64)
+    sensors = ['efficiency', 'fuel_level', 'flow_rate', 'temperature', 'pressure']
+    return Cube(sensors, ['BLR001', 'BLR002'], T0, 3600, values)
+
+
+class FleetKpiTest(SimpleTestCase):
+    """Per-boiler KPI tables from one sites x sensors x slots array"""
+
+    def test_to_cube(self):
+        cube = to_cube(['temperature', 'pressure'], None, T0, T0 + 7200, 3600,
+                       ['BLR002', 'BLR001', 'BLR001', 'BLR001'], ['pressure', 'temperature', 'flow_rate', 'pressure'],
+                       [T0, T0 + 3600, T0, T0 + 7200], [12.0, 85.0, 100.0, 13.0])
+        self.assertEqual(cube.sites, ['BLR001', 'BLR002'])
+        np.testing.assert_array_equal(cube.values, [[[np.nan, 85.0], [np.nan, np.nan]],
+                                                    [[np.nan, np.nan], [12.0, np.nan]]])
+        np.testing.assert_array_equal(cube.sensor('pressure'), [[np.nan, np.nan], [12.0, np.nan]])
+
+    def test_kpis(self):
+        totals = site_totals(kpi_cube())
+        kpis = ratios(totals)
+        np.testing.assert_allclose(kpis['mean_efficiency'], [260 / 3, 88.0])
+        np.testing.assert_allclose(kpis['weighted_efficiency'], [85.0, 88.0])  # the 80% hour raised twice the steam
+        np.testing.assert_allclose(kpis['fuel_burn_rate'], [4 / 3, np.nan])  # the refill is not a burn
+        np.testing.assert_allclose(kpis['optimal_fraction'], [2 / 3, 0.0])
+        fleet = ratios({name: values.sum() for name, values in totals.items()})
+        self.assertAlmostEqual(float(fleet['weighted_efficiency']), 51600 / 600)
+        np.testing.assert_array_equal(percentile_rank([85.0, np.nan, 88.0, 85.0]), [200 / 3, np.nan, 100.0, 200 / 3])
+
+    def test_job_stores_one_payload_per_organization_for_the_view(self):
+        def load(sensor_types, sites, start, stop, every):
+            if every == 21600:
+                raise ConnectionError('influxdb down')
+            self.assertEqual((list(sensor_types), sites, stop - start, every),
+                             (cube.sensor_types, None, 4 * 3600, 3600))
+            return cube
+
+        cube = kpi_cube()
+        client = mock.MagicMock()
+        client.hgetall.return_value = {b'BLR001': b'ACME001', b'BLR002': b'ACME001', b'BLR009': b'ACME001'}
+        stored = {}
+        client.pipeline.return_value.set.side_effect = lambda key, value, ex: stored.__setitem__(key, value)
+        job = FleetKpiJob(client, 'test', 'iot:site_organizations', periods={'4h': 3600, '30d': 21600}, load=load)
+        with self.assertLogs('analytic.kpis', 'ERROR'):
+            summary = job.run(now=T0 + 4 * 3600 + 60)
+        self.assertEqual((summary['periods'], summary['failed'], summary['sites'], summary['payloads']), (1, 1, 3, 2))
+        self.assertEqual(sorted(stored), [kpis_key('test', '4h', '*'), kpis_key('test', '4h', 'ACME001')])
+
+        client = mock.Mock()
+        client.get.side_effect = lambda key: stored.get(key.replace('ai_processor', 'test'))
+        with self.settings(ANALYTICS_KPIS={**settings.ANALYTICS_KPIS, 'periods': {'4h': 3600}}), \
+                mock.patch('analytic.views.get_redis', return_value=client):
+            body = self.client.get(reverse('fleet_kpis'), {'organization': 'ACME001'}).json()
+            self.assertEqual(self.client.get(reverse('fleet_kpis'), {'period': '1y'}).status_code, 400)
+            self.assertEqual(self.client.get(reverse('fleet_kpis'), {'organization': 'NONE'}).status_code, 404)
+        self.assertEqual((body['start'], body['end'], body['every']),
+                         ('2025-01-01T10:00:00Z', '2025-01-01T14:00:00Z', 3600))
+        self.assertEqual([boiler['site_id'] for boiler in body['boilers']], ['BLR002', 'BLR001', 'BLR009'])
+        self.assertEqual([boiler['efficiency_percentile'] for boiler in body['boilers']], [100.0, 50.0, None])
+        self.assertEqual(body['boilers'][1], {
+            'site_id': 'BLR001', 'mean_efficiency': 86.667, 'weighted_efficiency': 85.0, 'fuel_burn_rate': 1.333,
+            'optimal_fraction': 0.667, 'hours_in_band': 2.0, 'hours_with_data': 4.0, 'efficiency_percentile': 50.0,
+        })
+        self.assertEqual(body['fleet'], {
+            'boilers': 3, 'reporting': 2, 'mean_efficiency': 87.429, 'weighted_efficiency': 86.0,
+            'fuel_burn_rate': 1.333, 'optimal_fraction': 0.286,
+        })
+
+
+def local_store():
+    """Two sites with temperature every 20 minutes for two hours, BLR001 also with pressure"""
+    store = flux.LocalStore()
+    minutes = range(0, 120, 20)
+    store.write(('BLR001', 'temperature', T0_NS + m * 60 * 10**9, 80.0 + m) for m in minutes)
+    store.write(('BLR002', 'temperature', T0_NS + m * 60 * 10**9, 90.0) for m in minutes)
+    store.write([('BLR001', 'pressure', T0_NS, 12.0)])
+    return store
+
+
+class FluxQueryTest(SimpleTestCase):
+    """Typed history queries: Flux generation, the local stand-in and CSV parsing"""
+
+    def test_to_flux_pushes_the_reduction_down(self):
+        query = flux.SeriesQuery(('temperature', 'pressure'), T0, T0 + 7200, sites=('BLR001',), every=3600,
+                                 aggregate='max', group_by=('sensor_type',))
+        text = query.to_flux('sensor_data')
+        self.assertIn('contains(value: r.sensor_type, set: ["temperature", "pressure"])', text)
+        self.assertIn('filter(fn: (r) => r.site_id == "BLR001")', text)
+        self.assertIn('group(columns: ["sensor_type"])', text)
+        self.assertIn('aggregateWindow(every: 3600s, fn: max, createEmpty: false, timeSrc: "_start")', text)
+        self.assertIn('keep(columns: ["_time", "_value", "sensor_type"])', text)
+        summary = flux.SeriesQuery('temperature', T0, T0 + 60, aggregate='last', group_by=('sensor_type',))
+        self.assertIn('|> sort(columns: ["_time"])\n  |> last()', summary.to_flux('sensor_data'))
+        self.assertNotIn('aggregateWindow', summary.to_flux('sensor_data'))
+        self.assertNotIn('site_id', summary.to_flux('sensor_data'))
+        self.assertNotIn('aggregateWindow', query.to_raw_flux('sensor_data'))
+        for bad in ({'aggregate': 'median'}, {'group_by': ('unit',)}, {'every': 0}):
+            with self.assertRaises(flux.QueryError):
+                flux.SeriesQuery('temperature', T0, T0 + 60, **bad)
+
+    def test_local_store(self):
+        store = local_store()
+        hourly = store.run(flux.SeriesQuery('temperature', T0, T0 + 7200, every=3600))
+        self.assertEqual(hourly, [
+            flux.Row(T0_NS, 100.0, ('BLR001', 'temperature')),
+            flux.Row(T0_NS + 3600 * 10**9, 160.0, ('BLR001', 'temperature')),
+            flux.Row(T0_NS, 90.0, ('BLR002', 'temperature')),
+            flux.Row(T0_NS + 3600 * 10**9, 90.0, ('BLR002', 'temperature')),
+        ])
+        fleet = store.run(flux.SeriesQuery((), T0, T0 + 3600, aggregate='count', group_by=('sensor_type',)))
+        self.assertEqual(fleet, [flux.Row(T0_NS, 1.0, ('pressure',)), flux.Row(T0_NS, 6.0, ('temperature',))])
+        self.assertEqual(len(store.run_raw(flux.SeriesQuery((), T0, T0 + 7200, sites='BLR001'))), 7)
+
+    def test_influx_executor_parses_csv(self):
+        """A CSV response with two tables gives the rows the local store computes for the same query"""
+        body = (
+            ',result,table,_time,_value,site_id,sensor_type\r\n'
+            ',_result,0,2025-01-01T10:00:00Z,100,BLR001,temperature\r\n'
+            ',_result,0,2025-01-01T11:00:00Z,160,BLR001,temperature\r\n'
+            '\r\n'
+            ',result,table,_time,_value,site_id,sensor_type\r\n'
+            ',_result,1,2025-01-01T10:00:00.000000001Z,90,BLR002,temperature\r\n'
+            ',_result,1,2025-01-01T11:00:00Z,90,BLR002,temperature\r\n'
+        ).encode()
+        query_api = mock.Mock()
+        query_api.query_raw.return_value.data = body
+        executor = flux.InfluxExecutor(query_api, 'sensor_data', 'steambytes')
+        query = flux.SeriesQuery('temperature', T0, T0 + 7200, every=3600)
+        rows = executor.run(query)
+        self.assertEqual(query_api.query_raw.call_args[0][0], query.to_flux('sensor_data'))
+        self.assertEqual(executor.bytes_received, len(body))
+        self.assertEqual(rows[2].time, T0_NS + 1)
+        self.assertEqual([row._replace(time=row.time // 10) for row in rows],
+                         [row._replace(time=row.time // 10) for row in local_store().run(query)])
+
+        query_api.query_raw.return_value.data = b',result,table,_value,sensor_type\r\n,_result,0,42.5,pressure\r\n'
+        summary = flux.SeriesQuery('pressure', T0, T0 + 60, group_by=('sensor_type',))
+        self.assertEqual(executor.run(summary), [flux.Row(T0_NS, 42.5, ('pressure',))])
+        query_api.query_raw.return_value.data = b'error,reference\r\nunknown bucket,\r\n'
+        with self.assertRaises(flux.QueryError):
+            executor.run(summary)
+
+    def test_max_rows_stops_reading_the_response(self):
+        class Response(io.BytesIO):
+            def release_conn(self):
+                pass
+
+        lines = ''.join(f',_result,0,2025-01-01T10:{minute:02d}:00Z,1,BLR001,temperature\r\n' for minute in range(60))
+        header = ',result,table,_time,_value,site_id,sensor_type\r\n'
+        body = (header + lines).encode()
+        query_api = mock.Mock()
+        executor = flux.InfluxExecutor(query_api, 'sensor_data', 'steambytes')
+        query = flux.SeriesQuery('temperature', T0, T0 + 3600, every=60)
+        query_api.query_raw.return_value = Response(body)
+        self.assertEqual(len(executor.run(query, max_rows=60)), 60)
+        query_api.query_raw.return_value = Response((header + lines * 1000).encode())
+        with self.assertRaises(flux.TooManyRows):
+            executor.run(query, max_rows=60)
+        self.assertLess(executor.bytes_received, 2 * len(body) + 65536)  # the rest of the response is left unread
+        with self.assertRaises(flux.TooManyRows):
+            local_store().run(flux.SeriesQuery((), T0, T0 + 7200, every=60), max_rows=1)
+
+
+class ArchiveTest(SimpleTestCase):
+    """Parquet export of raw history and the memory-mapped reader"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        # Two days from midnight: BLR001 temperature every 10 minutes, pressure on the first day only
+        midnight = (T0 - T0 % DAY) * 10**9
+        self.store = flux.LocalStore()
+        self.store.write(('BLR001', 'temperature', midnight + m * 600 * 10**9, 80.0 + m % 6) for m in range(288))
+        self.store.write(('BLR001', 'pressure', midnight + m * 600 * 10**9, 12.5) for m in range(144))
+        self.store.write([('BLR002', 'temperature', midnight, 90.0)])
+
+    def test_export_and_read_back(self):
+        exporter = HistoryExporter(self.store, self.root, chunk_rows=50)
+        summary = exporter.run(['BLR001', 'BLR002'], date(2025, 1, 1), date(2025, 1, 3))
+        self.assertEqual((summary['files'], summary['readings'], summary['failed']), (3, 433, 0))
+        self.assertEqual([(p.site_id, p.day.isoformat()) for p in partitions(self.root)],
+                         [('BLR001', '2025-01-01'), ('BLR001', '2025-01-02'), ('BLR002', '2025-01-01')])
+
+        import pyarrow.parquet as pq
+
+        first = partitions(self.root, sites=['BLR001'])[0].path
+        metadata = pq.ParquetFile(first).metadata
+        self.assertEqual((metadata.num_rows, metadata.num_row_groups), (288, 6))  # 50-row batches
+        self.assertEqual(str(pq.read_schema(first).field('value').type), 'float')
+        self.assertEqual(str(pq.read_schema(first).field('time').type), 'timestamp[ns, tz=UTC]')
+
+        groups = list(iter_partitions(self.root, sites=['BLR001'], start=date(2025, 1, 2), sensor_types=['temperature']))
+        self.assertEqual(sum(len(values) for *_, values in groups), 144)
+        _, sensors, times, values = groups[0]
+        self.assertEqual((set(sensors), values.dtype, times.dtype), ({'temperature'}, np.float32, np.int64))
+        self.assertTrue(np.all(np.diff(times) > 0))
+
+        # Days with a file are skipped unless overwriting
+        self.assertEqual(exporter.run(['BLR001'], date(2025, 1, 1), date(2025, 1, 2))['skipped'], 1)
+
+    def test_archive_feeds_the_fleet_job(self):
+        HistoryExporter(self.store, self.root).run(['BLR001'], date(2025, 1, 1), date(2025, 1, 3))
+        midnight = T0 - T0 % DAY
+        sensors, values = load_archive_chunk(self.root, 'BLR001', midnight, midnight + 2 * DAY, 3600)
+        self.assertEqual(sensors, ['pressure', 'temperature'])
+        self.assertEqual(values.shape, (2, 48))
+        np.testing.assert_array_equal(values[1], np.full(48, 82.5))
+        self.assertTrue(np.isnan(values[0, 24:]).all())
+        rows = daily_rows(sensors, values, midnight, 3600)
+        self.assertEqual(len(rows), 3)
+
+    def test_archive_feeds_the_quality_job(self):
+        HistoryExporter(self.store, self.root).run(['BLR001'], date(2025, 1, 1), date(2025, 1, 3))
+        midnight = T0 - T0 % DAY
+        sites, sensors, times, values = load_archive_readings(self.root, ['BLR001'], midnight + DAY, midnight + 2 * DAY)
+        self.assertEqual((len(times), set(sites), set(sensors), values.dtype), (144, {'BLR001'}, {'temperature'},
+                                                                                np.float64))
+        self.assertTrue(times.min() >= (midnight + DAY) * 10**9)
+
+
+def gappy_store():
+    """One day from midnight with holes: BLR001 every minute, BLR002 temperature every 30 s and no pressure"""
+    midnight = T0 - T0 % DAY
+    store = flux.LocalStore()
+    minute = 60 * 10**9
+    store.write(('BLR001', 'temperature', midnight * 10**9 + m * minute, 80.0) for m in range(1440) if not 600 <= m < 720)
+    store.write(('BLR001', 'pressure', midnight * 10**9 + m * minute, 12.0) for m in range(1080))  # silent after 18:00
+    store.write(('BLR002', 'temperature', midnight * 10**9 + m * minute // 2, 90.0) for m in range(120, 2880))
+    return midnight, store
+
+
+class DataQualityTest(TestCase):
+    """Gap detection, completeness and resampling of irregular raw series"""
+
+    def readings(self, store, start, stop):
+        rows = store.run_raw(flux.SeriesQuery((), start, stop))
+        return to_readings([row.group[0] for row in rows], [row.group[1] for row in rows], [row.time for row in rows],
+                           [row.value for row in rows], keys=[('BLR002', 'pressure')])
+
+    def test_gaps_and_completeness(self):
+        midnight, store = gappy_store()
+        readings = self.readings(store, midnight, midnight + DAY)
+        self.assertEqual(readings.keys, [('BLR001', 'pressure'), ('BLR001', 'temperature'), ('BLR002', 'pressure'),
+                                         ('BLR002', 'temperature')])
+        cadence, inferred = cadences(readings, {'temperature': 60}, default=300)
+        np.testing.assert_array_equal(cadence, [60, 60, 300, 60])
+        np.testing.assert_array_equal(inferred, [True, False, False, False])
+
+        gaps = find_gaps(readings, cadence, midnight, midnight + DAY)
+        self.assertEqual(gaps.series.tolist(), [0, 1, 2, 3])
+        self.assertEqual(((gaps.stops - gaps.starts) // 10**9).tolist(), [361 * 60, 121 * 60, DAY, 3600])
+        self.assertEqual((gaps.starts[1] // 10**9 - midnight, gaps.stops[3] // 10**9 - midnight), (599 * 60, 3600))
+
+        filled, expected = completeness(readings, cadence, midnight, midnight + DAY)
+        self.assertEqual(filled.tolist(), [1080, 1320, 0, 1380])
+        self.assertEqual(expected.tolist(), [1440, 1440, 288, 1440])
+
+    def test_regular_grid_matches_pandas(self):
+        rng = np.random.default_rng(3)
+        times = np.sort(rng.integers(0, 3600, 400)) * 10**9 + T0_NS
+        sites = np.where(rng.random(400) < 0.5, 'BLR001', 'BLR002')
+        values = rng.normal(80, 5, 400)
+        readings = to_readings(sites, np.full(400, 'temperature'), times, values)
+        for how in ('mean', 'last'):
+            for limit in (0, 2, None):
+                with self.subTest(how=how, limit=limit):
+                    grid = regular_grid(readings, T0, T0 + 3600, 60, how=how, limit=limit)
+                    for row, (site, _) in enumerate(readings.keys):
+                        picked = sites == site
+                        series = pd.Series(values[picked], index=pd.to_datetime(times[picked], utc=True))
+                        expected = getattr(series.resample('60s'), how)().reindex(
+                            pd.date_range(pd.Timestamp(T0, unit='s', tz='UTC'), periods=60, freq='60s'))
+                        if limit != 0:
+                            expected = expected.ffill(limit=limit)
+                        np.testing.assert_allclose(grid[row], expected.to_numpy())
+
+    def test_job_stores_reports_for_the_view(self):
+        midnight, store = gappy_store()
+        job = QualityJob(sensor_types=('temperature', 'pressure'), cadence_seconds={'temperature': 60}, max_gaps=1,
+                         chunk_sites=1)
+        with mock.patch('analytic.quality.history.get_executor', return_value=store):
+            summary = job.run(['BLR001', 'BLR002'], date(2025, 1, 1), date(2025, 1, 2))
+        self.assertEqual((summary['reports'], summary['gaps'], summary['readings'], summary['failed']),
+                         (4, 4, 1320 + 1080 + 2760, 0))
+        report = SensorGapReport.objects.get(site_id='BLR002', sensor_type='pressure')
+        self.assertEqual((report.readings, report.completeness, report.cadence_seconds), (0, 0.0, 60.0))
+        self.assertEqual(report.gaps, [['2025-01-01T00:00:00Z', '2025-01-02T00:00:00Z']])
+
+        body = self.client.get(reverse('data_quality'), {'sites': 'BLR001'}).json()
+        self.assertEqual(body['day'], '2025-01-01')
+        site = body['sites']['BLR001']
+        self.assertAlmostEqual(site['completeness'], (0.75 + 1320 / 1440) / 2, places=3)
+        self.assertEqual(site['gap_count'], 2)
+        temperature = site['sensors']['temperature']
+        self.assertEqual((temperature['longest_gap_seconds'], temperature['cadence_inferred']), (7260.0, False))
+        self.assertEqual(temperature['gaps'], [['2025-01-01T09:59:00Z', '2025-01-01T12:00:00Z']])
+        self.assertTrue(site['sensors']['pressure']['cadence_inferred'])
+
+        # Rerunning replaces the day's reports
+        with mock.patch('analytic.quality.history.get_executor', return_value=store):
+            job.run(['BLR001', 'BLR002'], date(2025, 1, 1), date(2025, 1, 2))
+        self.assertEqual(SensorGapReport.objects.count(), 4)
+        self.assertEqual(self.client.get(reverse('data_quality'), {'day': '2025-01-02'}).json()['sites'], {})
+        self.assertEqual(self.client.get(reverse('data_quality'), {'day': 'yesterday'}).status_code, 400)
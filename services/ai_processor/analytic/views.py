@@ -1,4 +1,45 @@
-from django.http import JsonResponse
+import logging
+import time
+from datetime import date
+
+import numpy as np
+from boiler_common import metrics
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
+
+from .cache import get_redis, key_prefix
+from .consumer import anomaly_keys, parse_event
+from .forecast import METHODS
+from .history import HistoryError, load_cube, load_grid, parse_duration, parse_time
+from .kernels import STATISTICS, block_stats, rolling_stats
+from .kpis import ALL_ORGANIZATIONS, kpis_key
+from .models import SensorForecast, SensorGapReport
+from .multivariate import window_scores
+from .results import get_result_cache
+from .windows import get_window_store
+
+# Rolling statistics requests: defaults, and the largest (sites x slots) grid computed
+ROLLING_DEFAULTS = {'window': '1h', 'every': '1m', 'range': '24h', 'stats': 'mean,std,min,max'}
+MAX_GRID_CELLS = 5_000_000
+
+# Window store requests: default lookback
+WINDOW_DEFAULT_RANGE = '1h'
+
+# Multivariate scoring of historical windows: defaults
+MULTIVARIATE_DEFAULTS = {'every': '5m', 'range': '24h', 'warmup': '30'}
+
+# Anomaly event listings: default and largest page, and the most recent events scanned when filtering
+ANOMALY_PAGE = 100
+MAX_ANOMALY_PAGE = 1000
+MAX_ANOMALY_SCAN = 10_000
+
+KERNEL_LATENCY = metrics.histogram('analytics_kernel_duration_seconds', 'Analytics kernel compute time', ['kernel'])
+ROLLING_LATENCY = KERNEL_LATENCY.labels('rolling')
+WINDOW_LATENCY = KERNEL_LATENCY.labels('window')
+MULTIVARIATE_LATENCY = KERNEL_LATENCY.labels('multivariate')
+
+logger = logging.getLogger(__name__)
 
 # AI Processor Views - Cleaned for Re-implementation
 
@@ -9,3 +50,401 @@ def health_check(request):
         "service": "ai_processor",
         "purpose": "Analytics & ML Processing"
     })
+
+
+# ============================================================================
+# ANALYTICS VIEWS
+# ============================================================================
+
+def error_response(message, status=400):
+    return JsonResponse({"status": "error", "error": message}, status=status)
+
+
+def to_json_list(values):
+    """Array as nested lists with NaN as null"""
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def iso(seconds):
+    return np.datetime_as_string(np.asarray(seconds, dtype='datetime64[s]'), unit='s', timezone='UTC').tolist()
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def cached_json(namespace, params, sites, compute):
+    """
+    ``compute()``'s response, served from the result cache until new data arrives for ``sites``
+
+    ``params`` must identify the response completely; ``sites`` None means
+    any site. Only 200 responses are cached. The ``X-Cache`` header tells
+    where the response came from.
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return compute()
+    computed = []
+
+    def serialise():
+        response = compute()
+        computed.append(response)
+        return response.content if response.status_code == 200 else None
+
+    content, outcome = cache.fetch(namespace, params, sites, serialise)
+    response = computed[0] if computed else HttpResponse(content, content_type='application/json')
+    response['X-Cache'] = outcome
+    return response
+
+
+@require_GET
+def rolling_statistics(request):
+    """
+    Rolling statistics of one sensor type for many sites at once
+
+    Query parameters: ``sensor`` (required), ``sites`` (comma-separated,
+    default every site with data), ``window`` and ``every`` (slot width) as
+    durations such as 15m or 1h, ``range`` (lookback, default 24h) or
+    ``start``/``end``, ``stats`` (any of count, mean, std, min, max),
+    ``percentiles`` (e.g. 50,95), ``min_periods`` and ``latest=1`` to return
+    only the newest window of each site.
+    """
+    params = {**ROLLING_DEFAULTS, **request.GET.dict()}
+    sensor = params.get('sensor')
+    if not sensor:
+        return error_response("sensor is required")
+    sites = split_list(params['sites']) if params.get('sites') else None
+    statistics = split_list(params['stats'])
+    try:
+        every = parse_duration(params['every'])
+        window = parse_duration(params['window'])
+        # Without an end, up to the end of the current slot, so that the request stays the same for a whole slot
+        end = parse_time(params['end']) if 'end' in params else -(-int(time.time()) // every) * every
+        start = parse_time(params['start']) if 'start' in params else end - parse_duration(params['range'])
+        percentiles = [float(q) for q in split_list(params.get('percentiles', ''))]
+        min_periods = int(params.get('min_periods', 1))
+    except (HistoryError, ValueError) as e:
+        return error_response(str(e))
+    if window % every:
+        return error_response("window must be a whole number of slots (every)")
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        return error_response(f"stats must be among {', '.join(STATISTICS)}")
+
+    # InfluxDB windows are aligned on multiples of ``every``
+    start -= start % every
+    slots = -(-(end - start) // every)
+    if slots <= 0:
+        return error_response("start must be before end")
+    if sites is not None and len(sites) * slots > MAX_GRID_CELLS:
+        return error_response(f"sites x slots exceeds {MAX_GRID_CELLS}; narrow the range or widen every")
+
+    latest = params.get('latest') in ('1', 'true')
+
+    def compute():
+        try:
+            grid = load_grid(sensor, sites, start, end, every)
+        except Exception:
+            logger.exception("Loading %s history failed", sensor)
+            return error_response("sensor history is unavailable", status=503)
+        if grid.values.size > MAX_GRID_CELLS:
+            return error_response(f"sites x slots exceeds {MAX_GRID_CELLS}; narrow the range or widen every")
+        # The newest window only depends on the last ``window`` slots
+        values = grid.values[:, -(window // every):] if latest else grid.values
+        try:
+            with ROLLING_LATENCY.time():
+                results = rolling_stats(values, window // every, statistics, percentiles, min_periods)
+        except ValueError as e:
+            return error_response(str(e))
+        if latest:
+            results = {name: result[:, -1] for name, result in results.items()}
+        series = {name: to_json_list(result) for name, result in results.items()}
+        response = {
+            "sensor": sensor,
+            "window": params['window'],
+            "every": params['every'],
+            "start": iso(start),
+            "end": iso(end),
+            "sites": {
+                site: {name: values[row] for name, values in series.items()}
+                for row, site in enumerate(grid.sites)
+            },
+        }
+        if latest:
+            response["time"] = iso(grid.timestamps[-1])
+        else:
+            response["timestamps"] = iso(grid.timestamps)
+        return JsonResponse(response)
+
+    key = {
+        'sensor': sensor, 'sites': sites, 'start': start, 'end': end, 'every': params['every'],
+        'window': params['window'], 'stats': statistics, 'percentiles': percentiles,
+        'min_periods': min_periods, 'latest': latest,
+    }
+    return cached_json('rolling', key, sites, compute)
+
+
+@require_GET
+def multivariate_scores(request):
+    """
+    Mahalanobis distance of every slot of many sites' sensor vectors over a historical window
+
+    Query parameters: ``sites`` (comma-separated, default every site with
+    data), ``sensors`` (default the streaming detector's), ``every`` (slot
+    width, default 5m), ``range`` (lookback, default 24h) or
+    ``start``/``end``, ``warmup`` (slots before scoring starts, default 30)
+    and ``threshold``. Each slot is scored against the slots before it in the
+    window. Per site: the scores, the slots above the threshold with the
+    sensor contributing most, and the correlation matrix of the window.
+    """
+    config = settings.ANALYTICS_DETECTORS['multivariate']
+    params = {**MULTIVARIATE_DEFAULTS, **request.GET.dict()}
+    sites = split_list(params['sites']) if params.get('sites') else None
+    sensors = split_list(params['sensors']) if params.get('sensors') else list(config['sensor_types'])
+    try:
+        every = parse_duration(params['every'])
+        end = parse_time(params['end']) if 'end' in params else -(-int(time.time()) // every) * every
+        start = parse_time(params['start']) if 'start' in params else end - parse_duration(params['range'])
+        warmup = int(params['warmup'])
+        threshold = float(params.get('threshold', config['threshold']))
+    except (HistoryError, ValueError) as e:
+        return error_response(str(e))
+    if len(sensors) < 2 or len(set(sensors)) != len(sensors):
+        return error_response("sensors must name at least two distinct sensor types")
+    start -= start % every
+    slots = -(-(end - start) // every)
+    if slots <= 0:
+        return error_response("start must be before end")
+    if sites is not None and len(sites) * slots > MAX_GRID_CELLS:
+        return error_response(f"sites x slots exceeds {MAX_GRID_CELLS}; narrow the range or widen every")
+
+    def compute():
+        try:
+            cube = load_cube(sensors, sites, start, end, every)
+        except Exception:
+            logger.exception("Loading %s history failed", ', '.join(sensors))
+            return error_response("sensor history is unavailable", status=503)
+        if len(cube.sites) * slots > MAX_GRID_CELLS:
+            return error_response(f"sites x slots exceeds {MAX_GRID_CELLS}; narrow the range or widen every")
+        timestamps = start + every * np.arange(slots, dtype=np.int64)
+        # Sites in chunks, so the (slots x k x k) running sums stay within MAX_GRID_CELLS values
+        chunk = max(1, MAX_GRID_CELLS // (slots * len(sensors) ** 2))
+        results = {}
+        with MULTIVARIATE_LATENCY.time():
+            for first in range(0, len(cube.sites), chunk):
+                scores = window_scores(cube.values[first:first + chunk].transpose(0, 2, 1), warmup)
+                for offset, site in enumerate(cube.sites[first:first + chunk]):
+                    distance = scores.distance[offset]
+                    above = np.flatnonzero(distance > threshold)
+                    culprits = np.argmax(scores.contributions[offset, above], axis=1) if len(above) else []
+                    results[site] = {
+                        "score": to_json_list(distance),
+                        "samples": int(scores.samples[offset]),
+                        "correlation": to_json_list(scores.correlation[offset]),
+                        "anomalies": [
+                            {"time": iso(timestamps[slot]), "score": float(distance[slot]), "sensor": sensors[column]}
+                            for slot, column in zip(above, culprits)
+                        ],
+                    }
+        return JsonResponse({
+            "sensors": sensors,
+            "every": params['every'],
+            "start": iso(start),
+            "end": iso(end),
+            "threshold": threshold,
+            "timestamps": iso(timestamps),
+            "sites": results,
+        })
+
+    key = {'sites': sites, 'sensors': sensors, 'start': start, 'end': end, 'every': params['every'],
+           'warmup': warmup, 'threshold': threshold}
+    return cached_json('multivariate', key, sites, compute)
+
+
+@require_GET
+def anomaly_events(request):
+    """
+    Most recent anomaly events raised by the streaming detectors, newest first
+
+    Optional ``site``, ``sensor`` and ``detector`` filters, and ``limit``
+    (default 100, at most 1000). Filtered listings look at the latest
+    10,000 events only.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', ANOMALY_PAGE)), MAX_ANOMALY_PAGE)
+    except ValueError:
+        return error_response("limit must be an integer")
+    filters = {
+        field: request.GET[name]
+        for name, field in (('site', 'site_id'), ('sensor', 'sensor_type'), ('detector', 'detector'))
+        if request.GET.get(name)
+    }
+    events_key, _ = anomaly_keys()
+    try:
+        entries = get_redis().xrevrange(events_key, count=MAX_ANOMALY_SCAN if filters else limit)
+    except Exception:
+        logger.exception("Reading %s failed", events_key)
+        return error_response("anomaly events are unavailable", status=503)
+    events = []
+    for entry_id, fields in entries:
+        event = parse_event(entry_id, fields)
+        if all(event[field] == value for field, value in filters.items()):
+            events.append(event)
+            if len(events) == limit:
+                break
+    return JsonResponse({"events": events})
+
+
+@require_GET
+def window_statistics(request):
+    """
+    Statistics of the recent raw readings of one sensor type, from the in-memory window store
+
+    Query parameters: ``sensor`` (required), ``sites`` (comma-separated,
+    default every site in the store), ``range`` (lookback, default 1h),
+    ``last`` (at most this many newest readings per site) and
+    ``percentiles``. Only what the store holds is covered; longer history
+    comes from the rolling endpoint.
+    """
+    store = get_window_store()
+    if store is None:
+        return error_response("the window store is disabled", status=503)
+    sensor = request.GET.get('sensor')
+    if not sensor:
+        return error_response("sensor is required")
+    try:
+        since = time.time_ns() - parse_duration(request.GET.get('range', WINDOW_DEFAULT_RANGE)) * 10**9
+        last = int(request.GET['last']) if 'last' in request.GET else None
+        percentiles = [float(q) for q in split_list(request.GET.get('percentiles', ''))]
+    except (HistoryError, ValueError) as e:
+        return error_response(str(e))
+    if request.GET.get('sites'):
+        sites = split_list(request.GET['sites'])
+    else:
+        sites = sorted(site for site, sensor_type in store.keys() if sensor_type == sensor)
+
+    results = {}
+    with WINDOW_LATENCY.time():
+        for site in sites:
+            timestamps, values = store.window(site, sensor, last=last, since=since)
+            if not len(values):
+                results[site] = {"count": 0}
+                continue
+            # One block covering the whole window, copied out of the store under its lock
+            stats = block_stats(values[np.newaxis], len(values), percentiles)
+            results[site] = {name: to_json_list(result[0, 0]) for name, result in stats.items()}
+            results[site]["count"] = len(values)
+            results[site]["latest"] = float(values[-1])
+            results[site]["latest_time"] = iso(timestamps[-1] // 10**9)
+    return JsonResponse({"sensor": sensor, "sites": results})
+
+
+@require_GET
+def forecasts(request):
+    """
+    Latest fuel and efficiency forecasts, as stored by run_forecasts
+
+    Optional ``sites`` (comma-separated) and ``sensor`` filters. Per site
+    and sensor: the newest slot mean, and for each method (``linear``,
+    ``holt``) the trend level and rate per hour, when the threshold is
+    crossed (null when not within the horizon) and the hours left from now.
+    Nothing is fitted here.
+    """
+    rows = SensorForecast.objects.all()
+    if request.GET.get('sites'):
+        rows = rows.filter(site_id__in=split_list(request.GET['sites']))
+    if request.GET.get('sensor'):
+        rows = rows.filter(sensor_type=request.GET['sensor'])
+    now = time.time()
+    sites = {}
+    for row in rows:
+        forecast = {
+            "threshold": row.threshold,
+            "latest": row.latest,
+            "observed_at": iso(int(row.observed_at.timestamp())),
+            "samples": row.samples,
+            "computed_at": iso(int(row.computed_at.timestamp())),
+        }
+        for method in METHODS:
+            crossing = getattr(row, f'{method}_crossing')
+            forecast[method] = {
+                "level": getattr(row, f'{method}_level'),
+                "rate_per_hour": getattr(row, f'{method}_rate'),
+                "crossing_at": None if crossing is None else iso(int(crossing.timestamp())),
+                "hours_left": None if crossing is None else round(max(0.0, crossing.timestamp() - now) / 3600, 2),
+            }
+        sites.setdefault(row.site_id, {})[row.sensor_type] = forecast
+    return JsonResponse({"sites": sites})
+
+
+@require_GET
+def fleet_kpis(request):
+    """
+    KPI table of every boiler of an organization over a period, as stored by run_fleet_kpis
+
+    Query parameters: ``organization`` (default the whole fleet) and
+    ``period`` (one of the configured periods, default the first). The
+    stored payload is returned as is; nothing is computed here.
+    """
+    periods = settings.ANALYTICS_KPIS['periods']
+    period = request.GET.get('period') or next(iter(periods))
+    if period not in periods:
+        return error_response(f"period must be one of {', '.join(periods)}")
+    organization = request.GET.get('organization') or ALL_ORGANIZATIONS
+    key = kpis_key(key_prefix(), period, organization)
+    try:
+        payload = get_redis().get(key)
+    except Exception:
+        logger.exception("Reading %s failed", key)
+        return error_response("fleet KPIs are unavailable", status=503)
+    if payload is None:
+        return error_response(f"no KPIs for organization {organization} over {period} yet", status=404)
+    return HttpResponse(payload, content_type='application/json')
+
+
+@require_GET
+def data_quality(request):
+    """
+    Gap reports of one UTC day, as stored by run_data_quality
+
+    Query parameters: ``day`` (YYYY-MM-DD, default the newest day with
+    reports), optional ``sites`` (comma-separated) and ``sensor`` filters.
+    Per site: its completeness (mean over its sensors), readings and gaps,
+    and per sensor the stored report, with its longest gaps. Nothing is
+    computed from the readings here.
+    """
+    rows = SensorGapReport.objects.all()
+    if request.GET.get('sites'):
+        rows = rows.filter(site_id__in=split_list(request.GET['sites']))
+    if request.GET.get('sensor'):
+        rows = rows.filter(sensor_type=request.GET['sensor'])
+    if request.GET.get('day'):
+        try:
+            day = date.fromisoformat(request.GET['day'])
+        except ValueError:
+            return error_response("day must be YYYY-MM-DD")
+    else:
+        day = rows.order_by('-day').values_list('day', flat=True).first()
+        if day is None:
+            return error_response("no data-quality reports yet", status=404)
+    sites = {}
+    for row in rows.filter(day=day):
+        site = sites.setdefault(row.site_id, {"completeness": 0.0, "readings": 0, "gap_count": 0, "sensors": {}})
+        site["sensors"][row.sensor_type] = {
+            "readings": row.readings,
+            "cadence_seconds": row.cadence_seconds,
+            "cadence_inferred": row.cadence_inferred,
+            "expected_slots": row.expected_slots,
+            "completeness": row.completeness,
+            "gap_count": row.gap_count,
+            "gap_seconds": row.gap_seconds,
+            "longest_gap_seconds": row.longest_gap_seconds,
+            "gaps": row.gaps,
+            "computed_at": iso(int(row.computed_at.timestamp())),
+        }
+        site["completeness"] += row.completeness
+        site["readings"] += row.readings
+        site["gap_count"] += row.gap_count
+    for site in sites.values():
+        site["completeness"] = round(site["completeness"] / len(site["sensors"]), 4)
+    return JsonResponse({"day": day.isoformat(), "sites": sites})
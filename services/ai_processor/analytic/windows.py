@@ -0,0 +1,322 @@
+"""
+Recent readings of every (site, sensor) kept in memory
+
+``WindowStore`` holds the newest ``points`` raw readings of each
+``(site, sensor)`` in preallocated numpy rings, one row of timestamps and
+one of values per key. Analytics over the last few hours read them from
+here instead of querying InfluxDB.
+
+Each ring is mirrored: a reading is written at slot ``i`` and at slot
+``i + points`` of a row twice as wide. The newest ``n`` readings are then
+always one contiguous slice, however the ring has wrapped, and ``window``
+copies it out under the lock in one go. Request threads get their own
+arrays, so the feeder thread can keep writing into the rings while they
+compute.
+
+Memory is bounded by ``max_series`` rows, allocated once. When every row is
+taken, the least recently used key (written or read) is evicted, so sites
+that stop reporting age out first. ``WindowFeeder`` follows the
+iot_ingestion readings stream in a background thread. At exit the store is
+saved to disk with the last stream entry applied, and a restarted process
+reloads it and resumes from that entry instead of starting cold.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from boiler_common import metrics, readings as stream_format
+
+from .cache import get_redis
+
+logger = logging.getLogger(__name__)
+
+READINGS = metrics.counter('analytics_window_readings_total', 'Readings added to the window store')
+EVICTED = metrics.counter('analytics_window_evictions_total', 'Keys evicted from the window store')
+TRACKED = metrics.gauge('analytics_window_keys', 'Site and sensor pairs in the window store')
+
+
+def series_bytes(points):
+    """Memory of one key's mirrored rings of ``points`` timestamps and values"""
+    return 2 * points * (np.dtype(np.int64).itemsize + np.dtype(np.float64).itemsize)
+
+
+class WindowStore:
+    """Fixed-size rings of the newest readings per (site, sensor), with LRU eviction"""
+
+    def __init__(self, points=3600, max_series=1024):
+        if points < 1 or max_series < 1:
+            raise ValueError("points and max_series must be positive")
+        self.points = points
+        self.max_series = max_series
+        # np.zeros maps memory lazily, so rows cost nothing until first written
+        self.times = np.zeros((max_series, 2 * points), dtype=np.int64)
+        self.values = np.zeros((max_series, 2 * points), dtype=np.float64)
+        self.heads = np.zeros(max_series, dtype=np.int64)  # next slot written, in [0, points)
+        self.counts = np.zeros(max_series, dtype=np.int64)  # readings held, at most ``points``
+        self._rows = OrderedDict()  # (site_id, sensor_type) -> row, least recently used first
+        self._free = list(range(max_series - 1, -1, -1))
+        self._lock = threading.Lock()
+
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+    def keys(self):
+        """Stored (site_id, sensor_type) pairs, least recently used first"""
+        with self._lock:
+            return list(self._rows)
+
+    def _assign(self, keys):
+        """Rows of distinct keys, marking them most recently used and evicting for new ones"""
+        rows = np.empty(len(keys), dtype=np.int64)
+        for index, key in enumerate(keys):
+            row = self._rows.get(key)
+            if row is None:
+                if self._free:
+                    row = self._free.pop()
+                else:
+                    _, row = self._rows.popitem(last=False)
+                    self.evicted += 1
+                    EVICTED.inc()
+                self.heads[row] = self.counts[row] = 0
+                self._rows[key] = row
+            else:
+                self._rows.move_to_end(key)
+            rows[index] = row
+        return rows
+
+    def append(self, site_ids, sensor_types, timestamps, values):
+        """
+        Add a batch of readings in arrival order; returns the number stored
+
+        Readings of a key are expected in time order, as ingest delivers
+        them. Only the newest ``max_series`` keys of a batch, and the newest
+        ``points`` readings of each key, can be kept.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        index = {}
+        key_ids = np.fromiter((index.setdefault(key, len(index)) for key in zip(site_ids, sensor_types)),
+                              dtype=np.int64, count=len(values))
+        if not len(key_ids):
+            return 0
+        keys = list(index)
+        if len(keys) > self.max_series:
+            # Keys assigned earlier would be evicted by later ones in the same batch
+            kept = np.zeros(len(keys), dtype=bool)
+            kept[-self.max_series:] = True
+            keys = keys[-self.max_series:]
+            positions = np.flatnonzero(kept[key_ids])
+            key_ids = key_ids[positions] - (len(kept) - self.max_series)
+            timestamps, values = timestamps[positions], values[positions]
+
+        # Position of each reading among its key's readings in the batch, and each key's total
+        order = np.argsort(key_ids, kind='stable')
+        totals = np.bincount(key_ids, minlength=len(keys))
+        starts = np.cumsum(totals) - totals
+        occurrence = np.empty(len(key_ids), dtype=np.int64)
+        occurrence[order] = np.arange(len(key_ids)) - np.repeat(starts, totals)
+        # Readings that would be overwritten within the batch are skipped
+        newest = occurrence >= totals[key_ids] - self.points
+        if not newest.all():
+            key_ids, occurrence = key_ids[newest], occurrence[newest]
+            timestamps, values = timestamps[newest], values[newest]
+
+        with self._lock:
+            key_rows = self._assign(keys)
+            rows = key_rows[key_ids]
+            slots = (self.heads[rows] + occurrence) % self.points
+            for offset in (0, self.points):
+                self.times[rows, slots + offset] = timestamps
+                self.values[rows, slots + offset] = values
+            self.heads[key_rows] = (self.heads[key_rows] + totals) % self.points
+            self.counts[key_rows] = np.minimum(self.counts[key_rows] + totals, self.points)
+        READINGS.inc(len(values))
+        return len(values)
+
+    def window(self, site_id, sensor_type, last=None, since=None):
+        """
+        Copies of the newest readings of a key as ``(timestamps_ns, values)``, oldest first
+
+        ``last`` caps the number of readings and ``since`` (epoch ns) drops
+        older ones. Unknown keys give empty arrays. The copies are taken
+        under the lock (at most ``points`` readings), because the next
+        append to a full ring overwrites the oldest reading of the slice.
+        """
+        with self._lock:
+            row = self._rows.get((site_id, sensor_type))
+            if row is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            self._rows.move_to_end((site_id, sensor_type))
+            size = int(self.counts[row]) if last is None else min(int(self.counts[row]), last)
+            end = int(self.heads[row]) + self.points
+            start = end - size
+            if since is not None:
+                start += int(np.searchsorted(self.times[row, start:end], since))
+            return self.times[row, start:end].copy(), self.values[row, start:end].copy()
+
+    def stats(self):
+        return {
+            'keys': len(self),
+            'max_keys': self.max_series,
+            'points': self.points,
+            'bytes': self.nbytes,
+            'evicted': self.evicted,
+        }
+
+    def save(self, path, **extra):
+        """Write the stored keys and rings, plus string ``extra`` values, to an ``.npz`` file atomically"""
+        with self._lock:
+            keys = list(self._rows)
+            rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(keys))
+            arrays = {
+                'sites': np.array([key[0] for key in keys], dtype=str),
+                'sensors': np.array([key[1] for key in keys], dtype=str),
+                'times': self.times[rows, :self.points],
+                'values': self.values[rows, :self.points],
+                'heads': self.heads[rows],
+                'counts': self.counts[rows],
+            }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            np.savez(file, points=self.points, **arrays,
+                     **{name: np.array(value, dtype=str) for name, value in extra.items()})
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, points=3600, max_series=1024):
+        """
+        Store rebuilt from a ``save`` file; returns ``(store, extra)``
+
+        Raises ValueError when the file holds rings of another length. When
+        it holds more keys than ``max_series``, the most recently used are
+        kept.
+        """
+        store = cls(points, max_series)
+        with np.load(path, allow_pickle=False) as saved:
+            if int(saved['points']) != points:
+                raise ValueError(f"snapshot holds {int(saved['points'])} points per key, not {points}")
+            keep = slice(max(0, len(saved['sites']) - max_series), None)
+            keys = list(zip(saved['sites'][keep].tolist(), saved['sensors'][keep].tolist()))
+            size = len(keys)
+            for offset in (0, points):
+                store.times[:size, offset:offset + points] = saved['times'][keep]
+                store.values[:size, offset:offset + points] = saved['values'][keep]
+            store.heads[:size] = saved['heads'][keep]
+            store.counts[:size] = saved['counts'][keep]
+            store._rows = OrderedDict((key, row) for row, key in enumerate(keys))
+            store._free = list(range(max_series - 1, size - 1, -1))
+            extra = {name: str(saved[name]) for name in saved.files
+                     if name not in ('points', 'sites', 'sensors', 'times', 'values', 'heads', 'counts')}
+        return store, extra
+
+
+class WindowFeeder:
+    """Appends readings stream entries to a WindowStore from a background thread"""
+
+    def __init__(self, client, store, stream_key, last_id='$'):
+        self.client = client
+        self.store = store
+        self.stream_key = stream_key
+        self.last_id = last_id
+        self._stop = threading.Event()
+        self._thread = None
+
+    def apply(self, entries):
+        """Append ``(entry_id, fields)`` stream entries in order"""
+        for entry_id, fields in entries:
+            self.store.append(*stream_format.decode(fields))
+            self.last_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+    def poll(self, block_ms=1000, count=100):
+        """Wait up to ``block_ms`` for new entries and apply them; returns the number of entries"""
+        response = self.client.xread({self.stream_key: self.last_id}, count=count, block=block_ms)
+        entries = response[0][1] if response else []
+        self.apply(entries)
+        return len(entries)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='window-feeder', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Reading %s failed, retrying", self.stream_key)
+                self._stop.wait(1)
+
+
+_store = None
+_feeder = None
+_store_lock = threading.Lock()
+
+
+def open_store(config):
+    """Store from the configured snapshot, or an empty one; returns ``(store, last_id)``"""
+    points = config['points']
+    max_series = max(1, config['max_mb'] * 2**20 // series_bytes(points))
+    path = config['snapshot_path']
+    if path and os.path.exists(path):
+        try:
+            store, extra = WindowStore.load(path, points, max_series)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring window store snapshot %s: %s", path, e)
+        else:
+            logger.info("Restored %d window store keys at stream entry %s", len(store), extra.get('last_id'))
+            return store, extra.get('last_id', '$')
+    return WindowStore(points, max_series), '$'
+
+
+def get_window_store():
+    """Return the process-wide window store, fed from the readings stream, or None when it is disabled"""
+    global _store, _feeder
+    from django.conf import settings
+
+    config = settings.ANALYTICS_WINDOWS
+    if not config['enabled']:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store, last_id = open_store(config)
+                feeder = WindowFeeder(get_redis(), store, config['stream_key'], last_id)
+                feeder.start()
+                TRACKED.set_function(lambda: len(store))
+                atexit.register(shutdown)
+                _feeder, _store = feeder, store
+    return _store
+
+
+def shutdown():
+    """Stop following the stream and snapshot the store at interpreter exit"""
+    from django.conf import settings
+
+    if _feeder is None:
+        return
+    _feeder.stop()
+    path = settings.ANALYTICS_WINDOWS['snapshot_path']
+    if path:
+        try:
+            _store.save(path, last_id=_feeder.last_id)
+        except OSError:
+            logger.exception("Saving the window store to %s failed", path)
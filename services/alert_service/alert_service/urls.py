@@ -1,9 +1,11 @@
 from django.urls import path
+from boiler_common.metrics import metrics_view
 from notifier.views import health_check
 
-# Minimal URL configuration - Health check only
+# Minimal URL configuration - Health check and Prometheus metrics
 urlpatterns = [
     path('health/', health_check, name='health_check'),
     path('api/health/', health_check, name='api_health_check'),
+    path('metrics', metrics_view, name='metrics'),
     path('', health_check, name='root'),  # Default route
 ]
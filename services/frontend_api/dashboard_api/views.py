@@ -1,4 +1,102 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from boiler_common import flux
+from django.conf import settings
 from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+# Sensor history requests: defaults, and the most rows returned
+HISTORY_DEFAULTS = {'range': '24h', 'every': '1h', 'aggregate': 'mean'}
+MAX_HISTORY_ROWS = 100_000
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
 
 def health_check(request):
     return JsonResponse({"status": "ok", "service": "frontend_api"})
+
+
+def get_executor():
+    """Return the process-wide InfluxDB executor for typed history queries, creating the client on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from influxdb_client import InfluxDBClient
+
+                config = settings.INFLUXDB_CONFIG
+                client = InfluxDBClient(url=config['url'], token=config['token'], org=config['org'])
+                _executor = flux.InfluxExecutor(client.query_api(), config['bucket'], config['org'])
+    return _executor
+
+
+def too_many_rows():
+    return JsonResponse({"status": "error", "error": "too many rows; narrow the range or widen every"}, status=400)
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+@require_GET
+def sensor_history(request):
+    """
+    Aggregated sensor history for dashboard charts, reduced inside InfluxDB
+
+    Query parameters: ``sensors`` and ``sites`` (comma-separated, default
+    all), ``range`` (lookback, default 24h), ``every`` (window, default 1h,
+    or ``none`` for one value over the range), ``aggregate`` (mean, min,
+    max, sum, count, first or last) and ``fleet=1`` to combine all sites
+    per sensor type.
+    """
+    params = {**HISTORY_DEFAULTS, **request.GET.dict()}
+    try:
+        every = None if params['every'] == 'none' else flux.parse_duration(params['every'])
+        lookback = flux.parse_duration(params['range'])
+        stop = int(time.time())
+        if every:
+            # Up to the end of the current window, so the newest window is complete in the range
+            stop = -(-stop // every) * every
+        query = flux.SeriesQuery(
+            split_list(params.get('sensors', '')),
+            stop - lookback,
+            stop,
+            sites=split_list(params.get('sites', '')),
+            every=every,
+            aggregate=params['aggregate'],
+            group_by=('sensor_type',) if params.get('fleet') in ('1', 'true') else flux.TAGS,
+        )
+    except flux.QueryError as e:
+        return JsonResponse({"status": "error", "error": str(e)}, status=400)
+    # Refuse up front what is sure to be too large: windows per series times the series asked for, if known
+    windows = 1 if every is None else -(-lookback // every)
+    series = max(1, len(query.sensor_types)) * (1 if 'site_id' not in query.group_by else max(1, len(query.sites)))
+    if windows * series > MAX_HISTORY_ROWS:
+        return too_many_rows()
+    try:
+        # With every site, the series count is only known from the response, read up to the limit
+        rows = get_executor().run(query, max_rows=MAX_HISTORY_ROWS)
+    except flux.TooManyRows:
+        return too_many_rows()
+    except Exception:
+        logger.exception("Querying sensor history failed")
+        return JsonResponse({"status": "error", "error": "sensor history is unavailable"}, status=503)
+
+    series = {}
+    for row in rows:
+        points = series.setdefault('/'.join(row.group), {"times": [], "values": []})
+        points["times"].append(datetime.fromtimestamp(row.time // 1_000_000_000, tz=timezone.utc)
+                               .strftime('%Y-%m-%dT%H:%M:%SZ'))
+        points["values"].append(row.value)
+    return JsonResponse({
+        "group_by": list(query.group_by),
+        "aggregate": query.aggregate,
+        "every": params['every'],
+        "series": series,
+    })
@@ -11,11 +11,17 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Code shared by the services (boiler_common) lives in <repo>/shared; containers mount it into /app
+SHARED_DIR = BASE_DIR.parent.parent / 'shared'
+if SHARED_DIR.is_dir() and str(SHARED_DIR) not in sys.path:
+    sys.path.append(str(SHARED_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -43,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'boiler_common.metrics.metrics_middleware',  # first, so the latency covers every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -137,6 +144,14 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# InfluxDB Configuration for sensor history queries (boiler_common.flux)
+INFLUXDB_CONFIG = {
+    'url': os.environ.get('INFLUX_URL', 'http://influxdb:8086'),
+    'token': os.environ.get('INFLUX_TOKEN', 'steambytes_admin_token'),
+    'org': os.environ.get('INFLUX_ORG', 'steambytes'),
+    'bucket': os.environ.get('INFLUX_BUCKET', 'sensor_data'),
+}
+
 # Redis Configuration for API Caching
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
 
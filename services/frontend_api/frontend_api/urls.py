@@ -1,9 +1,12 @@
 from django.urls import path
-from dashboard_api.views import health_check
+from boiler_common.metrics import metrics_view
+from dashboard_api.views import health_check, sensor_history
 
-# Minimal URL configuration - Health check only
+# Health check, sensor history and Prometheus metrics
 urlpatterns = [
     path('health/', health_check, name='health_check'),
     path('api/health/', health_check, name='api_health_check'),
+    path('api/history/', sensor_history, name='sensor_history'),
+    path('metrics', metrics_view, name='metrics'),
     path('', health_check, name='root'),  # Default route
 ]
@@ -1,3 +1,30 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import RegistryVersion, Sensor, SensorRollup, Site
+
+
+class SensorInline(admin.TabularInline):
+    model = Sensor
+    extra = 0
+
+
+@admin.register(Site)
+class SiteAdmin(admin.ModelAdmin):
+    list_display = ['site_id', 'name', 'organization_code', 'is_active', 'rate_limit']
+    list_filter = ['is_active', 'organization_code']
+    search_fields = ['site_id', 'name', 'location']
+    inlines = [SensorInline]
+
+
+@admin.register(RegistryVersion)
+class RegistryVersionAdmin(admin.ModelAdmin):
+    list_display = ['version', 'updated_at']
+    readonly_fields = ['version', 'updated_at']
+
+
+@admin.register(SensorRollup)
+class SensorRollupAdmin(admin.ModelAdmin):
+    list_display = ['site_id', 'sensor_type', 'resolution', 'bucket', 'count', 'min_value', 'max_value', 'last_value']
+    list_filter = ['resolution', 'sensor_type']
+    search_fields = ['site_id']
+    date_hierarchy = 'bucket'
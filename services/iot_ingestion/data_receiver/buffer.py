@@ -0,0 +1,333 @@
+"""
+Write-behind buffer between the ingest views and InfluxDB
+
+Views hand their readings to a bounded in-process buffer and return as soon
+as they are queued. A background flusher drains the buffer in batches,
+writing whenever a full batch is available or the oldest queued reading has
+waited for the linger interval, whichever comes first. When the buffer is
+full, ``offer`` refuses the readings so the view can push back on the gateway
+instead of piling up threads.
+
+With a spool attached (see spool.py) nothing is lost when InfluxDB is slow
+or down: readings that do not fit in memory, and batches whose write fails,
+are appended to the on-disk log, and while the log holds unreplayed data new
+batches follow them there so the replayer stays the only writer until it
+has caught up.
+
+``on_written`` is called with each batch once InfluxDB has stored it; the
+readings stream uses it to move the data watermarks of the batch's sites.
+``on_stored`` is called once a batch is in InfluxDB or the spool, so it
+sees every reading exactly once unless it is dropped; the rollups use it.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from boiler_common import metrics
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.gauge('ingest_buffer_depth_readings', 'Readings waiting in the write buffer')
+SPOOL_PENDING = metrics.gauge('ingest_spool_pending_bytes', 'Spooled bytes not yet replayed to InfluxDB')
+WRITTEN = metrics.counter('ingest_buffer_readings_total', 'Readings leaving the write buffer, by outcome', ['outcome'])
+FLUSHED, SPILLED, DROPPED = (WRITTEN.labels(outcome) for outcome in ('written', 'spooled', 'dropped'))
+
+
+class WriteBuffer:
+    """Bounded buffer of readings drained by a background flusher thread"""
+
+    def __init__(self, write, max_size=200_000, batch_size=5_000, linger=0.5,
+                 retry_after=1, max_retries=3, retry_backoff=0.5, spool=None, serialize=None,
+                 on_written=None, on_stored=None):
+        self._write = write
+        self._on_written = on_written
+        self._on_stored = on_stored
+        self.spool = spool
+        self._serialize = serialize
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.linger = linger
+        self.retry_after = retry_after
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._chunks = deque()
+        self._depth = 0
+        self._first_enqueued = None
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        self.accepted = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.write_failures = 0
+        self.flushed_batches = 0
+        self.flushed_readings = 0
+        self.last_batch_size = 0
+
+    @property
+    def depth(self):
+        """Number of readings waiting to be written"""
+        return self._depth
+
+    def offer(self, readings):
+        """
+        Queue a request's readings for writing
+
+        All-or-nothing: readings that do not fit are spooled when a spool is
+        attached; otherwise, or when the spool is full too, returns False
+        without queueing anything so the caller can ask the gateway to retry.
+        """
+        count = len(readings)
+        if not count:
+            return True
+        with self._cond:
+            if self._depth + count <= self.max_size:
+                was_empty = not self._depth
+                if was_empty:
+                    self._first_enqueued = time.monotonic()
+                self._chunks.append(readings)
+                self._depth += count
+                self.accepted += count
+                # An idle flusher waits without a timeout; wake it to start the linger clock
+                if was_empty or self._depth >= self.batch_size:
+                    self._cond.notify()
+                return True
+        spilled = self.spool is not None and self._spill(readings)
+        with self._cond:
+            if spilled:
+                self.accepted += count
+            else:
+                self.rejected += count
+        return spilled
+
+    def start(self):
+        """Start the background flusher"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='ingest-flusher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the flusher after it has written everything still queued"""
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        self._thread = None
+        self.flush()
+
+    def flush(self):
+        """Synchronously write everything currently queued"""
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def stats(self):
+        """Snapshot of queue depth, flush batch sizes and drop counts"""
+        batches = self.flushed_batches
+        return {
+            'queue_depth': self._depth,
+            'max_size': self.max_size,
+            'batch_size': self.batch_size,
+            'linger_ms': int(self.linger * 1000),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'spilled': self.spilled,
+            'dropped': self.dropped,
+            'write_failures': self.write_failures,
+            'flushed_batches': batches,
+            'flushed_readings': self.flushed_readings,
+            'last_batch_size': self.last_batch_size,
+            'avg_batch_size': round(self.flushed_readings / batches, 1) if batches else 0,
+        }
+
+    def _ready(self, now):
+        if self._depth >= self.batch_size:
+            return True
+        return bool(self._depth) and (self._stopping or now - self._first_enqueued >= self.linger)
+
+    def _take_batch(self):
+        """Pop up to one batch worth of readings; the condition lock must be held"""
+        batch = []
+        while self._chunks and len(batch) < self.batch_size:
+            chunk = self._chunks.popleft()
+            room = self.batch_size - len(batch)
+            if len(chunk) > room:
+                self._chunks.appendleft(chunk[room:])
+                chunk = chunk[:room]
+            batch.extend(chunk)
+        self._depth -= len(batch)
+        self._first_enqueued = time.monotonic() if self._depth else None
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._ready(now):
+                    if self._stopping and not self._depth:
+                        return
+                    timeout = None
+                    if self._depth:
+                        timeout = max(0.0, self.linger - (now - self._first_enqueued))
+                    self._cond.wait(timeout)
+                    now = time.monotonic()
+                batch = self._take_batch()
+            self._write_batch(batch)
+
+    def _spill(self, readings):
+        """Append readings to the spool; returns False when it is full"""
+        if self.spool.append(self._serialize(readings)):
+            self.spilled += len(readings)
+            SPILLED.inc(len(readings))
+            self._report(self._on_stored, readings)
+            return True
+        return False
+
+    def _write_batch(self, batch):
+        if self.spool is not None:
+            self._write_or_spill(batch)
+            return
+        with self._write_lock:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._write(batch)
+                except Exception:
+                    self.write_failures += 1
+                    logger.exception("Batch write of %d readings failed (attempt %d)", len(batch), attempt + 1)
+                    if attempt < self.max_retries:
+                        time.sleep(self.retry_backoff * 2 ** attempt)
+                else:
+                    self.flushed_batches += 1
+                    self.flushed_readings += len(batch)
+                    FLUSHED.inc(len(batch))
+                    self.last_batch_size = len(batch)
+                    self._written(batch)
+                    return
+            self.dropped += len(batch)
+            DROPPED.inc(len(batch))
+            logger.error("Dropped %d readings after %d failed writes", len(batch), self.max_retries + 1)
+
+    def _written(self, batch):
+        self._report(self._on_written, batch)
+        self._report(self._on_stored, batch)
+
+    @staticmethod
+    def _report(callback, batch):
+        if callback is not None:
+            try:
+                callback(batch)
+            except Exception:
+                logger.exception("Reporting a stored batch of %d readings failed", len(batch))
+
+    def _write_or_spill(self, batch):
+        """Write a batch directly, or spool it while the store is down or the spool is draining"""
+        with self._write_lock:
+            if not self.spool.pending_bytes:
+                try:
+                    self._write(batch)
+                except Exception:
+                    self.write_failures += 1
+                    logger.warning("Batch write of %d readings failed, spooling", len(batch), exc_info=True)
+                else:
+                    self.flushed_batches += 1
+                    self.flushed_readings += len(batch)
+                    FLUSHED.inc(len(batch))
+                    self.last_batch_size = len(batch)
+                    self._written(batch)
+                    return
+            if not self._spill(batch):
+                self.dropped += len(batch)
+                DROPPED.inc(len(batch))
+                logger.error("Dropped %d readings: spool full", len(batch))
+
+
+_buffer = None
+_replayer = None
+_buffer_lock = threading.Lock()
+
+
+def create_spool():
+    """Open this process's spool and start its replayer, if a spool directory is configured"""
+    from .influx import line_sites, write_lines
+    from .spool import SegmentLog, SpoolReplayer, claim_spool_directory
+    from .stream import mark_written
+
+    config = settings.INGEST_SPOOL
+    if not config['directory']:
+        return None, None
+    directory, lock_file = claim_spool_directory(config['directory'])
+    spool = SegmentLog(
+        directory,
+        segment_size=config['segment_size_mb'] * 1024 * 1024,
+        max_bytes=config['max_size_mb'] * 1024 * 1024,
+        sync_interval=config['sync_interval_ms'] / 1000,
+    )
+    spool.lock_file = lock_file
+    replayer = SpoolReplayer(spool, write_lines, batch_bytes=config['replay_batch_mb'] * 1024 * 1024,
+                             on_written=lambda lines: mark_written(line_sites(lines)))
+    replayer.start()
+    return spool, replayer
+
+
+def get_buffer():
+    """Return the process-wide write buffer, starting its flusher on first use"""
+    global _buffer, _replayer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                from .influx import serialize_readings, write_readings
+                from .rollups import add_to_rollups
+                from .stream import mark_written
+
+                config = settings.INGEST_BUFFER
+                spool, _replayer = create_spool()
+                buffer = WriteBuffer(
+                    write_readings,
+                    max_size=config['max_size'],
+                    batch_size=config['batch_size'],
+                    linger=config['linger_ms'] / 1000,
+                    retry_after=config['retry_after'],
+                    spool=spool,
+                    serialize=serialize_readings,
+                    on_written=lambda batch: mark_written({reading.site_id for reading in batch}),
+                    on_stored=add_to_rollups,
+                )
+                buffer.start()
+                atexit.register(shutdown)
+                QUEUE_DEPTH.set_function(lambda: buffer.depth)
+                if spool is not None:
+                    SPOOL_PENDING.set_function(lambda: spool.pending_bytes)
+                _buffer = buffer
+    return _buffer
+
+
+def get_replayer():
+    """Return the spool replayer, or None when no spool is configured"""
+    get_buffer()
+    return _replayer
+
+
+def shutdown():
+    """Flush the buffer and close the spool at interpreter exit"""
+    if _replayer is not None:
+        _replayer.stop()
+    if _buffer is not None:
+        _buffer.stop()
+        if _buffer.spool is not None:
+            _buffer.spool.close()
@@ -0,0 +1,218 @@
+"""
+Real-time latest-value cache in Redis
+
+Implements the key patterns from docs/DATABASE_ARCHITECTURE.md under the
+service key prefix:
+
+    {prefix}:latest:{site_id}:{sensor_type}   hash {ts, value}   latest_ttl
+    {prefix}:dashboard:{site_id}              hash {sensor_type: value,
+                                                    sensor_type:ts: ts}  dashboard_ttl
+
+``ts`` is epoch milliseconds. All of an ingest request's readings are applied
+by one Lua script call, so a request costs a single Redis round trip however
+many sites and sensors it carries. The script only replaces a value when the
+incoming reading is strictly newer, so retried or out-of-order readings never
+overwrite fresher data.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+
+from boiler_common import metrics
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+REDIS_LATENCY = metrics.histogram('redis_request_duration_seconds', 'Redis call latency, failures included', ['operation'])
+UPDATE_LATENCY, DASHBOARD_LATENCY = REDIS_LATENCY.labels('update_latest'), REDIS_LATENCY.labels('get_dashboard')
+CACHE_REQUESTS = metrics.counter('cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+DASHBOARD_HIT, DASHBOARD_MISS = CACHE_REQUESTS.labels('latest_values', 'hit'), CACHE_REQUESTS.labels('latest_values', 'miss')
+
+# KEYS: pairs of (latest key, dashboard key), one pair per reading
+# ARGV: latest_ttl, dashboard_ttl, then (sensor_type, ts, value) per reading
+UPDATE_LATEST_SCRIPT = """
+local latest_ttl = tonumber(ARGV[1])
+local dashboard_ttl = tonumber(ARGV[2])
+local touched = {}
+local updated = 0
+for i = 1, #KEYS, 2 do
+    local arg = 3 + (i - 1) / 2 * 3
+    local sensor_type, ts, value = ARGV[arg], ARGV[arg + 1], ARGV[arg + 2]
+    local current = redis.call('HGET', KEYS[i], 'ts')
+    if not current or tonumber(current) < tonumber(ts) then
+        redis.call('HSET', KEYS[i], 'ts', ts, 'value', value)
+        redis.call('EXPIRE', KEYS[i], latest_ttl)
+        redis.call('HSET', KEYS[i + 1], sensor_type, value, sensor_type .. ':ts', ts)
+        touched[KEYS[i + 1]] = true
+        updated = updated + 1
+    end
+end
+for key in pairs(touched) do
+    redis.call('EXPIRE', key, dashboard_ttl)
+end
+return updated
+"""
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    """Return the process-wide Redis client for REDIS_URL"""
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                import redis
+
+                _redis = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _redis
+
+
+def key_prefix():
+    """Service key prefix shared with the Django cache configuration"""
+    return settings.CACHES['default'].get('KEY_PREFIX', 'iot_ingestion')
+
+
+def latest_key(site_id, sensor_type, prefix=None):
+    return f"{prefix or key_prefix()}:latest:{site_id}:{sensor_type}"
+
+
+def dashboard_key(site_id, prefix=None):
+    return f"{prefix or key_prefix()}:dashboard:{site_id}"
+
+
+def newest_per_sensor(readings):
+    """Reduce readings to the newest one per (site_id, sensor_type)"""
+    newest = {}
+    for reading in readings:
+        key = (reading.site_id, reading.sensor_type)
+        current = newest.get(key)
+        if current is None or reading.timestamp > current.timestamp:
+            newest[key] = reading
+    return newest
+
+
+class LatestValueCache:
+    """Applies ingest batches to the latest-value and dashboard keys"""
+
+    def __init__(self, client, prefix, latest_ttl=300, dashboard_ttl=60):
+        self.client = client
+        self.prefix = prefix
+        self.latest_ttl = latest_ttl
+        self.dashboard_ttl = dashboard_ttl
+        self._script = client.register_script(UPDATE_LATEST_SCRIPT)
+
+    def _script_args(self, newest):
+        keys = []
+        args = [self.latest_ttl, self.dashboard_ttl]
+        for (site_id, sensor_type), reading in newest.items():
+            keys.append(latest_key(site_id, sensor_type, self.prefix))
+            keys.append(dashboard_key(site_id, self.prefix))
+            args.extend((sensor_type, reading.timestamp // 1_000_000, repr(reading.value)))
+        return keys, args
+
+    def update(self, readings):
+        """Apply a batch in one round trip; returns how many keys were refreshed"""
+        newest = newest_per_sensor(readings)
+        if not newest:
+            return 0
+        keys, args = self._script_args(newest)
+        with UPDATE_LATENCY.time():
+            return self._script(keys=keys, args=args)
+
+    async def aupdate(self, readings):
+        """``update`` for a cache built on a ``redis.asyncio`` client"""
+        newest = newest_per_sensor(readings)
+        if not newest:
+            return 0
+        keys, args = self._script_args(newest)
+        with UPDATE_LATENCY.time():
+            return await self._script(keys=keys, args=args)
+
+    def get_dashboard(self, site_id):
+        """Latest values for one site as {sensor_type: {"value", "ts"}}"""
+        with DASHBOARD_LATENCY.time():
+            raw = self.client.hgetall(dashboard_key(site_id, self.prefix))
+        (DASHBOARD_HIT if raw else DASHBOARD_MISS).inc()
+        fields = {k.decode(): v.decode() for k, v in raw.items()}
+        return {
+            name: {"value": float(value), "ts": int(fields[f"{name}:ts"])}
+            for name, value in fields.items()
+            if not name.endswith(":ts") and f"{name}:ts" in fields
+        }
+
+
+_latest_cache = None
+_latest_cache_lock = threading.Lock()
+
+
+def get_latest_cache():
+    """Return the process-wide latest-value cache"""
+    global _latest_cache
+    if _latest_cache is None:
+        with _latest_cache_lock:
+            if _latest_cache is None:
+                config = settings.LATEST_VALUE_CACHE
+                _latest_cache = LatestValueCache(
+                    get_redis(),
+                    key_prefix(),
+                    latest_ttl=config['latest_ttl'],
+                    dashboard_ttl=config['dashboard_ttl'],
+                )
+    return _latest_cache
+
+
+# One async cache per event loop: redis.asyncio connections cannot be shared across loops
+_async_latest_caches = weakref.WeakKeyDictionary()
+
+
+def get_async_latest_cache():
+    """Return the latest-value cache for the running event loop, on a ``redis.asyncio`` client"""
+    loop = asyncio.get_running_loop()
+    cache = _async_latest_caches.get(loop)
+    if cache is None:
+        import redis.asyncio
+
+        config = settings.LATEST_VALUE_CACHE
+        client = redis.asyncio.Redis.from_url(settings.REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+        cache = LatestValueCache(
+            client,
+            key_prefix(),
+            latest_ttl=config['latest_ttl'],
+            dashboard_ttl=config['dashboard_ttl'],
+        )
+        _async_latest_caches[loop] = cache
+    return cache
+
+
+async def aclose_latest_cache():
+    """Close the running event loop's Redis client (before the loop itself is closed)"""
+    cache = _async_latest_caches.pop(asyncio.get_running_loop(), None)
+    if cache is not None:
+        await cache.client.aclose()
+
+
+def update_latest_values(readings):
+    """
+    Refresh the latest-value cache for an ingest batch
+
+    Cache failures are logged and swallowed; the readings are already queued
+    for InfluxDB and the cache will catch up on the next request.
+    """
+    try:
+        return get_latest_cache().update(readings)
+    except Exception:
+        logger.warning("Latest-value cache update failed for %d readings", len(readings), exc_info=True)
+        return 0
+
+
+async def aupdate_latest_values(readings):
+    """Async ``update_latest_values``: the event loop is free while Redis answers"""
+    try:
+        return await get_async_latest_cache().aupdate(readings)
+    except Exception:
+        logger.warning("Latest-value cache update failed for %d readings", len(readings), exc_info=True)
+        return 0
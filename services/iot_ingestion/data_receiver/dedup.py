@@ -0,0 +1,174 @@
+"""
+Bounded duplicate detection for retried readings
+
+Gateways retry on timeouts, so the same ``(site_id, sensor_type, timestamp)``
+reading can arrive several times. A rotating Bloom filter remembers recently
+accepted readings in fixed memory: ``generations`` filters are kept, new keys
+go into the newest one, and the oldest is discarded every rotation interval
+(or early, once the newest filter reaches its capacity, so the false-positive
+rate stays within budget however large the fleet grows). A reading is
+remembered for at least ``window`` seconds.
+
+Bloom filters have no false negatives but can report a reading as seen when
+it was not; the filters are sized so that this happens at most at the
+configured ``false_positive_rate``.
+"""
+
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from django.conf import settings
+
+_MASK64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over byte keys"""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0
+        self._array = bytearray((bits + 7) // 8)
+
+    def positions(self, key):
+        """Bit positions for a key (Kirsch-Mitzenmacher double hashing)"""
+        digest = int.from_bytes(blake2b(key, digest_size=16).digest(), 'little')
+        bits = self.bits
+        h1, h2 = (digest & _MASK64) % bits, ((digest >> 64) | 1) % bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def contains(self, positions):
+        array = self._array
+        for position in positions:
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        array = self._array
+        for position in positions:
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def false_positive_rate(self):
+        """Current probability that an unseen key tests positive"""
+        bits_set = int.from_bytes(self._array, 'little').bit_count()
+        return (bits_set / self.bits) ** self.hashes
+
+
+class RotatingDeduplicator:
+    """Time-windowed duplicate filter built from rotating Bloom filters"""
+
+    def __init__(self, window=600, generations=4, capacity=1_000_000, false_positive_rate=0.001, clock=time.monotonic):
+        self.window = window
+        self.generations = generations
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.rotation_interval = window / (generations - 1)
+        self._clock = clock
+
+        # Split the false-positive budget across the generations that are checked
+        per_filter = false_positive_rate / generations
+        self.bits = math.ceil(-capacity * math.log(per_filter) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+
+        self._lock = threading.Lock()
+        self._filters = [self._new_filter() for _ in range(generations)]
+        self._rotated_at = clock()
+
+        self.checked = 0
+        self.duplicates = 0
+        self.rotations = 0
+
+    def _new_filter(self):
+        return BloomFilter(self.bits, self.hashes)
+
+    def _maybe_rotate(self):
+        now = self._clock()
+        if now - self._rotated_at >= self.rotation_interval or self._filters[-1].count >= self.capacity:
+            self._filters.pop(0)
+            self._filters.append(self._new_filter())
+            self._rotated_at = now
+            self.rotations += 1
+
+    def check(self, readings):
+        """
+        Split readings into fresh ones and duplicates
+
+        Returns ``(fresh, pending)``. Nothing is remembered until ``commit``
+        is called with ``pending``, so a request that is refused downstream
+        can be retried without being mistaken for a duplicate. Repeats within
+        the batch itself are also dropped.
+        """
+        fresh = []
+        pending = []
+        batch_keys = set()
+        positions_for = self._filters[-1].positions
+        with self._lock:
+            self._maybe_rotate()
+            filters = self._filters[::-1]  # newest first: recent retries hit sooner
+            for reading in readings:
+                key = f'{reading.site_id}\x1f{reading.sensor_type}\x1f{reading.timestamp}'.encode()
+                if key in batch_keys:
+                    continue
+                positions = positions_for(key)
+                for bloom in filters:
+                    if bloom.contains(positions):
+                        break
+                else:
+                    batch_keys.add(key)
+                    fresh.append(reading)
+                    pending.append(positions)
+            self.checked += len(readings)
+            self.duplicates += len(readings) - len(fresh)
+        return fresh, pending
+
+    def commit(self, pending):
+        """Remember readings returned by ``check`` once they have been accepted"""
+        with self._lock:
+            newest = self._filters[-1]
+            for positions in pending:
+                newest.add(positions)
+
+    def stats(self):
+        checked = self.checked
+        estimated = 1.0
+        for bloom in self._filters:
+            estimated *= 1 - bloom.false_positive_rate()
+        return {
+            'checked': checked,
+            'duplicates': self.duplicates,
+            'hit_rate': round(self.duplicates / checked, 4) if checked else 0.0,
+            'window_seconds': self.window,
+            'generations': self.generations,
+            'capacity_per_generation': self.capacity,
+            'memory_bytes': self.generations * ((self.bits + 7) // 8),
+            'rotations': self.rotations,
+            'false_positive_budget': self.false_positive_rate,
+            'estimated_false_positive_rate': round(1 - estimated, 6),
+        }
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator():
+    """Return the process-wide deduplicator, or None when dedup is disabled"""
+    global _deduplicator
+    config = settings.INGEST_DEDUP
+    if not config['enabled']:
+        return None
+    if _deduplicator is None:
+        with _deduplicator_lock:
+            if _deduplicator is None:
+                _deduplicator = RotatingDeduplicator(
+                    window=config['window_seconds'],
+                    generations=config['generations'],
+                    capacity=config['capacity'],
+                    false_positive_rate=config['false_positive_rate'],
+                )
+    return _deduplicator
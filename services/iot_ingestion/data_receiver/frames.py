@@ -0,0 +1,151 @@
+"""
+Compact binary sensor frames
+
+A frame carries one site's readings for several sampling instants without
+repeating sensor names per reading. All integers are little-endian:
+
+    magic        4 bytes   b"SBF1"
+    flags        u8        bit 0 set: values are float64, otherwise float32
+    site_len     u8        followed by site_len bytes of UTF-8 site_id
+    type_count   u8        followed by type_count entries of
+                           u8 length + UTF-8 sensor_type (the dictionary)
+    base_time    i64       milliseconds since the epoch
+    samples      u32       number of sampling instants
+    deltas       samples x u32
+                           milliseconds since the previous instant; the first
+                           delta is relative to base_time
+    values       samples x type_count floats, row-major (one row per
+                           instant, one column per dictionary entry);
+                           NaN marks a sensor with no value at that instant
+
+A request body may hold any number of frames back to back, e.g. one per site.
+Gateways can use scripts/sensor_frame.py, which implements the same encoder.
+"""
+
+import math
+import struct
+
+from .payloads import PayloadError, Reading
+
+CONTENT_TYPE = 'application/vnd.steambytes.frame'
+MAGIC = b'SBF1'
+FLAG_FLOAT64 = 0x01
+
+_HEADER = struct.Struct('<4sBB')
+_U8 = struct.Struct('<B')
+_TIMING = struct.Struct('<qI')
+_NS_PER_MS = 1_000_000
+
+
+def encode_frame(site_id, sensor_types, timestamps, rows, float64=False):
+    """
+    Encode one site's readings as a frame
+
+    ``timestamps`` are epoch milliseconds in ascending order and ``rows`` holds
+    one sequence of values per timestamp, aligned with ``sensor_types``. Use
+    None or NaN for missing values.
+    """
+    site = site_id.encode('utf-8')
+    parts = [_HEADER.pack(MAGIC, FLAG_FLOAT64 if float64 else 0, len(site)), site, _U8.pack(len(sensor_types))]
+    for sensor_type in sensor_types:
+        name = sensor_type.encode('utf-8')
+        parts.append(_U8.pack(len(name)))
+        parts.append(name)
+
+    base = timestamps[0] if timestamps else 0
+    parts.append(_TIMING.pack(base, len(timestamps)))
+    previous = base
+    deltas = []
+    for timestamp in timestamps:
+        deltas.append(timestamp - previous)
+        previous = timestamp
+    parts.append(struct.pack(f'<{len(deltas)}I', *deltas))
+
+    values = [math.nan if value is None else value for row in rows for value in row]
+    parts.append(struct.pack(f"<{len(values)}{'d' if float64 else 'f'}", *values))
+    return b''.join(parts)
+
+
+def _unpack(buffer, offset):
+    """Unpack the frame starting at ``offset``; returns its parts and the next offset"""
+    try:
+        magic, flags, site_len = _HEADER.unpack_from(buffer, offset)
+        if magic != MAGIC:
+            raise PayloadError("bad frame magic")
+        offset += _HEADER.size
+        site_id = bytes(buffer[offset:offset + site_len]).decode('utf-8')
+        offset += site_len
+
+        (type_count,) = _U8.unpack_from(buffer, offset)
+        offset += 1
+        sensor_types = []
+        for _ in range(type_count):
+            (name_len,) = _U8.unpack_from(buffer, offset)
+            offset += 1
+            sensor_types.append(bytes(buffer[offset:offset + name_len]).decode('utf-8'))
+            offset += name_len
+
+        base, samples = _TIMING.unpack_from(buffer, offset)
+        offset += _TIMING.size
+        deltas = struct.unpack_from(f'<{samples}I', buffer, offset)
+        offset += 4 * samples
+
+        count = samples * type_count
+        if flags & FLAG_FLOAT64:
+            values = struct.unpack_from(f'<{count}d', buffer, offset)
+            offset += 8 * count
+        else:
+            values = struct.unpack_from(f'<{count}f', buffer, offset)
+            offset += 4 * count
+    except (struct.error, UnicodeDecodeError):
+        raise PayloadError("truncated or malformed frame") from None
+    return site_id, sensor_types, base, deltas, values, offset
+
+
+def _to_readings(site_id, sensor_types, base, deltas, values):
+    """Expand unpacked frame columns into readings, skipping NaN cells"""
+    if not site_id:
+        raise PayloadError("site_id is required")
+
+    readings = []
+    append = readings.append
+    timestamp = base
+    index = 0
+    for delta in deltas:
+        timestamp += delta
+        timestamp_ns = timestamp * _NS_PER_MS
+        for sensor_type in sensor_types:
+            value = values[index]
+            index += 1
+            if value - value:  # only NaN and infinities fail this
+                if value != value:  # NaN: no value for this sensor at this instant
+                    continue
+                raise PayloadError(f"{sensor_type}: value must be finite")
+            append(Reading(site_id, sensor_type, timestamp_ns, value))
+    return readings
+
+
+def decode_frames(body):
+    """
+    Decode a body of back-to-back frames
+
+    Yields ``(frame_number, readings, error)`` like ``parse_ndjson``. A frame
+    whose structure is broken ends decoding, since the next frame boundary
+    can no longer be located.
+    """
+    buffer = memoryview(body)
+    offset = 0
+    frame_number = 0
+    while offset < len(buffer):
+        frame_number += 1
+        try:
+            site_id, sensor_types, base, deltas, values, offset = _unpack(buffer, offset)
+        except PayloadError as e:
+            yield frame_number, None, str(e)
+            return
+        try:
+            readings = _to_readings(site_id, sensor_types, base, deltas, values)
+        except PayloadError as e:
+            yield frame_number, None, str(e)
+        else:
+            yield frame_number, readings, None
@@ -0,0 +1,112 @@
+"""
+InfluxDB writer for sensor readings
+
+Readings are serialised to line protocol and sent to the ``sensor_data``
+bucket in a single request per batch.
+"""
+
+import re
+import threading
+
+from boiler_common import metrics
+from django.conf import settings
+
+MEASUREMENT = 'sensor_reading'
+SITE_TAG = re.compile(r',site_id=((?:[^\\, ]|\\.)*)')
+
+INFLUX_LATENCY = metrics.histogram(
+    'influxdb_request_duration_seconds', 'InfluxDB call latency, failures included', ['operation'],
+)
+WRITE_LATENCY, PING_LATENCY = INFLUX_LATENCY.labels('write'), INFLUX_LATENCY.labels('ping')
+WRITE_BATCH = metrics.histogram(
+    'influxdb_write_batch_records', 'Records per InfluxDB write request', buckets=metrics.SIZE_BUCKETS,
+)
+
+_client = None
+_write_api = None
+_client_lock = threading.Lock()
+
+
+def get_write_api():
+    """Return the process-wide synchronous write API, creating it on first use"""
+    global _client, _write_api
+    if _write_api is None:
+        with _client_lock:
+            if _write_api is None:
+                from influxdb_client import InfluxDBClient
+                from influxdb_client.client.write_api import SYNCHRONOUS
+
+                config = settings.INFLUXDB_CONFIG
+                _client = InfluxDBClient(url=config['url'], token=config['token'], org=config['org'])
+                _write_api = _client.write_api(write_options=SYNCHRONOUS)
+    return _write_api
+
+
+def escape_tag(value):
+    """Escape a tag value for line protocol"""
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def to_line_protocol(reading):
+    """Serialise one reading to an InfluxDB line protocol record"""
+    return (
+        f"{MEASUREMENT},sensor_type={escape_tag(reading.sensor_type)},"
+        f"site_id={escape_tag(reading.site_id)} value={reading.value!r} {reading.timestamp}"
+    )
+
+
+def line_sites(lines):
+    """Site ids of line protocol records, as written by ``to_line_protocol``"""
+    sites = set()
+    for line in lines:
+        sites.update(unescape_tag(site) for site in SITE_TAG.findall(line))
+    return sites
+
+
+def unescape_tag(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def serialize_readings(readings):
+    """Serialise a batch as newline-separated line protocol bytes"""
+    return '\n'.join(to_line_protocol(reading) for reading in readings).encode('utf-8')
+
+
+def count_records(lines):
+    """Records in newline-separated line protocol, or in a list of such chunks (spool payloads hold many)"""
+    if isinstance(lines, (str, bytes)):
+        lines = [lines]
+    return sum(line.count('\n' if isinstance(line, str) else b'\n') + 1 for line in lines)
+
+
+def write_lines(lines):
+    """Write pre-serialised line protocol records in one request"""
+    from influxdb_client import WritePrecision
+
+    config = settings.INFLUXDB_CONFIG
+    WRITE_BATCH.observe(count_records(lines))
+    with WRITE_LATENCY.time():
+        get_write_api().write(
+            bucket=config['bucket'],
+            org=config['org'],
+            record=lines,
+            write_precision=WritePrecision.NS,
+        )
+
+
+def write_readings(readings):
+    """Write a batch of readings to the sensor_data bucket in one request"""
+    if readings:
+        write_lines([to_line_protocol(reading) for reading in readings])
+
+
+async def ping_async():
+    """Check that InfluxDB is reachable without blocking the event loop"""
+    from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+    config = settings.INFLUXDB_CONFIG
+    with PING_LATENCY.time():
+        async with InfluxDBClientAsync(
+            url=config['url'], token=config['token'], org=config['org'], timeout=2_000,
+        ) as client:
+            return await client.ping()
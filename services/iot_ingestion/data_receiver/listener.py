@@ -0,0 +1,260 @@
+"""
+Raw TCP/UDP listener for gateways that push one small record per message
+
+Going through HTTP and Django for every sensor sample costs far more than
+the sample itself. The listener accepts newline-separated records straight
+off a socket, in InfluxDB line protocol or as site payload JSON (lines
+starting with ``{``), and feeds them into the same pipeline as the HTTP
+views: registry validation, the per-site rate limit, dedup, the write-behind
+buffer and the latest-value cache. There is no 429 on a socket, so readings
+of sites over their limit are dropped and counted in ``rate_limited``.
+
+Records from every connection are collected into one pending batch that is
+submitted every ``linger`` seconds or once ``batch_size`` readings are
+waiting, so the per-batch costs (buffer lock, dedup lock, Redis round trip)
+are shared by many messages. When the write buffer pushes back, TCP
+connections stop being read until the batch is accepted, which slows the
+senders down through TCP flow control; UDP datagrams that arrive while too
+much is pending are dropped and counted.
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import time
+
+from .cache import aclose_latest_cache, aupdate_latest_values
+from .payloads import parse_line_protocol, parse_payload
+from .pipeline import BufferFull, accept_readings
+from .ratelimit import get_async_rate_limiter
+from .registry import aget_registry
+
+logger = logging.getLogger(__name__)
+
+
+class IngestListener:
+    """Parses records from any number of sockets and submits them in batches"""
+
+    def __init__(self, batch_size=5_000, linger=0.05, max_pending=100_000, precision=1, max_line_bytes=65_536,
+                 update_cache=True, rate_limit=True):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_pending = max_pending
+        self.precision = precision
+        self.max_line_bytes = max_line_bytes
+        self.update_cache = update_cache
+        self.rate_limit = rate_limit
+        self.registry = None
+        self.transports = set()
+
+        self._pending = []
+        self._ready = asyncio.Event()
+        self.paused = False
+
+        self.lines = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+        self.submitted = 0
+        self.batches = 0
+        self.last_error = None
+
+    @property
+    def backlogged(self):
+        return len(self._pending) >= self.max_pending
+
+    def feed(self, data):
+        """Parse newline-separated records and add their readings to the pending batch"""
+        received_at = time.time_ns()
+        pending = self._pending
+        registry = self.registry
+        for raw in data.split(b'\n'):
+            raw = raw.strip()
+            if not raw:
+                continue
+            self.lines += 1
+            try:
+                line = raw.decode('utf-8')
+                if line[0] == '{':
+                    readings = parse_payload(json.loads(line))
+                else:
+                    readings = parse_line_protocol(line, received_at, self.precision)
+                if registry is not None:
+                    registry.validate(readings)
+            except (ValueError, UnicodeDecodeError) as e:
+                self.rejected += 1
+                self.last_error = str(e)
+                continue
+            pending.extend(readings)
+        if len(pending) >= self.batch_size:
+            self._ready.set()
+
+    def drop(self, count=1):
+        """Count messages discarded without parsing"""
+        self.dropped += count
+
+    async def start(self):
+        """Load the registry before the first record arrives"""
+        self.registry = await aget_registry()
+
+    async def close(self):
+        """Submit what is still pending and release the Redis client"""
+        await self.flush()
+        await aclose_latest_cache()
+
+    async def run(self):
+        """Submit pending readings until cancelled"""
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.linger)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            self.registry = await aget_registry()
+            await self.flush()
+
+    async def flush(self):
+        """Submit everything pending, holding TCP reads while the write buffer is full"""
+        limiter = get_async_rate_limiter() if self.rate_limit else None
+        while self._pending:
+            batch, self._pending = self._pending, []
+            if limiter is not None:
+                batch = await self._drop_limited(limiter, batch)
+                if not batch:
+                    continue
+            try:
+                fresh = accept_readings(batch)
+            except BufferFull as e:
+                if limiter is not None:
+                    # Charged again when the batch is retried
+                    await limiter.arefund(batch, self.registry)
+                self._pending[:0] = batch
+                self._pause()
+                await asyncio.sleep(e.retry_after)
+                continue
+            self._resume()
+            self.batches += 1
+            self.submitted += len(fresh)
+            self.duplicates += len(batch) - len(fresh)
+            if self.update_cache:
+                await aupdate_latest_values(fresh)
+        self._resume()
+
+    async def _drop_limited(self, limiter, batch):
+        """Charge the batch to its sites and leave out the readings of sites over their limit"""
+        limited = await limiter.acheck(batch, self.registry)
+        if not limited:
+            return batch
+        kept = [reading for reading in batch if reading.site_id not in limited]
+        self.rate_limited += len(batch) - len(kept)
+        return kept
+
+    def _pause(self):
+        if not self.paused:
+            self.paused = True
+            logger.warning("Write buffer full, pausing %d connections", len(self.transports))
+            for transport in self.transports:
+                transport.pause_reading()
+
+    def _resume(self):
+        if self.paused:
+            self.paused = False
+            for transport in self.transports:
+                transport.resume_reading()
+
+    def stats(self):
+        return {
+            'connections': len(self.transports),
+            'lines': self.lines,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'duplicates': self.duplicates,
+            'rate_limited': self.rate_limited,
+            'submitted': self.submitted,
+            'batches': self.batches,
+            'pending': len(self._pending),
+            'last_error': self.last_error,
+        }
+
+
+class TCPIngestProtocol(asyncio.Protocol):
+    """One gateway connection: records are newline-terminated and may span reads"""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.transport = None
+        self._partial = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.listener.transports.add(transport)
+        if self.listener.paused:
+            transport.pause_reading()
+
+    def data_received(self, data):
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._partial += data
+            if len(self._partial) > self.listener.max_line_bytes:
+                self.listener.rejected += 1
+                self._partial = b''
+            return
+        self.listener.feed(self._partial + data[:end])
+        self._partial = data[end + 1:]
+
+    def connection_lost(self, exc):
+        self.listener.transports.discard(self.transport)
+        if self._partial:
+            self.listener.feed(self._partial)
+
+
+class UDPIngestProtocol(asyncio.DatagramProtocol):
+    """Each datagram holds one or more complete records"""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        if self.listener.backlogged:
+            self.listener.drop()
+            return
+        self.listener.feed(data)
+
+
+async def serve(listener, host='0.0.0.0', tcp_port=8094, udp_port=8094, stats_interval=0, report=print):
+    """
+    Run the TCP and UDP servers (a port of 0 disables that protocol) until cancelled
+
+    ``listener`` is an ``IngestListener``, or a ``sharding.ShardRouter`` that
+    forwards records to worker processes.
+
+    ``SO_REUSEPORT`` is set where available, so several listener processes
+    can share the ports and the kernel spreads connections across them.
+    """
+    loop = asyncio.get_running_loop()
+    await listener.start()
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    servers = []
+    if tcp_port:
+        servers.append(await loop.create_server(
+            lambda: TCPIngestProtocol(listener), host, tcp_port, reuse_port=reuse_port,
+        ))
+    if udp_port:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: UDPIngestProtocol(listener), local_addr=(host, udp_port), reuse_port=reuse_port,
+        )
+        servers.append(transport)
+
+    flusher = asyncio.create_task(listener.run())
+    try:
+        while True:
+            await asyncio.sleep(stats_interval or 3600)
+            if stats_interval:
+                report(listener.stats())
+    finally:
+        for server in servers:
+            server.close()
+        flusher.cancel()
+        await listener.close()
@@ -0,0 +1,80 @@
+"""
+Benchmark decode throughput of binary frames against the NDJSON path
+"""
+
+import io
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from data_receiver.frames import decode_frames, encode_frame
+from data_receiver.payloads import parse_ndjson
+
+SENSOR_TYPES = ['temperature', 'pressure', 'fuel_level', 'flow_rate', 'efficiency']
+BASE_MS = 1_735_725_600_000
+
+
+class Command(BaseCommand):
+    help = 'Compare decode throughput of binary frames and NDJSON site payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sites', type=int, default=200, help='Sites per request body')
+        parser.add_argument('--samples', type=int, default=10, help='Sampling instants per site')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed decode passes per format')
+
+    def handle(self, *args, **options):
+        sites, samples = options['sites'], options['samples']
+        rng = random.Random(42)
+        timestamps = [BASE_MS + i * 30_000 for i in range(samples)]
+        data = {
+            f'BLR{n:04d}': [[round(rng.uniform(10, 100), 2) for _ in SENSOR_TYPES] for _ in timestamps]
+            for n in range(sites)
+        }
+
+        ndjson = '\n'.join(
+            json.dumps({
+                'site_id': site_id,
+                'timestamp': ts,
+                'readings': [{'sensor_type': name, 'value': value} for name, value in zip(SENSOR_TYPES, row)],
+            })
+            for site_id, rows in data.items()
+            for ts, row in zip(timestamps, rows)
+        ).encode()
+        frame32 = b''.join(encode_frame(site_id, SENSOR_TYPES, timestamps, rows) for site_id, rows in data.items())
+        frame64 = b''.join(
+            encode_frame(site_id, SENSOR_TYPES, timestamps, rows, float64=True) for site_id, rows in data.items()
+        )
+
+        readings = sites * samples * len(SENSOR_TYPES)
+        self.stdout.write(f'{sites} sites x {samples} instants x {len(SENSOR_TYPES)} sensors = {readings} readings')
+        self.stdout.write(f"{'format':<10}{'bytes':>10}{'B/reading':>11}{'ms/body':>10}{'readings/s':>14}")
+
+        results = {}
+        for name, body, decode in (
+            ('ndjson', ndjson, lambda body: parse_ndjson(io.BytesIO(body))),
+            ('frame32', frame32, decode_frames),
+            ('frame64', frame64, decode_frames),
+        ):
+            elapsed = self.time_decode(body, decode, options['repeat'], readings)
+            results[name] = elapsed
+            self.stdout.write(
+                f'{name:<10}{len(body):>10}{len(body) / readings:>11.1f}'
+                f'{elapsed * 1000:>10.2f}{readings / elapsed:>14,.0f}'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"frame32 decodes {results['ndjson'] / results['frame32']:.1f}x faster "
+            f"and is {len(ndjson) / len(frame32):.1f}x smaller than NDJSON"
+        ))
+
+    def time_decode(self, body, decode, repeat, expected):
+        """Best wall time of ``repeat`` full decodes of ``body``"""
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            count = sum(len(readings) for _, readings, _ in decode(body))
+            best = min(best, time.perf_counter() - started)
+        assert count == expected, f'decoded {count} readings, expected {expected}'
+        return best
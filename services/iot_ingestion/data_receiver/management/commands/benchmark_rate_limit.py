@@ -0,0 +1,67 @@
+"""
+Benchmark the per-request cost of the ingest rate limiter
+
+Times ``RateLimiter.check`` for a single-site request and for a bulk body
+covering many sites, against Redis (one script call per request) and
+against the in-process fallback buckets.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from data_receiver.cache import get_redis
+from data_receiver.payloads import Reading
+from data_receiver.ratelimit import LocalTokenBuckets, RateLimiter
+
+SENSOR_TYPES = ['temperature', 'pressure', 'fuel_level', 'flow_rate', 'efficiency']
+BASE_NS = 1_735_725_600_000_000_000
+BUDGET_MS = 1.0
+
+
+class Command(BaseCommand):
+    help = 'Measure rate limiter latency per request against Redis and the in-process fallback'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000, help='Timed checks per scenario')
+        parser.add_argument('--bulk-sites', type=int, default=100, help='Sites in the bulk scenario')
+
+    def handle(self, *args, **options):
+        settings.INGEST_RATE_LIMIT = {**settings.INGEST_RATE_LIMIT, 'rate': 1e9, 'burst': 10**9}
+        single = [Reading('BLR0001', name, BASE_NS, 50.0) for name in SENSOR_TYPES]
+        bulk = [Reading(f'BLR{n:04d}', name, BASE_NS, 50.0)
+                for n in range(options['bulk_sites']) for name in SENSOR_TYPES]
+
+        redis_limiter = RateLimiter(get_redis(), 'benchmark', LocalTokenBuckets())
+        local_limiter = RateLimiter(get_redis(), 'benchmark', LocalTokenBuckets())
+        local_limiter.use_fallback()
+        scenarios = [('redis', redis_limiter), ('local', local_limiter)]
+        redis_limiter.check(single, None)
+        if redis_limiter.using_fallback:  # the check failed over to the fallback
+            self.stderr.write(f'Redis unavailable at {settings.REDIS_URL}; only the fallback is measured')
+            scenarios.pop(0)
+
+        self.stdout.write(f"{'backend':<8}{'request':<22}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        worst = 0.0
+        for backend, limiter in scenarios:
+            for label, readings in (('1 site x 5', single), (f"{options['bulk_sites']} sites x 5", bulk)):
+                timings = self.time_checks(limiter, readings, options['requests'])
+                p50, p99 = timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+                worst = max(worst, p99)
+                self.stdout.write(f'{backend:<8}{label:<22}{p50:>9.3f}{p99:>9.3f}{timings[-1]:>9.3f}')
+
+        if scenarios[0][0] == 'redis':
+            get_redis().delete(*get_redis().keys('benchmark:ratelimit:*'))
+        style = self.style.SUCCESS if worst < BUDGET_MS else self.style.ERROR
+        self.stdout.write(style(f'worst p99 {worst:.3f} ms (budget {BUDGET_MS} ms)'))
+
+    def time_checks(self, limiter, readings, count):
+        """Sorted latencies of ``count`` checks, in milliseconds"""
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            limiter.check(readings, None)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return timings
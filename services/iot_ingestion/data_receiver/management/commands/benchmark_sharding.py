@@ -0,0 +1,93 @@
+"""
+Benchmark listener throughput with readings sharded across worker processes
+
+Each run forks the workers, routes the same pre-generated line protocol
+through a ShardRouter and waits until every worker has drained its pipe and
+flushed its write buffer. InfluxDB writes and the Redis latest-value cache
+are replaced by no-ops and registry validation is off, so the figures show
+the parse, dedup and buffer work the workers share out.
+"""
+
+import multiprocessing
+import random
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from data_receiver import buffer
+from data_receiver.listener import IngestListener
+from data_receiver.sharding import ShardRouter, start_workers
+
+SENSOR_TYPES = ['temperature', 'pressure', 'fuel_level', 'flow_rate', 'efficiency']
+BASE_NS = 1_735_725_600_000_000_000
+
+
+def discard_writes():
+    """Worker setup: a write buffer that drops its batches and no registry lookups"""
+    settings.INGEST_REGISTRY = {**settings.INGEST_REGISTRY, 'enabled': False}
+    buffer._buffer = buffer.WriteBuffer(lambda batch: None, max_size=1_000_000, batch_size=5_000, linger=0.05)
+    buffer._buffer.start()
+
+
+class Command(BaseCommand):
+    help = 'Measure ingest listener throughput for 1, 2, 4 and 8 site-sharded workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sites', type=int, default=1000, help='Distinct sites in the generated traffic')
+        parser.add_argument('--lines', type=int, default=200_000, help='Line protocol records per run')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Worker counts to run')
+        parser.add_argument('--chunk-bytes', type=int, default=64 * 1024, help='Bytes per simulated socket read')
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        sites = [f'BLR{n:04d}' for n in range(options['sites'])]
+        records = b''.join(
+            (
+                f'boiler,site_id={sites[i % len(sites)]} '
+                + ','.join(f'{name}={rng.uniform(10, 100):.2f}' for name in SENSOR_TYPES)
+                + f' {BASE_NS + i * 1_000_000}\n'
+            ).encode()
+            for i in range(options['lines'])
+        )
+        step = options['chunk_bytes']
+        reads = []
+        start = 0
+        while start < len(records):
+            end = records.rfind(b'\n', start, start + step) + 1 or len(records)
+            reads.append(records[start:end])
+            start = end
+        readings = options['lines'] * len(SENSOR_TYPES)
+
+        self.stdout.write(f"{options['lines']} lines x {len(SENSOR_TYPES)} sensors over {len(sites)} sites")
+        self.stdout.write(f"{'workers':>8}{'seconds':>10}{'readings/s':>14}{'speedup':>9}{'max/min load':>14}")
+        baseline = None
+        for workers in options['workers']:
+            elapsed, router, finals = self.run(workers, reads)
+            submitted = sum(stats['submitted'] for stats in finals)
+            if submitted != readings:
+                self.stderr.write(f'{workers} workers submitted {submitted} of {readings} readings')
+            baseline = baseline or elapsed
+            self.stdout.write(
+                f'{workers:>8}{elapsed:>10.2f}{readings / elapsed:>14,.0f}{baseline / elapsed:>9.2f}'
+                f'{max(router.routed) / max(min(router.routed), 1):>14.2f}'
+            )
+
+    def run(self, workers, reads):
+        """Wall time from the first routed read until every worker has exited, and the workers' final stats"""
+        results = multiprocessing.get_context('fork').SimpleQueue()
+        make_listener = partial(IngestListener, precision=1, update_cache=False, rate_limit=False)
+        pipes, processes = start_workers(workers, make_listener, report=results.put, setup=discard_writes)
+        router = ShardRouter(pipes)
+        started = time.perf_counter()
+        for data in reads:
+            router.feed(data)
+        router.send_all()
+        for pipe in pipes:
+            pipe.close()
+        finals = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+        return elapsed, router, finals
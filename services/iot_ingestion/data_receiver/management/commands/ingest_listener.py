@@ -0,0 +1,88 @@
+"""
+Run the raw TCP/UDP ingest listener
+"""
+
+import asyncio
+import json
+import signal
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from data_receiver.listener import IngestListener, serve
+from data_receiver.payloads import PRECISIONS
+from data_receiver.sharding import ShardRouter, start_workers
+
+
+class Command(BaseCommand):
+    help = 'Accept InfluxDB line protocol or site payload JSON lines over raw TCP and UDP'
+
+    def add_arguments(self, parser):
+        config = settings.INGEST_LISTENER
+        parser.add_argument('--host', default=config['host'], help='Address to bind')
+        parser.add_argument('--tcp-port', type=int, default=config['tcp_port'], help='TCP port (0 disables TCP)')
+        parser.add_argument('--udp-port', type=int, default=config['udp_port'], help='UDP port (0 disables UDP)')
+        parser.add_argument(
+            '--precision', default=config['precision'], choices=sorted(PRECISIONS),
+            help='Unit of line protocol timestamps',
+        )
+        parser.add_argument('--stats-interval', type=float, default=10, help='Seconds between stats lines (0 disables)')
+        parser.add_argument(
+            '--workers', type=int, default=config['workers'],
+            help='Shard worker processes; readings are routed to them by site_id (1 = single process)',
+        )
+
+    def handle(self, *args, **options):
+        if not options['tcp_port'] and not options['udp_port']:
+            raise CommandError('Enable at least one of --tcp-port and --udp-port')
+
+        config = settings.INGEST_LISTENER
+        make_listener = partial(
+            IngestListener,
+            batch_size=config['batch_size'],
+            linger=config['linger_ms'] / 1000,
+            max_pending=config['max_pending'],
+            precision=PRECISIONS[options['precision']],
+        )
+        report = partial(self.report, options['stats_interval'] > 0)
+        workers = options['workers']
+        processes = []
+        if workers > 1:
+            pipes, processes = start_workers(
+                workers, make_listener, stats_interval=options['stats_interval'], report=report,
+            )
+            listener = ShardRouter(pipes)
+        else:
+            listener = make_listener()
+
+        self.stdout.write(
+            f"Listening on {options['host']} tcp:{options['tcp_port'] or 'off'} udp:{options['udp_port'] or 'off'}"
+            + (f" with {workers} shard workers" if workers > 1 else "")
+        )
+        asyncio.run(self.run(listener, options))
+        for process in processes:
+            process.join(30)
+        self.stdout.write(json.dumps(listener.stats()))
+
+    def report(self, periodic, stats):
+        if periodic or stats.get('final'):
+            self.stdout.write(json.dumps(stats))
+            self.stdout.flush()
+
+    async def run(self, listener, options):
+        task = asyncio.create_task(serve(
+            listener,
+            host=options['host'],
+            tcp_port=options['tcp_port'],
+            udp_port=options['udp_port'],
+            stats_interval=options['stats_interval'],
+            report=partial(self.report, True),
+        ))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
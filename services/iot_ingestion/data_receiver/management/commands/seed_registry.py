@@ -0,0 +1,60 @@
+"""
+Seed the site and sensor registry with the demo boiler sites
+
+The sites and sensor ranges match scripts/generate_sample_data.py, so the
+sample data generator is accepted by ingest validation out of the box.
+Existing rows are left untouched.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data_receiver.models import Sensor, Site
+
+SAMPLE_SITES = [
+    {"site_id": "BLR001", "name": "Factory A - Main Boiler", "location": "Shah Alam, Malaysia",
+     "organization_code": "ACME001"},
+    {"site_id": "BLR002", "name": "Factory B - Backup Boiler", "location": "Petaling Jaya, Malaysia",
+     "organization_code": "ACME001"},
+    {"site_id": "BLR003", "name": "Warehouse C - Steam Generator", "location": "Subang Jaya, Malaysia",
+     "organization_code": "TECH002"},
+]
+
+SENSOR_CONFIGS = [
+    {"sensor_type": "temperature", "unit": "celsius", "min_value": 60.0, "max_value": 120.0},
+    {"sensor_type": "pressure", "unit": "bar", "min_value": 5.0, "max_value": 25.0},
+    {"sensor_type": "fuel_level", "unit": "percentage", "min_value": 0.0, "max_value": 100.0},
+    {"sensor_type": "flow_rate", "unit": "l/min", "min_value": 10.0, "max_value": 500.0},
+    {"sensor_type": "efficiency", "unit": "percentage", "min_value": 70.0, "max_value": 95.0},
+]
+
+
+class Command(BaseCommand):
+    help = 'Create the demo sites and sensors in the ingest registry if they do not exist'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fleet', type=int, default=0,
+            help='Also register N synthetic sites (BLR0000, BLR0001, ...) for load testing',
+        )
+        parser.add_argument('--organization', default='ACME001', help='Organization code for synthetic sites')
+
+    def handle(self, *args, **options):
+        sites = list(SAMPLE_SITES)
+        sites += [
+            {"site_id": f"BLR{n:04d}", "name": f"Synthetic Boiler {n}", "location": "",
+             "organization_code": options['organization']}
+            for n in range(options['fleet'])
+        ]
+
+        with transaction.atomic():
+            existing = set(Site.objects.filter(site_id__in=[s['site_id'] for s in sites])
+                           .values_list('site_id', flat=True))
+            created = Site.objects.bulk_create([Site(**s) for s in sites if s['site_id'] not in existing])
+            Sensor.objects.bulk_create(
+                [Sensor(site=site, **config) for site in created for config in SENSOR_CONFIGS]
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Registry seeded: {len(created)} sites created, {len(existing)} already present"
+        ))
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistryVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Site',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site_id', models.CharField(help_text='Identifier sent by the gateway', max_length=50, unique=True)),
+                ('name', models.CharField(blank=True, help_text='Site name', max_length=255)),
+                ('location', models.CharField(blank=True, help_text='Site location', max_length=255)),
+                ('organization_code', models.CharField(blank=True, db_index=True, help_text='Code of the organization owning the site', max_length=50)),
+                ('is_active', models.BooleanField(default=True, help_text='Inactive sites are rejected at ingest')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['site_id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Sensor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sensor_type', models.CharField(help_text='Sensor type, e.g. temperature', max_length=50)),
+                ('unit', models.CharField(blank=True, help_text='Unit of the reported values', max_length=20)),
+                ('min_value', models.FloatField(help_text='Lowest valid reading')),
+                ('max_value', models.FloatField(help_text='Highest valid reading')),
+                ('is_active', models.BooleanField(default=True, help_text='Inactive sensors are rejected at ingest')),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sensors', to='data_receiver.site')),
+            ],
+            options={
+                'ordering': ['site', 'sensor_type'],
+                'constraints': [models.UniqueConstraint(fields=('site', 'sensor_type'), name='unique_sensor_per_site')],
+            },
+        ),
+    ]
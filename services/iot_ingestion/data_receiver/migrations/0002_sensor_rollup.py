@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_receiver', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('site_id', models.CharField(max_length=50)),
+                ('sensor_type', models.CharField(max_length=50)),
+                ('bucket', models.DateTimeField(help_text='Start of the bucket (UTC)')),
+                ('count', models.PositiveIntegerField()),
+                ('sum_value', models.FloatField()),
+                ('min_value', models.FloatField()),
+                ('max_value', models.FloatField()),
+                ('last_value', models.FloatField(help_text='Value of the latest reading in the bucket')),
+                ('last_time', models.DateTimeField(help_text='Timestamp of the latest reading in the bucket')),
+            ],
+            options={
+                'ordering': ['resolution', 'site_id', 'sensor_type', 'bucket'],
+                'constraints': [models.UniqueConstraint(fields=('resolution', 'site_id', 'sensor_type', 'bucket'), name='unique_rollup_bucket')],
+            },
+        ),
+    ]
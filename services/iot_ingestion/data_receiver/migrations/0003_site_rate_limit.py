@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_receiver', '0002_sensor_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='rate_burst',
+            field=models.PositiveIntegerField(blank=True, help_text='Readings the site may send at once above its rate; empty uses the default', null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='rate_limit',
+            field=models.FloatField(blank=True, help_text='Readings per second accepted from the site; empty uses the default', null=True),
+        ),
+    ]
@@ -1,4 +1,158 @@
 from django.db import models
+from django.db.models import F
 
-# IoT Ingestion Models - Cleaned for Re-implementation
-# This service will handle sensor data ingestion
+# IoT Ingestion Models - Site and sensor registry
+# The ingest path validates readings against an in-process snapshot of these
+# tables (see registry.py); RegistryVersion tells it when to reload.
+
+class RegistryVersion(models.Model):
+    """
+    Single-row counter bumped on every registry change
+    Ingest processes compare it with their snapshot's version to know when to reload
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def current(cls):
+        """Current registry version (0 before the first change)"""
+        return cls.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        """Increment the registry version"""
+        if not cls.objects.filter(pk=1).update(version=F('version') + 1):
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
+
+    def __str__(self):
+        return f"Registry v{self.version}"
+
+class RegistryQuerySet(models.QuerySet):
+    """
+    Bulk writes bump the registry version too
+    They bypass save() and delete(): admin "delete selected", bulk_create, bulk_update and update()
+    """
+
+    def delete(self):
+        result = super().delete()
+        if result[0]:
+            RegistryVersion.bump()
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        if rows:
+            RegistryVersion.bump()
+        return rows
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        if created:
+            RegistryVersion.bump()
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        if rows:
+            RegistryVersion.bump()
+        return rows
+
+class RegistryModel(models.Model):
+    """Base for registry tables: any save or delete, single or bulk, bumps the registry version"""
+
+    objects = RegistryQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        RegistryVersion.bump()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        RegistryVersion.bump()
+        return result
+
+class Site(RegistryModel):
+    """
+    A boiler site that is allowed to send readings
+    Sites belong to an organization by its code (see frontend_web Organization)
+    """
+    site_id = models.CharField(max_length=50, unique=True, help_text="Identifier sent by the gateway")
+    name = models.CharField(max_length=255, blank=True, help_text="Site name")
+    location = models.CharField(max_length=255, blank=True, help_text="Site location")
+    organization_code = models.CharField(
+        max_length=50, blank=True, db_index=True, help_text="Code of the organization owning the site"
+    )
+    is_active = models.BooleanField(default=True, help_text="Inactive sites are rejected at ingest")
+    rate_limit = models.FloatField(
+        null=True, blank=True, help_text="Readings per second accepted from the site; empty uses the default"
+    )
+    rate_burst = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Readings the site may send at once above its rate; empty uses the default"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['site_id']
+
+    def __str__(self):
+        return f"{self.site_id} - {self.name}" if self.name else self.site_id
+
+class Sensor(RegistryModel):
+    """A sensor installed at a site, with the range of values it can legitimately report"""
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='sensors')
+    sensor_type = models.CharField(max_length=50, help_text="Sensor type, e.g. temperature")
+    unit = models.CharField(max_length=20, blank=True, help_text="Unit of the reported values")
+    min_value = models.FloatField(help_text="Lowest valid reading")
+    max_value = models.FloatField(help_text="Highest valid reading")
+    is_active = models.BooleanField(default=True, help_text="Inactive sensors are rejected at ingest")
+
+    class Meta:
+        ordering = ['site', 'sensor_type']
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'sensor_type'], name='unique_sensor_per_site'),
+        ]
+
+    def __str__(self):
+        return f"{self.site.site_id}:{self.sensor_type}"
+
+class SensorRollup(models.Model):
+    """
+    Aggregate of one sensor's readings over a 1-minute, 1-hour or 1-day bucket
+    Maintained incrementally at ingest by rollups.py; rows are only ever merged into
+    """
+    RESOLUTION_CHOICES = [('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')]
+
+    resolution = models.CharField(max_length=2, choices=RESOLUTION_CHOICES)
+    site_id = models.CharField(max_length=50)
+    sensor_type = models.CharField(max_length=50)
+    bucket = models.DateTimeField(help_text="Start of the bucket (UTC)")
+    count = models.PositiveIntegerField()
+    sum_value = models.FloatField()
+    min_value = models.FloatField()
+    max_value = models.FloatField()
+    last_value = models.FloatField(help_text="Value of the latest reading in the bucket")
+    last_time = models.DateTimeField(help_text="Timestamp of the latest reading in the bucket")
+
+    class Meta:
+        ordering = ['resolution', 'site_id', 'sensor_type', 'bucket']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['resolution', 'site_id', 'sensor_type', 'bucket'], name='unique_rollup_bucket',
+            ),
+        ]
+
+    @property
+    def mean(self):
+        return self.sum_value / self.count if self.count else None
+
+    def __str__(self):
+        return f"{self.site_id} {self.sensor_type} {self.resolution} {self.bucket:%Y-%m-%d %H:%M}"
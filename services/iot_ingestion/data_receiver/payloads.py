@@ -0,0 +1,213 @@
+"""
+Ingest payload parsing for the data_receiver app
+
+A site payload is the contract used by the gateways and by
+scripts/generate_sample_data.py:
+
+    {"site_id": "BLR001", "timestamp": "2025-01-01T10:00:00Z",
+     "readings": [{"sensor_type": "temperature", "value": 88.5}, ...]}
+
+Individual readings may carry their own "timestamp", which lets one payload
+hold several sampling instants. The bulk endpoint accepts many of these
+payloads as newline-delimited JSON (one payload per line). The raw socket
+listener also takes InfluxDB line protocol (see ``parse_line_protocol``).
+"""
+
+import json
+import math
+import re
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+
+class Reading(NamedTuple):
+    """A single sensor value, timestamped in nanoseconds since the epoch"""
+    site_id: str
+    sensor_type: str
+    timestamp: int
+    value: float
+
+
+class PayloadError(ValueError):
+    """Raised when a payload cannot be turned into readings"""
+
+
+def parse_timestamp(value):
+    """
+    Convert an ISO 8601 string or a numeric epoch into nanoseconds
+
+    Naive ISO strings are treated as UTC. Numeric epochs are interpreted by
+    magnitude: seconds, milliseconds, microseconds or nanoseconds.
+    """
+    if isinstance(value, bool):
+        raise PayloadError("timestamp must be a string or a number")
+
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value) or value < 0:
+            raise PayloadError(f"invalid timestamp: {value!r}")
+        if value < 1e11:
+            return int(value * 1_000_000_000)
+        if value < 1e14:
+            return int(value * 1_000_000)
+        if value < 1e17:
+            return int(value * 1_000)
+        return int(value)
+
+    if isinstance(value, str):
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise PayloadError(f"invalid timestamp: {value!r}") from None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        delta = moment - datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return (delta.days * 86_400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1_000
+
+    raise PayloadError("timestamp must be a string or a number")
+
+
+def parse_payload(data):
+    """Turn one site payload (already decoded from JSON) into a list of readings"""
+    if not isinstance(data, dict):
+        raise PayloadError("payload must be a JSON object")
+
+    site_id = data.get("site_id")
+    if not isinstance(site_id, str) or not site_id:
+        raise PayloadError("site_id is required")
+
+    entries = data.get("readings")
+    if not isinstance(entries, list) or not entries:
+        raise PayloadError("readings must be a non-empty list")
+
+    default_timestamp = data.get("timestamp")
+    if default_timestamp is not None:
+        default_timestamp = parse_timestamp(default_timestamp)
+
+    readings = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise PayloadError("each reading must be a JSON object")
+
+        sensor_type = entry.get("sensor_type")
+        if not isinstance(sensor_type, str) or not sensor_type:
+            raise PayloadError("sensor_type is required")
+
+        value = entry.get("value")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise PayloadError(f"{sensor_type}: value must be a number")
+        value = float(value)
+        if not math.isfinite(value):
+            raise PayloadError(f"{sensor_type}: value must be finite")
+
+        timestamp = entry.get("timestamp")
+        if timestamp is not None:
+            timestamp = parse_timestamp(timestamp)
+        elif default_timestamp is not None:
+            timestamp = default_timestamp
+        else:
+            raise PayloadError(f"{sensor_type}: timestamp is required")
+
+        readings.append(Reading(site_id, sensor_type, timestamp, value))
+
+    return readings
+
+
+def parse_ndjson(stream):
+    """
+    Parse a newline-delimited stream of site payloads
+
+    The stream is consumed line by line so the body never has to be held in
+    memory as a whole. Yields ``(line_number, readings, error)`` for every
+    non-blank line, where exactly one of ``readings`` and ``error`` is set.
+    """
+    for line_number, raw in enumerate(stream, start=1):
+        line = raw.strip()
+        if not line:
+            continue
+        try:
+            readings = parse_payload(json.loads(line))
+        except (ValueError, UnicodeDecodeError) as e:
+            # json.JSONDecodeError and PayloadError are both ValueErrors
+            yield line_number, None, str(e)
+        else:
+            yield line_number, readings, None
+
+
+# Line protocol: separators preceded by a backslash are part of the name or value
+_ESCAPED = re.compile(r'\\(.)')
+_SEPARATORS = {sep: re.compile(r'(?<!\\)' + re.escape(sep)) for sep in (' ', ',', '=')}
+
+# Timestamp precision of line protocol records, as a multiplier to nanoseconds
+PRECISIONS = {'ns': 1, 'us': 1_000, 'ms': 1_000_000, 's': 1_000_000_000}
+
+
+def _split(text, sep):
+    """Split on separators that are not escaped with a backslash"""
+    if '\\' not in text:
+        return text.split(sep)
+    return _SEPARATORS[sep].split(text)
+
+
+def _pair(text, kind):
+    """Split ``key=value`` on the first unescaped ``=``, unescaping both sides"""
+    if '\\' not in text:
+        key, sep, value = text.partition('=')
+    else:
+        match = _SEPARATORS['='].search(text)
+        key, sep, value = (text[:match.start()], '=', text[match.end():]) if match else (text, '', '')
+        key, value = _ESCAPED.sub(r'\1', key), _ESCAPED.sub(r'\1', value)
+    if not sep or not key or not value:
+        raise PayloadError(f"invalid {kind}: {text!r}")
+    return key, value
+
+
+def parse_line_protocol(line, received_at, precision=1):
+    """
+    Turn one InfluxDB line protocol record into readings
+
+    Two shapes are accepted, both with a ``site_id`` tag:
+
+        sensor_reading,site_id=BLR001,sensor_type=temperature value=88.5 1735725600000000000
+        boiler,site_id=BLR001 temperature=88.5,pressure=12.1 1735725600000000000
+
+    With a ``sensor_type`` tag the ``value`` field is the reading; otherwise
+    every field is a sensor. Fields must be numeric (``i``/``u`` integer
+    suffixes are allowed). The timestamp is in ``precision`` units (a
+    multiplier to nanoseconds); records without one get ``received_at``.
+    """
+    parts = _split(line, ' ')
+    if len(parts) not in (2, 3):
+        raise PayloadError("expected '<measurement>,<tags> <fields> [timestamp]'")
+
+    tags = dict(_pair(tag, 'tag') for tag in _split(parts[0], ',')[1:])
+    site_id = tags.get('site_id')
+    if not site_id:
+        raise PayloadError("site_id tag is required")
+
+    if len(parts) == 3:
+        try:
+            timestamp = int(parts[2]) * precision
+        except ValueError:
+            raise PayloadError(f"invalid timestamp: {parts[2]!r}") from None
+    else:
+        timestamp = received_at
+
+    fields = {}
+    for field in _split(parts[1], ','):
+        key, raw = _pair(field, 'field')
+        if raw[-1] in 'iu':
+            raw = raw[:-1]
+        try:
+            value = float(raw)
+        except ValueError:
+            raise PayloadError(f"{key}: value must be a number") from None
+        if not math.isfinite(value):
+            raise PayloadError(f"{key}: value must be finite")
+        fields[key] = value
+
+    sensor_type = tags.get('sensor_type')
+    if sensor_type is None:
+        return [Reading(site_id, name, timestamp, value) for name, value in fields.items()]
+    if 'value' not in fields:
+        raise PayloadError(f"{sensor_type}: value field is required")
+    return [Reading(site_id, sensor_type, timestamp, fields['value'])]
@@ -0,0 +1,80 @@
+"""
+Ingest pipeline shared by every entry point
+
+Once a request's readings have been parsed, they all take the same path:
+duplicates are filtered out, the rest are queued on the write buffer and
+published to the readings stream, and the latest-value cache is refreshed.
+The write buffer folds them into the rollups once they are stored.
+``asubmit_readings`` is the same path for async views, awaiting Redis
+instead of blocking on it.
+"""
+
+from boiler_common import metrics
+
+from .buffer import get_buffer
+from .cache import aupdate_latest_values, update_latest_values
+from .dedup import get_deduplicator
+from .stream import get_publisher
+
+BATCH_SIZE = metrics.histogram(
+    'ingest_batch_readings', 'Readings per batch offered to the ingest pipeline', buckets=metrics.SIZE_BUCKETS,
+)
+READINGS = metrics.counter('ingest_readings_total', 'Readings offered to the ingest pipeline, by outcome', ['outcome'])
+ACCEPTED, DUPLICATE, REFUSED = (READINGS.labels(outcome) for outcome in ('accepted', 'duplicate', 'buffer_full'))
+
+
+class BufferFull(Exception):
+    """Raised when the write buffer (and spool) cannot take a batch"""
+
+    def __init__(self, retry_after):
+        super().__init__("ingest buffer full")
+        self.retry_after = retry_after
+
+
+def accept_readings(readings):
+    """
+    Filter duplicates, queue the rest on the write buffer and publish them
+
+    Returns the fresh readings. Raises BufferFull when the batch cannot be
+    queued; nothing is remembered by the dedup index in that case, so the
+    gateway can safely retry.
+    """
+    BATCH_SIZE.observe(len(readings))
+    deduplicator = get_deduplicator()
+    if deduplicator is not None:
+        fresh, pending = deduplicator.check(readings)
+    else:
+        fresh, pending = readings, None
+
+    buffer = get_buffer()
+    if not buffer.offer(fresh):
+        REFUSED.inc(len(readings))
+        raise BufferFull(buffer.retry_after)
+    ACCEPTED.inc(len(fresh))
+    DUPLICATE.inc(len(readings) - len(fresh))
+
+    if pending:
+        deduplicator.commit(pending)
+    publisher = get_publisher()
+    if publisher is not None:
+        publisher.add(fresh)
+    return fresh
+
+
+def submit_readings(readings):
+    """
+    Accept parsed readings for storage
+
+    Returns the number of readings dropped as duplicates; raises BufferFull
+    as ``accept_readings`` does.
+    """
+    fresh = accept_readings(readings)
+    update_latest_values(fresh)
+    return len(readings) - len(fresh)
+
+
+async def asubmit_readings(readings):
+    """Async ``submit_readings``"""
+    fresh = accept_readings(readings)
+    await aupdate_latest_values(fresh)
+    return len(readings) - len(fresh)
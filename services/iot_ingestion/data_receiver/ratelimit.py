@@ -0,0 +1,302 @@
+"""
+Per-site token-bucket rate limiting for the ingest endpoints
+
+Every site has a bucket that refills at its configured rate (readings per
+second) up to its burst size. A request costs one token per reading. All
+the sites in a request are checked and charged by one Lua script call, so
+the limiter costs a single Redis round trip however many sites a bulk body
+carries. The script reads Redis' own clock, so buckets shared by every
+ingest process and worker stay consistent without clock agreement.
+
+A request is allowed when its site has at least ``min(cost, burst)``
+tokens, and the full cost is then charged. The bucket may go negative, so
+a backfill larger than the burst is let through once and the site then
+waits until its average rate is back under the limit.
+
+When Redis is unreachable, the same buckets are kept in process memory,
+and Redis is retried after ``retry_interval`` seconds. Each process then
+enforces the full limit on its own, so the effective limit is multiplied by
+the number of processes until Redis is back.
+
+Readings that pass the limit but are then refused by a full write buffer
+are refunded, so a gateway retrying after a 503 is not also rate limited.
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+import weakref
+
+from boiler_common import metrics
+from django.conf import settings
+
+from .cache import get_async_latest_cache, get_redis, key_prefix
+
+logger = logging.getLogger(__name__)
+
+# KEYS: one bucket hash per site
+# ARGV: (rate, burst, cost) per key
+# Returns the wait in milliseconds per key, 0 when the readings were allowed.
+# Calling TIME before writing relies on effects replication (the default since Redis 5).
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local waits = {}
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local needed = math.min(cost, burst)
+    if tokens >= needed then
+        tokens = tokens - cost
+        waits[i] = 0
+    else
+        waits[i] = math.ceil((needed - tokens) / rate * 1000)
+    end
+    redis.call('HSET', KEYS[i], 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil((burst - tokens) / rate * 1000) + 1000)
+end
+return waits
+"""
+
+# Gives back tokens charged for readings that were then refused (write buffer full).
+# KEYS and ARGV as above; buckets that have expired since are left alone, they are full.
+REFUND_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    if state[1] then
+        local tokens = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate + cost)
+        redis.call('HSET', KEYS[i], 'tokens', tokens, 'ts', now)
+        redis.call('PEXPIRE', KEYS[i], math.ceil((burst - tokens) / rate * 1000) + 1000)
+    end
+end
+return 0
+"""
+
+REDIS_LATENCY = metrics.histogram('redis_request_duration_seconds', 'Redis call latency, failures included', ['operation'])
+CHECK_LATENCY = REDIS_LATENCY.labels('rate_limit')
+CHECKS = metrics.counter('ingest_rate_limit_checks_total', 'Rate limit checks by backend', ['backend'])
+REDIS_CHECKS, LOCAL_CHECKS = CHECKS.labels('redis'), CHECKS.labels('local')
+LIMITED = metrics.counter('ingest_rate_limited_readings_total', 'Readings refused by the per-site rate limit')
+
+
+def bucket_key(site_id, prefix=None):
+    return f"{prefix or key_prefix()}:ratelimit:{site_id}"
+
+
+def site_costs(readings):
+    """Number of readings per site, in first-seen order"""
+    costs = {}
+    for reading in readings:
+        costs[reading.site_id] = costs.get(reading.site_id, 0) + 1
+    return costs
+
+
+def site_limits(costs, registry):
+    """``[(site_id, rate, burst, cost)]`` using each site's registry limits or the configured default"""
+    config = settings.INGEST_RATE_LIMIT
+    sites = registry.sites if registry is not None else {}
+    requests = []
+    for site_id, cost in costs.items():
+        entry = sites.get(site_id)
+        rate = entry.rate_limit if entry is not None and entry.rate_limit else config['rate']
+        burst = entry.rate_burst if entry is not None and entry.rate_burst else config['burst']
+        requests.append((site_id, rate, burst, cost))
+    return requests
+
+
+class LocalTokenBuckets:
+    """The token-bucket script evaluated in process memory"""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._buckets = {}  # site_id -> [tokens, ts]
+        self._lock = threading.Lock()
+
+    def acquire(self, requests):
+        """Charge each ``(site_id, rate, burst, cost)``; returns the wait in seconds per request, 0 if allowed"""
+        now = self._clock()
+        waits = []
+        with self._lock:
+            for site_id, rate, burst, cost in requests:
+                bucket = self._buckets.get(site_id)
+                if bucket is None:
+                    bucket = self._buckets[site_id] = [burst, now]
+                tokens = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+                needed = min(cost, burst)
+                if tokens >= needed:
+                    tokens -= cost
+                    waits.append(0)
+                else:
+                    waits.append((needed - tokens) / rate)
+                bucket[0], bucket[1] = tokens, now
+        return waits
+
+    def refund(self, requests):
+        """Give back the cost of each ``(site_id, rate, burst, cost)`` charged by ``acquire``"""
+        now = self._clock()
+        with self._lock:
+            for site_id, rate, burst, cost in requests:
+                bucket = self._buckets.get(site_id)
+                if bucket is not None:
+                    bucket[0] = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate + cost)
+                    bucket[1] = now
+
+
+class RateLimiter:
+    """Token buckets in Redis, falling back to ``fallback`` while Redis is unreachable"""
+
+    def __init__(self, client, prefix, fallback, retry_interval=5.0, clock=time.monotonic):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback
+        self.retry_interval = retry_interval
+        self._clock = clock
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._refund_script = client.register_script(REFUND_SCRIPT)
+        self._redis_down_until = 0.0
+
+    @property
+    def using_fallback(self):
+        """True while checks go to the in-process buckets instead of Redis"""
+        return not self._use_redis()
+
+    def use_fallback(self, seconds=math.inf):
+        """Check against the in-process buckets for ``seconds``, by default for good, as if Redis were down"""
+        self._redis_down_until = self._clock() + seconds
+
+    def _script_args(self, requests):
+        keys = [bucket_key(site_id, self.prefix) for site_id, _, _, _ in requests]
+        args = [value for _, rate, burst, cost in requests for value in (rate, burst, cost)]
+        return keys, args
+
+    def _use_redis(self):
+        return self._clock() >= self._redis_down_until
+
+    def _redis_failed(self):
+        self._redis_down_until = self._clock() + self.retry_interval
+        logger.warning("Rate limiter cannot reach Redis, using in-process buckets for %ss",
+                       self.retry_interval, exc_info=True)
+
+    @staticmethod
+    def _limited(requests, waits, scale):
+        limited = {site_id: wait * scale for (site_id, _, _, cost), wait in zip(requests, waits) if wait}
+        if limited:
+            LIMITED.inc(sum(cost for site_id, _, _, cost in requests if site_id in limited))
+        return limited
+
+    def check(self, readings, registry):
+        """Charge the readings to their sites; returns ``{site_id: retry_after seconds}`` for refused sites"""
+        requests = site_limits(site_costs(readings), registry)
+        if self._use_redis():
+            keys, args = self._script_args(requests)
+            try:
+                with CHECK_LATENCY.time():
+                    waits = self._script(keys=keys, args=args)
+            except Exception:
+                self._redis_failed()
+            else:
+                REDIS_CHECKS.inc()
+                return self._limited(requests, waits, 0.001)
+        LOCAL_CHECKS.inc()
+        return self._limited(requests, self.fallback.acquire(requests), 1)
+
+    async def acheck(self, readings, registry):
+        """``check`` for a limiter built on a ``redis.asyncio`` client"""
+        requests = site_limits(site_costs(readings), registry)
+        if self._use_redis():
+            keys, args = self._script_args(requests)
+            try:
+                with CHECK_LATENCY.time():
+                    waits = await self._script(keys=keys, args=args)
+            except Exception:
+                self._redis_failed()
+            else:
+                REDIS_CHECKS.inc()
+                return self._limited(requests, waits, 0.001)
+        LOCAL_CHECKS.inc()
+        return self._limited(requests, self.fallback.acquire(requests), 1)
+
+    def refund(self, readings, registry):
+        """
+        Give back what ``check`` charged for readings that were not accepted after all
+
+        Best effort: if Redis fails here the tokens stay spent, they are not
+        refunded to the in-process buckets that were never charged.
+        """
+        requests = site_limits(site_costs(readings), registry)
+        if not self._use_redis():
+            self.fallback.refund(requests)
+            return
+        keys, args = self._script_args(requests)
+        try:
+            with CHECK_LATENCY.time():
+                self._refund_script(keys=keys, args=args)
+        except Exception:
+            self._redis_failed()
+
+    async def arefund(self, readings, registry):
+        """``refund`` for a limiter built on a ``redis.asyncio`` client"""
+        requests = site_limits(site_costs(readings), registry)
+        if not self._use_redis():
+            self.fallback.refund(requests)
+            return
+        keys, args = self._script_args(requests)
+        try:
+            with CHECK_LATENCY.time():
+                await self._refund_script(keys=keys, args=args)
+        except Exception:
+            self._redis_failed()
+
+
+def retry_after(limited):
+    """Whole seconds a gateway should wait before retrying the slowest refused site"""
+    return max(1, math.ceil(max(limited.values())))
+
+
+_fallback = LocalTokenBuckets()
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter, or None when rate limiting is disabled"""
+    global _limiter
+    config = settings.INGEST_RATE_LIMIT
+    if not config['enabled']:
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(get_redis(), key_prefix(), _fallback, config['fallback_retry_seconds'])
+    return _limiter
+
+
+# One async limiter per event loop, on that loop's latest-value cache client
+_async_limiters = weakref.WeakKeyDictionary()
+
+
+def get_async_rate_limiter():
+    """Return the rate limiter for the running event loop, or None when rate limiting is disabled"""
+    config = settings.INGEST_RATE_LIMIT
+    if not config['enabled']:
+        return None
+    loop = asyncio.get_running_loop()
+    limiter = _async_limiters.get(loop)
+    if limiter is None:
+        limiter = RateLimiter(
+            get_async_latest_cache().client, key_prefix(), _fallback, config['fallback_retry_seconds'],
+        )
+        _async_limiters[loop] = limiter
+    return limiter
@@ -0,0 +1,192 @@
+"""
+In-process snapshot of the site and sensor registry
+
+Validating every reading against Postgres would cost a query per reading, so
+each process keeps an immutable snapshot of the registry in plain dicts and
+validation is a dict lookup. The snapshot carries the ``RegistryVersion`` it
+was built from; at most once per ``check_interval`` seconds the cache reads
+the current version (a single-row query) and rebuilds the snapshot only when
+it has changed.
+
+Every rebuild also replaces the site -> organization hash in Redis, which
+ai_processor reads to group its fleet analytics by organization.
+"""
+
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from boiler_common import metrics
+from boiler_common import readings as stream_format
+from django.conf import settings
+
+from .payloads import PayloadError
+
+logger = logging.getLogger(__name__)
+
+# A hit is a lookup served by the current snapshot, a miss one that had to rebuild it
+CACHE_REQUESTS = metrics.counter('cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+REGISTRY_HIT, REGISTRY_MISS = CACHE_REQUESTS.labels('registry', 'hit'), CACHE_REQUESTS.labels('registry', 'miss')
+
+
+class SiteEntry(NamedTuple):
+    site_id: str
+    name: str
+    location: str
+    organization_code: str
+    sensors: dict  # sensor_type -> (min_value, max_value, unit)
+    rate_limit: float = None  # readings per second, None for the default
+    rate_burst: int = None
+
+
+class RegistrySnapshot:
+    """Immutable view of the active sites and sensors at one registry version"""
+
+    def __init__(self, version, sites):
+        self.version = version
+        self.sites = {site.site_id: site for site in sites}
+        self._ranges = {
+            (site.site_id, sensor_type): (bounds[0], bounds[1])
+            for site in sites
+            for sensor_type, bounds in site.sensors.items()
+        }
+
+    def validate(self, readings):
+        """Raise PayloadError unless every reading is from a known sensor and within its range"""
+        ranges = self._ranges
+        for reading in readings:
+            bounds = ranges.get((reading.site_id, reading.sensor_type))
+            if bounds is None:
+                if reading.site_id not in self.sites:
+                    raise PayloadError(f"unknown site_id {reading.site_id!r}")
+                raise PayloadError(f"unknown sensor_type {reading.sensor_type!r} for site {reading.site_id}")
+            if not bounds[0] <= reading.value <= bounds[1]:
+                raise PayloadError(
+                    f"{reading.sensor_type} value {reading.value} outside [{bounds[0]}, {bounds[1]}]"
+                )
+
+    def for_organization(self, organization_code):
+        return [site for site in self.sites.values() if site.organization_code == organization_code]
+
+
+def load_snapshot():
+    """Build a snapshot of the active registry from the database"""
+    from .models import RegistryVersion, Sensor, Site
+
+    version = RegistryVersion.current()
+    sites = {
+        site['site_id']: SiteEntry(sensors={}, **site)
+        for site in Site.objects.filter(is_active=True).values(
+            'site_id', 'name', 'location', 'organization_code', 'rate_limit', 'rate_burst'
+        )
+    }
+    sensors = Sensor.objects.filter(is_active=True, site__is_active=True).values_list(
+        'site__site_id', 'sensor_type', 'min_value', 'max_value', 'unit'
+    )
+    for site_id, sensor_type, min_value, max_value, unit in sensors:
+        sites[site_id].sensors[sensor_type] = (min_value, max_value, unit)
+    return RegistrySnapshot(version, list(sites.values()))
+
+
+def publish_organizations(snapshot, client, key):
+    """Replace the ``key`` hash with the organization code of every site in the snapshot"""
+    organizations = {site_id: site.organization_code for site_id, site in snapshot.sites.items()
+                     if site.organization_code}
+    pipe = client.pipeline()
+    pipe.delete(key)
+    if organizations:
+        pipe.hset(key, mapping=organizations)
+    pipe.execute()
+
+
+def load_and_publish():
+    """``load_snapshot``, publishing the site organizations on the way (a Redis failure is only logged)"""
+    from .cache import get_redis, key_prefix
+
+    snapshot = load_snapshot()
+    try:
+        publish_organizations(snapshot, get_redis(), stream_format.organizations_key(key_prefix()))
+    except Exception:
+        logger.warning("Publishing site organizations failed", exc_info=True)
+    return snapshot
+
+
+def current_version():
+    from .models import RegistryVersion
+
+    return RegistryVersion.current()
+
+
+class RegistryCache:
+    """Versioned snapshot, re-checked against the registry version every ``check_interval`` seconds"""
+
+    def __init__(self, check_interval=5.0, load=load_snapshot, version=current_version, clock=time.monotonic):
+        self.check_interval = check_interval
+        self._load = load
+        self._version = version
+        self._clock = clock
+        self._snapshot = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def get(self):
+        """Return the current snapshot, reloading it if the registry changed"""
+        now = self._clock()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            REGISTRY_HIT.inc()
+            return self._snapshot
+        with self._lock:
+            if self._snapshot is None or now - self._checked_at >= self.check_interval:
+                if self._snapshot is None or self._version() != self._snapshot.version:
+                    self._snapshot = self._load()
+                    self.reloads += 1
+                    REGISTRY_MISS.inc()
+                    self._checked_at = now
+                    return self._snapshot
+                self._checked_at = now
+        REGISTRY_HIT.inc()
+        return self._snapshot
+
+    async def aget(self):
+        """``get`` for async views: the database is only touched (in a thread) when a check is due"""
+        if self._snapshot is not None and self._clock() - self._checked_at < self.check_interval:
+            REGISTRY_HIT.inc()
+            return self._snapshot
+        return await sync_to_async(self.get)()
+
+    def invalidate(self):
+        """Force the next ``get`` to re-check the version"""
+        self._checked_at = float('-inf')
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_registry_cache():
+    """Return the process-wide registry cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RegistryCache(
+                    check_interval=settings.INGEST_REGISTRY['check_interval'], load=load_and_publish,
+                )
+    return _cache
+
+
+def get_registry():
+    """Current registry snapshot, or None when ingest validation is disabled"""
+    if not settings.INGEST_REGISTRY['enabled']:
+        return None
+    return get_registry_cache().get()
+
+
+async def aget_registry():
+    """Async ``get_registry``"""
+    if not settings.INGEST_REGISTRY['enabled']:
+        return None
+    return await get_registry_cache().aget()
@@ -0,0 +1,271 @@
+"""
+Continuous 1-minute, 1-hour and 1-day rollups maintained at ingest
+
+Every stored reading (written to InfluxDB or spooled for replay, see
+``WriteBuffer``'s ``on_stored``) is folded into an in-memory aggregate for its
+``(site, sensor, minute)``: count, sum, min, max and the latest value. Once
+a minute has been closed for ``grace`` seconds, its aggregate is persisted
+as a ``SensorRollup`` row and merged into the hour and day rows that
+contain it, so range queries read one row per bucket instead of every raw
+point.
+
+All merges are additive upserts (count and sum add up, min/max widen, the
+later ``last`` wins). A reading that arrives after its minute was persisted
+simply starts a new partial aggregate for that minute, which is merged into
+the same rows on the next flush. Late data therefore lands in the right
+buckets, and several ingest processes can write the same buckets safely.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from boiler_common import metrics
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+OPEN_MINUTES = metrics.gauge('ingest_rollup_open_minutes', 'Minute aggregates not yet persisted')
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+_NS = 1_000_000_000
+
+
+def to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+def merge(into, other):
+    """Fold aggregate ``other`` into ``into``; both are [count, sum, min, max, last_ns, last_value]"""
+    into[0] += other[0]
+    into[1] += other[1]
+    if other[2] < into[2]:
+        into[2] = other[2]
+    if other[3] > into[3]:
+        into[3] = other[3]
+    if other[4] >= into[4]:
+        into[4] = other[4]
+        into[5] = other[5]
+
+
+def rollup_rows(minutes):
+    """
+    Rows to upsert for closed minute aggregates
+
+    ``minutes`` maps ``(site_id, sensor_type, minute_start)`` to an aggregate;
+    the result maps ``(resolution, site_id, sensor_type, bucket_start)`` to the
+    combined aggregate, for the minutes themselves and every hour and day
+    they fall in.
+    """
+    rows = {}
+    for (site_id, sensor_type, start), aggregate in minutes.items():
+        for resolution, seconds in RESOLUTIONS.items():
+            key = (resolution, site_id, sensor_type, start - start % seconds)
+            row = rows.get(key)
+            if row is None:
+                rows[key] = list(aggregate)
+            else:
+                merge(row, aggregate)
+    return rows
+
+
+_UPSERT = """
+    INSERT INTO {table} (resolution, site_id, sensor_type, bucket, count, sum_value, min_value, max_value,
+                         last_value, last_time)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (resolution, site_id, sensor_type, bucket) DO UPDATE SET
+        count = {table}.count + excluded.count,
+        sum_value = {table}.sum_value + excluded.sum_value,
+        min_value = CASE WHEN excluded.min_value < {table}.min_value
+                         THEN excluded.min_value ELSE {table}.min_value END,
+        max_value = CASE WHEN excluded.max_value > {table}.max_value
+                         THEN excluded.max_value ELSE {table}.max_value END,
+        last_value = CASE WHEN excluded.last_time >= {table}.last_time
+                          THEN excluded.last_value ELSE {table}.last_value END,
+        last_time = CASE WHEN excluded.last_time >= {table}.last_time
+                         THEN excluded.last_time ELSE {table}.last_time END
+"""
+
+
+def persist_rows(rows):
+    """
+    Merge rollup rows into ``SensorRollup`` with one additive upsert per row
+
+    Rows are upserted in ``(site_id, sensor_type, resolution, bucket)``
+    order, so processes flushing the same buckets lock them in the same
+    order and cannot deadlock each other.
+    """
+    from .models import SensorRollup
+
+    adapt = connection.ops.adapt_datetimefield_value
+    params = [
+        (resolution, site_id, sensor_type, adapt(to_datetime(start)),
+         count, total, low, high, last_value, adapt(to_datetime(last_ns / _NS)))
+        for (resolution, site_id, sensor_type, start), (count, total, low, high, last_ns, last_value)
+        in sorted(rows.items(), key=lambda item: (item[0][1], item[0][2], item[0][0], item[0][3]))
+    ]
+    sql = _UPSERT.format(table=connection.ops.quote_name(SensorRollup._meta.db_table))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+class RollupAggregator:
+    """Minute aggregates of stored readings, persisted by a background thread once closed"""
+
+    def __init__(self, persist=persist_rows, grace=10.0, flush_interval=5.0, clock=time.time):
+        self._persist = persist
+        self.grace = grace
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._minutes = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.readings = 0
+        self.late = 0
+        self.flushed_rows = 0
+        self.flush_failures = 0
+
+    def add(self, readings):
+        """Fold readings into their minute aggregates"""
+        cutoff = self._clock() - self.grace - 60
+        with self._lock:
+            minutes = self._minutes
+            for site_id, sensor_type, timestamp, value in readings:
+                start = timestamp // _NS // 60 * 60
+                key = (site_id, sensor_type, start)
+                aggregate = minutes.get(key)
+                if aggregate is None:
+                    minutes[key] = [1, value, value, value, timestamp, value]
+                    if start <= cutoff:
+                        self.late += 1
+                    continue
+                aggregate[0] += 1
+                aggregate[1] += value
+                if value < aggregate[2]:
+                    aggregate[2] = value
+                if value > aggregate[3]:
+                    aggregate[3] = value
+                if timestamp >= aggregate[4]:
+                    aggregate[4] = timestamp
+                    aggregate[5] = value
+            self.readings += len(readings)
+
+    def take_closed(self, everything=False):
+        """Remove and return the minute aggregates that are past their grace period"""
+        cutoff = self._clock() - self.grace - 60
+        with self._lock:
+            if everything:
+                closed, self._minutes = self._minutes, {}
+                return closed
+            closed = {key: aggregate for key, aggregate in self._minutes.items() if key[2] <= cutoff}
+            for key in closed:
+                del self._minutes[key]
+        return closed
+
+    def flush(self, everything=False):
+        """Persist closed minutes (all minutes when ``everything``); failed ones are kept for the next flush"""
+        with self._flush_lock:
+            closed = self.take_closed(everything)
+            if not closed:
+                return 0
+            rows = rollup_rows(closed)
+            try:
+                self._persist(rows)
+            except Exception:
+                self.flush_failures += 1
+                logger.warning("Persisting %d rollup rows failed, retrying later", len(rows), exc_info=True)
+                with self._lock:
+                    for key, aggregate in closed.items():
+                        current = self._minutes.get(key)
+                        if current is None:
+                            self._minutes[key] = aggregate
+                        else:
+                            merge(current, aggregate)
+                return 0
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+    def start(self):
+        """Start the background flusher"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='rollup-flusher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the flusher and persist every open minute"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush(everything=True)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        connection.close()
+
+    def stats(self):
+        return {
+            'open_minutes': len(self._minutes),
+            'readings': self.readings,
+            'late': self.late,
+            'flushed_rows': self.flushed_rows,
+            'flush_failures': self.flush_failures,
+        }
+
+
+_aggregator = None
+_aggregator_lock = threading.Lock()
+
+
+def get_rollups():
+    """Return the process-wide rollup aggregator, or None when rollups are disabled"""
+    global _aggregator
+    config = settings.INGEST_ROLLUPS
+    if not config['enabled']:
+        return None
+    if _aggregator is None:
+        with _aggregator_lock:
+            if _aggregator is None:
+                aggregator = RollupAggregator(
+                    grace=config['grace_seconds'],
+                    flush_interval=config['flush_interval_seconds'],
+                )
+                aggregator.start()
+                atexit.register(shutdown)
+                OPEN_MINUTES.set_function(lambda: len(aggregator._minutes))
+                _aggregator = aggregator
+    return _aggregator
+
+
+def add_to_rollups(readings):
+    """Fold stored readings into the process-wide rollups, if enabled"""
+    rollups = get_rollups()
+    if rollups is not None:
+        rollups.add(readings)
+
+
+def shutdown():
+    """Persist open minutes at interpreter exit"""
+    if _aggregator is not None:
+        _aggregator.stop()
+
+
+def query_rollups(site_id, resolution, start, end, sensor_type=None):
+    """Persisted buckets of a site with ``start <= bucket < end`` (datetimes), by sensor and then time"""
+    from .models import SensorRollup
+
+    rollups = SensorRollup.objects.filter(
+        resolution=resolution, site_id=site_id, bucket__gte=start, bucket__lt=end,
+    )
+    if sensor_type:
+        rollups = rollups.filter(sensor_type=sensor_type)
+    return rollups.order_by('sensor_type', 'bucket')
@@ -0,0 +1,257 @@
+"""
+Site-sharded ingest across worker processes
+
+One process parses, validates and deduplicates every reading under a single
+GIL. In sharded mode (``ingest_listener --workers N``) the process owning
+the sockets only routes: it reads the ``site_id`` out of each raw record
+without parsing the rest, picks a worker by consistent hashing and forwards
+the raw lines over a pipe. Each worker is a forked ``IngestListener`` with
+its own write buffer, dedup index, spool slot and latest-value cache client,
+so all the per-reading work runs in parallel.
+
+A site always hashes to the same worker and pipes are FIFO, so readings of
+one site are processed in the order they arrived. Consistent hashing with
+virtual nodes keeps the load even and moves only about 1/N of the sites
+when the worker count changes.
+
+Backpressure flows back through the pipes: a worker whose write buffer is
+full stops reading its pipe, the pipe fills up and the router blocks on it,
+which stops the router reading from its sockets.
+"""
+
+import asyncio
+import bisect
+import logging
+import multiprocessing
+import re
+import signal
+from hashlib import blake2b
+
+logger = logging.getLogger(__name__)
+
+# Raw-record site_id extraction: the tag in line protocol, the key in JSON
+_JSON_SITE_ID = re.compile(rb'"site_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def _hash(key):
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to ``nodes`` shards through virtual nodes"""
+
+    def __init__(self, nodes, replicas=128):
+        self.nodes = nodes
+        points = sorted(
+            (_hash(f'{node}:{replica}'.encode()), node) for node in range(nodes) for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+def site_key(line):
+    """The raw ``site_id`` of a record, or None when it has none (the worker will reject it)"""
+    if line[:1] == b'{':
+        match = _JSON_SITE_ID.search(line)
+        return match.group(1) if match else None
+    start = line.find(b'site_id=')
+    if start < 0:
+        return None
+    start += 8
+    end = start
+    length = len(line)
+    while end < length and line[end] not in b', ':
+        end += 2 if line[end] == 0x5c else 1  # skip the character after a backslash
+    return line[start:end]
+
+
+class ShardRouter:
+    """
+    Routes raw records from the sockets to worker pipes by site
+
+    Exposes the part of the ``IngestListener`` interface the socket protocols
+    use, so the same TCP and UDP protocols can front either of them.
+    """
+
+    def __init__(self, connections, linger=0.005, max_chunk_bytes=256 * 1024, max_line_bytes=65_536):
+        self.connections = connections
+        self.ring = HashRing(len(connections))
+        self.linger = linger
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_line_bytes = max_line_bytes
+        self.transports = set()
+        self.paused = False
+        self.backlogged = False
+
+        self._chunks = [[] for _ in connections]
+        self._sizes = [0] * len(connections)
+
+        self.lines = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.routed = [0] * len(connections)
+
+    def feed(self, data):
+        """Append each record to its site's worker chunk"""
+        node_for = self.ring.node_for
+        chunks = self._chunks
+        sizes = self._sizes
+        for line in data.split(b'\n'):
+            line = line.strip()
+            if not line:
+                continue
+            self.lines += 1
+            # Not cached per site: keys come from unauthenticated sockets, and a hash plus bisect is cheap
+            node = node_for(site_key(line) or b'')
+            chunks[node].append(line)
+            sizes[node] += len(line) + 1
+            if sizes[node] >= self.max_chunk_bytes:
+                self._send(node)
+
+    def drop(self, count=1):
+        self.dropped += count
+
+    def _send(self, node):
+        lines = self._chunks[node]
+        if lines:
+            # Blocks while the worker's pipe is full: that is the backpressure path
+            self.connections[node].send_bytes(b'\n'.join(lines))
+            self.routed[node] += len(lines)
+            self._chunks[node] = []
+            self._sizes[node] = 0
+
+    def send_all(self):
+        for node in range(len(self.connections)):
+            self._send(node)
+
+    async def start(self):
+        pass
+
+    async def run(self):
+        """Forward partial chunks every ``linger`` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(self.linger)
+            self.send_all()
+
+    async def close(self):
+        """Forward what is left and close the pipes, which tells the workers to finish"""
+        self.send_all()
+        for connection in self.connections:
+            connection.close()
+
+    def stats(self):
+        return {
+            'connections': len(self.transports),
+            'lines': self.lines,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'routed': self.routed,
+        }
+
+
+class PipeReader:
+    """
+    Feeds a worker's listener from its pipe
+
+    Registered as one of the listener's transports, so the listener's own
+    backpressure (pause while the write buffer is full) stops reading the
+    pipe as it would a socket.
+    """
+
+    def __init__(self, connection, listener, loop):
+        self.connection = connection
+        self.listener = listener
+        self.loop = loop
+        self.closed = loop.create_future()
+        listener.transports.add(self)
+        self.resume_reading()
+
+    def _on_readable(self):
+        try:
+            data = self.connection.recv_bytes()
+        except (EOFError, OSError):
+            self.pause_reading()
+            self.listener.transports.discard(self)
+            if not self.closed.done():
+                self.closed.set_result(None)
+            return
+        self.listener.feed(data)
+
+    def pause_reading(self):
+        self.loop.remove_reader(self.connection.fileno())
+
+    def resume_reading(self):
+        if not self.closed.done():
+            self.loop.add_reader(self.connection.fileno(), self._on_readable)
+
+
+async def _run_worker(index, connection, listener, stats_interval, report):
+    loop = asyncio.get_running_loop()
+    await listener.start()
+    reader = PipeReader(connection, listener, loop)
+    flusher = asyncio.create_task(listener.run())
+    try:
+        while not reader.closed.done():
+            await asyncio.wait([reader.closed], timeout=stats_interval or None)
+            if stats_interval:
+                report({'worker': index, **listener.stats()})
+    finally:
+        flusher.cancel()
+        await listener.close()
+
+
+def worker_main(index, connection, make_listener, stats_interval=0, report=print, setup=None, inherited=()):
+    """Entry point of a forked shard worker: run a listener fed from ``connection`` until the router closes it"""
+    from .buffer import shutdown
+    from .rollups import shutdown as shutdown_rollups
+    from .stream import shutdown as shutdown_stream
+
+    # Router-side pipe ends copied by fork would keep our pipe from ever reaching EOF
+    for other in inherited:
+        other.close()
+    # Ctrl-C reaches the whole process group; workers stop when the router closes their pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if setup is not None:
+        setup()
+    listener = make_listener()
+    try:
+        asyncio.run(_run_worker(index, connection, listener, stats_interval, report))
+    finally:
+        shutdown()
+        shutdown_rollups()
+        shutdown_stream()
+    report({'worker': index, 'final': True, **listener.stats()})
+
+
+def start_workers(count, make_listener, stats_interval=0, report=print, setup=None):
+    """
+    Fork ``count`` shard workers
+
+    ``make_listener`` builds each worker's ``IngestListener``; ``setup``, if
+    given, runs in the worker first. Returns the router-side pipe ends and
+    the processes. Database connections are closed first so no worker
+    inherits a shared socket.
+    """
+    from django.db import connections
+
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    pipes = []
+    processes = []
+    for index in range(count):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=worker_main,
+            args=(index, receiver, make_listener, stats_interval, report, setup, [*pipes, sender]),
+            name=f'ingest-shard-{index}',
+            daemon=True,
+        )
+        process.start()
+        receiver.close()
+        pipes.append(sender)
+        processes.append(process)
+    return pipes, processes
@@ -0,0 +1,356 @@
+"""
+Durable local spool for ingest batches
+
+When InfluxDB is down or cannot keep up, the write buffer spills batches of
+line protocol into an append-only log on local disk instead of holding them
+in memory or dropping them. A background replayer drains the log in large
+batches once the store accepts writes again.
+
+The log is a directory of segment files ``{sequence:012d}.seg``. Each
+segment is preallocated and memory-mapped; records are appended as
+
+    length   u32   payload size in bytes (0 marks the end of the segment)
+    crc32    u32   checksum of the payload
+    payload  length bytes of line protocol
+
+Appends are made durable with ``msync`` in batches (every ``sync_every``
+records or ``sync_interval`` seconds) rather than once per record. The
+replay position is kept in a ``checkpoint`` file and fully replayed segments
+are deleted. On startup a torn tail record is detected by its checksum and
+overwritten by the next append.
+
+Each process claims its own slot directory under the spool root with an
+exclusive file lock, so several workers can share one root and a restarted
+worker picks up whatever a previous one left behind.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT = 'checkpoint'
+LOCK_FILE = '.lock'
+
+
+class SpoolLocked(Exception):
+    """Raised when another process already owns a spool directory"""
+
+
+def claim_spool_directory(root, max_slots=64):
+    """
+    Claim the first free slot directory under ``root``
+
+    Returns ``(path, lock_file)``; the lock is held for as long as the file
+    object stays open.
+    """
+    os.makedirs(root, exist_ok=True)
+    for slot in range(max_slots):
+        path = os.path.join(root, str(slot))
+        os.makedirs(path, exist_ok=True)
+        lock_file = open(os.path.join(path, LOCK_FILE), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return path, lock_file
+    raise SpoolLocked(f"all {max_slots} spool slots under {root} are in use")
+
+
+class SegmentLog:
+    """Append-only log of byte records in memory-mapped segment files"""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_bytes=2 * 1024 ** 3,
+                 sync_interval=0.2, sync_every=256):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.sync_every = sync_every
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        self.appended_records = 0
+        self.appended_bytes = 0
+        self.rejected_records = 0
+        self.syncs = 0
+
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._read_position = self._load_checkpoint()
+        if self._segments:
+            self._open_segment(self._segments[-1])
+            self._write_offset = self._scan_end(self._segments[-1])
+        else:
+            self._create_segment(0, segment_size)
+        self.pending_bytes = self._count_pending()
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def append(self, payload):
+        """Append one record; returns False when the spool is full"""
+        if not payload:
+            return True
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        size = len(record)
+        with self._lock:
+            if self.pending_bytes + size > self.max_bytes:
+                self.rejected_records += 1
+                return False
+            if self._write_offset + size > len(self._map):
+                self._roll(size)
+            self._map[self._write_offset:self._write_offset + size] = record
+            self._write_offset += size
+            self.pending_bytes += size
+            self.appended_records += 1
+            self.appended_bytes += size
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+        return True
+
+    def sync(self):
+        """Flush appended records to disk"""
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._map.close()
+            self._file.close()
+
+    def _sync(self):
+        if self._unsynced:
+            self._map.flush()
+            self._unsynced = 0
+            self.syncs += 1
+        self._last_sync = time.monotonic()
+
+    def _roll(self, needed):
+        """Seal the active segment and start the next one"""
+        self._sync()
+        self._map.close()
+        self._file.close()
+        self._create_segment(self._segments[-1] + 1, max(self.segment_size, needed + RECORD_HEADER.size))
+
+    def _segment_path(self, sequence):
+        return os.path.join(self.directory, f'{sequence:012d}{SEGMENT_SUFFIX}')
+
+    def _create_segment(self, sequence, size):
+        with open(self._segment_path(sequence), 'wb') as f:
+            f.truncate(size)
+        if sequence not in self._segments:
+            self._segments.append(sequence)
+        self._open_segment(sequence)
+        self._write_offset = 0
+
+    def _open_segment(self, sequence):
+        self._file = open(self._segment_path(sequence), 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def read(self, max_bytes):
+        """
+        Read records from the replay position
+
+        Returns ``(payloads, position, size)``: up to ``max_bytes`` of
+        payloads (at least one record when any are pending), the position
+        just after them and their size on disk. Pass the position and size to
+        ``commit`` once the payloads have been stored.
+        """
+        with self._lock:
+            segments = list(self._segments)
+            active, write_offset = segments[-1], self._write_offset
+        sequence, offset = self._read_position
+        payloads = []
+        size = 0
+        while True:
+            limit = write_offset if sequence == active else None
+            for payload, end in self._iter_records(sequence, offset, limit):
+                if payloads and size + len(payload) + RECORD_HEADER.size > max_bytes:
+                    return payloads, (sequence, offset), size
+                payloads.append(payload)
+                size += end - offset
+                offset = end
+            later = [s for s in segments if s > sequence]
+            if sequence == active or not later:
+                return payloads, (sequence, offset), size
+            sequence, offset = later[0], 0
+
+    @property
+    def read_position(self):
+        """``(segment, offset)`` of the next record to replay"""
+        return self._read_position
+
+    def commit(self, position, size):
+        """Advance the replay position and delete fully replayed segments"""
+        with self._lock:
+            self._read_position = position
+            self.pending_bytes = max(0, self.pending_bytes - size)
+            while self._segments[0] < position[0]:
+                os.remove(self._segment_path(self._segments.pop(0)))
+        self._save_checkpoint(position)
+
+    def _iter_records(self, sequence, offset, limit=None):
+        """Yield ``(payload, end_offset)`` for valid records from ``offset``"""
+        with open(self._segment_path(sequence), 'rb') as f:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end_of_data = len(view) if limit is None else limit
+            while offset + RECORD_HEADER.size <= end_of_data:
+                length, checksum = RECORD_HEADER.unpack_from(view, offset)
+                start = offset + RECORD_HEADER.size
+                if not length or start + length > end_of_data:
+                    return
+                payload = view[start:start + length]
+                if zlib.crc32(payload) != checksum:
+                    return
+                offset = start + length
+                yield payload, offset
+        finally:
+            view.close()
+
+    def _scan_end(self, sequence):
+        """Offset just after the last intact record of a segment"""
+        end = 0
+        for _, end in self._iter_records(sequence, 0):
+            pass
+        return end
+
+    def _count_pending(self):
+        sequence, offset = self._read_position
+        pending = 0
+        for segment in self._segments:
+            if segment < sequence:
+                continue
+            end = self._write_offset if segment == self._segments[-1] else self._scan_end(segment)
+            pending += max(0, end - (offset if segment == sequence else 0))
+        return pending
+
+    def _load_checkpoint(self):
+        first = self._segments[0] if self._segments else 0
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                sequence, offset = (int(part) for part in f.read().split())
+        except (OSError, ValueError):
+            return first, 0
+        if sequence < first:
+            return first, 0
+        return sequence, offset
+
+    def _save_checkpoint(self, position):
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            f.write(f'{position[0]} {position[1]}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'segments': len(self._segments),
+            'pending_bytes': self.pending_bytes,
+            'max_bytes': self.max_bytes,
+            'appended_records': self.appended_records,
+            'appended_bytes': self.appended_bytes,
+            'rejected_records': self.rejected_records,
+            'syncs': self.syncs,
+        }
+
+
+class SpoolReplayer:
+    """Background thread draining a SegmentLog into the time-series store"""
+
+    def __init__(self, spool, write_lines, batch_bytes=8 * 1024 * 1024, idle_interval=1.0, retry_interval=5.0,
+                 on_written=None):
+        self.spool = spool
+        self._write_lines = write_lines
+        self._on_written = on_written  # called with the line protocol records of each stored batch
+        self.batch_bytes = batch_bytes
+        self.idle_interval = idle_interval
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.replayed_batches = 0
+        self.replayed_readings = 0
+        self.replay_failures = 0
+        self.last_replay_rate = 0.0
+
+    def replay_once(self):
+        """Replay one batch; returns the number of readings written"""
+        payloads, position, size = self.spool.read(self.batch_bytes)
+        if not payloads:
+            if position != self.spool.read_position:
+                self.spool.commit(position, 0)  # skip past sealed, fully replayed segments
+            return 0
+        started = time.monotonic()
+        lines = [payload.decode('utf-8') for payload in payloads]
+        self._write_lines(lines)
+        readings = sum(line.count('\n') + 1 for line in lines)
+        self.spool.commit(position, size)
+        if self._on_written is not None:
+            try:
+                self._on_written(lines)
+            except Exception:
+                logger.exception("Reporting %d replayed readings failed", readings)
+        elapsed = time.monotonic() - started
+        self.replayed_batches += 1
+        self.replayed_readings += readings
+        self.last_replay_rate = round(readings / elapsed, 1) if elapsed > 0 else float(readings)
+        return readings
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                written = self.replay_once()
+            except Exception:
+                self.replay_failures += 1
+                logger.warning("Spool replay failed, retrying in %ss", self.retry_interval, exc_info=True)
+                self._stop.wait(self.retry_interval)
+                continue
+            if not written:
+                self.spool.sync()
+                self._stop.wait(self.idle_interval)
+
+    def stats(self):
+        return {
+            'replayed_batches': self.replayed_batches,
+            'replayed_readings': self.replayed_readings,
+            'replay_failures': self.replay_failures,
+            'last_replay_rate': self.last_replay_rate,
+        }
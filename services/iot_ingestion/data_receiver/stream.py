@@ -0,0 +1,172 @@
+"""
+Accepted readings published to a Redis stream for the analytics consumers
+
+ai_processor follows live data through this stream instead of polling
+InfluxDB. The pipeline hands each accepted batch to a ``ReadingPublisher``,
+which only appends it to a list. A background thread sends everything
+collected every ``flush_interval`` seconds, several stream entries per
+pipelined round trip, so publishing adds no Redis call to the request path.
+
+The same round trip moves forward the data watermark of every site whose
+readings reached InfluxDB since the previous flush, which tells ai_processor
+its cached results for them are stale. The write buffer and the spool
+replayer report those sites through ``mark_written`` once a write succeeds,
+so readings held back by retries or spooled during an outage move the
+watermark when they are stored, not when they were accepted.
+
+The stream is a live feed, not a second copy of the data. InfluxDB remains
+the record: the stream is capped at about ``maxlen`` entries, and readings
+that cannot be published while Redis is down are dropped once
+``max_pending`` are waiting.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from boiler_common import metrics, readings as stream_format
+from django.conf import settings
+
+from .cache import get_redis, key_prefix
+
+logger = logging.getLogger(__name__)
+
+PUBLISHED = metrics.counter('ingest_stream_readings_total', 'Readings handed to the readings stream, by outcome',
+                            ['outcome'])
+SENT, DROPPED = PUBLISHED.labels('published'), PUBLISHED.labels('dropped')
+
+
+class ReadingPublisher:
+    """Batches accepted readings into entries of a Redis stream from a background thread"""
+
+    def __init__(self, client, key, maxlen=stream_format.DEFAULT_MAXLEN, entry_size=5000,
+                 flush_interval=0.1, max_pending=100_000, watermarks_key=None):
+        self.client = client
+        self.key = key
+        self.watermarks_key = watermarks_key
+        self.maxlen = maxlen
+        self.entry_size = entry_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._written = set()  # sites whose readings were stored since the last flush
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.published = 0
+        self.dropped = 0
+
+    def add(self, readings):
+        """Queue readings for the next flush, dropping the oldest beyond ``max_pending``"""
+        with self._lock:
+            self._pending.extend(readings)
+            excess = len(self._pending) - self.max_pending
+            if excess > 0:
+                del self._pending[:excess]
+                self.dropped += excess
+                DROPPED.inc(excess)
+
+    def mark_written(self, site_ids):
+        """Move the watermarks of sites whose readings were just stored in InfluxDB at the next flush"""
+        if self.watermarks_key:
+            with self._lock:
+                self._written.update(site_ids)
+
+    def flush(self):
+        """Publish every queued reading and move the watermarks of stored sites; returns the number published"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            written, self._written = self._written, set()
+        if not pending and not written:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        for start in range(0, len(pending), self.entry_size):
+            pipe.xadd(self.key, stream_format.encode(pending[start:start + self.entry_size]),
+                      maxlen=self.maxlen, approximate=True)
+        if written:
+            now = time.time_ns()
+            watermarks = dict.fromkeys(written, now)
+            watermarks[stream_format.ALL_SITES] = now
+            pipe.hset(self.watermarks_key, mapping=watermarks)
+        try:
+            pipe.execute()
+        except Exception:
+            # Requeue ahead of newer readings; ``add`` drops the oldest if Redis stays down
+            with self._lock:
+                self._written |= written
+                self._pending[:0] = pending
+                excess = len(self._pending) - self.max_pending
+                if excess > 0:
+                    del self._pending[:excess]
+                    self.dropped += excess
+                    DROPPED.inc(excess)
+            logger.warning("Publishing %d readings to %s failed", len(pending), self.key, exc_info=True)
+            return 0
+        self.published += len(pending)
+        SENT.inc(len(pending))
+        return len(pending)
+
+    def start(self):
+        """Start the background publisher"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='stream-publisher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop the publisher after a last flush"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self):
+        return {'pending': len(self._pending), 'published': self.published, 'dropped': self.dropped}
+
+
+def mark_written(site_ids):
+    """Tell the process-wide publisher that readings of ``site_ids`` reached InfluxDB"""
+    publisher = get_publisher()
+    if publisher is not None:
+        publisher.mark_written(site_ids)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return the process-wide readings stream publisher, or None when the stream is disabled"""
+    global _publisher
+    config = settings.INGEST_STREAM
+    if not config['enabled']:
+        return None
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                publisher = ReadingPublisher(
+                    get_redis(),
+                    stream_format.stream_key(key_prefix()),
+                    maxlen=config['maxlen'],
+                    entry_size=config['entry_size'],
+                    flush_interval=config['flush_interval_ms'] / 1000,
+                    max_pending=config['max_pending'],
+                    watermarks_key=stream_format.watermarks_key(key_prefix()),
+                )
+                publisher.start()
+                atexit.register(shutdown)
+                _publisher = publisher
+    return _publisher
+
+
+def shutdown():
+    """Publish queued readings at interpreter exit"""
+    if _publisher is not None:
+        _publisher.stop()
@@ -1,3 +1,1288 @@
-from django.test import TestCase
+"""
+Test cases for the data_receiver application
+"""
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from boiler_common import metrics
+from django.conf import settings
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .buffer import WriteBuffer
+from .cache import LatestValueCache, newest_per_sensor
+from .dedup import RotatingDeduplicator
+from .frames import CONTENT_TYPE as FRAME_CONTENT_TYPE, decode_frames, encode_frame
+from .influx import count_records, line_sites, serialize_readings, to_line_protocol, write_lines
+from .models import RegistryVersion, Sensor, SensorRollup, Site
+from .listener import IngestListener, TCPIngestProtocol, UDPIngestProtocol
+from .payloads import PayloadError, Reading, parse_line_protocol, parse_ndjson, parse_payload, parse_timestamp
+from .ratelimit import LocalTokenBuckets, RateLimiter
+from .registry import RegistryCache, RegistrySnapshot, SiteEntry, load_and_publish, load_snapshot
+from .rollups import RESOLUTIONS as RESOLUTION_SECONDS, RollupAggregator, persist_rows
+from .sharding import HashRing, ShardRouter, site_key, start_workers
+from .spool import SegmentLog, SpoolReplayer, claim_spool_directory
+from .stream import ReadingPublisher
+from .views import ingest_async, ingest_bulk_async, readiness
+
+T0 = 1_735_725_600_000_000_000  # 2025-01-01T10:00:00Z in nanoseconds
+
+
+def redis_client():
+    """Redis client for REDIS_URL, or None when no server is reachable"""
+    import redis
+
+    client = redis.Redis.from_url(settings.REDIS_URL, socket_connect_timeout=0.5, socket_timeout=1)
+    try:
+        client.ping()
+    except redis.RedisError:
+        return None
+    return client
+
+
+REDIS = redis_client()
+
+
+def site_payload(site_id="BLR001", timestamp="2025-01-01T10:00:00Z", **values):
+    """Build a site payload in the gateway format"""
+    values = values or {"temperature": 88.5, "pressure": 12.0}
+    return {
+        "site_id": site_id,
+        "timestamp": timestamp,
+        "readings": [{"sensor_type": k, "value": v} for k, v in values.items()],
+    }
+
+
+def sample_registry(version=1):
+    """Registry snapshot with the demo sites and the temperature/pressure sensors"""
+    sensors = {"temperature": (60.0, 120.0, "celsius"), "pressure": (5.0, 25.0, "bar")}
+    return RegistrySnapshot(version, [
+        SiteEntry(site_id, "", "", "ACME001", sensors) for site_id in ("BLR001", "BLR002", "BLR003")
+    ])
+
+
+class PayloadParsingTest(SimpleTestCase):
+    """Test cases for site payload parsing"""
+
+    def test_parse_timestamp_formats(self):
+        """ISO strings and numeric epochs resolve to the same nanosecond value"""
+        self.assertEqual(parse_timestamp("2025-01-01T10:00:00Z"), T0)
+        self.assertEqual(parse_timestamp("2025-01-01T10:00:00"), T0)
+        self.assertEqual(parse_timestamp(1_735_725_600), T0)
+        self.assertEqual(parse_timestamp(1_735_725_600_000), T0)
+        self.assertEqual(parse_timestamp(T0), T0)
+        with self.assertRaises(PayloadError):
+            parse_timestamp("yesterday")
+
+    def test_parse_payload(self):
+        """A site payload expands into one reading per sensor"""
+        readings = parse_payload(site_payload())
+        self.assertEqual(readings, [
+            Reading("BLR001", "temperature", T0, 88.5),
+            Reading("BLR001", "pressure", T0, 12.0),
+        ])
+
+    def test_per_reading_timestamp_overrides_payload(self):
+        """Readings may carry their own timestamp"""
+        payload = site_payload(timestamp=None)
+        payload["readings"][0]["timestamp"] = "2025-01-01T10:00:00Z"
+        payload["readings"][1]["timestamp"] = 1_735_725_630
+        readings = parse_payload(payload)
+        self.assertEqual([r.timestamp for r in readings], [T0, T0 + 30_000_000_000])
+
+    def test_invalid_payloads(self):
+        """Malformed payloads raise PayloadError"""
+        for payload in (
+            [],
+            {"readings": [{"sensor_type": "temperature", "value": 1}]},
+            site_payload(temperature="hot"),
+            site_payload(temperature=float("nan")),
+            site_payload(timestamp=None),
+            {"site_id": "BLR001", "timestamp": "2025-01-01T10:00:00Z", "readings": []},
+        ):
+            with self.assertRaises(PayloadError):
+                parse_payload(payload)
+
+    def test_parse_ndjson_reports_each_line(self):
+        """Bad lines are reported without stopping the stream"""
+        body = "\n".join([
+            json.dumps(site_payload("BLR001")),
+            "",
+            "{not json",
+            json.dumps(site_payload("BLR002", temperature=90.0)),
+        ])
+        results = list(parse_ndjson(io.StringIO(body)))
+        self.assertEqual([line for line, _, _ in results], [1, 3, 4])
+        self.assertEqual(len(results[0][1]), 2)
+        self.assertIsNotNone(results[1][2])
+        self.assertEqual(results[2][1], [Reading("BLR002", "temperature", T0, 90.0)])
+
+    def test_line_protocol(self):
+        """Readings serialise to escaped line protocol"""
+        line = to_line_protocol(Reading("BLR 001", "temperature", T0, 88.5))
+        self.assertEqual(line, f"sensor_reading,sensor_type=temperature,site_id=BLR\\ 001 value=88.5 {T0}")
+
+
+    def test_parse_line_protocol(self):
+        """Both line protocol shapes parse, with escapes, integer fields and precision"""
+        self.assertEqual(
+            parse_line_protocol("sensor_reading,site_id=BLR001,sensor_type=temperature value=88.5 " + str(T0), 0),
+            [Reading("BLR001", "temperature", T0, 88.5)],
+        )
+        readings = parse_line_protocol(r"boiler,site_id=BLR\ 1,note=a\=b pressure=12i,temperature=88.5", 7)
+        self.assertEqual(readings, [Reading("BLR 1", "pressure", 7, 12.0), Reading("BLR 1", "temperature", 7, 88.5)])
+        self.assertEqual(
+            parse_line_protocol("boiler,site_id=BLR001 pressure=12 1735725600", 0, precision=1_000_000_000)[0].timestamp,
+            T0,
+        )
+        for line, message in (
+            ("boiler pressure=12", "site_id"),
+            ("boiler,site_id=BLR001 pressure=high", "number"),
+            ("boiler,site_id=BLR001,sensor_type=pressure reading=1", "value field"),
+            ("boiler,site_id=BLR001", "expected"),
+            ("boiler,site_id=BLR001 pressure=1 soon", "timestamp"),
+        ):
+            with self.assertRaisesMessage(PayloadError, message):
+                parse_line_protocol(line, 0)
+
+
+class FrameCodecTest(SimpleTestCase):
+    """Test cases for the binary frame format"""
+
+    T0_MS = T0 // 1_000_000
+
+    def test_round_trip(self):
+        """Frames decode to the same readings as the equivalent JSON payload"""
+        body = encode_frame("BLR001", ["temperature", "pressure"], [self.T0_MS, self.T0_MS + 30_000],
+                            [[88.5, 12.0], [89.0, None]])
+        [(number, readings, error)] = list(decode_frames(body))
+        self.assertEqual((number, error), (1, None))
+        self.assertEqual(readings, [
+            Reading("BLR001", "temperature", T0, 88.5),
+            Reading("BLR001", "pressure", T0, 12.0),
+            Reading("BLR001", "temperature", T0 + 30_000_000_000, 89.0),
+        ])
+
+    def test_float64_values(self):
+        """float64 frames keep full precision"""
+        body = encode_frame("BLR001", ["flow_rate"], [self.T0_MS], [[123.456789]], float64=True)
+        [(_, readings, _)] = list(decode_frames(body))
+        self.assertEqual(readings[0].value, 123.456789)
+
+    def test_multiple_frames(self):
+        """A body may hold one frame per site"""
+        body = b"".join(
+            encode_frame(site_id, ["temperature"], [self.T0_MS], [[90.0]]) for site_id in ("BLR001", "BLR002")
+        )
+        results = list(decode_frames(body))
+        self.assertEqual([r[1][0].site_id for r in results], ["BLR001", "BLR002"])
+
+    def test_bad_frames(self):
+        """Value errors reject one frame; structural errors stop decoding"""
+        good = encode_frame("BLR001", ["temperature"], [self.T0_MS], [[90.0]])
+        infinite = encode_frame("BLR002", ["temperature"], [self.T0_MS], [[float("inf")]])
+        results = list(decode_frames(infinite + good + good[:-3]))
+        self.assertEqual([r[2] is None for r in results], [False, True, False])
+        self.assertIn("malformed", results[2][2])
+
+
+class IngestViewTest(SimpleTestCase):
+    """Test cases for the ingest endpoints"""
+
+    def setUp(self):
+        self.write = mock.Mock()
+        self.buffer = WriteBuffer(self.write, max_size=100, batch_size=50)
+        self.deduplicator = RotatingDeduplicator(capacity=1000)
+        self.update_latest_values = mock.Mock()
+        for target, value in (
+            ("data_receiver.views.get_buffer", self.buffer),
+            ("data_receiver.pipeline.get_buffer", self.buffer),
+            ("data_receiver.views.get_deduplicator", self.deduplicator),
+            ("data_receiver.pipeline.get_deduplicator", self.deduplicator),
+            ("data_receiver.views.get_rollups", None),
+            ("data_receiver.pipeline.get_publisher", None),
+            ("data_receiver.views.get_publisher", None),
+            ("data_receiver.views.get_rate_limiter", None),
+            ("data_receiver.views.get_async_rate_limiter", None),
+            ("data_receiver.views.get_replayer", None),
+            ("data_receiver.views.get_registry", sample_registry()),
+            ("data_receiver.views.aget_registry", sample_registry()),
+        ):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.aupdate_latest_values = mock.AsyncMock()
+        for target, value in (
+            ("data_receiver.pipeline.update_latest_values", self.update_latest_values),
+            ("data_receiver.pipeline.aupdate_latest_values", self.aupdate_latest_values),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post_ndjson(self, lines):
+        body = "\n".join(json.dumps(line) if isinstance(line, dict) else line for line in lines)
+        return self.client.post(reverse("ingest_bulk"), data=body, content_type="application/x-ndjson")
+
+    def test_single_site_ingest(self):
+        """The single-site endpoint accepts the sample data payload"""
+        response = self.client.post(reverse("ingest"), data=site_payload(), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["processed_records"], 2)
+        self.assertEqual(self.buffer.depth, 2)
+
+    def test_bulk_ingest_writes_one_batch(self):
+        """Many sites and timestamps are written with a single InfluxDB call"""
+        response = self.post_ndjson([
+            site_payload("BLR001"),
+            site_payload("BLR002", timestamp="2025-01-01T10:00:30Z"),
+            site_payload("BLR003", temperature=91.0),
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["status"], "ok")
+        self.assertEqual(data["lines_accepted"], 3)
+        self.assertEqual(data["lines_rejected"], 0)
+        self.assertEqual(data["processed_records"], 5)
+        self.buffer.flush()
+        self.write.assert_called_once()
+        self.assertEqual(len(self.write.call_args.args[0]), 5)
+        self.update_latest_values.assert_called_once()
+
+    def test_bulk_ingest_partial(self):
+        """Rejected lines are counted and reported with their line number"""
+        response = self.post_ndjson([site_payload("BLR001"), "{oops", {"site_id": "BLR002"}])
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["status"], "partial")
+        self.assertEqual((data["lines_accepted"], data["lines_rejected"]), (1, 2))
+        self.assertEqual([e["line"] for e in data["errors"]], [2, 3])
+
+    def test_bulk_ingest_nothing_valid(self):
+        """A body without valid lines is rejected and nothing is queued"""
+        response = self.post_ndjson(["{oops"])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.buffer.depth, 0)
+
+    def test_retried_request_is_deduplicated(self):
+        """A retried request is acknowledged but its readings are not queued again"""
+        lines = [site_payload("BLR001"), site_payload("BLR002")]
+        self.post_ndjson(lines)
+        response = self.post_ndjson(lines + [site_payload("BLR003")])
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["processed_records"], 6)
+        self.assertEqual(data["duplicates"], 4)
+        self.assertEqual(self.buffer.depth, 6)
+
+    def test_refused_request_can_be_retried(self):
+        """Readings refused by backpressure are not remembered as seen"""
+        self.buffer.max_size = 1
+        self.assertEqual(self.post_ndjson([site_payload()]).status_code, 503)
+        self.buffer.max_size = 100
+        self.assertEqual(self.post_ndjson([site_payload()]).json()["duplicates"], 0)
+
+    def test_bulk_ingest_frames(self):
+        """Binary frames are accepted through content negotiation"""
+        t0_ms = T0 // 1_000_000
+        body = b"".join(
+            encode_frame(site_id, ["temperature", "pressure"], [t0_ms, t0_ms + 30_000], [[88.5, 12.0], [89.0, 12.5]])
+            for site_id in ("BLR001", "BLR002")
+        )
+        response = self.client.post(reverse("ingest_bulk"), data=body, content_type=FRAME_CONTENT_TYPE)
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["lines_accepted"], 2)
+        self.assertEqual(data["processed_records"], 8)
+
+    def test_registry_validation(self):
+        """Lines from unknown sites or sensors, or with out-of-range values, are rejected"""
+        response = self.post_ndjson([
+            site_payload("BLR001"),
+            site_payload("BLR999"),
+            site_payload("BLR002", fuel_level=50.0),
+            site_payload("BLR003", temperature=150.0),
+        ])
+        data = response.json()
+        self.assertEqual(data["lines_accepted"], 1)
+        self.assertEqual([e["line"] for e in data["errors"]], [2, 3, 4])
+        self.assertIn("unknown site_id", data["errors"][0]["error"])
+        self.assertIn("unknown sensor_type", data["errors"][1]["error"])
+        self.assertIn("outside [60.0, 120.0]", data["errors"][2]["error"])
+
+        response = self.client.post(
+            reverse("ingest"), data=site_payload(temperature=20.0), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.buffer.depth, 2)
+
+    def test_buffer_full(self):
+        """A full buffer pushes back with 503 and Retry-After"""
+        self.buffer.max_size = 3
+        response = self.post_ndjson([site_payload(), site_payload("BLR002")])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(self.buffer.stats()["rejected"], 4)
+        self.update_latest_values.assert_not_called()
+
+    def test_stats(self):
+        """Buffer statistics are exposed"""
+        self.post_ndjson([site_payload()])
+        data = self.client.get(reverse("ingest_stats")).json()
+        self.assertEqual(data["buffer"]["queue_depth"], 2)
+
+    def test_rate_limited(self):
+        """Over-limit single-site requests get a 429; bulk bodies keep the sites under their limit"""
+        limiter = local_limiter()
+        with mock.patch("data_receiver.views.get_rate_limiter", return_value=limiter), \
+                self.settings(INGEST_RATE_LIMIT={**settings.INGEST_RATE_LIMIT, "rate": 1, "burst": 3}):
+            self.assertEqual(self.client.post(reverse("ingest"), data=site_payload(),
+                                              content_type="application/json").status_code, 200)
+            response = self.client.post(reverse("ingest"), data=site_payload(timestamp="2025-01-01T10:00:01Z"),
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "1")
+
+            response = self.post_ndjson([site_payload(timestamp="2025-01-01T10:00:02Z"), site_payload("BLR002")])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["status"], "partial")
+            self.assertEqual(list(response.json()["rate_limited"]), ["BLR001"])
+            self.assertEqual(self.buffer.depth, 4)
+
+    def test_buffer_full_refunds_rate_limit(self):
+        """Readings refused with a 503 are not charged, so the gateway's retry is not rate limited"""
+        limiter = local_limiter()
+        self.buffer.max_size = 1
+        with mock.patch("data_receiver.views.get_rate_limiter", return_value=limiter), \
+                self.settings(INGEST_RATE_LIMIT={**settings.INGEST_RATE_LIMIT, "rate": 1, "burst": 3}):
+            for view in ("ingest", "ingest_bulk"):
+                self.assertEqual(self.client.post(reverse(view), data=site_payload(),
+                                                  content_type="application/json").status_code, 503)
+            self.buffer.max_size = 100
+            self.assertEqual(self.client.post(reverse("ingest"), data=site_payload(),
+                                              content_type="application/json").status_code, 200)
+
+    def test_get_not_allowed(self):
+        """Ingest endpoints only accept POST"""
+        self.assertEqual(self.client.get(reverse("ingest_bulk")).status_code, 405)
+
+    async def test_async_ingest(self):
+        """The async views share parsing and validation and await the cache update"""
+        factory = AsyncRequestFactory()
+        request = factory.post("/", data=site_payload(), content_type="application/json")
+        response = await ingest_async(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["processed_records"], 2)
+
+        request = factory.post("/", data=site_payload(temperature=20.0), content_type="application/json")
+        self.assertEqual((await ingest_async(request)).status_code, 400)
+        self.assertEqual(self.buffer.depth, 2)
+        self.aupdate_latest_values.assert_awaited_once()
+        self.update_latest_values.assert_not_called()
+
+    async def test_async_bulk_ingest(self):
+        """Large async bulk bodies are parsed off the event loop with the same result"""
+        body = "\n".join(json.dumps(site_payload(site_id)) for site_id in ("BLR001", "BLR002", "BLR999"))
+        for offload_bytes in (1 << 20, 0):
+            with mock.patch("data_receiver.views.ASYNC_PARSE_OFFLOAD_BYTES", offload_bytes):
+                request = AsyncRequestFactory().post("/", data=body, content_type="application/x-ndjson")
+                response = await ingest_bulk_async(request)
+            data = json.loads(response.content)
+            self.assertEqual(data["status"], "partial")
+            self.assertEqual(data["lines_accepted"], 2)
+        self.assertEqual(self.buffer.depth, 4)  # the second pass was all duplicates
+
+    async def test_readiness(self):
+        """Readiness reports each backend and fails when one is down"""
+        client = mock.Mock(ping=mock.AsyncMock(return_value=True))
+        with mock.patch("data_receiver.views.get_async_latest_cache", return_value=mock.Mock(client=client)), \
+                mock.patch("data_receiver.views.ping_async", mock.AsyncMock(side_effect=OSError)):
+            response = await readiness(AsyncRequestFactory().get("/"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content), {"status": "unavailable", "influxdb": False, "redis": True})
+
+
+class MetricsTest(SimpleTestCase):
+    """Test cases for the shared Prometheus instrumentation"""
+
+    def test_thread_shards_are_merged(self):
+        """Updates from many threads, including finished ones, all reach the scrape"""
+        registry = metrics.Registry()
+        requests = registry.register(metrics.Counter, "test_requests_total", "Requests", ["view"])
+        latency = registry.register(metrics.Histogram, "test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+        def work():
+            for _ in range(1000):
+                requests.labels("ingest").inc()
+            latency.observe(0.5)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latency.observe(0.05)
+        latency.observe(3)
+
+        self.assertEqual(requests.collect(), {("ingest",): 8000})
+        self.assertEqual(requests.labels("ingest")._shards._live, [])  # finished threads were retired
+        text = metrics.exposition(registry)
+        self.assertIn('test_requests_total{view="ingest"} 8000', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 9', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 10', text)
+        self.assertIn("test_latency_seconds_count 10", text)
+        with self.assertRaises(ValueError):
+            registry.register(metrics.Gauge, "test_requests_total", "Requests")
+
+    def test_sibling_process_files(self):
+        """Counters from other workers are added; gauges of exited workers are dropped"""
+        registry = metrics.Registry()
+        requests = registry.register(metrics.Counter, "test_requests_total", "Requests")
+        depth = registry.register(metrics.Gauge, "test_depth", "Depth")
+        requests.inc(2)
+        depth.set(5)
+        with tempfile.TemporaryDirectory() as directory:
+            files = metrics.ProcessFiles(directory, registry)
+            for pid, alive in ((1, True), (999_999_999, False)):
+                with open(files.path(pid), "w") as f:
+                    json.dump(registry.snapshot(), f)
+            text = metrics.exposition(registry, files)
+        self.assertIn("test_requests_total 6", text)
+        self.assertIn("test_depth 10", text)
+
+    def test_endpoint(self):
+        self.client.get(reverse("health_check"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn('http_requests_total{view="health_check",method="GET",status="200"}', response.content.decode())
+
+    def test_unknown_methods_share_one_label(self):
+        """Made-up request methods do not add a label value each"""
+        self.client.generic("BREW", reverse("health_check"))
+        self.client.generic("PROPFIND", reverse("health_check"))
+        text = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('http_requests_total{view="health_check",method="other",status="200"}', text)
+        self.assertNotIn("BREW", text)
+
+
+def local_limiter():
+    """Rate limiter that keeps its buckets in process, as it does while Redis is down"""
+    limiter = RateLimiter(mock.Mock(), "test", LocalTokenBuckets())
+    limiter.use_fallback()
+    return limiter
+
+
+class RateLimitTest(SimpleTestCase):
+    """Test cases for the per-site token buckets"""
+
+    def readings(self, site_id, count):
+        return [Reading(site_id, "pressure", T0 + n, 12.0) for n in range(count)]
+
+    def test_local_buckets(self):
+        """Buckets refill at the rate up to the burst; a backfill above the burst passes once, then waits"""
+        now = [0.0]
+        buckets = LocalTokenBuckets(clock=lambda: now[0])
+        self.assertEqual(buckets.acquire([("BLR001", 10, 20, 15), ("BLR002", 10, 20, 50)]), [0, 0])
+        self.assertEqual(buckets.acquire([("BLR001", 10, 20, 10)]), [0.5])
+        now[0] = 0.5
+        self.assertEqual(buckets.acquire([("BLR001", 10, 20, 10)]), [0])
+        self.assertAlmostEqual(buckets.acquire([("BLR002", 10, 20, 1)])[0], 2.6)  # 30 tokens in debt at t=0
+        buckets.refund([("BLR002", 10, 20, 50)])
+        self.assertEqual(buckets.acquire([("BLR002", 10, 20, 20)]), [0])
+        buckets.refund([("BLR003", 10, 20, 5)])  # never charged: stays full
+        self.assertEqual(buckets.acquire([("BLR003", 10, 20, 21)]), [0])
+
+    def test_falls_back_when_redis_fails(self):
+        """Redis errors switch the limiter to in-process buckets for the retry interval"""
+        import redis
+
+        client = mock.Mock()
+        client.register_script.return_value = mock.Mock(side_effect=redis.ConnectionError)
+        now = [0.0]
+        limiter = RateLimiter(client, "test", LocalTokenBuckets(), retry_interval=5, clock=lambda: now[0])
+        with self.assertLogs("data_receiver.ratelimit", "WARNING"):
+            self.assertEqual(limiter.check(self.readings("BLR001", 600), None), {})
+        self.assertEqual(client.register_script.return_value.call_count, 1)
+        self.assertEqual(set(limiter.check(self.readings("BLR001", 600), None)), {"BLR001"})
+        self.assertEqual(client.register_script.return_value.call_count, 1)
+        now[0] = 6
+        with self.assertLogs("data_receiver.ratelimit", "WARNING"):
+            limiter.check(self.readings("BLR002", 1), None)
+        self.assertEqual(client.register_script.return_value.call_count, 2)
+
+    def test_registry_limits(self):
+        registry = RegistrySnapshot(1, [SiteEntry("BLR001", "", "", "", {}, rate_limit=1, rate_burst=2)])
+        limiter = local_limiter()
+        self.assertEqual(limiter.check(self.readings("BLR001", 2), registry), {})
+        self.assertIn("BLR001", limiter.check(self.readings("BLR001", 1), registry))
+        self.assertEqual(limiter.check(self.readings("BLR002", 10), registry), {})  # default limits
+
+    @skipUnless(REDIS, "Redis server not available")
+    def test_redis_script(self):
+        """One script call charges every site of a batch; refused sites are not charged"""
+        prefix = f"test-{os.getpid()}"
+        limiter = RateLimiter(REDIS, prefix, LocalTokenBuckets())
+        self.addCleanup(lambda: REDIS.delete(*REDIS.keys(f"{prefix}:*")) if REDIS.keys(f"{prefix}:*") else None)
+        with self.settings(INGEST_RATE_LIMIT={**settings.INGEST_RATE_LIMIT, "rate": 10, "burst": 5}):
+            batch = self.readings("BLR001", 5) + self.readings("BLR002", 1)
+            self.assertEqual(limiter.check(batch, None), {})
+            limited = limiter.check(batch, None)
+            self.assertEqual(list(limited), ["BLR001"])
+            self.assertGreater(limited["BLR001"], 0.3)
+            self.assertLessEqual(limited["BLR001"], 0.5)
+            tokens = float(REDIS.hget(f"{prefix}:ratelimit:BLR002", "tokens"))
+            self.assertAlmostEqual(tokens, 3, delta=0.1)
+            self.assertGreater(REDIS.pttl(f"{prefix}:ratelimit:BLR001"), 0)
+            limiter.refund(self.readings("BLR002", 1), None)
+            tokens = float(REDIS.hget(f"{prefix}:ratelimit:BLR002", "tokens"))
+            self.assertAlmostEqual(tokens, 4, delta=0.1)
+
+
+class ReadingPublisherTest(SimpleTestCase):
+    """Test cases for the readings stream publisher"""
+
+    def readings(self, count):
+        return [Reading("BLR001", "temperature", T0 + n, 80.0 + n) for n in range(count)]
+
+    def test_keeps_newest_readings_while_redis_is_down(self):
+        import redis
+
+        client = mock.Mock()
+        client.pipeline.return_value.execute.side_effect = redis.ConnectionError
+        publisher = ReadingPublisher(client, "test:readings", max_pending=5)
+        publisher.add(self.readings(3))
+        with self.assertLogs("data_receiver.stream", "WARNING"):
+            self.assertEqual(publisher.flush(), 0)
+        publisher.add(self.readings(4)[1:])
+        self.assertEqual(publisher.stats(), {"pending": 5, "published": 0, "dropped": 1})
+        self.assertEqual([r.value for r in publisher._pending], [81.0, 82.0, 81.0, 82.0, 83.0])
+
+    @skipUnless(REDIS, "Redis server not available")
+    def test_publishes_columnar_entries(self):
+        key = f"test-{os.getpid()}:readings"
+        watermarks_key = f"test-{os.getpid()}:site_watermarks"
+        self.addCleanup(REDIS.delete, key, watermarks_key)
+        publisher = ReadingPublisher(REDIS, key, entry_size=4, watermarks_key=watermarks_key)
+        publisher.add(self.readings(6))
+        publisher.mark_written(["BLR001"])
+        self.assertEqual(publisher.flush(), 6)
+        watermarks = REDIS.hgetall(watermarks_key)
+        self.assertEqual(set(watermarks), {b"BLR001", b"*"})
+        self.assertEqual(watermarks[b"BLR001"], watermarks[b"*"])
+        entries = REDIS.xrange(key)
+        self.assertEqual(len(entries), 2)
+        fields = entries[1][1]
+        self.assertEqual(fields[b"site"], b"BLR001\nBLR001")
+        self.assertEqual(fields[b"sensor"], b"temperature\ntemperature")
+        self.assertEqual(struct.unpack("<2q", fields[b"ts"]), (T0 + 4, T0 + 5))
+        self.assertEqual(struct.unpack("<2d", fields[b"value"]), (84.0, 85.0))
+
+
+class WriteBufferTest(SimpleTestCase):
+    """Test cases for the write-behind buffer"""
+
+    def readings(self, count, site_id="BLR001"):
+        return [Reading(site_id, "temperature", T0 + i, float(i)) for i in range(count)]
+
+    def test_flush_splits_into_batches(self):
+        """Queued readings are written in batch_size chunks, in order"""
+        write = mock.Mock()
+        buffer = WriteBuffer(write, batch_size=4)
+        buffer.offer(self.readings(3))
+        buffer.offer(self.readings(6))
+        buffer.flush()
+        self.assertEqual([len(c.args[0]) for c in write.call_args_list], [4, 4, 1])
+        stats = buffer.stats()
+        self.assertEqual(stats["flushed_batches"], 3)
+        self.assertEqual(stats["flushed_readings"], 9)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_offer_is_all_or_nothing(self):
+        """Readings that do not fit are refused as a whole"""
+        buffer = WriteBuffer(mock.Mock(), max_size=5)
+        self.assertTrue(buffer.offer(self.readings(4)))
+        self.assertFalse(buffer.offer(self.readings(2)))
+        self.assertEqual(buffer.depth, 4)
+        self.assertEqual(buffer.stats()["rejected"], 2)
+
+    def test_flusher_writes_full_batch(self):
+        """The background flusher writes as soon as a batch is full"""
+        written = threading.Event()
+        buffer = WriteBuffer(lambda batch: written.set(), batch_size=5, linger=60)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.offer(self.readings(5))
+        self.assertTrue(written.wait(5))
+
+    def test_flusher_writes_after_linger(self):
+        """A partial batch is written once the linger interval expires"""
+        written = threading.Event()
+        buffer = WriteBuffer(lambda batch: written.set(), batch_size=1000, linger=0.05)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.offer(self.readings(2))
+        self.assertTrue(written.wait(5))
+        self.assertEqual(buffer.stats()["last_batch_size"], 2)
+
+    def test_idle_flusher_writes_partial_batch_within_linger(self):
+        """A partial batch offered to an idle flusher is written after the linger time, without another offer"""
+        batches = []
+        written = threading.Event()
+
+        def write(batch):
+            batches.append(len(batch))
+            written.set()
+
+        buffer = WriteBuffer(write, batch_size=5, linger=0.1)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.offer(self.readings(5))  # full batch, so the flusher drains it and goes idle
+        self.assertTrue(written.wait(5))
+        written.clear()
+        time.sleep(0.2)  # the flusher now waits without a timeout
+        offered = time.monotonic()
+        buffer.offer(self.readings(2))
+        self.assertTrue(written.wait(1))
+        self.assertLess(time.monotonic() - offered, 0.5)
+        self.assertEqual(batches, [5, 2])
+
+    def test_on_stored_sees_written_batches_only(self):
+        """Batches reach on_stored once written; dropped ones never do"""
+        stored = []
+        write = mock.Mock(side_effect=[None, ConnectionError("influxdb down")])
+        buffer = WriteBuffer(write, max_retries=0, on_stored=stored.append)
+        buffer.offer(self.readings(2))
+        buffer.flush()
+        buffer.offer(self.readings(3))
+        with self.assertLogs("data_receiver.buffer", level="ERROR"):
+            buffer.flush()
+        self.assertEqual([len(batch) for batch in stored], [2])
+
+    def test_failed_batch_is_dropped_and_counted(self):
+        """Batches that keep failing are dropped after the retries"""
+        write = mock.Mock(side_effect=ConnectionError("influxdb down"))
+        buffer = WriteBuffer(write, max_retries=2, retry_backoff=0)
+        buffer.offer(self.readings(3))
+        with self.assertLogs("data_receiver.buffer", level="ERROR"):
+            buffer.flush()
+        self.assertEqual(write.call_count, 3)
+        self.assertEqual(buffer.stats()["dropped"], 3)
+
+
+class SpoolTest(SimpleTestCase):
+    """Test cases for the on-disk ingest spool"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(lambda: __import__("shutil").rmtree(self.directory, ignore_errors=True))
+
+    def open_log(self, **kwargs):
+        kwargs.setdefault("segment_size", 256)
+        log = SegmentLog(self.directory, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def test_append_read_commit(self):
+        """Records are read back in order and committed segments are deleted"""
+        log = self.open_log()
+        payloads = [f"record-{i}".encode() * 5 for i in range(20)]
+        for payload in payloads:
+            self.assertTrue(log.append(payload))
+        self.assertGreater(log.stats()["segments"], 1)
+
+        read, position, size = log.read(max_bytes=1 << 20)
+        self.assertEqual(read, payloads)
+        self.assertEqual(size, log.pending_bytes)
+        log.commit(position, size)
+        self.assertEqual(log.pending_bytes, 0)
+        self.assertEqual(log.stats()["segments"], 1)
+        self.assertEqual(log.read(1 << 20)[0], [])
+
+    def test_read_respects_max_bytes(self):
+        """A read returns at most max_bytes, but always at least one record"""
+        log = self.open_log()
+        for i in range(5):
+            log.append(b"x" * 40)
+        self.assertEqual(len(log.read(max_bytes=100)[0]), 2)
+        self.assertEqual(len(log.read(max_bytes=1)[0]), 1)
+
+    def test_reopen_resumes_from_checkpoint(self):
+        """Pending records and the replay position survive a restart"""
+        log = SegmentLog(self.directory, segment_size=256)
+        for i in range(6):
+            log.append(f"r{i}".encode())
+        payloads, position, size = log.read(max_bytes=20)
+        log.commit(position, size)
+        log.close()
+
+        reopened = self.open_log()
+        remaining = reopened.read(1 << 20)[0]
+        self.assertEqual(payloads + remaining, [f"r{i}".encode() for i in range(6)])
+        self.assertEqual(reopened.pending_bytes, sum(len(p) + 8 for p in remaining))
+        reopened.append(b"r6")
+        self.assertEqual(reopened.read(1 << 20)[0][-1], b"r6")
+
+    def test_torn_tail_is_ignored(self):
+        """A half-written record at the tail is detected by its checksum"""
+        log = SegmentLog(self.directory, segment_size=256)
+        log.append(b"good")
+        log.append(b"torn record")
+        log.close()
+        path = os.path.join(self.directory, "000000000000.seg")
+        with open(path, "r+b") as f:
+            f.seek(12 + 8)
+            f.write(b"XXXX")
+
+        reopened = self.open_log()
+        self.assertEqual(reopened.read(1 << 20)[0], [b"good"])
+        reopened.append(b"next")
+        self.assertEqual(reopened.read(1 << 20)[0], [b"good", b"next"])
+
+    def test_max_bytes(self):
+        """Appends are refused once the spool is full"""
+        log = self.open_log(max_bytes=30)
+        self.assertTrue(log.append(b"x" * 10))
+        self.assertFalse(log.append(b"x" * 10))
+        self.assertEqual(log.stats()["rejected_records"], 1)
+
+    def test_claim_directory(self):
+        """Each claimant gets its own locked slot"""
+        first, lock_a = claim_spool_directory(self.directory)
+        second, lock_b = claim_spool_directory(self.directory)
+        self.addCleanup(lock_a.close)
+        self.addCleanup(lock_b.close)
+        self.assertNotEqual(first, second)
+
+    def test_replayer(self):
+        """The replayer writes spooled line protocol and keeps it on failure"""
+        log = self.open_log()
+        readings = [Reading("BLR001", "temperature", T0 + i, float(i)) for i in range(3)]
+        log.append(serialize_readings(readings))
+        write_lines = mock.Mock(side_effect=[ConnectionError("influxdb down"), None])
+        replayer = SpoolReplayer(log, write_lines)
+
+        with self.assertRaises(ConnectionError):
+            replayer.replay_once()
+        self.assertGreater(log.pending_bytes, 0)
+
+        self.assertEqual(replayer.replay_once(), 3)
+        self.assertEqual(log.pending_bytes, 0)
+        [lines] = write_lines.call_args.args
+        self.assertEqual(lines, ["\n".join(to_line_protocol(r) for r in readings)])
+        self.assertEqual(replayer.stats()["replayed_readings"], 3)
+
+    def test_write_batch_counts_records_not_payloads(self):
+        """A replayed list of spool payloads is measured by the records they hold"""
+        payloads = ["a v=1 1\na v=2 2\na v=3 3", "a v=4 4"]
+        self.assertEqual(count_records(payloads), 4)
+        self.assertEqual(count_records(b"a v=1 1\na v=2 2"), 2)
+        self.assertEqual(count_records(["a v=1 1", "a v=2 2"]), 2)
+        with mock.patch("data_receiver.influx.get_write_api"), \
+                mock.patch("data_receiver.influx.WRITE_BATCH") as write_batch:
+            write_lines(payloads)
+        write_batch.observe.assert_called_once_with(4)
+
+    def test_watermarks_move_when_spooled_readings_are_replayed(self):
+        """Readings accepted during an outage move their site's watermark only once the replayer stores them"""
+        client = mock.Mock()
+        publisher = ReadingPublisher(client, "test:readings", watermarks_key="test:site_watermarks")
+        written_sites = lambda batch: publisher.mark_written({reading.site_id for reading in batch})
+        log = self.open_log(segment_size=4096)
+        buffer = WriteBuffer(mock.Mock(side_effect=ConnectionError("influxdb down")), spool=log,
+                             serialize=serialize_readings, on_written=written_sites)
+        readings = [Reading("BLR\\ 1,a", "temperature", T0 + i, float(i)) for i in range(3)]
+        buffer.offer(readings)
+        publisher.add(readings)
+        with self.assertLogs("data_receiver.buffer", level="WARNING"):
+            buffer.flush()  # spooled
+        self.assertGreater(log.pending_bytes, 0)
+        self.assertEqual(publisher.flush(), 3)  # published, but only spooled: no watermark yet
+        client.pipeline.return_value.hset.assert_not_called()
+
+        write_lines = mock.Mock()
+        replayer = SpoolReplayer(log, write_lines, on_written=lambda lines: publisher.mark_written(line_sites(lines)))
+        self.assertEqual(replayer.replay_once(), 3)
+        write_lines.assert_called_once()
+        self.assertEqual(log.pending_bytes, 0)
+        publisher.flush()
+        client.pipeline.return_value.hset.assert_called_once()
+        mapping = client.pipeline.return_value.hset.call_args.kwargs["mapping"]
+        self.assertEqual(set(mapping), {"BLR\\ 1,a", "*"})
+        self.assertGreater(int(mapping["BLR\\ 1,a"]), T0)
+
+    def test_buffer_spills_to_spool(self):
+        """Failed writes and overflow go to the spool, then follow it until it drains"""
+        log = self.open_log(segment_size=4096)
+        write = mock.Mock(side_effect=[ConnectionError("influxdb down")])
+        stored = []
+        buffer = WriteBuffer(write, max_size=3, batch_size=3, spool=log, serialize=serialize_readings,
+                             on_stored=stored.append)
+        readings = [Reading("BLR001", "temperature", T0 + i, float(i)) for i in range(3)]
+
+        self.assertTrue(buffer.offer(readings))
+        with self.assertLogs("data_receiver.buffer", level="WARNING"):
+            buffer.flush()  # write fails
+        self.assertTrue(buffer.offer(readings))
+        self.assertTrue(buffer.offer(readings[:1]))  # does not fit in memory
+        buffer.flush()  # spool not drained yet, so this batch is spooled too
+        self.assertEqual(write.call_count, 1)
+
+        stats = buffer.stats()
+        self.assertEqual((stats["spilled"], stats["dropped"], stats["rejected"]), (7, 0, 0))
+        self.assertEqual(sum(len(batch) for batch in stored), 7)  # spooled readings count as stored
+        self.assertEqual(len(log.read(1 << 20)[0]), 3)
+
+
+class DeduplicatorTest(SimpleTestCase):
+    """Test cases for the rotating Bloom filter dedup index"""
+
+    def setUp(self):
+        self.now = 0.0
+        self.deduplicator = RotatingDeduplicator(window=60, generations=4, capacity=1000, clock=lambda: self.now)
+
+    def submit(self, readings):
+        fresh, pending = self.deduplicator.check(readings)
+        self.deduplicator.commit(pending)
+        return fresh
+
+    def test_duplicates_within_window(self):
+        """Repeats are filtered, in later batches and within the same batch"""
+        reading = Reading("BLR001", "temperature", T0, 88.5)
+        other = reading._replace(timestamp=T0 + 1)
+        self.assertEqual(self.submit([reading, reading, other]), [reading, other])
+        self.assertEqual(self.submit([reading, other]), [])
+        stats = self.deduplicator.stats()
+        self.assertEqual((stats["checked"], stats["duplicates"]), (5, 3))
+        self.assertEqual(stats["hit_rate"], 0.6)
+
+    def test_check_without_commit(self):
+        """Readings are only remembered once committed"""
+        reading = Reading("BLR001", "temperature", T0, 88.5)
+        self.deduplicator.check([reading])
+        self.assertEqual(self.deduplicator.check([reading])[0], [reading])
+
+    def test_window_expiry(self):
+        """Readings are remembered for the window and forgotten after rotating out"""
+        reading = Reading("BLR001", "temperature", T0, 88.5)
+        self.submit([reading])
+        self.now = 59.0
+        self.assertEqual(self.submit([reading]), [])
+        for _ in range(4):
+            self.now += 20.0
+            self.deduplicator.check([])
+        self.assertEqual(self.submit([reading]), [reading])
+
+    def test_memory_is_fixed_and_capacity_rotates(self):
+        """Filling a generation rotates early and keeps the false-positive rate in budget"""
+        memory = self.deduplicator.stats()["memory_bytes"]
+        readings = [Reading("BLR001", "temperature", T0 + i, 1.0) for i in range(2500)]
+        for start in range(0, 2500, 100):
+            self.submit(readings[start:start + 100])
+        stats = self.deduplicator.stats()
+        self.assertEqual(stats["memory_bytes"], memory)
+        self.assertGreaterEqual(stats["rotations"], 2)
+        self.assertLessEqual(stats["estimated_false_positive_rate"], stats["false_positive_budget"])
+
+        unseen = [Reading("BLR999", "pressure", T0 + i, 1.0) for i in range(2000)]
+        false_positives = len(unseen) - len(self.deduplicator.check(unseen)[0])
+        self.assertLessEqual(false_positives, 10)
+
+
+class LatestValueCacheTest(SimpleTestCase):
+    """Test cases for the latest-value cache"""
+
+    def test_newest_per_sensor(self):
+        """A batch is reduced to the newest reading per sensor before it is sent"""
+        older = Reading("BLR001", "temperature", T0, 80.0)
+        newer = Reading("BLR001", "temperature", T0 + 1, 81.0)
+        other = Reading("BLR002", "temperature", T0, 70.0)
+        self.assertEqual(newest_per_sensor([newer, older, other]), {
+            ("BLR001", "temperature"): newer,
+            ("BLR002", "temperature"): other,
+        })
+
+    @skipUnless(REDIS, "Redis is not reachable at REDIS_URL")
+    def test_update_and_out_of_order(self):
+        """Values refresh in one call and older readings never overwrite newer ones"""
+        prefix = "test_iot_ingestion"
+        self.addCleanup(lambda: [REDIS.delete(key) for key in REDIS.scan_iter(f"{prefix}:*")])
+        cache = LatestValueCache(REDIS, prefix)
+
+        updated = cache.update([
+            Reading("BLR001", "temperature", T0 + 30_000_000_000, 90.0),
+            Reading("BLR001", "pressure", T0, 12.0),
+            Reading("BLR002", "temperature", T0, 70.0),
+        ])
+        self.assertEqual(updated, 3)
+
+        updated = cache.update([
+            Reading("BLR001", "temperature", T0, 85.0),  # older than the cached value
+            Reading("BLR001", "pressure", T0 + 30_000_000_000, 13.0),
+        ])
+        self.assertEqual(updated, 1)
+
+        t0_ms = T0 // 1_000_000
+        self.assertEqual(cache.get_dashboard("BLR001"), {
+            "temperature": {"value": 90.0, "ts": t0_ms + 30_000},
+            "pressure": {"value": 13.0, "ts": t0_ms + 30_000},
+        })
+        self.assertEqual(REDIS.hget(f"{prefix}:latest:BLR001:temperature", "value"), b"90.0")
+        self.assertLessEqual(REDIS.ttl(f"{prefix}:dashboard:BLR001"), 60)
+
+
+class RegistryTest(TestCase):
+    """Test cases for the site/sensor registry and its snapshot cache"""
+
+    def setUp(self):
+        call_command("seed_registry", stdout=io.StringIO())
+
+    def test_seed_and_snapshot(self):
+        """Seeded sites and sensor ranges end up in the snapshot"""
+        snapshot = load_snapshot()
+        self.assertEqual(set(snapshot.sites), {"BLR001", "BLR002", "BLR003"})
+        self.assertEqual(snapshot.sites["BLR001"].sensors["pressure"], (5.0, 25.0, "bar"))
+        self.assertEqual(snapshot.version, RegistryVersion.current())
+        self.assertEqual([s.site_id for s in snapshot.for_organization("TECH002")], ["BLR003"])
+
+        call_command("seed_registry", stdout=io.StringIO())
+        self.assertEqual(Site.objects.count(), 3)
+        self.assertEqual(RegistryVersion.current(), snapshot.version)
+
+    def test_changes_bump_version(self):
+        """Saving or deleting registry rows bumps the version; inactive rows drop out"""
+        version = RegistryVersion.current()
+        site = Site.objects.get(site_id="BLR002")
+        site.is_active = False
+        site.save()
+        Sensor.objects.get(site__site_id="BLR001", sensor_type="efficiency").delete()
+        self.assertEqual(RegistryVersion.current(), version + 2)
+
+        snapshot = load_snapshot()
+        self.assertNotIn("BLR002", snapshot.sites)
+        self.assertNotIn("efficiency", snapshot.sites["BLR001"].sensors)
+
+    def test_bulk_changes_bump_version(self):
+        """Queryset deletes and updates, as the admin actions run them, refresh the snapshot"""
+        cache = RegistryCache(check_interval=0)
+        self.assertIn("BLR002", cache.get().sites)
+        Site.objects.filter(site_id="BLR002").delete()
+        self.assertNotIn("BLR002", cache.get().sites)
+
+        Sensor.objects.filter(sensor_type="efficiency").update(is_active=False)
+        self.assertNotIn("efficiency", cache.get().sites["BLR001"].sensors)
+        version = RegistryVersion.current()
+        Site.objects.filter(site_id="BLR999").update(name="nobody")  # no rows changed
+        self.assertEqual(RegistryVersion.current(), version)
+
+    def test_cache_reloads_only_on_version_change(self):
+        """The version is checked once per interval and the snapshot rebuilt only when it moved"""
+        now = [0.0]
+        cache = RegistryCache(check_interval=5, clock=lambda: now[0])
+        first = cache.get()
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get(), first)
+
+        now[0] = 6.0
+        with self.assertNumQueries(1):
+            self.assertIs(cache.get(), first)
+
+        Sensor.objects.filter(sensor_type="flow_rate").first().save()
+        self.assertIs(cache.get(), first)  # within the interval
+        now[0] = 12.0
+        second = cache.get()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.version, first.version + 1)
+        self.assertEqual(cache.reloads, 2)
+
+    def test_organizations_published_on_reload(self):
+        """A rebuilt snapshot replaces the site -> organization hash read by ai_processor"""
+        client = mock.MagicMock()
+        pipe = client.pipeline.return_value
+        with mock.patch("data_receiver.cache.get_redis", return_value=client):
+            snapshot = load_and_publish()
+        self.assertEqual(set(snapshot.sites), {"BLR001", "BLR002", "BLR003"})
+        pipe.delete.assert_called_once_with("iot_ingestion:site_organizations")
+        pipe.hset.assert_called_once_with("iot_ingestion:site_organizations", mapping={
+            "BLR001": "ACME001", "BLR002": "ACME001", "BLR003": "TECH002",
+        })
+        pipe.execute.assert_called_once()
+
+        client.pipeline.side_effect = ConnectionError("redis down")
+        with mock.patch("data_receiver.cache.get_redis", return_value=client), \
+                self.assertLogs("data_receiver.registry", "WARNING"):
+            self.assertEqual(load_and_publish().version, snapshot.version)
+
+    def test_registry_endpoint(self):
+        """Sites can be listed per organization"""
+        with mock.patch("data_receiver.views.get_registry_cache", return_value=RegistryCache()):
+            data = self.client.get(reverse("registry_sites"), {"organization": "ACME001"}).json()
+        self.assertEqual([s["site_id"] for s in data["sites"]], ["BLR001", "BLR002"])
+        self.assertEqual(len(data["sites"][0]["sensors"]), 5)
+
+
+class RollupTest(TestCase):
+    """Test cases for the incremental 1m/1h/1d rollups"""
+
+    def setUp(self):
+        self.now = [T0 / 1e9]
+        self.rollups = RollupAggregator(grace=10, clock=lambda: self.now[0])
+
+    def reading(self, seconds, value, sensor_type="pressure"):
+        return Reading("BLR001", sensor_type, T0 + int(seconds * 1e9), value)
+
+    def rollup(self, resolution, seconds=0, sensor_type="pressure"):
+        bucket = datetime.fromtimestamp((T0 // 10**9 + seconds) // RESOLUTION_SECONDS[resolution]
+                                        * RESOLUTION_SECONDS[resolution], tz=timezone.utc)
+        return SensorRollup.objects.get(resolution=resolution, site_id="BLR001", sensor_type=sensor_type,
+                                        bucket=bucket)
+
+    def test_closed_minutes_roll_up(self):
+        """Minutes are persisted after their grace period and merged into the hour and day"""
+        self.rollups.add([self.reading(0, 10.0), self.reading(30, 14.0), self.reading(20, 12.0),
+                          self.reading(65, 20.0), self.reading(5, 70.0, "temperature")])
+        self.now[0] += 60 + 9
+        self.assertEqual(self.rollups.flush(), 0)  # still within the grace period
+        self.now[0] += 1
+        self.assertEqual(self.rollups.flush(), 6)  # two sensors x three resolutions; the second minute stays open
+
+        minute = self.rollup("1m")
+        self.assertEqual((minute.count, minute.min_value, minute.max_value, minute.mean), (3, 10.0, 14.0, 12.0))
+        self.assertEqual(minute.last_value, 14.0)
+        self.assertEqual(self.rollup("1h").count, 3)
+
+        self.rollups.stop()
+        hour, day = self.rollup("1h"), self.rollup("1d")
+        self.assertEqual((hour.count, hour.max_value, hour.last_value), (4, 20.0, 20.0))
+        self.assertEqual(day.sum_value, 56.0)
+        self.assertEqual(SensorRollup.objects.filter(resolution="1m").count(), 3)
+
+    def test_late_data_updates_its_bucket(self):
+        """A reading for an already persisted minute is merged into the existing rows"""
+        self.rollups.add([self.reading(10, 10.0), self.reading(50, 12.0)])
+        self.now[0] += 3600
+        self.rollups.flush()
+        self.rollups.add([self.reading(30, 5.0)])
+        self.assertEqual(self.rollups.late, 1)
+        self.rollups.flush()
+
+        for resolution in ("1m", "1h", "1d"):
+            rollup = self.rollup(resolution)
+            self.assertEqual((rollup.count, rollup.min_value, rollup.max_value), (3, 5.0, 12.0))
+            self.assertEqual(rollup.last_value, 12.0)  # the late reading is older than the last one
+        self.assertEqual(SensorRollup.objects.count(), 3)
+
+    def test_failed_flush_is_retried(self):
+        """Minutes that could not be persisted are kept and merged with newer data"""
+        failing = RollupAggregator(persist=mock.Mock(side_effect=RuntimeError), clock=lambda: self.now[0])
+        failing.add([self.reading(0, 10.0)])
+        self.now[0] += 3600
+        with self.assertLogs("data_receiver.rollups", "WARNING"):
+            self.assertEqual(failing.flush(), 0)
+        failing.add([self.reading(1, 11.0)])
+        self.assertEqual(failing.stats()["open_minutes"], 1)
+        self.assertEqual(failing.take_closed()[("BLR001", "pressure", T0 // 10**9)][0], 2)
+
+    def test_rows_are_upserted_in_key_order(self):
+        """Every flush locks rollup rows in the same order, whatever order they were aggregated in"""
+        from django.db.backends.utils import CursorWrapper
+
+        aggregate = [1, 1.0, 1.0, 1.0, T0, 1.0]
+        rows = {(resolution, site_id, "pressure", 0): aggregate
+                for site_id in ("BLR002", "BLR001") for resolution in ("1m", "1d", "1h")}
+        with mock.patch.object(CursorWrapper, "executemany") as executemany:
+            persist_rows(rows)
+        params = executemany.call_args.args[1]
+        self.assertEqual([(row[1], row[0]) for row in params], [
+            ("BLR001", "1d"), ("BLR001", "1h"), ("BLR001", "1m"),
+            ("BLR002", "1d"), ("BLR002", "1h"), ("BLR002", "1m"),
+        ])
+
+    def test_rollup_endpoint(self):
+        self.rollups.add([self.reading(minute * 60, 10.0 + minute) for minute in range(120)])
+        self.rollups.stop()
+        url = reverse("sensor_rollups", args=["BLR001"])
+        data = self.client.get(url, {"resolution": "1h", "start": "2025-01-01T00:00:00Z",
+                                     "end": "2025-01-02T00:00:00Z"}).json()
+        buckets = data["series"]["pressure"]
+        self.assertEqual([b["count"] for b in buckets], [60, 60])
+        self.assertEqual((buckets[1]["min"], buckets[1]["max"], buckets[1]["last"]), (70.0, 129.0, 129.0))
+        self.assertEqual(buckets[0]["bucket"], "2025-01-01T10:00:00+00:00")
+
+        response = self.client.get(url, {"resolution": "1m", "start": "2024-01-01T00:00:00Z",
+                                         "end": "2025-01-02T00:00:00Z"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url, {"resolution": "5m"}).status_code, 400)
+
+
+class IngestListenerTest(SimpleTestCase):
+    """Test cases for the raw TCP/UDP listener"""
+
+    def setUp(self):
+        self.accepted = []
+        for target, value in (
+            ("data_receiver.listener.accept_readings", mock.Mock(side_effect=self.accept)),
+            ("data_receiver.listener.aupdate_latest_values", mock.AsyncMock()),
+            ("data_receiver.listener.get_async_rate_limiter", mock.Mock(return_value=None)),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def accept(self, readings):
+        self.accepted.extend(readings)
+        return readings
+
+    async def test_mixed_formats_and_validation(self):
+        """Line protocol and JSON lines share one batch; invalid and unregistered records are counted"""
+        listener = IngestListener()
+        listener.registry = sample_registry()
+        listener.feed(
+            b"sensor_reading,site_id=BLR001,sensor_type=temperature value=88.5 " + str(T0).encode() + b"\n"
+            + json.dumps(site_payload("BLR002")).encode() + b"\n"
+            + b"boiler,site_id=BLR999 pressure=12\n"
+            + b"garbage\n\n"
+        )
+        await listener.flush()
+        self.assertEqual(len(self.accepted), 3)
+        stats = listener.stats()
+        self.assertEqual((stats["lines"], stats["rejected"], stats["batches"]), (4, 2, 1))
+
+    async def test_tcp_and_udp(self):
+        """Records split across TCP reads are reassembled; UDP datagrams are dropped when backlogged"""
+        listener = IngestListener(max_pending=2)
+        tcp = TCPIngestProtocol(listener)
+        tcp.connection_made(mock.Mock())
+        tcp.data_received(b"boiler,site_id=BLR001 pressure=12,temp")
+        tcp.data_received(b"erature=88 1\nboiler,site_id=BLR002 pres")
+        self.assertEqual(len(listener._pending), 2)
+        tcp.connection_lost(None)
+        self.assertEqual(len(listener._pending), 2)  # the unfinished record is invalid
+        self.assertEqual(listener.rejected, 1)
+
+        udp = UDPIngestProtocol(listener)
+        udp.datagram_received(b"boiler,site_id=BLR003 pressure=12 1", None)
+        self.assertEqual(listener.dropped, 1)
+        await listener.flush()
+        udp.datagram_received(b"boiler,site_id=BLR003 pressure=12 1", None)
+        self.assertEqual(len(listener._pending), 1)
+
+    async def test_buffer_full_pauses_tcp(self):
+        """While the write buffer refuses batches, TCP connections are not read"""
+        from .pipeline import BufferFull
+
+        listener = IngestListener()
+        transport = mock.Mock()
+        TCPIngestProtocol(listener).connection_made(transport)
+        listener.feed(b"boiler,site_id=BLR001 pressure=12 1")
+        calls = iter([BufferFull(0), None])
+
+        def accept(readings):
+            error = next(calls)
+            if error is not None:
+                raise error
+            return readings
+
+        with mock.patch("data_receiver.listener.accept_readings", side_effect=accept), \
+                self.assertLogs("data_receiver.listener", "WARNING"):
+            await listener.flush()
+        transport.pause_reading.assert_called_once()
+        transport.resume_reading.assert_called_once()
+        self.assertEqual(listener.submitted, 1)
+
+    async def test_rate_limited_sites_are_dropped(self):
+        """Readings of sites over their limit are left out and counted; a refused batch is refunded"""
+        from .pipeline import BufferFull
+
+        limiter = local_limiter()
+        listener = IngestListener()
+        listener.feed(b"".join(b"boiler,site_id=BLR001 pressure=12 %d\n" % n for n in range(1, 4))
+                      + b"boiler,site_id=BLR002 pressure=12 1")
+        calls = iter([BufferFull(0), None, None])
+
+        def accept(readings):
+            error = next(calls)
+            if error is not None:
+                raise error
+            self.accepted.extend(readings)
+            return readings
+
+        with mock.patch("data_receiver.listener.get_async_rate_limiter", return_value=limiter), \
+                mock.patch("data_receiver.listener.accept_readings", side_effect=accept), \
+                self.settings(INGEST_RATE_LIMIT={**settings.INGEST_RATE_LIMIT, "rate": 1, "burst": 3}), \
+                self.assertLogs("data_receiver.listener", "WARNING"):
+            await listener.flush()  # refused once, then accepted on the refunded tokens
+            self.assertEqual(len(self.accepted), 4)
+            listener.feed(b"boiler,site_id=BLR001 pressure=12 4\nboiler,site_id=BLR002 pressure=12 2")
+            await listener.flush()
+        self.assertEqual([reading.site_id for reading in self.accepted[4:]], ["BLR002"])
+        self.assertEqual(listener.stats()["rate_limited"], 1)
+
+
+class ShardingTest(SimpleTestCase):
+    """Test cases for routing listener records to site-sharded workers"""
+
+    def test_hash_ring_balance_and_movement(self):
+        """Sites spread evenly and adding a worker moves only about 1/N of them"""
+        keys = [f"BLR{n:04d}".encode() for n in range(4000)]
+        four, five = HashRing(4), HashRing(5)
+        counts = [0] * 4
+        for key in keys:
+            counts[four.node_for(key)] += 1
+        self.assertLess(max(counts) / min(counts), 1.4)
+        moved = sum(four.node_for(key) != five.node_for(key) for key in keys)
+        self.assertLess(moved / len(keys), 0.3)
+        self.assertEqual([HashRing(4).node_for(key) for key in keys[:50]], [four.node_for(key) for key in keys[:50]])
+
+    def test_site_key(self):
+        self.assertEqual(site_key(b"boiler,site_id=BLR001 pressure=12 1"), b"BLR001")
+        self.assertEqual(site_key(b"boiler,region=x,site_id=BLR001,sensor_type=pressure value=1"), b"BLR001")
+        self.assertEqual(site_key(b"boiler,site_id=BLR\ 1\,x pressure=12"), b"BLR\ 1\,x")
+        self.assertEqual(site_key(b'{"timestamp": 1, "site_id": "BLR002", "readings": []}'), b"BLR002")
+        self.assertIsNone(site_key(b"boiler pressure=12"))
+
+    def test_router_keeps_sites_on_one_pipe_in_order(self):
+        connections = [mock.Mock() for _ in range(3)]
+        router = ShardRouter(connections, max_chunk_bytes=200)
+        lines = [f"boiler,site_id=BLR{n % 20:04d} pressure={n}".encode() for n in range(300)]
+        router.feed(b"\n".join(lines[:150]) + b"\n")
+        router.feed(b"\n".join(lines[150:]))
+        router.send_all()
+
+        received = {}
+        for node, connection in enumerate(connections):
+            for call in connection.send_bytes.call_args_list:
+                for line in call.args[0].split(b"\n"):
+                    received.setdefault(site_key(line), []).append((node, line))
+        self.assertEqual(sum(router.routed), 300)
+        for key, entries in received.items():
+            self.assertEqual(len({node for node, _ in entries}), 1)
+            self.assertEqual([line for _, line in entries], [line for line in lines if site_key(line) == key])
+
+    def test_forked_workers_drain_their_pipes(self):
+        """Workers submit everything routed to them and exit once the router closes"""
+        results = multiprocessing.get_context("fork").SimpleQueue()
+        with self.settings(INGEST_REGISTRY={"enabled": False, "check_interval": 5}), \
+                mock.patch("data_receiver.listener.accept_readings", side_effect=lambda readings: readings):
+            pipes, processes = start_workers(
+                2, lambda: IngestListener(linger=0.01, update_cache=False, rate_limit=False), report=results.put,
+            )
+        router = ShardRouter(pipes)
+        router.feed(b"".join(b"boiler,site_id=BLR%04d pressure=12 %d\n" % (n % 10, n) for n in range(100)))
+        asyncio.run(router.close())
+        finals = [results.get() for _ in processes]
+        for process in processes:
+            process.join(10)
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(sum(stats["submitted"] for stats in finals), 100)
+        self.assertEqual(sorted(stats["submitted"] for stats in finals), sorted(router.routed))
@@ -1,11 +1,371 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
 from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from .buffer import get_buffer, get_replayer
+from .cache import get_async_latest_cache, get_latest_cache
+from .dedup import get_deduplicator
+from .frames import CONTENT_TYPE as FRAME_CONTENT_TYPE, decode_frames
+from .influx import ping_async
+from .payloads import PayloadError, parse_ndjson, parse_payload, parse_timestamp
+from .pipeline import BufferFull, asubmit_readings, submit_readings
+from .ratelimit import get_async_rate_limiter, get_rate_limiter, retry_after
+from .registry import aget_registry, get_registry, get_registry_cache
+from .rollups import RESOLUTIONS, get_rollups, query_rollups, to_datetime
+from .stream import get_publisher
+
+# Upper bound on the per-line errors echoed back to a gateway
+MAX_REPORTED_ERRORS = 20
+
+# Async bulk bodies larger than this are parsed off the event loop
+ASYNC_PARSE_OFFLOAD_BYTES = 256 * 1024
+
+# Rollup queries: default range per resolution, and the most buckets per sensor returned
+ROLLUP_DEFAULT_BUCKETS = {'1m': 60 * 24, '1h': 24 * 7, '1d': 90}
+MAX_ROLLUP_BUCKETS = 10_000
 
 # IoT Ingestion Views - Cleaned for Re-implementation
 
 def health_check(request):
     """Health check endpoint for iot_ingestion service"""
     return JsonResponse({
-        "status": "ok", 
+        "status": "ok",
         "service": "iot_ingestion",
         "purpose": "Sensor Data Ingestion"
     })
+
+# ============================================================================
+# INGEST VIEWS
+# ============================================================================
+
+def buffer_full_response(error):
+    """503 telling the gateway to back off while the write buffer drains"""
+    response = JsonResponse({"status": "error", "error": str(error)}, status=503)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+def rate_limited_response(limited):
+    """429 telling the gateway when its sites may send again"""
+    response = JsonResponse({
+        "status": "error",
+        "error": "rate limit exceeded",
+        "retry_after": {site_id: round(wait, 3) for site_id, wait in limited.items()},
+    }, status=429)
+    response["Retry-After"] = str(retry_after(limited))
+    return response
+
+def drop_limited(readings, result, limited):
+    """Remove the readings of rate-limited sites from a bulk batch and report them"""
+    result["rate_limited"] = {site_id: round(wait, 3) for site_id, wait in limited.items()}
+    return [reading for reading in readings if reading.site_id not in limited]
+
+def read_payload(request, registry):
+    """Parse and validate a single-site request body; raises ValueError on bad input"""
+    if request.content_type == FRAME_CONTENT_TYPE:
+        readings = []
+        for _, frame_readings, error in decode_frames(request.body):
+            if error is not None:
+                raise PayloadError(error)
+            readings.extend(frame_readings)
+    else:
+        readings = parse_payload(json.loads(request.body))
+    if registry is not None:
+        registry.validate(readings)
+    return readings
+
+def read_bulk(request, registry):
+    """
+    Parse and validate a bulk request body line by line
+
+    Returns the accepted readings and the per-line summary for the response.
+    """
+    readings = []
+    errors = []
+    lines_accepted = 0
+    lines_rejected = 0
+
+    if request.content_type == FRAME_CONTENT_TYPE:
+        results = decode_frames(request.body)
+    else:
+        results = parse_ndjson(request)
+
+    for line_number, line_readings, error in results:
+        if error is None and registry is not None:
+            try:
+                registry.validate(line_readings)
+            except PayloadError as e:
+                error = str(e)
+        if error is None:
+            readings.extend(line_readings)
+            lines_accepted += 1
+        else:
+            lines_rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line_number, "error": error})
+
+    return readings, {
+        "lines_accepted": lines_accepted,
+        "lines_rejected": lines_rejected,
+        "processed_records": len(readings),
+        "errors": errors,
+    }
+
+@csrf_exempt
+@require_POST
+def ingest(request):
+    """Ingest a single site payload, as JSON or as binary frames"""
+    registry = get_registry()
+    try:
+        readings = read_payload(request, registry)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({"status": "error", "error": str(e)}, status=400)
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limited = limiter.check(readings, registry)
+        if limited:
+            return rate_limited_response(limited)
+
+    try:
+        duplicates = submit_readings(readings)
+    except BufferFull as e:
+        if limiter is not None:
+            limiter.refund(readings, registry)
+        return buffer_full_response(e)
+
+    return JsonResponse({"status": "ok", "processed_records": len(readings), "duplicates": duplicates})
+
+@csrf_exempt
+@require_POST
+def ingest_bulk(request):
+    """
+    Ingest many site payloads at once
+
+    The body is either newline-delimited JSON, parsed line by line, or a run
+    of binary frames (``application/vnd.steambytes.frame``), where each frame
+    counts as a line. Every accepted reading is queued as a single batch and
+    rejected lines do not affect the rest. A line is also rejected when any
+    of its readings is from an unregistered site or sensor, or out of range.
+    Readings already received (gateway retries) are acknowledged but not
+    written again. Readings of sites over their rate limit are left out and
+    listed under ``rate_limited``; when that leaves nothing, the response is
+    a 429.
+    """
+    registry = get_registry()
+    readings, result = read_bulk(request, registry)
+
+    if not readings:
+        result["status"] = "error"
+        return JsonResponse(result, status=400)
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limited = limiter.check(readings, registry)
+        if limited:
+            readings = drop_limited(readings, result, limited)
+            if not readings:
+                return rate_limited_response(limited)
+
+    try:
+        result["duplicates"] = submit_readings(readings)
+    except BufferFull as e:
+        if limiter is not None:
+            limiter.refund(readings, registry)
+        return buffer_full_response(e)
+
+    result["status"] = "ok" if not result["lines_rejected"] and "rate_limited" not in result else "partial"
+    return JsonResponse(result)
+
+# ============================================================================
+# ASYNC INGEST VIEWS (served under ASGI, see SERVER_MODE in settings)
+# ============================================================================
+
+@csrf_exempt
+@require_POST
+async def ingest_async(request):
+    """``ingest`` for ASGI workers: the only awaits are the Redis rate limit check and cache update"""
+    registry = await aget_registry()
+    try:
+        readings = read_payload(request, registry)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({"status": "error", "error": str(e)}, status=400)
+
+    limiter = get_async_rate_limiter()
+    if limiter is not None:
+        limited = await limiter.acheck(readings, registry)
+        if limited:
+            return rate_limited_response(limited)
+
+    try:
+        duplicates = await asubmit_readings(readings)
+    except BufferFull as e:
+        if limiter is not None:
+            await limiter.arefund(readings, registry)
+        return buffer_full_response(e)
+
+    return JsonResponse({"status": "ok", "processed_records": len(readings), "duplicates": duplicates})
+
+@csrf_exempt
+@require_POST
+async def ingest_bulk_async(request):
+    """
+    ``ingest_bulk`` for ASGI workers
+
+    Bodies over ASYNC_PARSE_OFFLOAD_BYTES are parsed in a worker thread so a
+    large upload does not stall every other connection on the event loop.
+    """
+    registry = await aget_registry()
+    if len(request.body) > ASYNC_PARSE_OFFLOAD_BYTES:
+        readings, result = await sync_to_async(read_bulk, thread_sensitive=False)(request, registry)
+    else:
+        readings, result = read_bulk(request, registry)
+
+    if not readings:
+        result["status"] = "error"
+        return JsonResponse(result, status=400)
+
+    limiter = get_async_rate_limiter()
+    if limiter is not None:
+        limited = await limiter.acheck(readings, registry)
+        if limited:
+            readings = drop_limited(readings, result, limited)
+            if not readings:
+                return rate_limited_response(limited)
+
+    try:
+        result["duplicates"] = await asubmit_readings(readings)
+    except BufferFull as e:
+        if limiter is not None:
+            await limiter.arefund(readings, registry)
+        return buffer_full_response(e)
+
+    result["status"] = "ok" if not result["lines_rejected"] and "rate_limited" not in result else "partial"
+    return JsonResponse(result)
+
+async def readiness(request):
+    """Readiness check: pings InfluxDB and Redis concurrently with the async clients"""
+    async def check(probe):
+        try:
+            return bool(await probe)
+        except Exception:
+            return False
+
+    influxdb, redis = await asyncio.gather(check(ping_async()), check(get_async_latest_cache().client.ping()))
+    ready = influxdb and redis
+    return JsonResponse(
+        {"status": "ok" if ready else "unavailable", "influxdb": influxdb, "redis": redis},
+        status=200 if ready else 503,
+    )
+
+@require_GET
+def ingest_stats(request):
+    """Write buffer, spool, dedup, rollup and readings stream statistics"""
+    buffer = get_buffer()
+    deduplicator = get_deduplicator()
+    rollups = get_rollups()
+    publisher = get_publisher()
+    stats = {
+        "buffer": buffer.stats(),
+        "spool": None,
+        "dedup": deduplicator.stats() if deduplicator is not None else None,
+        "rollups": rollups.stats() if rollups is not None else None,
+        "stream": publisher.stats() if publisher is not None else None,
+    }
+    if buffer.spool is not None:
+        stats["spool"] = buffer.spool.stats()
+        replayer = get_replayer()
+        if replayer is not None:
+            stats["spool"].update(replayer.stats())
+    return JsonResponse(stats)
+
+@require_GET
+def latest_values(request, site_id):
+    """Latest cached value of every sensor at a site"""
+    try:
+        sensors = get_latest_cache().get_dashboard(site_id)
+    except Exception:
+        return JsonResponse({"status": "error", "error": "cache unavailable"}, status=503)
+    return JsonResponse({"site_id": site_id, "sensors": sensors})
+
+@require_GET
+def sensor_rollups(request, site_id):
+    """
+    Rollup buckets of a site's sensors
+
+    Query parameters: ``resolution`` (1m, 1h or 1d, default 1h), optional
+    ``sensor_type``, and ``start``/``end`` as ISO 8601 or epoch timestamps.
+    Without ``start`` the range covers a day of minutes, a week of hours or
+    90 days. Counts cover readings stored in InfluxDB or the spool; readings
+    still in the write buffer, or dropped from it, are not counted. Buckets
+    whose minutes have not been persisted yet are missing or partial.
+    """
+    resolution = request.GET.get('resolution', '1h')
+    if resolution not in RESOLUTIONS:
+        return JsonResponse({"status": "error", "error": f"resolution must be one of {', '.join(RESOLUTIONS)}"},
+                            status=400)
+    seconds = RESOLUTIONS[resolution]
+    try:
+        end = parse_timestamp(request.GET['end']) / 1e9 if 'end' in request.GET else time.time()
+        start = (parse_timestamp(request.GET['start']) / 1e9 if 'start' in request.GET
+                 else end - ROLLUP_DEFAULT_BUCKETS[resolution] * seconds)
+    except PayloadError as e:
+        return JsonResponse({"status": "error", "error": str(e)}, status=400)
+    if (end - start) / seconds > MAX_ROLLUP_BUCKETS:
+        return JsonResponse(
+            {"status": "error", "error": f"range covers more than {MAX_ROLLUP_BUCKETS} {resolution} buckets"},
+            status=400,
+        )
+
+    series = {}
+    for rollup in query_rollups(site_id, resolution, to_datetime(start), to_datetime(end),
+                                request.GET.get('sensor_type')):
+        series.setdefault(rollup.sensor_type, []).append({
+            "bucket": rollup.bucket.isoformat(),
+            "count": rollup.count,
+            "mean": rollup.mean,
+            "min": rollup.min_value,
+            "max": rollup.max_value,
+            "last": rollup.last_value,
+            "last_time": rollup.last_time.isoformat(),
+        })
+    return JsonResponse({
+        "site_id": site_id,
+        "resolution": resolution,
+        "start": to_datetime(start).isoformat(),
+        "end": to_datetime(end).isoformat(),
+        "series": series,
+    })
+
+@require_GET
+def registry_sites(request):
+    """
+    Active sites and sensor ranges from the in-process registry snapshot
+
+    Optional ``?organization=<code>`` limits the list to one organization.
+    """
+    snapshot = get_registry_cache().get()
+    organization = request.GET.get('organization')
+    sites = snapshot.for_organization(organization) if organization else snapshot.sites.values()
+    return JsonResponse({
+        "version": snapshot.version,
+        "sites": [
+            {
+                "site_id": site.site_id,
+                "name": site.name,
+                "location": site.location,
+                "organization_code": site.organization_code,
+                "rate_limit": site.rate_limit,
+                "rate_burst": site.rate_burst,
+                "sensors": [
+                    {"sensor_type": sensor_type, "unit": unit, "min_value": min_value, "max_value": max_value}
+                    for sensor_type, (min_value, max_value, unit) in site.sensors.items()
+                ],
+            }
+            for site in sites
+        ],
+    })
@@ -11,11 +11,17 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Code shared by the services (boiler_common) lives in <repo>/shared; containers mount it into /app
+SHARED_DIR = BASE_DIR.parent.parent / 'shared'
+if SHARED_DIR.is_dir() and str(SHARED_DIR) not in sys.path:
+    sys.path.append(str(SHARED_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -43,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'boiler_common.metrics.metrics_middleware',  # first, so the latency covers every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -145,6 +152,78 @@ INFLUXDB_CONFIG = {
     'bucket': os.environ.get('INFLUX_BUCKET', 'sensor_data'),
 }
 
+# Write-behind buffer between the ingest views and InfluxDB
+INGEST_BUFFER = {
+    'max_size': int(os.environ.get('INGEST_BUFFER_MAX_SIZE', 200000)),  # readings held before pushing back
+    'batch_size': int(os.environ.get('INGEST_BUFFER_BATCH_SIZE', 5000)),  # readings per InfluxDB write
+    'linger_ms': int(os.environ.get('INGEST_BUFFER_LINGER_MS', 500)),  # max wait before a partial batch is written
+    'retry_after': 1,  # seconds suggested to gateways when the buffer is full
+}
+
+# Durable local spool used while InfluxDB is down or lagging; set INGEST_SPOOL_DIR='' to disable
+INGEST_SPOOL = {
+    'directory': os.environ.get('INGEST_SPOOL_DIR', str(BASE_DIR / 'spool')),
+    'segment_size_mb': int(os.environ.get('INGEST_SPOOL_SEGMENT_MB', 64)),
+    'max_size_mb': int(os.environ.get('INGEST_SPOOL_MAX_MB', 2048)),
+    'sync_interval_ms': int(os.environ.get('INGEST_SPOOL_SYNC_MS', 200)),  # fsync batching window
+    'replay_batch_mb': 8,
+}
+
+# Duplicate detection for gateway retries (rotating Bloom filters, fixed memory)
+INGEST_DEDUP = {
+    'enabled': os.environ.get('INGEST_DEDUP_ENABLED', '1') == '1',
+    'window_seconds': int(os.environ.get('INGEST_DEDUP_WINDOW', 600)),  # how long a reading is remembered
+    'generations': 4,
+    'capacity': int(os.environ.get('INGEST_DEDUP_CAPACITY', 1000000)),  # readings per generation
+    'false_positive_rate': 0.001,
+}
+
+# Continuous 1m/1h/1d rollups maintained at ingest (see data_receiver/rollups.py)
+INGEST_ROLLUPS = {
+    'enabled': os.environ.get('INGEST_ROLLUPS_ENABLED', '1') == '1',
+    'grace_seconds': int(os.environ.get('INGEST_ROLLUPS_GRACE', 10)),  # wait for stragglers before persisting a minute
+    'flush_interval_seconds': 5,
+}
+
+# Accepted readings published to the Redis stream <prefix>:readings for ai_processor (see data_receiver/stream.py)
+INGEST_STREAM = {
+    'enabled': os.environ.get('INGEST_STREAM_ENABLED', '1') == '1',
+    'maxlen': int(os.environ.get('INGEST_STREAM_MAXLEN', 100000)),  # entries kept (approximate)
+    'entry_size': 5000,  # readings per stream entry
+    'flush_interval_ms': 100,
+    'max_pending': 100000,  # readings queued while Redis is unreachable; older ones are dropped
+}
+
+# Per-site token buckets at the ingest endpoints; sites can override these in the registry
+INGEST_RATE_LIMIT = {
+    'enabled': os.environ.get('INGEST_RATE_LIMIT_ENABLED', '1') == '1',
+    'rate': float(os.environ.get('INGEST_RATE_LIMIT_RATE', 50)),  # readings per second per site
+    'burst': int(os.environ.get('INGEST_RATE_LIMIT_BURST', 1000)),  # readings a site may send at once
+    'fallback_retry_seconds': 5,  # in-process buckets are used this long after Redis fails
+}
+
+# Serving mode set by the init script: 'asgi' runs uvicorn workers and routes the
+# ingest endpoints to the async views, 'wsgi' runs the sync views
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+
+# Site/sensor registry validation at ingest (see data_receiver/registry.py)
+INGEST_REGISTRY = {
+    'enabled': os.environ.get('INGEST_REGISTRY_ENABLED', '1') == '1',
+    'check_interval': float(os.environ.get('INGEST_REGISTRY_CHECK_INTERVAL', 5)),  # seconds between version checks
+}
+
+# Raw TCP/UDP listener (manage.py ingest_listener)
+INGEST_LISTENER = {
+    'host': os.environ.get('INGEST_LISTENER_HOST', '0.0.0.0'),
+    'tcp_port': int(os.environ.get('INGEST_LISTENER_TCP_PORT', 8094)),  # 0 disables TCP
+    'udp_port': int(os.environ.get('INGEST_LISTENER_UDP_PORT', 8094)),  # 0 disables UDP
+    'precision': os.environ.get('INGEST_LISTENER_PRECISION', 'ns'),  # line protocol timestamp unit
+    'batch_size': 5000,
+    'linger_ms': 50,
+    'max_pending': 100000,  # readings; UDP datagrams are dropped beyond this
+    'workers': int(os.environ.get('INGEST_LISTENER_WORKERS', 1)),  # >1 shards sites across processes
+}
+
 # Redis Configuration for Real-time Data Caching
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
 
@@ -160,6 +239,12 @@ CACHES = {
     }
 }
 
+# Latest sensor values and dashboard snapshots (see docs/DATABASE_ARCHITECTURE.md)
+LATEST_VALUE_CACHE = {
+    'latest_ttl': 300,  # latest:{site_id}:{sensor_type}, 5 minutes
+    'dashboard_ttl': 60,  # dashboard:{site_id}, 1 minute
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,9 +1,25 @@
+from boiler_common.metrics import metrics_view
+from django.conf import settings
 from django.urls import path
-from data_receiver.views import health_check
+from data_receiver.views import (
+    health_check, ingest, ingest_async, ingest_bulk, ingest_bulk_async, ingest_stats, latest_values, readiness,
+    registry_sites, sensor_rollups,
+)
+
+# Under ASGI the same ingest URLs are served by the async views
+if settings.SERVER_MODE == 'asgi':
+    ingest, ingest_bulk = ingest_async, ingest_bulk_async
 
-# Minimal URL configuration - Health check only
 urlpatterns = [
     path('health/', health_check, name='health_check'),
     path('api/health/', health_check, name='api_health_check'),
+    path('api/ready/', readiness, name='readiness'),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/ingest/', ingest, name='ingest'),
+    path('api/ingest/bulk/', ingest_bulk, name='ingest_bulk'),
+    path('api/ingest/stats/', ingest_stats, name='ingest_stats'),
+    path('api/latest/<str:site_id>/', latest_values, name='latest_values'),
+    path('api/rollups/<str:site_id>/', sensor_rollups, name='sensor_rollups'),
+    path('api/registry/sites/', registry_sites, name='registry_sites'),
     path('', health_check, name='root'),  # Default route
 ]
@@ -0,0 +1,3 @@
+"""
+Code shared by the boiler monitoring Django services
+"""
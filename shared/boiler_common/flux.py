@@ -0,0 +1,330 @@
+"""
+Typed sensor history queries, pushed down to InfluxDB as Flux
+
+A ``SeriesQuery`` says which readings are wanted (sensor types, sites, time
+range) and how InfluxDB should reduce them before sending anything back: the
+tags the result is grouped by, the aggregate function, and the window width.
+``to_flux`` turns it into one Flux query against the ``sensor_data`` bucket,
+with filtering, ``group`` and ``aggregateWindow`` all running inside InfluxDB.
+A day of one-second readings for a site then crosses the wire as 24 hourly
+rows instead of 86,400 points.
+
+Two executors answer the same queries with the same rows:
+
+- ``InfluxExecutor`` runs the Flux over HTTP and parses the CSV response
+  with the standard library, counting the bytes received; raw readings can
+  also be streamed in bounded batches
+- ``LocalStore`` keeps readings in memory and evaluates queries in Python,
+  as a stand-in for InfluxDB in tests
+
+Only the standard library is needed; ``InfluxExecutor`` takes the
+``influxdb_client`` query API of the calling service.
+
+Usage::
+
+    from boiler_common import flux
+
+    query = flux.SeriesQuery(('temperature',), start, stop, sites=('BLR001',), every=3600)
+    rows = flux.InfluxExecutor(client.query_api(), 'sensor_data', 'steambytes').run(query)
+"""
+
+import csv
+import io
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+MEASUREMENT = 'sensor_reading'
+FIELD = 'value'
+TAGS = ('site_id', 'sensor_type')
+
+# Aggregates computed the same way by InfluxDB and LocalStore
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'count', 'first', 'last')
+
+_DURATION = re.compile(r'^(\d+)(s|m|h|d|w)$')
+_UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+_NS = 1_000_000_000
+
+
+class QueryError(ValueError):
+    """A query that cannot be expressed or answered"""
+
+
+class TooManyRows(QueryError):
+    """A query returned more rows than the caller's ``max_rows``"""
+
+
+def limited(rows, max_rows):
+    """``rows`` as a list, raising TooManyRows as soon as there are more than ``max_rows``"""
+    if max_rows is None:
+        return list(rows)
+    kept = []
+    for row in rows:
+        if len(kept) == max_rows:
+            raise TooManyRows(f"more than {max_rows} rows")
+        kept.append(row)
+    return kept
+
+
+def parse_duration(text):
+    """Convert a Flux-style duration such as ``90s``, ``15m``, ``1h`` or ``7d`` into seconds"""
+    match = _DURATION.match(text or '')
+    if not match or int(match.group(1)) == 0:
+        raise QueryError(f"invalid duration {text!r}, expected e.g. 30s, 15m, 1h or 7d")
+    return int(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+
+
+def flux_string(value):
+    """Quote a value as a Flux string literal"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def flux_time(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _membership(tag, values):
+    if len(values) == 1:
+        return f'r.{tag} == {flux_string(values[0])}'
+    return f'contains(value: r.{tag}, set: [{", ".join(flux_string(value) for value in values)}])'
+
+
+class Row(NamedTuple):
+    time: int  # epoch ns: the window start, or the query start for whole-range aggregates
+    value: float
+    group: tuple  # values of the query's group_by tags, in that order
+
+
+@dataclass(frozen=True)
+class SeriesQuery:
+    """
+    Readings of ``sensor_types`` (all when empty) for ``sites`` (all when empty) in ``[start, stop)``
+
+    Times are epoch seconds. Rows are grouped by the ``group_by`` tags, e.g.
+    ``('sensor_type',)`` for fleet-wide series. ``aggregate`` reduces each
+    group per window of ``every`` seconds (aligned on the epoch), or over the
+    whole range when ``every`` is None.
+    """
+    sensor_types: tuple
+    start: int
+    stop: int
+    sites: tuple = ()
+    every: int = None
+    aggregate: str = 'mean'
+    group_by: tuple = TAGS
+
+    def __post_init__(self):
+        for name in ('sensor_types', 'sites', 'group_by'):
+            value = getattr(self, name)
+            object.__setattr__(self, name, (value,) if isinstance(value, str) else tuple(value))
+        if self.aggregate not in AGGREGATES:
+            raise QueryError(f"aggregate must be one of {', '.join(AGGREGATES)}")
+        if set(self.group_by) - set(TAGS):
+            raise QueryError(f"group_by must be among {', '.join(TAGS)}")
+        if self.every is not None and self.every < 1:
+            raise QueryError("every must be at least 1 second")
+        if self.stop <= self.start:
+            raise QueryError("start must be before stop")
+
+    def _selection(self, bucket):
+        predicate = f'r._measurement == {flux_string(MEASUREMENT)} and r._field == {flux_string(FIELD)}'
+        if self.sensor_types:
+            predicate += f' and {_membership("sensor_type", self.sensor_types)}'
+        lines = [
+            f'from(bucket: {flux_string(bucket)})',
+            f'  |> range(start: {flux_time(self.start)}, stop: {flux_time(self.stop)})',
+            f'  |> filter(fn: (r) => {predicate})',
+        ]
+        if self.sites:
+            lines.append(f'  |> filter(fn: (r) => {_membership("site_id", self.sites)})')
+        return lines
+
+    def to_flux(self, bucket):
+        """Flux query that filters, groups and aggregates inside InfluxDB"""
+        lines = self._selection(bucket)
+        lines.append(f'  |> group(columns: [{", ".join(flux_string(tag) for tag in self.group_by)}])')
+        if self.aggregate in ('first', 'last') and self.group_by != TAGS:
+            # Merged series are concatenated, not interleaved in time
+            lines.append('  |> sort(columns: ["_time"])')
+        columns = ['_value', *self.group_by]
+        if self.every is None:
+            lines.append(f'  |> {self.aggregate}()')
+        else:
+            lines.append(f'  |> aggregateWindow(every: {self.every}s, fn: {self.aggregate}, '
+                         f'createEmpty: false, timeSrc: "_start")')
+            columns.insert(0, '_time')
+        lines.append(f'  |> keep(columns: [{", ".join(flux_string(column) for column in columns)}])')
+        return '\n'.join(lines)
+
+    def to_raw_flux(self, bucket):
+        """Flux query returning every matching reading unreduced, as an analysis without pushdown would"""
+        lines = self._selection(bucket)
+        lines.append(f'  |> keep(columns: ["_time", "_value", {", ".join(flux_string(tag) for tag in TAGS)}])')
+        return '\n'.join(lines)
+
+
+def parse_time_ns(text):
+    """RFC 3339 UTC timestamp with up to nanosecond digits, as InfluxDB writes it, in epoch ns"""
+    base, _, fraction = text.rstrip('Z').partition('.')
+    seconds = int(datetime.fromisoformat(base).replace(tzinfo=timezone.utc).timestamp())
+    return seconds * _NS + int((fraction + '000000000')[:9])
+
+
+def iter_csv(lines, group_by, default_time=0):
+    """
+    Rows of a Flux CSV response without annotations, read line by line
+
+    Tables are separated by blank lines, each with its own header. Rows
+    without ``_time`` get ``default_time``.
+    """
+    header = None
+    reader = csv.reader(lines)
+    for record in reader:
+        if not record or not any(record):
+            header = None
+            continue
+        if header is None:
+            header = {name: index for index, name in enumerate(record)}
+            if 'error' in header and '_value' not in header:
+                raise QueryError(f"InfluxDB query failed: {','.join(next(reader, []))}")
+            time_column = header.get('_time')
+            value_column = header['_value']
+            group_columns = [header[tag] for tag in group_by]
+            continue
+        yield Row(
+            default_time if time_column is None else parse_time_ns(record[time_column]),
+            float(record[value_column]),
+            tuple(record[column] for column in group_columns),
+        )
+
+
+def parse_csv(text, group_by, default_time=0):
+    """All rows of a Flux CSV response held in ``text`` (see ``iter_csv``)"""
+    return list(iter_csv(io.StringIO(text), group_by, default_time))
+
+
+def batched(rows, size):
+    """Lists of up to ``size`` consecutive rows"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class InfluxExecutor:
+    """Runs SeriesQuery objects against InfluxDB; ``bytes_received`` adds up the response sizes"""
+
+    def __init__(self, query_api, bucket, org):
+        self.query_api = query_api
+        self.bucket = bucket
+        self.org = org
+        self.bytes_received = 0
+
+    def _response(self, flux):
+        from influxdb_client.domain.dialect import Dialect
+
+        # An HTTP response with the CSV body still unread, not parsed by the client
+        return self.query_api.query_raw(flux, org=self.org, dialect=Dialect(header=True, annotations=[]))
+
+    def _fetch(self, flux):
+        data = self._response(flux).data
+        self.bytes_received += len(data)
+        return data.decode()
+
+    def run(self, query, max_rows=None):
+        """
+        Rows of a query, reduced by InfluxDB, sorted by group and time
+
+        With ``max_rows`` the response is read as it arrives and TooManyRows
+        is raised as soon as it holds more, so an oversized result is never
+        held in memory.
+        """
+        if max_rows is None:
+            rows = parse_csv(self._fetch(query.to_flux(self.bucket)), query.group_by, query.start * _NS)
+        else:
+            response = self._response(query.to_flux(self.bucket))
+            try:
+                lines = io.TextIOWrapper(response, encoding='utf-8', newline='')
+                rows = limited(iter_csv(lines, query.group_by, query.start * _NS), max_rows)
+            finally:
+                self.bytes_received += response.tell()
+                response.release_conn()
+        return sorted(rows, key=lambda row: (row.group, row.time))
+
+    def run_raw(self, query):
+        """Every reading a query selects, grouped by site and sensor type, in time order"""
+        rows = parse_csv(self._fetch(query.to_raw_flux(self.bucket)), TAGS)
+        return sorted(rows, key=lambda row: (row.group, row.time))
+
+    def stream_raw(self, query, batch_rows=100_000):
+        """
+        Every reading a query selects, in batches of up to ``batch_rows`` rows read off the response as it arrives
+
+        Memory is bounded by the batch size whatever the range. Rows come as
+        InfluxDB sends them: by site and sensor type, each in time order.
+        """
+        response = self._response(query.to_raw_flux(self.bucket))
+        try:
+            yield from batched(iter_csv(io.TextIOWrapper(response, encoding='utf-8', newline=''), TAGS), batch_rows)
+        finally:
+            self.bytes_received += response.tell()
+            response.release_conn()
+
+
+def _reduce(aggregate, points):
+    """``points`` are (time, value) in time order"""
+    values = [value for _, value in points]
+    if aggregate == 'mean':
+        return sum(values) / len(values)
+    if aggregate == 'count':
+        return float(len(values))
+    if aggregate == 'first':
+        return values[0]
+    if aggregate == 'last':
+        return values[-1]
+    return {'min': min, 'max': max, 'sum': sum}[aggregate](values)
+
+
+class LocalStore:
+    """In-memory readings answering SeriesQuery objects like InfluxDB would, for tests"""
+
+    def __init__(self):
+        self.points = []  # (site_id, sensor_type, time_ns, value)
+
+    def write(self, readings):
+        """Add ``(site_id, sensor_type, timestamp_ns, value)`` tuples"""
+        self.points.extend((site, sensor, int(ts), float(value)) for site, sensor, ts, value in readings)
+
+    def _selected(self, query):
+        start, stop = query.start * _NS, query.stop * _NS
+        sensors, sites = set(query.sensor_types), set(query.sites)
+        return sorted(
+            (point for point in self.points
+             if start <= point[2] < stop and (not sensors or point[1] in sensors) and (not sites or point[0] in sites)),
+            key=lambda point: point[2],
+        )
+
+    def run(self, query, max_rows=None):
+        indexes = [TAGS.index(tag) for tag in query.group_by]
+        groups = {}
+        for point in self._selected(query):
+            if query.every is None:
+                window = query.start * _NS
+            else:
+                window = point[2] - point[2] % (query.every * _NS)
+            key = (tuple(point[index] for index in indexes), window)
+            groups.setdefault(key, []).append((point[2], point[3]))
+        rows = [Row(window, _reduce(query.aggregate, points), group) for (group, window), points in groups.items()]
+        return sorted(limited(rows, max_rows), key=lambda row: (row.group, row.time))
+
+    def run_raw(self, query):
+        rows = [Row(time, value, (site, sensor)) for site, sensor, time, value in self._selected(query)]
+        return sorted(rows, key=lambda row: (row.group, row.time))
+
+    def stream_raw(self, query, batch_rows=100_000):
+        return batched(self.run_raw(query), batch_rows)
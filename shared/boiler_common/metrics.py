@@ -0,0 +1,489 @@
+"""
+Prometheus metrics shared by the Django services
+
+Counters, gauges and fixed-bucket histograms that are cheap to update on hot
+paths. Every series keeps one accumulator per thread, so an update is a
+thread-local lookup and an in-place add with no lock. The per-thread values
+are summed when ``/metrics`` is scraped. Accumulators of threads that have
+exited are folded into a retired total, so per-request threads do not pile up.
+
+Services running several worker processes (uvicorn ``--workers``) set
+``METRICS_MULTIPROCESS_DIR`` to a directory shared by the workers. Each
+process then writes its totals there every few seconds, and a scrape served
+by any worker sums the others' latest files with its own live values. Gauges
+of processes that have exited are dropped; their counters and histograms
+are kept.
+
+Usage::
+
+    from boiler_common import metrics
+
+    WRITE_LATENCY = metrics.histogram('influxdb_write_seconds', 'InfluxDB write latency')
+    with WRITE_LATENCY.time():
+        ...
+
+    # urls.py
+    path('metrics', metrics.metrics_view, name='metrics')
+
+    # settings.MIDDLEWARE, first entry
+    'boiler_common.metrics.metrics_middleware'
+"""
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from math import inf
+
+# Request and client call latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Batch sizes, in items
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1_000, 5_000, 10_000, 50_000, 100_000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Shards:
+    """Per-thread accumulators of one series; each is a list of numbers summed element-wise"""
+
+    def __init__(self, size):
+        self._size = size
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._live = []  # (thread, accumulator)
+        self._retired = [0] * self._size
+
+    def get(self):
+        """The calling thread's accumulator"""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = [0] * self._size
+            with self._lock:
+                self._live.append((threading.current_thread(), values))
+            return values
+
+    def total(self):
+        """Sum of every accumulator, retiring those of finished threads"""
+        with self._lock:
+            total = list(self._retired)
+            live = []
+            for thread, values in self._live:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    self._retired = [a + b for a, b in zip(self._retired, values)]
+                total = [a + b for a, b in zip(total, values)]
+            self._live = live
+        return total
+
+
+class _Timer:
+    """Context manager observing the elapsed wall time on exit"""
+
+    __slots__ = ('_series', '_started')
+
+    def __init__(self, series):
+        self._series = series
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._series.observe(time.perf_counter() - self._started)
+
+
+class CounterSeries:
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.get()[0] += amount
+
+    def collect(self):
+        return self._shards.total()[0]
+
+    def reset(self):
+        self._shards.reset()
+
+
+class GaugeSeries:
+    """A value that is set, or read from ``function`` at scrape time"""
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def collect(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def reset(self):
+        self._value = 0
+
+
+class HistogramSeries:
+    """Fixed buckets; the accumulator holds a count per bucket (the last is +Inf) and the sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value):
+        values = self._shards.get()
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+    def collect(self):
+        return self._shards.total()
+
+    def reset(self):
+        self._shards.reset()
+
+
+class Metric:
+    """A named metric with zero or more labels; each label combination is a series"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), **options):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._options = options
+        self._series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The series for these label values, created on first use"""
+        series = self._series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+            with self._lock:
+                series = self._series.setdefault(tuple(str(v) for v in values), self._new_series())
+                self._series[values] = series
+        return series
+
+    def collect(self):
+        """``{label values: value}`` for every series"""
+        seen = set()
+        result = {}
+        for values, series in list(self._series.items()):
+            if id(series) not in seen:
+                seen.add(id(series))
+                result[tuple(str(v) for v in values)] = series.collect()
+        return result
+
+    def reset(self):
+        for series in list(self._series.values()):
+            series.reset()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_series(self):
+        return CounterSeries()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_series(self):
+        return GaugeSeries()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def _new_series(self):
+        return HistogramSeries(self._options['buckets'])
+
+    @property
+    def buckets(self):
+        return self._options['buckets']
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class Registry:
+    """All metrics of the process, by name"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, cls, name, documentation, labelnames=(), **options):
+        """Return the metric called ``name``, creating it if needed, so modules can declare metrics at import"""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **options)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"metric {name} already registered with a different type or labels")
+        return metric
+
+    def metrics(self):
+        return list(self._metrics.values())
+
+    def snapshot(self):
+        """``{name: {type, values: [[labels, value], ...]}}`` for writing to the multiprocess directory"""
+        return {
+            metric.name: {'type': metric.type, 'values': [[list(k), v] for k, v in metric.collect().items()]}
+            for metric in self.metrics()
+        }
+
+    def reset(self):
+        """Zero every series; used in a forked child so it does not report its parent's counts"""
+        for metric in self.metrics():
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=tuple(buckets))
+
+
+# ============================================================================
+# MULTIPLE PROCESSES
+# ============================================================================
+
+class ProcessFiles:
+    """Periodic per-process snapshots in a directory shared by sibling workers"""
+
+    def __init__(self, directory, registry=REGISTRY, interval=5.0):
+        self.directory = directory
+        self.registry = registry
+        self.interval = interval
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def write(self):
+        """Replace this process's snapshot file"""
+        path = self.path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def others(self):
+        """Snapshots of the other processes, with a flag telling whether each is still running"""
+        own = f'{os.getpid()}.json'
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield snapshot, _pid_alive(int(name[:-5]))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(total, value):
+    if isinstance(value, list):
+        return [a + b for a, b in zip(total, value)] if total is not None else list(value)
+    return value + (total or 0)
+
+
+_process_files = None
+if os.environ.get('METRICS_MULTIPROCESS_DIR'):
+    _process_files = ProcessFiles(os.environ['METRICS_MULTIPROCESS_DIR'])
+    _process_files.start()
+    atexit.register(_process_files.write)
+
+
+def _after_fork():
+    REGISTRY.reset()
+    if _process_files is not None:
+        _process_files.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+# ============================================================================
+# EXPOSITION
+# ============================================================================
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == inf:
+        return '+Inf'
+    if value == -inf:
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def collect(registry=REGISTRY, process_files=None):
+    """``(metric, {label values: value})`` pairs, merged with sibling processes when configured"""
+    process_files = process_files if process_files is not None else _process_files
+    merged = [(metric, metric.collect()) for metric in registry.metrics()]
+    if process_files is None:
+        return merged
+    by_name = {metric.name: values for metric, values in merged}
+    for snapshot, alive in process_files.others():
+        for name, data in snapshot.items():
+            values = by_name.get(name)
+            if values is None or (data['type'] == 'gauge' and not alive):
+                continue
+            for labels, value in data['values']:
+                key = tuple(labels)
+                values[key] = _add(values.get(key), value)
+    return merged
+
+
+def exposition(registry=REGISTRY, process_files=None):
+    """Render every metric in the Prometheus text format"""
+    lines = []
+    for metric, values in collect(registry, process_files):
+        lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for labels, value in sorted(values.items()):
+            if metric.type != 'histogram':
+                lines.append(f'{metric.name}{_labels(metric.labelnames, labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, inf), value):
+                cumulative += count
+                le = _labels(metric.labelnames, labels, f'le="{_number(bound)}"')
+                lines.append(f'{metric.name}_bucket{le} {cumulative}')
+            lines.append(f'{metric.name}_sum{_labels(metric.labelnames, labels)} {_number(value[-1])}')
+            lines.append(f'{metric.name}_count{_labels(metric.labelnames, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================================================
+# DJANGO
+# ============================================================================
+
+REQUEST_LATENCY = histogram(
+    'http_request_duration_seconds', 'Time spent in Django handling a request', ['view', 'method'],
+)
+REQUESTS = counter('http_requests_total', 'Requests handled, by view and status code', ['view', 'method', 'status'])
+# Any other method string a client sends is counted as ``other``, so clients cannot mint label values
+HTTP_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'CONNECT', 'TRACE'})
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint"""
+    from django.http import HttpResponse
+
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE)
+
+
+def _observe(request, response, started):
+    match = getattr(request, 'resolver_match', None)
+    view = (match.url_name or match.view_name) if match is not None else 'unmatched'
+    method = request.method if request.method in HTTP_METHODS else 'other'
+    REQUEST_LATENCY.labels(view, method).observe(time.perf_counter() - started)
+    REQUESTS.labels(view, method, response.status_code).inc()
+
+
+def metrics_middleware(get_response):
+    """Record the latency and status of every request, per URL name; works for sync and async views"""
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            response = await get_response(request)
+            _observe(request, response, started)
+            return response
+
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            response = get_response(request)
+            _observe(request, response, started)
+            return response
+
+    return middleware
+
+
+metrics_middleware.sync_capable = True
+metrics_middleware.async_capable = True